@@ -19,6 +19,7 @@ from utils import get_user_mention_html, send_telegram_log, fetch_user_display_d
 from business_data import BUSINESS_DATA, BUSINESS_UPGRADES # Для проверки achievement_type: business_buy_all_upgrades_for_one
 from item_data import PHONE_COMPONENTS, PHONE_CASES # Для проверки наличия всех апгрейдов по бизнесу и информации о телефонах
 from exclusive_phone_data import VINTAGE_PHONE_KEYS_FOR_BM # Для BM достижений
+from event_queue import register_event_handler
 
 logger = logging.getLogger(__name__)
 achievements_router = Router()
@@ -38,11 +39,14 @@ async def check_and_grant_achievements(
     # **kwargs_for_checks позволяет передавать любые данные, специфичные для текущего действия.
     # Например: current_oneui_version=X.X, onecoin_change=Y, phone_type_bought="A", etc.
     message_thread_id: Optional[int] = None,
+    raise_errors: bool = False,
     **kwargs_for_checks: Any
 ):
     """
     Центральная функция для проверки и выдачи достижений.
     Вызывается после каждого действия пользователя, которое может привести к получению достижения.
+    Ошибки логируются и не пробрасываются, если не задан raise_errors (так вызывает воркер event_queue,
+    чтобы упавшая проверка была повторена).
     """
     user_link = ""
     try:
@@ -665,9 +669,41 @@ async def check_and_grant_achievements(
                     await send_telegram_log(bot_instance, f"🏆 Достижение разблокировано: {user_link} получил '{achievement_info['name']}' (Ключ: {achievement_key})")
 
     except Exception as e:
+        if raise_errors:
+            raise
         logger.error(f"Error in check_and_grant_achievements for user {user_id}: {e}", exc_info=True)
 
 
+# --- Проверка достижений через очередь событий ---
+ACHIEVEMENTS_CHECK_EVENT = "achievements_check"
+
+async def enqueue_achievements_check(
+    user_id: int,
+    chat_id: int,
+    message_thread_id: Optional[int] = None,
+    **kwargs_for_checks: Any
+) -> bool:
+    """
+    То же, что check_and_grant_achievements, но выполняется воркером event_queue, а не в обработчике команды.
+    kwargs_for_checks должны сериализоваться в JSON. Возвращает False, если событие не удалось поставить в очередь.
+    """
+    return await database.add_event_to_queue(user_id, ACHIEVEMENTS_CHECK_EVENT, {
+        "chat_id": chat_id,
+        "message_thread_id": message_thread_id,
+        "checks": kwargs_for_checks,
+    })
+
+@register_event_handler(ACHIEVEMENTS_CHECK_EVENT)
+async def _handle_achievements_check_event(bot: Bot, event: Dict[str, Any]) -> None:
+    data = event.get('event_data') or {}
+    await check_and_grant_achievements(
+        event['user_id'], data['chat_id'], bot,
+        message_thread_id=data.get('message_thread_id'),
+        raise_errors=True, # Ошибку должен увидеть воркер: повтор с задержкой, затем 'dead'
+        **(data.get('checks') or {})
+    )
+
+
 # --- Команда для просмотра достижений ---
 
 @achievements_router.message(Command("selectachievement", "выбратьдостижение", "моёдостижение", "достижения", ignore_case=True))
@@ -0,0 +1,156 @@
+# admin_logic.py
+import html
+from typing import List
+
+from aiogram import Router
+from aiogram.filters import Command, CommandObject, Filter
+from aiogram.types import Message
+
+import db_metrics
+import locks
+import outbox
+import deadlines
+from config import Config
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+admin_router = Router()
+
+DBSTATS_DEFAULT_TOP = 15
+DBSTATS_MAX_TOP = 100
+DBSTATS_SLOW_LIMIT = 15
+MESSAGE_LIMIT = 4096 # Лимит длины сообщения Telegram
+
+
+class AdminFilter(Filter):
+    async def __call__(self, message: Message) -> bool:
+        if not message.from_user:
+            return False
+        return message.from_user.id == Config.ADMIN_ID
+
+
+def _pre_messages(header: str, lines: List[str]) -> List[str]:
+    """Таблица в <pre>, разбитая по строкам на сообщения не длиннее MESSAGE_LIMIT; заголовок - в первом."""
+    messages: List[str] = []
+    prefix = f"{header}\n"
+    chunk: List[str] = []
+    size = 0
+    for line in lines:
+        escaped = html.escape(line)
+        if chunk and len(prefix) + size + len(escaped) + len("<pre></pre>") + 1 > MESSAGE_LIMIT:
+            messages.append(f"{prefix}<pre>{chr(10).join(chunk)}</pre>")
+            prefix, chunk, size = "", [], 0
+        chunk.append(escaped)
+        size += len(escaped) + 1
+    messages.append(f"{prefix}<pre>{chr(10).join(chunk)}</pre>")
+    return messages
+
+
+def _format_db_stats(top: int) -> List[str]:
+    snapshot = db_metrics.snapshot()
+    if not snapshot:
+        return ["Метрик БД пока нет."]
+    rows = sorted(snapshot.items(), key=lambda item: item[1]["total_ms"], reverse=True)[:top]
+    lines: List[str] = [f"{'операция':<34} {'вызовы':>7} {'ош':>4} {'p50':>7} {'p95':>7} {'p99':>7} {'всего,с':>8}"]
+    for operation, stats in rows:
+        lines.append(
+            f"{operation[:34]:<34} {stats['count']:>7} {stats['errors']:>4} "
+            f"{stats['p50_ms']:>7.1f} {stats['p95_ms']:>7.1f} {stats['p99_ms']:>7.1f} {stats['total_ms'] / 1000:>8.1f}"
+        )
+    header = f"<b>📊 БД: топ {len(rows)} операций по суммарному времени</b> (мс, порог медленных: {Config.DB_SLOW_QUERY_MS:.0f} мс)"
+    return _pre_messages(header, lines)
+
+
+def _format_slow_queries() -> str:
+    entries = db_metrics.slow_queries(DBSTATS_SLOW_LIMIT)
+    if not entries:
+        return "Медленных запросов не было."
+    lines = [
+        f"{e['at'].strftime('%H:%M:%S')} {e['ms']:>8.1f} мс {e['operation']} ← {e['caller']}" + (" (ошибка)" if e['failed'] else "")
+        for e in entries
+    ]
+    return f"<b>🐢 Последние медленные запросы</b>\n<pre>{html.escape(chr(10).join(lines))}</pre>"
+
+
+@admin_router.message(Command("dbstats", ignore_case=True), AdminFilter())
+async def cmd_db_stats(message: Message, command: CommandObject):
+    """/dbstats [N] - топ операций БД (N не больше DBSTATS_MAX_TOP); /dbstats slow - медленные запросы; /dbstats reset - сброс."""
+    arg = (command.args or "").strip().lower()
+    if arg == "reset":
+        db_metrics.reset()
+        await message.reply("Метрики БД сброшены.")
+        return
+    if arg == "slow":
+        await message.reply(_format_slow_queries(), parse_mode="HTML")
+        return
+    top = min(int(arg), DBSTATS_MAX_TOP) if arg.isdigit() else DBSTATS_DEFAULT_TOP
+    for text in _format_db_stats(top):
+        await message.reply(text, parse_mode="HTML")
+
+
+@admin_router.message(Command("lockstats", ignore_case=True), AdminFilter())
+async def cmd_lock_stats(message: Message, command: CommandObject):
+    """/lockstats - метрики блокировок команд; /lockstats reset - сброс счетчиков."""
+    if (command.args or "").strip().lower() == "reset":
+        for name in locks.lock_stats():
+            locks.get_lock_manager(name).reset_stats()
+        await message.reply("Метрики блокировок сброшены.")
+        return
+    stats = locks.lock_stats()
+    if not stats:
+        await message.reply("Блокировки еще не использовались.")
+        return
+    lines = [f"{'набор':<12} {'актив':>6} {'пик':>6} {'захватов':>9} {'ждали':>7} {'ср.ож':>8} {'макс':>8}"]
+    for name, s in sorted(stats.items()):
+        lines.append(
+            f"{name[:12]:<12} {s['active_keys']:>6} {s['peak_keys']:>6} {s['acquisitions']:>9} "
+            f"{s['contended']:>7} {s['avg_wait_ms']:>8.1f} {s['max_wait_ms']:>8.1f}"
+        )
+    backend = locks.get_lock_backend()
+    if backend is not None:
+        lines.append("")
+        lines.append(f"бэкенд {backend.name}: {'захватов':>9} {'ср.ож':>8} {'макс':>8}")
+        for name, s in sorted(stats.items()):
+            lines.append(f"{name[:12]:<12} {s['backend_acquisitions']:>15} {s['backend_avg_wait_ms']:>8.1f} {s['backend_max_wait_ms']:>8.1f}")
+    await message.reply(f"<b>🔒 Блокировки команд</b> (ожидание в мс)\n<pre>{html.escape(chr(10).join(lines))}</pre>", parse_mode="HTML")
+
+
+@admin_router.message(Command("outboxstats", ignore_case=True), AdminFilter())
+async def cmd_outbox_stats(message: Message):
+    """/outboxstats - состояние очереди исходящих сообщений."""
+    dispatcher = outbox.get_outbound_dispatcher()
+    if dispatcher is None:
+        await message.reply("Очередь исходящих сообщений не настроена.")
+        return
+    s = dispatcher.stats()
+    lines = [
+        f"в очереди: {s['queued']} (чатов: {s['chats']}), отправляется: {s['in_flight']}",
+        f"отправлено: {s['sent']}, повторов: {s['retried']}, RetryAfter: {s['rate_limited']}, пропущено: {s['dropped']}",
+        f"ждут токен лимитера: {s['limiter_waiting']}",
+    ]
+    await message.reply(f"<b>📤 Исходящие сообщения</b>{'' if dispatcher.running else ' (остановлена)'}\n<pre>{html.escape(chr(10).join(lines))}</pre>", parse_mode="HTML")
+
+
+@admin_router.message(Command("deadlinestats", ignore_case=True), AdminFilter())
+async def cmd_deadline_stats(message: Message):
+    """/deadlinestats - сроки, ожидающие выполнения в этом процессе."""
+    engine = deadlines.get_deadline_engine()
+    if engine is None:
+        await message.reply("Движок сроков не настроен.")
+        return
+    s = engine.stats()
+    by_kind = ", ".join(f"{kind}: {count}" for kind, count in sorted(s['pending_by_kind'].items())) or "-"
+    next_due = f"{max(s['next_due_in_seconds'], 0):.0f} сек" if s['next_due_in_seconds'] is not None else "-"
+    lines = [
+        f"ожидают: {s['pending']} ({by_kind})",
+        f"выполняются: {s['in_progress']}, ближайший через: {next_due}",
+        f"выполнено: {s['fired']}, ошибок: {s['failed']}, выполнены без изменений в БД: {s['handled_unchanged']}",
+    ]
+    await message.reply(f"<b>⏰ Сроки</b>{'' if engine.running else ' (не запущен в этом процессе)'}\n<pre>{html.escape(chr(10).join(lines))}</pre>", parse_mode="HTML")
+
+
+def setup_admin_handlers(dp: Router):
+    dp.include_router(admin_router)
+    logger.info("Обработчики админ-команд зарегистрированы.")
@@ -20,19 +20,17 @@ from utils import get_user_mention_html, send_telegram_log, get_current_price
 import json
 
 # Данные о товарах
-from phone_data import PHONE_MODELS as PHONE_MODELS_STANDARD_LIST, PHONE_COLORS
+from phone_data import PHONE_COLORS
 from item_data import PHONE_COMPONENTS, PHONE_CASES
-from exclusive_phone_data import EXCLUSIVE_PHONE_MODELS, VINTAGE_PHONE_KEYS_FOR_BM
+from exclusive_phone_data import VINTAGE_PHONE_KEYS_FOR_BM
+import catalog
 
 import logging
 
 logger = logging.getLogger(__name__)
 black_market_router = Router()
 
-# Преобразуем списки стандартных телефонов в словари для быстрого доступа по ключу
-PHONE_MODELS_STD_DICT = {phone_info["key"]: phone_info for phone_info in PHONE_MODELS_STANDARD_LIST}
-EXCLUSIVE_PHONE_MODELS_DICT = {phone_info["key"]: phone_info for phone_info in EXCLUSIVE_PHONE_MODELS}
-# PHONE_COMPONENTS и PHONE_CASES уже словари
+# Словари телефонов по ключу - в catalog.py; PHONE_COMPONENTS и PHONE_CASES уже словари
 
 
 # FSM для процесса покупки на черном рынке (остается без изменений)
@@ -134,7 +132,7 @@ async def _generate_personal_bm_offers_for_user(user_id: int, conn_ext: Optional
         # --- Логика, очень похожая на refresh_black_market_offers, но без очистки и записи в БД напрямую ---
         
         all_possible_regular_items = []
-        for phone_key, phone_data in PHONE_MODELS_STD_DICT.items():
+        for phone_key, phone_data in catalog.PHONE_MODELS_BY_KEY.items():
             all_possible_regular_items.append({"key": phone_key, "type": "phone", "data": phone_data})
         for comp_key, comp_data in PHONE_COMPONENTS.items():
             if comp_data.get("component_type") == "component":
@@ -145,9 +143,9 @@ async def _generate_personal_bm_offers_for_user(user_id: int, conn_ext: Optional
         current_offers_for_list: List[Dict[str, Any]] = []
 
         # 1. Генерация "Краденого" телефона (1 слот)
-        if Config.BLACKMARKET_NUM_STOLEN_ITEMS > 0 and PHONE_MODELS_STD_DICT:
-            stolen_phone_key = random.choice(list(PHONE_MODELS_STD_DICT.keys()))
-            stolen_phone_data = PHONE_MODELS_STD_DICT[stolen_phone_key]
+        if Config.BLACKMARKET_NUM_STOLEN_ITEMS > 0 and catalog.PHONE_MODELS_BY_KEY:
+            stolen_phone_key = random.choice(list(catalog.PHONE_MODELS_BY_KEY.keys()))
+            stolen_phone_data = catalog.PHONE_MODELS_BY_KEY[stolen_phone_key]
             
             base_price = stolen_phone_data['price']
             price_after_inflation = await get_current_price(base_price, conn_ext=conn)
@@ -230,7 +228,7 @@ async def _generate_personal_bm_offers_for_user(user_id: int, conn_ext: Optional
                 })
         
         # 3. Шанс на замену одного "обычного" слота эксклюзивом
-        if EXCLUSIVE_PHONE_MODELS_DICT or VINTAGE_PHONE_KEYS_FOR_BM:
+        if catalog.EXCLUSIVE_PHONE_MODELS_BY_KEY or VINTAGE_PHONE_KEYS_FOR_BM:
             if random.random() < Config.BLACKMARKET_EXCLUSIVE_ITEM_CHANCE:
                 eligible_slots_indices = [
                     idx for idx, offer in enumerate(current_offers_for_list) 
@@ -239,16 +237,16 @@ async def _generate_personal_bm_offers_for_user(user_id: int, conn_ext: Optional
                 if eligible_slots_indices:
                     slot_to_replace_idx = random.choice(eligible_slots_indices)
                     exclusive_type_choice = "custom"
-                    if VINTAGE_PHONE_KEYS_FOR_BM and EXCLUSIVE_PHONE_MODELS_DICT:
+                    if VINTAGE_PHONE_KEYS_FOR_BM and catalog.EXCLUSIVE_PHONE_MODELS_BY_KEY:
                         exclusive_type_choice = random.choice(["custom", "vintage"])
                     elif VINTAGE_PHONE_KEYS_FOR_BM:
                         exclusive_type_choice = "vintage"
                     
                     exclusive_offer_data_dict: Optional[Dict[str, Any]] = None # Переименовано
 
-                    if exclusive_type_choice == "custom" and EXCLUSIVE_PHONE_MODELS_DICT:
-                        exclusive_key = random.choice(list(EXCLUSIVE_PHONE_MODELS_DICT.keys()))
-                        excl_data = EXCLUSIVE_PHONE_MODELS_DICT[exclusive_key]
+                    if exclusive_type_choice == "custom" and catalog.EXCLUSIVE_PHONE_MODELS_BY_KEY:
+                        exclusive_key = random.choice(list(catalog.EXCLUSIVE_PHONE_MODELS_BY_KEY.keys()))
+                        excl_data = catalog.EXCLUSIVE_PHONE_MODELS_BY_KEY[exclusive_key]
                         base_price_excl = excl_data['base_price']
                         price_after_inflation_excl = await get_current_price(base_price_excl, conn_ext=conn)
                         ch_discount_excl = random.uniform(Config.BLACKMARKET_REGULAR_ITEM_DISCOUNT_MIN, 
@@ -276,8 +274,8 @@ async def _generate_personal_bm_offers_for_user(user_id: int, conn_ext: Optional
                         }
                     elif exclusive_type_choice == "vintage" and VINTAGE_PHONE_KEYS_FOR_BM:
                         vintage_key = random.choice(VINTAGE_PHONE_KEYS_FOR_BM)
-                        if vintage_key in PHONE_MODELS_STD_DICT:
-                            vintage_data = PHONE_MODELS_STD_DICT[vintage_key]
+                        if vintage_key in catalog.PHONE_MODELS_BY_KEY:
+                            vintage_data = catalog.PHONE_MODELS_BY_KEY[vintage_key]
                             base_price_vint = vintage_data['price']
                             price_after_inflation_vint = await get_current_price(base_price_vint, conn_ext=conn)
                             ch_discount_vint = random.uniform(Config.BLACKMARKET_REGULAR_ITEM_DISCOUNT_MIN, 
@@ -467,8 +465,8 @@ async def cmd_blackmarket_show(message: Message, bot: Bot):
             if display_name_override:
                 item_name_display = html.escape(display_name_override)
             elif item_type == "phone":
-                phone_info_std = PHONE_MODELS_STD_DICT.get(item_key)
-                phone_info_excl = EXCLUSIVE_PHONE_MODELS_DICT.get(item_key)
+                phone_info_std = catalog.PHONE_MODELS_BY_KEY.get(item_key)
+                phone_info_excl = catalog.EXCLUSIVE_PHONE_MODELS_BY_KEY.get(item_key)
                 if phone_info_excl:
                     item_name_display = html.escape(phone_info_excl.get('display_name', phone_info_excl.get('name', item_key)))
                 elif phone_info_std:
@@ -601,7 +599,7 @@ async def cmd_buy_bm_slot_start(message: Message, command: CommandObject, state:
 
         if not item_name_display: # Логика получения имени, если нет display_name_override
             if item_type == "phone":
-                phone_info = PHONE_MODELS_STD_DICT.get(item_key) or EXCLUSIVE_PHONE_MODELS_DICT.get(item_key)
+                phone_info = catalog.PHONE_MODELS_BY_KEY.get(item_key) or catalog.EXCLUSIVE_PHONE_MODELS_BY_KEY.get(item_key)
                 item_name_display = html.escape(phone_info.get('name', item_key)) if phone_info else f"Телефон ({item_key})"
             elif item_type == "component":
                 item_name_display = html.escape(PHONE_COMPONENTS.get(item_key, {}).get('name', item_key))
@@ -796,8 +794,8 @@ async def cmd_bm_purchase_confirm_yes(message: Message, state: FSMContext, bot:
             log_item_details += ")"
 
             if item_type == 'phone':
-                phone_static_data_std = PHONE_MODELS_STD_DICT.get(item_key)
-                phone_static_data_excl = EXCLUSIVE_PHONE_MODELS_DICT.get(item_key)
+                phone_static_data_std = catalog.PHONE_MODELS_BY_KEY.get(item_key)
+                phone_static_data_excl = catalog.EXCLUSIVE_PHONE_MODELS_BY_KEY.get(item_key)
                 phone_static_data_source = phone_static_data_excl or phone_static_data_std
 
                 if not phone_static_data_source:
@@ -14,8 +14,11 @@ from aiogram.types import Message, CallbackQuery # CallbackQuery понадоб
 # Импорты из твоих файлов
 from config import Config
 import database
+import digest
 from business_data import BUSINESS_DATA, BUSINESS_UPGRADES, BANK_DATA, BUSINESS_EVENTS # Новые данные
-from utils import get_user_mention_html, send_telegram_log, fetch_user_display_data
+import catalog
+import shop_pages
+from utils import get_user_mention_html, send_telegram_log, fetch_user_display_data, prefetch_user_display_data
 
 import logging
 
@@ -45,12 +48,11 @@ async def _get_user_info_for_db(user_id: int, chat_id: int) -> Tuple[Optional[st
 
 def _get_business_index(business_key: str) -> int:
     """Возвращает порядковый номер бизнеса (от 1 до 18) по его ключу."""
-    business_keys_list = list(BUSINESS_DATA.keys())
-    try:
-        return business_keys_list.index(business_key) + 1
-    except ValueError:
+    business_index = catalog.BUSINESS_INDEX_BY_KEY.get(business_key)
+    if business_index is None:
         logger.warning(f"Business key '{business_key}' not found in BUSINESS_DATA. Returning -1.")
         return -1
+    return business_index
 
 def _calculate_staff_income_percentage(business_index: int) -> float:
     """
@@ -149,7 +151,7 @@ async def buy_business_command(message: Message, command: CommandObject, bot: Bo
 
             if target_business_index > 1: # Если это не первый бизнес, проверяем предыдущий
                 # Находим ключ предыдущего бизнеса
-                previous_business_key = list(BUSINESS_DATA.keys())[target_business_index - 2] # -2 потому что index() возвращает 0-based, а мы хотим N-1 бизнес
+                previous_business_key = catalog.BUSINESS_KEYS_ORDERED[target_business_index - 2] # -2 потому что index() возвращает 0-based, а мы хотим N-1 бизнес
                 
                 # Проверяем, куплен ли предыдущий бизнес
                 previous_business_owned = False
@@ -255,30 +257,16 @@ async def buy_business_command(message: Message, command: CommandObject, bot: Bo
             await send_telegram_log(bot, f"🔴 <b>Ошибка /buybusiness</b>\nUser: {user_link} ({user_id})\nChat: {html.escape(chat_title_for_db or str(chat_id))} ({chat_id})\nErr: <pre>{html.escape(str(e))}</pre>")
 
 
-@business_router.message(Command("businessshop", "магазинбизнесов", "списокбизнесов", "бизнесы", ignore_case=True))
-async def business_shop_command(message: Message):
-    if not message.from_user:
-        await message.reply("Не могу определить пользователя.")
-        return
-
-    user_id = message.from_user.id
-    chat_id = message.chat.id
-    user_link = get_user_mention_html(user_id, message.from_user.full_name, message.from_user.username)
-
-    user_businesses = await database.get_user_businesses(user_id, chat_id)
-    owned_business_keys = {biz['business_key'] for biz in user_businesses}
-
-    all_business_keys_ordered = list(BUSINESS_DATA.keys())
+def _render_business_shop_page(last_owned_business_index: int, inflation_multiplier: float) -> str:
+    """
+    Страница /businessshop для shop_pages. Зависит только от номера последнего купленного бизнеса
+    (-1 - бизнесов нет); цены бизнесов инфляцией не затрагиваются.
+    """
+    user_link = shop_pages.USER_LINK_PLACEHOLDER
+    all_business_keys_ordered = catalog.BUSINESS_KEYS_ORDERED
     
     response_lines = [f"<b>🏢 {user_link}, доступные бизнесы для покупки:</b>\n"]
     
-    # Определяем индекс последнего купленного бизнеса (или -1, если бизнесов нет)
-    last_owned_business_index = -1
-    if owned_business_keys:
-        for i, key in enumerate(all_business_keys_ordered):
-            if key in owned_business_keys:
-                last_owned_business_index = i
-    
     # --- НОВАЯ ЛОГИКА ОТОБРАЖЕНИЯ ---
 
     # Если бизнесов нет вообще, показываем первые N бизнесов
@@ -361,7 +349,36 @@ async def business_shop_command(message: Message):
     response_lines.append(f"Используйте: <code>/buybusiness</code> <u>ключ_бизнеса</u>")
     response_lines.append(f"Пример: <code>/buybusiness</code> <u>business_1_home_samsung_region_change</u>")
 
-    await message.reply("\n".join(response_lines), parse_mode="HTML", disable_web_page_preview=True)
+    return "\n".join(response_lines)
+
+
+shop_pages.register("businessshop", _render_business_shop_page, range(-1, len(catalog.BUSINESS_KEYS_ORDERED)))
+
+
+@business_router.message(Command("businessshop", "магазинбизнесов", "списокбизнесов", "бизнесы", ignore_case=True))
+async def business_shop_command(message: Message):
+    if not message.from_user:
+        await message.reply("Не могу определить пользователя.")
+        return
+
+    user_id = message.from_user.id
+    chat_id = message.chat.id
+    user_link = get_user_mention_html(user_id, message.from_user.full_name, message.from_user.username)
+
+    user_businesses = await database.get_user_businesses(user_id, chat_id)
+    owned_business_keys = {biz['business_key'] for biz in user_businesses}
+
+    all_business_keys_ordered = catalog.BUSINESS_KEYS_ORDERED
+    
+    # Определяем индекс последнего купленного бизнеса (или -1, если бизнесов нет)
+    last_owned_business_index = -1
+    if owned_business_keys:
+        for i, key in enumerate(all_business_keys_ordered):
+            if key in owned_business_keys:
+                last_owned_business_index = i
+    
+    # Готовая страница из кэша - одна на каждый вариант прогресса
+    await shop_pages.answer_page(message, "businessshop", last_owned_business_index, user_link, reply=True)
 
 @business_router.message(Command("mybusinesses", "моибизнесы", "мойбизнес", "бизнесстатус", ignore_case=True))
 async def my_businesses_command(message: Message, bot: Bot):
@@ -1511,6 +1528,9 @@ async def process_daily_business_income_and_events(bot: Bot):
                 all_users_with_businesses[user_id_biz][chat_id_biz] = []
             all_users_with_businesses[user_id_biz][chat_id_biz].append(biz_data)
 
+        # Имена всех владельцев одним запросом вместо запроса на каждого
+        await prefetch_user_display_data(list(all_users_with_businesses))
+
         # Шаг 2: Обработка каждого бизнеса
         for user_id, chats_data in all_users_with_businesses.items():
             user_full_name, user_username = await fetch_user_display_data(bot, user_id) 
@@ -1676,18 +1696,17 @@ async def process_daily_business_income_and_events(bot: Bot):
 
     # Отправка сообщений пользователям теперь после блока try/finally для conn
     if all_event_messages: 
-        logger.info(f"SCHEDULER: Попытка отправить {len(all_event_messages)} сообщений о событиях/уведомлениях.")
-        for msg_data in all_event_messages: # ЭТО СТРОКА 1731 В ТВОЕМ ТРЕЙСБЕКЕ
-            try:
-                target_user_id_for_msg = msg_data.get('user_id')
-                message_text_to_send = msg_data.get('message')
-                # target_chat_id_for_msg = msg_data.get('chat_id') # Если нужно отправлять в чат события
-
-                if target_user_id_for_msg and message_text_to_send:
-                    # По умолчанию отправляем в ЛС пользователя
-                    await bot.send_message(target_user_id_for_msg, message_text_to_send, parse_mode="HTML", disable_web_page_preview=True)
-            except Exception as e_send_msg:
-                logger.warning(f"SCHEDULER: Не удалось отправить запланированное сообщение пользователю {msg_data.get('user_id')}: {e_send_msg}")
+        logger.info(f"SCHEDULER: Постановка в очередь отправки {len(all_event_messages)} сообщений о событиях/уведомлениях.")
+        # По умолчанию отправляем в ЛС пользователя; сообщения попадают в сводку уведомлений (digest.py)
+        messages_to_send = [
+            (msg_data['user_id'], msg_data['message'])
+            for msg_data in all_event_messages
+            if msg_data.get('user_id') and msg_data.get('message')
+        ]
+        try:
+            await digest.notify_many(bot, messages_to_send, "business")
+        except Exception as e_send_msg:
+            logger.warning(f"SCHEDULER: Не удалось поставить в очередь {len(messages_to_send)} запланированных сообщений: {e_send_msg}")
     else:
         logger.info("SCHEDULER: Нет сообщений о событиях/уведомлениях для отправки.")
 
@@ -0,0 +1,141 @@
+# catalog.py
+"""
+Единый каталог статических данных: телефоны (phone_data, exclusive_phone_data), предметы (item_data)
+и бизнесы (business_data).
+
+Раньше словарь {key: модель} строился заново в каждом модуле под своим именем (PHONE_MODELS_STD_DICT,
+PHONE_MODELS_REM, ...), а обработчики на каждый вызов перебирали PHONE_MODELS / PHONE_COMPONENTS в поисках
+телефонов серии, батарей или компонентов для поломки и разбирали строку памяти ("1TB") заново.
+Здесь все индексы строятся один раз при импорте и отдаются только для чтения (MappingProxyType, кортежи).
+Сами записи - те же словари из *_data.py, без копий.
+"""
+from types import MappingProxyType
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+from phone_data import PHONE_MODELS as _PHONE_MODELS_LIST
+from exclusive_phone_data import EXCLUSIVE_PHONE_MODELS as _EXCLUSIVE_PHONE_MODELS_LIST
+from item_data import PHONE_COMPONENTS, PHONE_CASES, CORE_PHONE_COMPONENT_TYPES
+from business_data import BUSINESS_DATA
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+PhoneInfo = Mapping[str, Any]
+
+DEFAULT_MEMORY_GB = 128 # Если строку памяти не удалось разобрать
+DEFAULT_BREAKDOWN_SERIES = "A" # Эксклюзивные серии (X, L, ...) ломаются компонентами A-серии
+
+
+def parse_memory_string_to_gb(memory_str: Any, default: int = DEFAULT_MEMORY_GB) -> int:
+    """'512GB' -> 512, '1TB Предвидения' -> 1024. Без единиц считаем GB."""
+    if not isinstance(memory_str, str):
+        logger.warning(f"parse_memory_string_to_gb: получена не строка: {memory_str}")
+        return default
+
+    memory_str_upper = memory_str.upper().strip()
+    num_part = ""
+    for char_mem in memory_str_upper:
+        if char_mem.isdigit() or char_mem == '.':
+            num_part += char_mem
+        elif num_part:
+            break
+    try:
+        value = float(num_part)
+    except ValueError:
+        logger.warning(f"Не удалось извлечь число из строки памяти: '{memory_str}'. Возвращено {default}GB.")
+        return default
+    memory_gb = int(value * 1024) if 'TB' in memory_str_upper else int(value)
+    return memory_gb if memory_gb > 0 else default
+
+
+# --- Телефоны ---
+PHONE_MODELS_BY_KEY: Mapping[str, PhoneInfo] = MappingProxyType({p["key"]: p for p in _PHONE_MODELS_LIST})
+EXCLUSIVE_PHONE_MODELS_BY_KEY: Mapping[str, PhoneInfo] = MappingProxyType({p["key"]: p for p in _EXCLUSIVE_PHONE_MODELS_LIST})
+# Стандартные модели имеют приоритет над эксклюзивными с тем же ключом
+ALL_PHONE_MODELS_BY_KEY: Mapping[str, PhoneInfo] = MappingProxyType({**EXCLUSIVE_PHONE_MODELS_BY_KEY, **PHONE_MODELS_BY_KEY})
+
+
+def _group_by_series(phones: List[PhoneInfo]) -> Mapping[str, Tuple[PhoneInfo, ...]]:
+    grouped: Dict[str, List[PhoneInfo]] = {}
+    for phone_info in phones:
+        grouped.setdefault(phone_info.get("series") or "", []).append(phone_info)
+    return MappingProxyType({series: tuple(items) for series, items in grouped.items()})
+
+
+# Серия -> модели в порядке phone_data (только стандартные: их продают магазин, крафт и рулетка)
+PHONE_MODELS_BY_SERIES = _group_by_series(_PHONE_MODELS_LIST)
+EXCLUSIVE_PHONE_MODELS_BY_SERIES = _group_by_series(_EXCLUSIVE_PHONE_MODELS_LIST)
+
+
+# Начальная память каждой модели (стандартной и эксклюзивной) в GB
+PHONE_MEMORY_GB: Mapping[str, int] = MappingProxyType({
+    key: parse_memory_string_to_gb(phone_info.get("memory", f"{DEFAULT_MEMORY_GB}GB"))
+    for key, phone_info in ALL_PHONE_MODELS_BY_KEY.items()
+})
+
+
+def get_phone_model(phone_model_key: Optional[str]) -> Optional[PhoneInfo]:
+    """Модель по ключу: сначала стандартные, затем эксклюзивные."""
+    if phone_model_key is None:
+        return None
+    return ALL_PHONE_MODELS_BY_KEY.get(phone_model_key)
+
+
+def get_phone_memory_gb(phone_model_key: Optional[str], default: int = 0) -> int:
+    if phone_model_key is None:
+        return default
+    return PHONE_MEMORY_GB.get(phone_model_key, default)
+
+
+# --- Компоненты и чехлы ---
+def _keys_grouped_by(items: Mapping[str, Mapping[str, Any]], field: str, exclude_type: Optional[str] = None) -> Mapping[Any, Tuple[str, ...]]:
+    grouped: Dict[Any, List[str]] = {}
+    for key, info in items.items():
+        if exclude_type is not None and info.get("component_type") == exclude_type:
+            continue
+        grouped.setdefault(info.get(field), []).append(key)
+    return MappingProxyType({value: tuple(keys) for value, keys in grouped.items()})
+
+
+# component_type ("component", "battery", "memory_module") -> ключи
+COMPONENT_KEYS_BY_TYPE = _keys_grouped_by(PHONE_COMPONENTS, "component_type")
+# Серия -> ключи деталей серии (без универсальных модулей памяти)
+COMPONENT_KEYS_BY_SERIES = _keys_grouped_by(PHONE_COMPONENTS, "series", exclude_type="memory_module")
+BATTERY_COMPONENT_KEYS = frozenset(COMPONENT_KEYS_BY_TYPE.get("battery", ()))
+MEMORY_MODULE_KEYS: Tuple[str, ...] = COMPONENT_KEYS_BY_TYPE.get("memory_module", ())
+CASE_KEYS_BY_SERIES = _keys_grouped_by(PHONE_CASES, "series")
+
+
+def _core_component_keys_by_series() -> Mapping[str, Mapping[str, str]]:
+    # Серия -> {тип детали из CORE_PHONE_COMPONENT_TYPES: ключ детали}, например "S" -> {"screen": "SCREEN_S", ...}
+    result: Dict[str, Mapping[str, str]] = {}
+    for series in COMPONENT_KEYS_BY_SERIES:
+        if not series:
+            continue
+        keys = {comp_type: f"{comp_type.upper()}_{series}" for comp_type in CORE_PHONE_COMPONENT_TYPES}
+        result[series] = MappingProxyType({comp_type: key for comp_type, key in keys.items() if key in PHONE_COMPONENTS})
+    return MappingProxyType(result)
+
+
+SERIES_CORE_COMPONENT_KEYS = _core_component_keys_by_series()
+
+
+def breakdown_component_keys(series: Optional[str]) -> Tuple[str, ...]:
+    """Ключи деталей, которые могут сломаться у телефона серии (для неизвестных серий - DEFAULT_BREAKDOWN_SERIES)."""
+    core_keys = SERIES_CORE_COMPONENT_KEYS.get(series or "") or SERIES_CORE_COMPONENT_KEYS.get(DEFAULT_BREAKDOWN_SERIES, {})
+    return tuple(core_keys.values())
+
+
+# Серия -> ключ батареи серии
+BATTERY_KEY_BY_SERIES: Mapping[str, str] = MappingProxyType({
+    series: key
+    for series, keys in COMPONENT_KEYS_BY_SERIES.items() if series
+    for key in reversed(keys) if key in BATTERY_COMPONENT_KEYS
+})
+
+
+# --- Бизнесы ---
+BUSINESS_KEYS_ORDERED: Tuple[str, ...] = tuple(BUSINESS_DATA.keys())
+# Ключ -> порядковый номер бизнеса (с 1), как в /businessshop
+BUSINESS_INDEX_BY_KEY: Mapping[str, int] = MappingProxyType({key: index for index, key in enumerate(BUSINESS_KEYS_ORDERED, start=1)})
@@ -9,6 +9,129 @@ load_dotenv()
 class Config:
     BOT_TOKEN = os.getenv("BOT_TOKEN")
     DATABASE_URL = os.getenv("DATABASE_URL")
+
+    # Пул соединений asyncpg (создается в on_startup, закрывается в on_shutdown)
+    DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 2))
+    DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 20))
+    DB_POOL_MAX_INACTIVE_CONNECTION_LIFETIME = float(os.getenv("DB_POOL_MAX_INACTIVE_CONNECTION_LIFETIME", 300.0)) # Секунды простоя до закрытия соединения
+    DB_POOL_ACQUIRE_TIMEOUT = float(os.getenv("DB_POOL_ACQUIRE_TIMEOUT", 10.0)) # Сколько ждать свободное соединение из пула
+    DB_POOL_CLOSE_TIMEOUT = float(os.getenv("DB_POOL_CLOSE_TIMEOUT", 10.0)) # Сколько ждать возврата соединений при остановке
+    # Одна транзакция на весь апдейт (все команды становятся атомарными). Выключено по умолчанию:
+    # обработчики, которые ловят ошибки БД и продолжают работу, в общей транзакции получат "transaction is aborted".
+    DB_REQUEST_TRANSACTION = os.getenv("DB_REQUEST_TRANSACTION", "0").lower() in ("1", "true", "yes")
+    # Сколько пар (user_id, chat_id) помнить как "уже есть в user_oneui" (KnownUsersMiddleware)
+    KNOWN_USERS_CACHE_MAX_SIZE = int(os.getenv("KNOWN_USERS_CACHE_MAX_SIZE", 100000))
+    # Сколько последних записанных имен (username/full_name/chat_title) помнить, чтобы не переписывать их без изменений
+    IDENTITY_CACHE_MAX_SIZE = int(os.getenv("IDENTITY_CACHE_MAX_SIZE", 50000))
+    IDENTITY_CACHE_TTL_SECONDS = float(os.getenv("IDENTITY_CACHE_TTL_SECONDS", 300.0)) # Имя могло смениться в другом процессе
+    # Справочник отображаемых имен (directory.py): сколько пользователей помнить и как долго
+    USER_DIRECTORY_MAX_SIZE = int(os.getenv("USER_DIRECTORY_MAX_SIZE", 50000))
+    USER_DIRECTORY_TTL_SECONDS = float(os.getenv("USER_DIRECTORY_TTL_SECONDS", 3600.0))
+    USER_DIRECTORY_NEGATIVE_TTL_SECONDS = float(os.getenv("USER_DIRECTORY_NEGATIVE_TTL_SECONDS", 600.0)) # Не повторять неудачный get_chat
+    CHAT_DIRECTORY_MAX_SIZE = int(os.getenv("CHAT_DIRECTORY_MAX_SIZE", 20000))
+    CHAT_DIRECTORY_TTL_SECONDS = float(os.getenv("CHAT_DIRECTORY_TTL_SECONDS", 6 * 3600.0))
+    # /reminders в личке: сколько чатов обрабатывать одновременно (каждый берет соединение из пула)
+    REMINDERS_CHAT_CONCURRENCY = int(os.getenv("REMINDERS_CHAT_CONCURRENCY", 5))
+
+    # --- Очередь событий (event_queue.py) ---
+    EVENT_QUEUE_BATCH_SIZE = int(os.getenv("EVENT_QUEUE_BATCH_SIZE", 50)) # Сколько событий захватывать за раз
+    EVENT_QUEUE_CONCURRENCY = int(os.getenv("EVENT_QUEUE_CONCURRENCY", 10)) # Сколько событий пачки обрабатывать одновременно
+    EVENT_QUEUE_MAX_ATTEMPTS = int(os.getenv("EVENT_QUEUE_MAX_ATTEMPTS", 5)) # После стольких неудач событие уходит в 'dead'
+    EVENT_QUEUE_RETRY_BASE_SECONDS = float(os.getenv("EVENT_QUEUE_RETRY_BASE_SECONDS", 5.0)) # Задержка первой повторной попытки (дальше x2)
+    EVENT_QUEUE_RETRY_MAX_SECONDS = float(os.getenv("EVENT_QUEUE_RETRY_MAX_SECONDS", 600.0))
+    EVENT_QUEUE_LOCK_TIMEOUT_SECONDS = float(os.getenv("EVENT_QUEUE_LOCK_TIMEOUT_SECONDS", 300.0)) # Через сколько захваченное событие считается зависшим
+    EVENT_QUEUE_POLL_INTERVAL_SECONDS = float(os.getenv("EVENT_QUEUE_POLL_INTERVAL_SECONDS", 30.0)) # Опрос на случай пропущенного NOTIFY и для отложенных повторов
+
+    # --- Способ получения апдейтов: "polling" (getUpdates) или "webhook" (webhook.py) ---
+    BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+    WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+    WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+    WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+    WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN") # Обязателен в режиме webhook; сверяется с заголовком X-Telegram-Bot-Api-Secret-Token
+    WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL") # Публичный адрес для setWebhook; если не задан, webhook настраивается вручную
+    WEBHOOK_MAX_IN_FLIGHT = int(os.getenv("WEBHOOK_MAX_IN_FLIGHT", 200)) # Больше апдейтов в обработке - отвечаем 503, Telegram повторит
+    WEBHOOK_DRAIN_TIMEOUT_SECONDS = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT_SECONDS", 30.0)) # Сколько ждать принятые апдейты при остановке
+
+    # --- Несколько процессов-обработчиков (sharding.py) ---
+    # 1 - обычный polling в одном процессе. N > 1 - приемник раздает апдейты N процессам по from_user.id % N;
+    # настройки пула DB_POOL_* действуют на каждый процесс, т.е. всего соединений до N * DB_POOL_MAX_SIZE
+    BOT_WORKERS = int(os.getenv("BOT_WORKERS", 1))
+    SHARD_QUEUE_SIZE = int(os.getenv("SHARD_QUEUE_SIZE", 1000)) # Апдейтов в очереди одного обработчика, дальше приемник ждет
+    SHARD_WORKER_MAX_CONCURRENT_UPDATES = int(os.getenv("SHARD_WORKER_MAX_CONCURRENT_UPDATES", 100)) # Одновременно обрабатываемых апдейтов в процессе
+    SHARD_POLLING_TIMEOUT_SECONDS = int(os.getenv("SHARD_POLLING_TIMEOUT_SECONDS", 30)) # Long polling таймаут getUpdates в приемнике
+
+    # --- Блокировки команд (locks.py) ---
+    # "memory" - только локальные локи (один процесс бота); "postgres" - еще и advisory-блокировки PostgreSQL,
+    # чтобы несколько процессов/серверов бота не выполняли одну команду одного пользователя параллельно
+    LOCK_BACKEND = os.getenv("LOCK_BACKEND", "memory").lower()
+    LOCK_ADVISORY_TIMEOUT_SECONDS = float(os.getenv("LOCK_ADVISORY_TIMEOUT_SECONDS", 30.0))
+
+    # --- Выбор лидера для задач планировщика (leader_election.py) ---
+    # Задачи APScheduler выполняет только процесс, держащий аренду в system_settings. Выключать имеет смысл
+    # только если бот гарантированно запущен в одном экземпляре (тогда планировщик стартует сразу)
+    SCHEDULER_LEADER_ELECTION = os.getenv("SCHEDULER_LEADER_ELECTION", "1").lower() in ("1", "true", "yes")
+    SCHEDULER_LEASE_SECONDS = float(os.getenv("SCHEDULER_LEASE_SECONDS", 15.0)) # Через сколько без продления аренду может забрать другой процесс
+    SCHEDULER_HEARTBEAT_SECONDS = float(os.getenv("SCHEDULER_HEARTBEAT_SECONDS", 5.0)) # Как часто лидер продлевает аренду, а остальные пытаются ее взять
+
+    # --- Хранилище FSM в PostgreSQL (fsm_storage.py) ---
+    FSM_TTL_GRACE_SECONDS = float(os.getenv("FSM_TTL_GRACE_SECONDS", 300.0)) # Запас сверх таймаута подтверждения до удаления состояния
+    FSM_DEFAULT_TTL_SECONDS = float(os.getenv("FSM_DEFAULT_TTL_SECONDS", 3600.0)) # Для состояний без своего таймаута
+    FSM_FLUSH_INTERVAL_SECONDS = float(os.getenv("FSM_FLUSH_INTERVAL_SECONDS", 0.2)) # Как долго копить изменения перед записью в БД
+    FSM_FLUSH_BATCH_SIZE = int(os.getenv("FSM_FLUSH_BATCH_SIZE", 200)) # Записывать сразу, если накопилось столько ключей
+    FSM_CACHE_TTL_SECONDS = float(os.getenv("FSM_CACHE_TTL_SECONDS", 300.0)) # Сколько доверять кэшу процесса без перечитывания из БД
+    FSM_CACHE_MAX_SIZE = int(os.getenv("FSM_CACHE_MAX_SIZE", 10000))
+    FSM_CLEANUP_INTERVAL_SECONDS = int(os.getenv("FSM_CLEANUP_INTERVAL_SECONDS", 3600)) # Как часто удалять истекшие состояния
+
+    # --- Метрики запросов к БД (db_metrics.py, команда /dbstats) ---
+    DB_METRICS_ENABLED = os.getenv("DB_METRICS_ENABLED", "1").lower() in ("1", "true", "yes")
+    DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", 200.0)) # Вызовы дольше этого пишутся в лог медленных запросов
+    DB_METRICS_SAMPLE_SIZE = int(os.getenv("DB_METRICS_SAMPLE_SIZE", 1000)) # Сколько последних замеров на операцию хранить для перцентилей
+    DB_SLOW_QUERY_LOG_SIZE = int(os.getenv("DB_SLOW_QUERY_LOG_SIZE", 100))
+
+    # --- Очередь исходящих сообщений (outbox.py) ---
+    OUTBOX_GLOBAL_RATE_PER_SECOND = float(os.getenv("OUTBOX_GLOBAL_RATE_PER_SECOND", 25.0)) # Лимит Telegram ~30 сообщений/сек на бота, держим запас
+    OUTBOX_PRIVATE_CHAT_INTERVAL_SECONDS = float(os.getenv("OUTBOX_PRIVATE_CHAT_INTERVAL_SECONDS", 1.0)) # Не чаще одного сообщения в секунду в один ЛС
+    OUTBOX_GROUP_CHAT_INTERVAL_SECONDS = float(os.getenv("OUTBOX_GROUP_CHAT_INTERVAL_SECONDS", 3.0)) # В группу - не больше 20 в минуту
+    OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 5)) # Повторы при ошибках, кроме RetryAfter
+    OUTBOX_RETRY_BASE_SECONDS = float(os.getenv("OUTBOX_RETRY_BASE_SECONDS", 2.0))
+    OUTBOX_LEASE_SECONDS = float(os.getenv("OUTBOX_LEASE_SECONDS", 3600.0)) # Через сколько сообщения упавшего процесса забирает другой
+    OUTBOX_DRAIN_TIMEOUT_SECONDS = float(os.getenv("OUTBOX_DRAIN_TIMEOUT_SECONDS", 10.0)) # Сколько досылать очередь при остановке
+
+    # --- Движок сроков (deadlines.py) ---
+    DEADLINE_RECONCILE_INTERVAL_SECONDS = float(os.getenv("DEADLINE_RECONCILE_INTERVAL_SECONDS", 60.0)) # Как часто сверять сроки с БД (сроки других процессов приходят с этой задержкой)
+    DEADLINE_HORIZON_SECONDS = float(os.getenv("DEADLINE_HORIZON_SECONDS", 3600.0)) # Сроки дальше этого в память не загружаются
+    DEADLINE_MAX_CONCURRENCY = int(os.getenv("DEADLINE_MAX_CONCURRENCY", 10)) # Обработчиков сроков одновременно
+
+    # --- Сводка уведомлений планировщика (digest.py) ---
+    DIGEST_ENABLED = os.getenv("DIGEST_ENABLED", "1").lower() in ("1", "true", "yes")
+    DIGEST_WINDOW_MINUTES = float(os.getenv("DIGEST_WINDOW_MINUTES", 60.0)) # Сколько копить уведомления пользователя перед отправкой сводки
+    DIGEST_FLUSH_INTERVAL_SECONDS = int(os.getenv("DIGEST_FLUSH_INTERVAL_SECONDS", 300)) # Как часто проверять, чьи сводки пора отправить
+    DIGEST_FLUSH_BATCH_USERS = int(os.getenv("DIGEST_FLUSH_BATCH_USERS", 500)) # Пользователей за один запрос к БД
+
+    # --- Ограничение частоты команд (FloodControlMiddleware) ---
+    FLOOD_CONTROL_ENABLED = os.getenv("FLOOD_CONTROL_ENABLED", "1").lower() in ("1", "true", "yes")
+    FLOOD_USER_BURST = float(os.getenv("FLOOD_USER_BURST", 10.0)) # Сколько "единиц" команд пользователь может потратить подряд
+    FLOOD_USER_RATE_PER_SECOND = float(os.getenv("FLOOD_USER_RATE_PER_SECOND", 0.5)) # Скорость восстановления ведра пользователя
+    FLOOD_CHAT_BURST = float(os.getenv("FLOOD_CHAT_BURST", 40.0)) # То же для всего чата (защита от одной активной группы)
+    FLOOD_CHAT_RATE_PER_SECOND = float(os.getenv("FLOOD_CHAT_RATE_PER_SECOND", 3.0))
+    FLOOD_WARNING_WINDOW_SECONDS = float(os.getenv("FLOOD_WARNING_WINDOW_SECONDS", 30.0)) # Предупреждение "не так быстро" - не чаще раза за окно
+    FLOOD_WARNING_TEXT = "⏳ Не так быстро! Подождите немного перед следующей командой."
+    # Стоимость тяжелых команд по имени функции-обработчика (все алиасы ведут в одну функцию); остальные стоят 1
+    FLOOD_COMMAND_COSTS = {
+        "cmd_show_reminders": 5.0,          # /reminders: запросы по каждому чату + get_chat
+        "cmd_my_stats_explicit": 4.0,       # /mystats
+        "cmd_general_stats_handler": 4.0,   # /стата
+        "cmd_user_stats_explicit": 4.0,     # /userstats
+        "top_global_command": 3.0,
+        "top_onecoins_global_command": 3.0,
+        "top_families_command": 3.0,
+        "oneui_command": 2.0,
+        "cmd_myphones": 2.0,
+        "cmd_phoneshop": 2.0,
+        "cmd_itemshop": 2.0,
+        "my_businesses_command": 2.0,
+    }
+
     ADMIN_ID = int(os.getenv("ADMIN_ID", 0))
     TIMEZONE = os.getenv("TIMEZONE", "Europe/Moscow")
     RESET_HOUR = 21 # Используется для сброса кулдауна OneUI
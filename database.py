@@ -9,8 +9,9 @@ from typing import Optional, List, Dict, Any, Tuple
 import logging
 from decimal import Decimal, ROUND_HALF_UP
 import json 
+import contextvars
+from contextlib import asynccontextmanager
 from item_data import PHONE_COMPONENTS
-from phone_data import PHONE_MODELS as PHONE_MODELS_LIST_DB # Импортируем список
 from item_data import PHONE_COMPONENTS as PHONE_COMPONENTS_DB # Импортируем компоненты
 
 # Убедитесь, что Config импортируется правильно. Если Config находится в корне проекта,
@@ -18,563 +19,311 @@ from item_data import PHONE_COMPONENTS as PHONE_COMPONENTS_DB # Импортир
 # Если database.py в подпапке, возможно, потребуется "from ..config import Config"
 # или настройка PYTHONPATH. Для простоты предполагаем, что импорт корректен.
 from config import Config
+import migrations
+import locks
+import db_metrics
+import deadlines
+import settings_cache
+import catalog
+import directory
+import sys
 
 load_dotenv()
 logger = logging.getLogger(__name__)
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-# --- Словари для блокировок команд (перемещено из main.py) ---
-user_command_locks: Dict[Tuple[int, int], asyncio.Lock] = {}
-locks_dict_creation_lock = asyncio.Lock()
+# --- Блокировки команд по (user_id, chat_id) (см. locks.py) ---
+user_command_locks = locks.get_lock_manager("user_chat")
 
-async def get_user_chat_lock(user_id: int, chat_id: int) -> asyncio.Lock:
-    key = (user_id, chat_id)
-    async with locks_dict_creation_lock:
-        if key not in user_command_locks:
-            user_command_locks[key] = asyncio.Lock()
-        return user_command_locks[key]
+async def get_user_chat_lock(user_id: int, chat_id: int) -> locks.KeyedLock:
+    return user_command_locks.get(user_id, chat_id)
 
 # Константа для минимальной версии OneUI для создания семьи, если она не определена в Config
 FAMILY_CREATION_MIN_VERSION = getattr(Config, 'FAMILY_CREATION_MIN_VERSION', 5.0)
-PHONE_MODELS = {phone_info["key"]: phone_info for phone_info in PHONE_MODELS_LIST_DB}
 PHONE_COMPONENTS = PHONE_COMPONENTS_DB # Просто присваиваем, если он уже словарь
 
 
-async def get_connection() -> asyncpg.Connection:
+# --- Последние записанные имена (username, full_name, chat_title) ---
+# LRU по (таблица, user_id, chat_id). Если переданное имя совпадает с уже записанным,
+# в upsert уходит NULL, и COALESCE(EXCLUDED.x, t.x) оставляет старое значение - вместе
+# с проверкой IS DISTINCT FROM в SQL это убирает пустые перезаписи строк.
+# Те же строки пишут и другие процессы (реплики webhook, обработчики других шардов), поэтому
+# запись живет IDENTITY_CACHE_TTL_SECONDS с момента, когда имя действительно было записано:
+# устаревшее значение в БД исправится не позже чем через TTL.
+_IdentityKey = Tuple[str, int, int]
+_Identity = Tuple[Optional[str], Optional[str], Optional[str]]
+_persisted_identity = directory.LruTtlCache(
+    max_size=Config.IDENTITY_CACHE_MAX_SIZE, ttl=Config.IDENTITY_CACHE_TTL_SECONDS, negative_ttl=0.0,
+)
+
+
+def _identity_delta(table: str, user_id: int, chat_id: int,
+                    username: Optional[str], full_name: Optional[str], chat_title: Optional[str]) -> _Identity:
+    """Возвращает имена для записи, заменяя на None те, что уже лежат в БД."""
+    key = (table, user_id, chat_id)
+    known = _persisted_identity.get(key)
+    if known is directory.MISSING:
+        return username, full_name, chat_title
+    new_values = (username, full_name, chat_title)
+    return tuple(None if new is not None and new == old else new for new, old in zip(new_values, known))  # type: ignore[return-value]
+
+
+def _remember_identity(conn: Any, table: str, user_id: int, chat_id: int,
+                       username: Optional[str], full_name: Optional[str], chat_title: Optional[str]) -> None:
+    """
+    Запоминает имена после успешного upsert (COALESCE: None не перезаписывает старое значение).
+    Внутри внешней транзакции запись еще может откатиться - тогда запись LRU просто сбрасываем.
+    Если ничего нового не записано (ушли только NULL), срок записи не продлевается.
+    """
+    key = (table, user_id, chat_id)
+    if conn.is_in_transaction():
+        _persisted_identity.discard(key)
+        return
+    known = _persisted_identity.get(key)
+    if known is directory.MISSING:
+        known = (None, None, None)
+    new_values = (username, full_name, chat_title)
+    merged = tuple(new if new is not None else old for new, old in zip(new_values, known))
+    if merged != known:
+        _persisted_identity.put(key, merged)
+
+
+# --- Пул соединений ---
+# Один пул на процесс. Создается в on_startup (main.py) через create_pool() и закрывается в on_shutdown.
+_pool: Optional[asyncpg.Pool] = None
+
+
+class PooledConnection:
+    """
+    Обертка над соединением, взятым из пула.
+    Весь код модуля привык делать `await conn.close()` в finally, поэтому close() здесь
+    возвращает соединение в пул, а не разрывает его. Остальные атрибуты проксируются.
+    """
+    __slots__ = ("_pool", "_conn", "_released")
+
+    def __init__(self, pool: asyncpg.Pool, conn: Any):
+        self._pool = pool
+        self._conn = conn
+        self._released = False
+
+    def __getattr__(self, name: str) -> Any:
+        if self._released:
+            raise asyncpg.InterfaceError(f"Соединение уже возвращено в пул (обращение к '{name}').")
+        return getattr(self._conn, name)
+
+    def is_closed(self) -> bool:
+        return self._released or self._conn.is_closed()
+
+    async def close(self, *, timeout: Optional[float] = None) -> None:
+        if self._released:
+            return
+        self._released = True
+        await self._pool.release(self._conn, timeout=timeout)
+
+    def terminate(self) -> None:
+        # Жесткий разрыв (например, при отмене задачи): соединение уничтожается, пул создаст новое
+        if self._released:
+            return
+        self._released = True
+        self._conn.terminate()
+        asyncio.ensure_future(self._pool.release(self._conn))
+
+
+async def create_pool() -> asyncpg.Pool:
+    global _pool
+    if _pool is not None:
+        return _pool
     if not DATABASE_URL:
         logger.critical("DATABASE_URL environment variable not set.")
         raise ValueError("DATABASE_URL environment variable not set.")
     try:
-        return await asyncpg.connect(DATABASE_URL, statement_cache_size=0)
+        _pool = await asyncpg.create_pool(
+            DATABASE_URL,
+            min_size=Config.DB_POOL_MIN_SIZE,
+            max_size=Config.DB_POOL_MAX_SIZE,
+            max_inactive_connection_lifetime=Config.DB_POOL_MAX_INACTIVE_CONNECTION_LIFETIME,
+            statement_cache_size=0,
+        )
+        logger.info(f"Пул соединений БД создан (min={Config.DB_POOL_MIN_SIZE}, max={Config.DB_POOL_MAX_SIZE}).")
+        settings_cache_instance.start()
+        return _pool
     except Exception as e:
-        logger.critical(f"Failed to connect to database: {e}", exc_info=True)
+        logger.critical(f"Failed to create database pool: {e}", exc_info=True)
         raise
 
-async def init_db():
-    conn = await get_connection()
-    try:
-        # --- Таблица user_oneui (основная таблица для версий и монет) ---
-        table_exists = await conn.fetchval("SELECT EXISTS (SELECT 1 FROM information_schema.tables WHERE table_name = 'user_oneui');")
-        if not table_exists:
-             await conn.execute("""
-                 CREATE TABLE user_oneui (
-                     user_id BIGINT NOT NULL,
-                     chat_id BIGINT NOT NULL,
-                     PRIMARY KEY (user_id, chat_id)
-                 )
-             """)
-             logger.info("Таблица 'user_oneui' создана с минимальной структурой.")
-        else:
-            logger.info("Таблица 'user_oneui' уже существует.")
-            
-                
-
-
-        
-        # ДОБАВЬ ЭТОТ БЛОК ДЛЯ СОЗДАНИЯ ТАБЛИЦЫ ОГРАБЛЕНИЙ
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS user_robbank_status (
-                user_id BIGINT NOT NULL,
-                chat_id BIGINT NOT NULL,
-                last_robbank_attempt_utc TIMESTAMP WITH TIME ZONE,
-                robbank_oneui_blocked_until_utc TIMESTAMP WITH TIME ZONE,
-                current_operation_name TEXT,
-                current_operation_start_utc TIMESTAMP WITH TIME ZONE,
-                current_operation_base_reward INTEGER,
-                PRIMARY KEY (user_id, chat_id),
-                FOREIGN KEY (user_id, chat_id) REFERENCES user_oneui (user_id, chat_id) ON DELETE CASCADE
-            );
-        """)
-        logger.info("Таблица 'user_robbank_status' проверена/создана.")
-        # Индексы для user_robbank_status (опционально, но полезно для производительности)
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_robbank_status_blocked ON user_robbank_status (robbank_oneui_blocked_until_utc);")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_robbank_status_pending_op ON user_robbank_status (current_operation_start_utc);")
-        # --- КОНЕЦ БЛОКА ДЛЯ ТАБЛИЦЫ ОГРАБЛЕНИЙ ---    
-            
-            
 
-        # Функции для добавления колонок (они должны быть определены ниже в этом файле)
-        await add_username_column(conn_ext=conn)
-        await add_full_name_column(conn_ext=conn)
-        await add_chat_title_column(conn_ext=conn)
-        await add_version_column(conn_ext=conn)
-        await add_last_used_column(conn_ext=conn)
-        await add_onecoins_column(conn_ext=conn)
-        await add_telegram_chat_link_column(conn_ext=conn)
-        await _add_column_if_not_exists(conn, "user_oneui", "total_income_earned_from_businesses", "BIGINT DEFAULT 0 NOT NULL") # <<< НОВОЕ ПОЛЕ
-        
-        logger.info("Колонки таблицы 'user_oneui' проверены/добавлены.")
+async def close_pool():
+    global _pool
+    pool, _pool = _pool, None
+    if pool is None:
+        return
+    await settings_cache_instance.stop()
+    try:
+        await asyncio.wait_for(pool.close(), timeout=Config.DB_POOL_CLOSE_TIMEOUT)
+        logger.info("Пул соединений БД закрыт.")
+    except asyncio.TimeoutError:
+        logger.warning("Не все соединения вернулись в пул вовремя, пул закрыт принудительно.")
+        pool.terminate()
+    except Exception as e:
+        logger.error(f"Ошибка при закрытии пула БД: {e}", exc_info=True)
+        pool.terminate()
 
-        # --- Таблица user_bonus_multipliers ---
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS user_bonus_multipliers (
-                user_id BIGINT NOT NULL,
-                chat_id BIGINT NOT NULL,
-                current_bonus_multiplier NUMERIC(3, 2),
-                is_bonus_consumed BOOLEAN DEFAULT TRUE NOT NULL,
-                last_claimed_timestamp TIMESTAMP WITH TIME ZONE,
-                PRIMARY KEY (user_id, chat_id)
-            )
-        """)
-        logger.info("Таблица 'user_bonus_multipliers' проверена/создана (с chat_id).")
-        
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS user_display_achievement (
-                user_id BIGINT PRIMARY KEY,
-                selected_achievement_key TEXT DEFAULT NULL,
-                updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        logger.info("Таблица 'user_display_achievement' проверена/создана.")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_display_achievement_user_id ON user_display_achievement (user_id);")
-        logger.info("Индексы для 'user_display_achievement' проверены/созданы.")
-        
-        
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS user_phones (
-                phone_inventory_id SERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL,
-                chat_id_acquired_in BIGINT NOT NULL,
-                phone_model_key TEXT NOT NULL,
-                color TEXT NOT NULL,
-                purchase_price_onecoins INTEGER NOT NULL,
-                purchase_date_utc TIMESTAMP WITH TIME ZONE NOT NULL,
-                is_sold BOOLEAN DEFAULT FALSE NOT NULL,
-                sold_date_utc TIMESTAMP WITH TIME ZONE,
-                sold_price_onecoins INTEGER
-            )
-        """)
-        logger.info("Таблица 'user_phones' проверена/создана.")
 
-        # Индексы для таблицы user_phones (НОВОЕ)
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_phones_user_id ON user_phones (user_id)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_phones_user_active ON user_phones (user_id, is_sold)")
-        logger.info("Индексы для 'user_phones' проверены/созданы.")
+def get_pool() -> Optional[asyncpg.Pool]:
+    return _pool
 
 
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS user_achievements (
-                user_id BIGINT NOT NULL,
-                achievement_key TEXT NOT NULL,
-                achieved_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP NOT NULL,
-                progress_data JSONB DEFAULT NULL, -- Для достижений с прогрессом (если решим использовать)
-                PRIMARY KEY (user_id, achievement_key)
-            );
-        """)
-        logger.info("Таблица 'user_achievements' проверена/создана.")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_achievements_user_id ON user_achievements (user_id);")
-        # --- КОНЕЦ НОВОЙ ТАБЛИЦЫ ДЛЯ ДОСТИЖЕНИЙ ---
-
-        logger.info("Все таблицы проверены/созданы и при необходимости изменены.") 
-
-
-        # --- Таблица user_version_history ---
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS user_version_history (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL,
-                chat_id BIGINT NOT NULL,
-                version NUMERIC(10, 1),
-                full_name_at_change TEXT, -- <<<< НОВАЯ КОЛОНКА
-                changed_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE (user_id, chat_id, changed_at) -- Убедитесь, что UNIQUE constraint не мешает, если full_name_at_change может быть разным при одинаковых user, chat, time
-                                                    -- Вряд ли, так как changed_at обычно уникально до микросекунд, но стоит помнить.
-                                                    -- Если changed_at может быть не уникальным, можно убрать его из UNIQUE или добавить id в UNIQUE.
-                                                    -- Однако, DEFAULT CURRENT_TIMESTAMP обычно достаточно уникален.
-            )
-        """)
-        logger.info("Таблица 'user_version_history' проверена/создана (с full_name_at_change).")
-        
-        # --- Таблица для инвентаря предметов пользователя (детали, чехлы, модули памяти) ---
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS user_items (
-                user_item_id SERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL,
-                item_key TEXT NOT NULL,
-                item_type TEXT NOT NULL,
-                quantity INTEGER DEFAULT 1 NOT NULL,
-                data JSONB DEFAULT NULL, -- <<< ИСПРАВЛЕНИЕ: ДОБАВЛЕНА ЗАПЯТАЯ
-                equipped_phone_id INTEGER DEFAULT NULL
-            )
-        """)
-        logger.info("Таблица 'user_items' проверена/создана (без UNIQUE для item_key).")
-        # Основной индекс по user_id оставляем
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_items_user_id ON user_items (user_id)")
-        # Индекс (user_id, item_key) все еще полезен для быстрого поиска всех предметов определенного типа у пользователя,
-        # даже если они не уникальны в комбинации.
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_items_user_item_type ON user_items (user_id, item_key, item_type)")
-        logger.info("Индексы для 'user_items' проверены/созданы.")
-
-        # --- Добавление новых полей в таблицу user_phones ---
-        phone_columns_to_add = [
-            ("current_memory_gb", "INTEGER DEFAULT NULL"), # Изначально NULL, будет установлено при покупке из phone_data.py
-            ("is_broken", "BOOLEAN DEFAULT FALSE NOT NULL"),
-            ("broken_component_key", "TEXT DEFAULT NULL"), # Ключ сломанного компонента из PHONE_COMPONENTS
-            ("insurance_active_until", "TIMESTAMP WITH TIME ZONE DEFAULT NULL"),
-            ("equipped_case_key", "TEXT DEFAULT NULL"), # Ключ надетого чехла из PHONE_CASES
-            ("is_contraband", "BOOLEAN DEFAULT FALSE NOT NULL"),
-            ("last_charged_utc", "TIMESTAMP WITH TIME ZONE DEFAULT NULL"),
-            ("battery_dead_after_utc", "TIMESTAMP WITH TIME ZONE DEFAULT NULL"),
-            ("battery_break_after_utc", "TIMESTAMP WITH TIME ZONE DEFAULT NULL"),
-            ("data", "JSONB DEFAULT NULL") 
-        ]
-
-        for col_name, col_def in phone_columns_to_add:
-            await _add_column_if_not_exists(conn, "user_phones", col_name, col_def)
-        logger.info("Новые колонки для 'user_phones' проверены/добавлены.")
-
-        # Добавляем колонку, если она еще не существует (для старых БД)
-        await _add_column_if_not_exists(conn, "user_version_history", "full_name_at_change", "TEXT")
-        # logger.info("Колонка 'full_name_at_change' проверена/добавлена в 'user_version_history'.") # Уже есть в _add_column_if_not_exists
-
-
-        # --- Остальная часть init_db без изменений ---
-        # (проверка FOREIGN KEY и типа changed_at, создание других таблиц)
-        fk_exists = await conn.fetchval("""
-            SELECT EXISTS (
-                SELECT 1 FROM information_schema.table_constraints tc
-                JOIN information_schema.key_column_usage kcu ON tc.constraint_name = kcu.constraint_name
-                WHERE tc.table_name = 'user_version_history' AND tc.constraint_type = 'FOREIGN KEY'
-                AND (kcu.constraint_name LIKE 'user_version_history_user_id_fkey%' OR kcu.constraint_name LIKE 'user_version_history_user_chat_fkey%')
-            );
-        """)
-        if not fk_exists:
-            try:
-                 await conn.execute("ALTER TABLE user_version_history ADD CONSTRAINT user_version_history_user_chat_fkey FOREIGN KEY (user_id, chat_id) REFERENCES user_oneui (user_id, chat_id) ON DELETE CASCADE;")
-                 logger.info("Добавлен FOREIGN KEY для user_version_history -> user_oneui.")
-            except Exception as e_fk:
-                 logger.warning(f"Не удалось добавить FOREIGN KEY для user_version_history: {e_fk}. Убедитесь, что user_oneui существует.")
-
+# --- Соединение, привязанное к апдейту (см. middlewares.DbConnectionMiddleware) ---
+class _RequestConnectionScope:
+    """
+    Одно соединение на обработку апдейта. Берется из пула лениво, при первом обращении к БД.
+    Переиспользуется только в той задаче, которая открыла scope: фоновые задачи
+    (asyncio.create_task) и параллельные gather-вызовы получают свои соединения из пула,
+    чтобы не было конкурентных запросов на одном соединении.
+    """
+    __slots__ = ("owner_task", "use_transaction", "conn", "transaction", "closed")
+
+    def __init__(self, use_transaction: bool = False):
+        self.owner_task = asyncio.current_task()
+        self.use_transaction = use_transaction
+        self.conn: Optional[Any] = None
+        self.transaction: Optional[Any] = None
+        self.closed = False
+
+    async def borrow(self) -> "_BorrowedConnection":
+        if self.conn is None:
+            self.conn = await _open_connection()
+            if self.use_transaction:
+                self.transaction = self.conn.transaction()
+                await self.transaction.start()
+        return _BorrowedConnection(self.conn)
+
+    async def finish(self, failed: bool) -> None:
+        self.closed = True
+        conn, self.conn = self.conn, None
+        if conn is None:
+            return
         try:
-            col_type_info = await conn.fetchrow("SELECT data_type FROM information_schema.columns WHERE table_name = 'user_version_history' AND column_name = 'changed_at'")
-            if col_type_info and col_type_info['data_type'] == 'timestamp without time zone':
-                await conn.execute("ALTER TABLE user_version_history ALTER COLUMN changed_at TYPE TIMESTAMP WITH TIME ZONE USING changed_at AT TIME ZONE 'UTC';")
-                logger.info("ИЗМЕНЕНО: Колонка 'user_version_history.changed_at' конвертирована в TIMESTAMP WITH TIME ZONE.")
-        except Exception as e_alter_ca:
-            logger.warning(f"ЗАМЕЧАНИЕ: Не удалось проверить/изменить тип 'user_version_history.changed_at': {e_alter_ca}")
+            if self.transaction is not None and not conn.is_closed():
+                if failed:
+                    await self.transaction.rollback()
+                else:
+                    await self.transaction.commit()
+        except Exception as e:
+            logger.error(f"DB: Ошибка завершения транзакции апдейта: {e}", exc_info=True)
+        finally:
+            self.transaction = None
+            if not conn.is_closed():
+                await conn.close()
 
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS user_pending_phone_prizes (
-                prize_id SERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL,
-                phone_model_key TEXT NOT NULL,
-                color TEXT NOT NULL,
-                initial_memory_gb INTEGER NOT NULL,
-                prize_won_at_utc TIMESTAMP WITH TIME ZONE NOT NULL,
-                original_roulette_chat_id BIGINT NOT NULL,
-                -- Можно добавить другие поля, если нужны
-                --data JSONB DEFAULT NULL
-                UNIQUE (user_id) -- У пользователя может быть только один такой приз, ожидающий решения
-            )
-        """)
-        logger.info("Таблица 'user_pending_phone_prizes' проверена/создана.")
-        # --- НОВЫЕ ТАБЛИЦЫ ДЛЯ БИЗНЕСОВ И БАНКА ---
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS user_businesses (
-                business_id SERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL,
-                chat_id BIGINT NOT NULL,
-                username TEXT DEFAULT NULL, -- Добавлено
-                full_name TEXT DEFAULT NULL, -- Добавлено
-                chat_title TEXT DEFAULT NULL, -- Добавлено
-                business_key TEXT NOT NULL,
-                current_level INTEGER DEFAULT 0 NOT NULL,
-                staff_hired_slots INTEGER DEFAULT 0 NOT NULL,
-                last_income_calculation_utc TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP NOT NULL,
-                time_purchased_utc TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP NOT NULL,
-                is_active BOOLEAN DEFAULT TRUE NOT NULL,
-                name_override TEXT DEFAULT NULL,
-                UNIQUE (user_id, chat_id, business_key)
-            );
-        """)
-        logger.info("Таблица 'user_businesses' проверена/создана.")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_businesses_user_chat ON user_businesses (user_id, chat_id)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_businesses_active ON user_businesses (is_active)")
 
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS user_business_upgrades (
-                upgrade_id SERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL,                
-                business_internal_id INTEGER NOT NULL REFERENCES user_businesses(business_id) ON DELETE CASCADE,
-                upgrade_key TEXT NOT NULL,
-                time_installed_utc TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP NOT NULL,
-                UNIQUE (business_internal_id, upgrade_key)
-            );
-        """)
-        logger.info("Таблица 'user_business_upgrades' проверена/создана.")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_business_upgrades_business_id ON user_business_upgrades (business_internal_id)")
+class _BorrowedConnection:
+    """Соединение апдейта, выданное вложенной функции. close() ничего не делает - соединением владеет scope."""
+    __slots__ = ("_conn",)
 
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS user_bank (
-                user_id BIGINT NOT NULL,
-                chat_id BIGINT NOT NULL, -- Добавлено поле chat_id для привязки к чату
-                username TEXT DEFAULT NULL, -- Добавлено
-                full_name TEXT DEFAULT NULL, -- Добавлено
-                chat_title TEXT DEFAULT NULL, -- Добавлено
-                current_balance BIGINT DEFAULT 0 NOT NULL,
-                bank_level INTEGER DEFAULT 0 NOT NULL,
-                last_deposit_utc TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP NOT NULL,
-                PRIMARY KEY (user_id, chat_id) -- Первичный ключ теперь состоит из двух полей
-            );
-        """)
-        logger.info("Таблица 'user_bank' проверена/создана (теперь с привязкой к чату).")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_bank_user_id ON user_bank (user_id)") # Добавим индекс для быстрого поиска всех банков пользователя
-        # --- КОНЕЦ НОВЫХ ТАБЛИЦ ---
-
-        # Добавляем индекс по user_id для быстрого поиска pending призов
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_pending_phone_prizes_user_id ON user_pending_phone_prizes (user_id)")
-        # Добавляем индекс по времени выигрыша для поиска просроченных призов
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_pending_phone_prizes_won_at_utc ON user_pending_phone_prizes (prize_won_at_utc)")
-        logger.info("Индексы для 'user_pending_phone_prizes' проверены/созданы.") 
+    def __init__(self, conn: Any):
+        self._conn = conn
 
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._conn, name)
 
+    def is_closed(self) -> bool:
+        return self._conn.is_closed()
 
-        
-        
-        
-        
-        # --- Таблицы семей ---
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS families (
-                family_id SERIAL PRIMARY KEY, name TEXT UNIQUE NOT NULL, leader_id BIGINT NOT NULL,
-                chat_id_created_in BIGINT NOT NULL, chat_title_created_in TEXT,
-                created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        logger.info("Таблица 'families' проверена/создана.")
+    async def close(self, *, timeout: Optional[float] = None) -> None:
+        return None
 
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS family_members (
-                member_entry_id SERIAL PRIMARY KEY, family_id INTEGER NOT NULL REFERENCES families(family_id) ON DELETE CASCADE,
-                user_id BIGINT NOT NULL, full_name_when_joined TEXT, chat_id_joined_from BIGINT NOT NULL,
-                joined_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP, is_active BOOLEAN DEFAULT TRUE,
-                UNIQUE (family_id, user_id)
-            )
-        """)
-        logger.info("Таблица 'family_members' проверена/создана.")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_family_members_active ON family_members (family_id, user_id, is_active)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_family_members_user_active ON family_members (user_id, is_active)")
+    def terminate(self) -> None:
+        return None
 
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS family_logs (
-                log_id SERIAL PRIMARY KEY, family_id INTEGER NOT NULL REFERENCES families(family_id) ON DELETE CASCADE,
-                timestamp TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP, action_type TEXT NOT NULL,
-                actor_user_id BIGINT, actor_full_name TEXT, target_user_id BIGINT NULL, target_full_name TEXT NULL,
-                chat_id_context BIGINT, chat_title_context TEXT, description TEXT NOT NULL
-            )
-        """)
-        logger.info("Таблица 'family_logs' проверена/создана.")
 
-        # --- Таблицы соревнований ---
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS family_competitions (
-                competition_id SERIAL PRIMARY KEY,
-                start_ts TIMESTAMP WITH TIME ZONE,
-                end_ts TIMESTAMP WITH TIME ZONE,
-                is_active BOOLEAN DEFAULT FALSE,
-                winner_family_id INTEGER NULL REFERENCES families(family_id) ON DELETE SET NULL,
-                started_by_admin_id BIGINT,
-                rewards_distributed BOOLEAN DEFAULT FALSE
-            )
-        """)
-        logger.info("Таблица 'family_competitions' проверена/создана.")
-        
-        
+_request_scope: contextvars.ContextVar[Optional[_RequestConnectionScope]] = contextvars.ContextVar("db_request_scope", default=None)
 
-        async def ensure_fc_column_and_type(col_name, col_def_type_no_constraints, col_def_full_with_constraints):
-            exists_query = "SELECT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name='family_competitions' AND column_name=$1);"
-            exists = await conn.fetchval(exists_query, col_name)
-            renamed_from_old = False
-            if not exists:
-                old_col_name = None
-                if col_name == 'start_ts': old_col_name = 'start_time'
-                elif col_name == 'end_ts': old_col_name = 'end_time'
-                if old_col_name and await conn.fetchval(exists_query, old_col_name):
-                    await conn.execute(f"ALTER TABLE family_competitions RENAME COLUMN {old_col_name} TO {col_name};")
-                    logger.info(f"ИЗМЕНЕНО: Колонка '{old_col_name}' переименована в '{col_name}' в 'family_competitions'.")
-                    renamed_from_old = True
-                if not renamed_from_old: # Только если не было переименования, пытаемся добавить
-                    await conn.execute(f"ALTER TABLE family_competitions ADD COLUMN IF NOT EXISTS {col_name} {col_def_full_with_constraints};")
-                    # Проверяем еще раз после ADD COLUMN
-                    if await conn.fetchval(exists_query, col_name): # Используем exists_query с новым именем
-                         logger.info(f"ИЗМЕНЕНО: Добавлена колонка '{col_name}' в 'family_competitions'.")
-                    else:
-                         logger.warning(f"Колонка '{col_name}' НЕ была добавлена в 'family_competitions' после ALTER ADD.")
-
-            if "TIMESTAMP" in col_def_type_no_constraints.upper(): # Проверка типа, если колонка существует
-                if await conn.fetchval(exists_query, col_name):
-                    current_type_info = await conn.fetchrow(f"SELECT data_type FROM information_schema.columns WHERE table_name='family_competitions' AND column_name='{col_name}';")
-                    if current_type_info and current_type_info['data_type'] == 'timestamp without time zone':
-                        await conn.execute(f"ALTER TABLE family_competitions ALTER COLUMN {col_name} TYPE TIMESTAMP WITH TIME ZONE USING {col_name} AT TIME ZONE 'UTC';")
-                        logger.info(f"ИЗМЕНЕНО: Колонка 'family_competitions.{col_name}' конвертирована в TIMESTAMP WITH TIME ZONE.")
-                else:
-                    logger.warning(f"Колонка '{col_name}' не найдена в 'family_competitions' после попыток добавления/переименования. Проверка типа пропущена.")
 
-        await ensure_fc_column_and_type('start_ts', 'TIMESTAMP WITH TIME ZONE', 'TIMESTAMP WITH TIME ZONE')
-        await ensure_fc_column_and_type('end_ts', 'TIMESTAMP WITH TIME ZONE', 'TIMESTAMP WITH TIME ZONE')
-        await ensure_fc_column_and_type('is_active', 'BOOLEAN', 'BOOLEAN DEFAULT FALSE')
-        await ensure_fc_column_and_type('winner_family_id', 'INTEGER', 'INTEGER NULL REFERENCES families(family_id) ON DELETE SET NULL')
-        await ensure_fc_column_and_type('started_by_admin_id', 'BIGINT', 'BIGINT')
-        await ensure_fc_column_and_type('rewards_distributed', 'BOOLEAN', 'BOOLEAN DEFAULT FALSE')
+@asynccontextmanager
+async def request_connection_scope(use_transaction: bool = False):
+    """
+    Привязывает одно соединение (и, опционально, одну транзакцию) к текущему апдейту.
+    Все вызовы get_connection() внутри блока в той же задаче получают это соединение,
+    поэтому функции database.* без conn_ext больше не открывают свои.
+
+    Следствия для кода внутри блока:
+    - запись без conn_ext попадает в открытую транзакцию вызывающего (conn.transaction() или
+      общая транзакция апдейта) и откатывается вместе с ней, а не коммитится сама;
+    - соединение занято до конца апдейта, включая запросы к Telegram и ожидание блокировок.
+    Побочные эффекты, которые должны закоммититься независимо (outbox, журналы), берут
+    отдельное соединение через get_standalone_connection().
+    """
+    scope = _RequestConnectionScope(use_transaction)
+    token = _request_scope.set(scope)
+    failed = False
+    try:
+        yield scope
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        _request_scope.reset(token)
+        await scope.finish(failed)
 
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS family_competition_scores (
-                score_entry_id SERIAL PRIMARY KEY,
-                competition_id INTEGER NOT NULL REFERENCES family_competitions(competition_id) ON DELETE CASCADE,
-                family_id INTEGER NOT NULL REFERENCES families(family_id) ON DELETE CASCADE,
-                total_score NUMERIC(10, 1) DEFAULT 0.0,
-                UNIQUE (competition_id, family_id)
-            )
-        """)
-        logger.info("Таблица 'family_competition_scores' проверена/создана.")
-        await conn.execute("ALTER TABLE family_competition_scores ADD COLUMN IF NOT EXISTS total_score NUMERIC(10,1) DEFAULT 0.0;")
 
+async def get_connection() -> asyncpg.Connection:
+    scope = _request_scope.get()
+    if scope is not None and not scope.closed and scope.owner_task is asyncio.current_task():
+        return await scope.borrow()  # type: ignore[return-value]
+    return await _open_connection()
 
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS family_competition_daily_contributions (
-                contribution_id SERIAL PRIMARY KEY,
-                competition_id INTEGER NOT NULL REFERENCES family_competitions(competition_id) ON DELETE CASCADE,
-                family_id INTEGER NOT NULL REFERENCES families(family_id) ON DELETE CASCADE,
-                user_id BIGINT NOT NULL,
-                contribution_date DATE NOT NULL,
-                max_oneui_version_today NUMERIC(10, 1) NOT NULL,
-                UNIQUE (competition_id, family_id, user_id, contribution_date)
-            )
-        """)
-        logger.info("Таблица 'family_competition_daily_contributions' проверена/создана.")
 
-        # --- Таблицы для бонусных систем ---
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS system_settings (
-                setting_key TEXT PRIMARY KEY,
-                setting_value_text TEXT,
-                setting_value_timestamp TIMESTAMP WITH TIME ZONE,
-                setting_value_int INTEGER,
-                setting_value_bool BOOLEAN
-            )
-        """)
-        logger.info("Таблица 'system_settings' проверена/создана.")
+async def get_standalone_connection() -> asyncpg.Connection:
+    """
+    Всегда отдельное соединение из пула, даже внутри request_connection_scope:
+    его запросы не входят в транзакцию апдейта и коммитятся сразу. Закрывать через close().
+    """
+    return await _open_connection()
 
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS user_daily_streaks (
-                user_id BIGINT NOT NULL,
-                chat_id BIGINT NOT NULL, -- << НОВОЕ ПОЛЕ
-                current_streak INTEGER DEFAULT 0 NOT NULL,
-                last_streak_check_date DATE,
-                last_streak_timestamp_utc TIMESTAMP WITH TIME ZONE,
-                username_at_last_check TEXT,
-                full_name_at_last_check TEXT,
-                chat_title_at_last_check TEXT,
-                PRIMARY KEY (user_id, chat_id) -- << ИЗМЕНЕННЫЙ КЛЮЧ
-            );
-        """)
-        logger.info("Таблица 'user_daily_streaks' проверена/создана (с chat_id и составным ключом).")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_daily_streaks_last_date ON user_daily_streaks (last_streak_check_date);")
-
-        # === ТАБЛИЦА ДЛЯ РУЛЕТКИ (ROULETTE_STATUS) ===
-        # ИЗМЕНЕНО: Добавлено поле extra_roulette_spins
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS roulette_status (
-                user_id BIGINT NOT NULL,
-                chat_id BIGINT NOT NULL,
-                last_roulette_spin_timestamp TIMESTAMP WITH TIME ZONE,
-                extra_bonus_attempts INTEGER DEFAULT 0 NOT NULL,
-                extra_oneui_attempts INTEGER DEFAULT 0 NOT NULL,
-                pending_bonus_multiplier_boost NUMERIC(3,1),
-                negative_change_protection_charges INTEGER DEFAULT 0 NOT NULL,
-                extra_roulette_spins INTEGER DEFAULT 0 NOT NULL, -- <<<< НОВОЕ ПОЛЕ ДОБАВЛЕНО ЗДЕСЬ
-                PRIMARY KEY (user_id, chat_id),
-                FOREIGN KEY (user_id, chat_id) REFERENCES user_oneui (user_id, chat_id) ON DELETE CASCADE
-            )
-        """)
-        logger.info("Таблица 'roulette_status' проверена/создана (с полем extra_roulette_spins).")
-        
-        # Команда для добавления колонки, если таблица уже существовала без нее:
-        try:
-            await conn.execute("ALTER TABLE roulette_status ADD COLUMN IF NOT EXISTS extra_roulette_spins INTEGER DEFAULT 0 NOT NULL;")
-            logger.info("Колонка 'extra_roulette_spins' проверена/добавлена в 'roulette_status'.")
-        except Exception as e_alter_rs:
-            logger.warning(f"Не удалось добавить/проверить колонку 'extra_roulette_spins' в 'roulette_status' через ALTER: {e_alter_rs}")
-        # === КОНЕЦ ТАБЛИЦЫ ДЛЯ РУЛЕТКИ ===
-        
-        # <<< НАЧАЛО ВСТАВКИ ДЛЯ ИНФЛЯЦИИ В INIT_DB >>>
-        logger.info("DB Init: Проверка/установка начального множителя инфляции...")
-        # Используем conn, который уже открыт для init_db
-        current_inflation_multiplier_from_db = await get_setting_float(
-            Config.INFLATION_SETTING_KEY,
-            conn_ext=conn # Передаем существующее соединение
-        )
-
-        if current_inflation_multiplier_from_db is None:
-            # Если значение не найдено в БД (даже после попытки получить default из get_setting_float,
-            # что означает, что самого ключа нет), устанавливаем значение из Config.
-            await set_setting_float(
-                Config.INFLATION_SETTING_KEY,
-                Config.DEFAULT_INFLATION_MULTIPLIER,
-                conn_ext=conn # Передаем существующее соединение
-            )
-            logger.info(f"DB Init: Установлен начальный множитель инфляции (ключ: '{Config.INFLATION_SETTING_KEY}') в БД: {Config.DEFAULT_INFLATION_MULTIPLIER}")
-        else:
-            logger.info(f"DB Init: Текущий множитель инфляции (ключ: '{Config.INFLATION_SETTING_KEY}') из БД: {current_inflation_multiplier_from_db}")
-        # <<< КОНЕЦ ВСТАВКИ ДЛЯ ИНФЛЯЦИИ В INIT_DB >>>
-        
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS user_black_market_monthly_stats (
-                user_id BIGINT NOT NULL,
-                year_month TEXT NOT NULL, -- Формат "YYYY-MM"
-                phones_purchased_count INTEGER DEFAULT 0 NOT NULL,
-                PRIMARY KEY (user_id, year_month)
-            )
-        """)         
-        logger.info("Таблица 'user_black_market_monthly_stats' проверена/создана.")
-        
-        
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS user_daily_onecoin_claims (
-                user_id BIGINT NOT NULL,
-                chat_id BIGINT NOT NULL,
-                last_claim_utc TIMESTAMP WITH TIME ZONE DEFAULT NULL,
-                PRIMARY KEY (user_id, chat_id),
-                CONSTRAINT fk_user_oneui_onecoin_claim
-                FOREIGN KEY (user_id, chat_id)
-                REFERENCES user_oneui (user_id, chat_id)
-                ON DELETE CASCADE
-            )
-        """)
-        logger.info("Таблица 'user_daily_onecoin_claims' проверена/создана.")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_daily_onecoin_claims_user_chat ON user_daily_onecoin_claims (user_id, chat_id);")
 
+async def _open_connection() -> asyncpg.Connection:
+    if not DATABASE_URL:
+        logger.critical("DATABASE_URL environment variable not set.")
+        raise ValueError("DATABASE_URL environment variable not set.")
+    try:
+        if _pool is not None:
+            raw_conn = await _pool.acquire(timeout=Config.DB_POOL_ACQUIRE_TIMEOUT)
+            return PooledConnection(_pool, raw_conn)  # type: ignore[return-value]
+        # Пул еще не создан (скрипты, ранний старт) - работаем отдельным соединением
+        return await asyncpg.connect(DATABASE_URL, statement_cache_size=0)
+    except Exception as e:
+        logger.critical(f"Failed to connect to database: {e}", exc_info=True)
+        raise
 
-        logger.info("Индексы для 'user_daily_onecoin_claims' проверены/созданы.")
-        
-        
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS user_black_market_slots (
-                user_id BIGINT NOT NULL,
-                slot_number INTEGER NOT NULL, -- 1, 2, ..., Config.BLACKMARKET_TOTAL_SLOTS
-                item_key TEXT NOT NULL,
-                item_type TEXT NOT NULL,
-                display_name_override TEXT,
-                current_price INTEGER NOT NULL,
-                original_price_before_bm INTEGER NOT NULL,
-                is_stolen BOOLEAN DEFAULT FALSE NOT NULL,
-                is_exclusive BOOLEAN DEFAULT FALSE NOT NULL,
-                quantity_available INTEGER DEFAULT 1 NOT NULL,
-                wear_data JSONB,
-                custom_data JSONB,
-                generated_at_utc TIMESTAMP WITH TIME ZONE NOT NULL,
-                is_purchased BOOLEAN DEFAULT FALSE NOT NULL,
-                PRIMARY KEY (user_id, slot_number)
-            )
-        """)
-        logger.info("Таблица 'user_black_market_slots' проверена/создана.")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_bm_slots_user_generated_at ON user_black_market_slots (user_id, generated_at_utc)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_bm_slots_user_purchased ON user_black_market_slots (user_id, slot_number, is_purchased)")
-        
-        
-        logger.info("Все таблицы проверены/созданы и при необходимости изменены.")
+async def _seed_inflation_multiplier(conn: asyncpg.Connection) -> None:
+    """
+    Начальный множитель инфляции из Config.DEFAULT_INFLATION_MULTIPLIER, если ключа еще нет.
+    Значение не зашито в SQL миграции: от него зависела бы контрольная сумма.
+    """
+    status = await conn.execute("""
+        INSERT INTO system_settings (setting_key, setting_value_text)
+        VALUES ($1, $2)
+        ON CONFLICT (setting_key) DO NOTHING
+        """, Config.INFLATION_SETTING_KEY, f"{Config.DEFAULT_INFLATION_MULTIPLIER:.4f}"
+    )
+    if status.endswith(" 1"):
+        logger.info(f"DB Init: Установлен начальный множитель инфляции (ключ: '{Config.INFLATION_SETTING_KEY}') в БД: {Config.DEFAULT_INFLATION_MULTIPLIER}")
 
+async def init_db():
+    """
+    Применяет недостающие миграции схемы (см. пакет migrations).
+    Если схема актуальна - это один SELECT из schema_migrations.
+    """
+    conn = await get_connection()
+    try:
+        applied = await migrations.apply_migrations(conn)
+        if applied:
+            logger.info(f"DB Init: Применено миграций: {len(applied)} (последняя: {applied[-1].version:04d}_{applied[-1].name}).")
+            await _seed_inflation_multiplier(conn)
+        else:
+            logger.info("DB Init: Схема БД актуальна, миграции не требуются.")
     except Exception as e:
         logger.critical(f"КРИТИЧЕСКАЯ ОШИБКА во время init_db: {e}", exc_info=True)
         # Можно перевыбросить ошибку, если это критично для запуска бота
@@ -582,7 +331,7 @@ async def init_db():
     finally:
         if conn and not conn.is_closed():
             await conn.close()
-            
+
 async def get_all_user_activity_chats(user_id: int, conn_ext: Optional[asyncpg.Connection] = None) -> List[int]:
     """
     Получает список ID всех чатов, где у пользователя есть какая-либо запись в user_oneui.
@@ -600,6 +349,29 @@ async def get_all_user_activity_chats(user_id: int, conn_ext: Optional[asyncpg.C
             await conn.close()            
             
             
+async def get_user_activity_chat_titles(user_id: int, conn_ext: Optional[asyncpg.Connection] = None) -> Dict[int, Optional[str]]:
+    """
+    Как get_all_user_activity_chats, но вместе с последним известным названием чата:
+    user_oneui.chat_title из самой свежей по last_used записи чата.
+    """
+    conn = conn_ext if conn_ext else await get_connection()
+    try:
+        rows = await conn.fetch("""
+            SELECT DISTINCT ON (chat_id) chat_id, chat_title
+            FROM user_oneui
+            WHERE user_id = $1
+            ORDER BY chat_id, last_used DESC NULLS LAST
+            """, user_id
+        )
+        return {row['chat_id']: row['chat_title'] for row in rows}
+    except Exception as e:
+        logger.error(f"DB: Ошибка получения активных чатов с названиями для user {user_id}: {e}", exc_info=True)
+        return {}
+    finally:
+        if not conn_ext and conn and not conn.is_closed():
+            await conn.close()
+
+
 async def get_user_bm_monthly_purchases(user_id: int, year_month: str, conn_ext: Optional[asyncpg.Connection] = None) -> int:
     """Возвращает phones_purchased_count для пользователя за указанный year_month. Если записи нет, возвращает 0."""
     conn = conn_ext if conn_ext else await get_connection()
@@ -912,6 +684,9 @@ async def add_pending_phone_prize(
             """,
             user_id, phone_model_key, color, initial_memory_gb, prize_won_at_utc, original_roulette_chat_id
         )
+        if prize_id:
+            deadlines.schedule(deadlines.KIND_PHONE_PRIZE, user_id,
+                               prize_won_at_utc + timedelta(seconds=Config.MARKET_PHONE_CONFIRMATION_TIMEOUT_SECONDS))
         return prize_id
     except Exception as e:
         logger.error(f"DB: Ошибка при добавлении pending phone prize для user {user_id}, model {phone_model_key}: {e}", exc_info=True)
@@ -955,6 +730,7 @@ async def remove_pending_phone_prize(user_id: int, conn_ext: Optional[asyncpg.Co
             "DELETE FROM user_pending_phone_prizes WHERE user_id = $1",
             user_id
         )
+        deadlines.cancel(deadlines.KIND_PHONE_PRIZE, user_id)
         return result == "DELETE 1"
     except Exception as e:
         logger.error(f"DB: Ошибка при удалении pending phone prize для user {user_id}: {e}", exc_info=True)
@@ -992,79 +768,6 @@ async def get_expired_pending_phone_prizes(expiry_time_ago_td: timedelta, conn_e
             await conn_to_use.close()
 
 
-async def _add_column_if_not_exists(conn: asyncpg.Connection, table_name: str, column_name: str, column_definition: str):
-    """Вспомогательная функция для добавления колонки, если она не существует."""
-    exists = await conn.fetchval(
-        "SELECT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name = $1 AND column_name = $2)",
-        table_name, column_name
-    )
-    if not exists:
-        try:
-            await conn.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_definition}")
-            logger.info(f"Добавлена колонка '{column_name}' в таблицу '{table_name}'.")
-        except Exception as e:
-            logger.error(f"Не удалось добавить колонку '{column_name}' в таблицу '{table_name}': {e}")
-    # else:
-    # logger.debug(f"Колонка '{column_name}' уже существует в таблице '{table_name}'.")
-
-
-async def add_onecoins_column(conn_ext: Optional[asyncpg.Connection] = None):
-    conn = conn_ext if conn_ext else await get_connection()
-    try:
-        await _add_column_if_not_exists(conn, "user_oneui", "onecoins", "INTEGER DEFAULT 0 NOT NULL")
-    finally:
-        if not conn_ext and conn and not conn.is_closed(): await conn.close()
-
-async def add_telegram_chat_link_column(conn_ext: Optional[asyncpg.Connection] = None):
-    conn = conn_ext if conn_ext else await get_connection()
-    try:
-        await _add_column_if_not_exists(conn, "user_oneui", "telegram_chat_link", "TEXT DEFAULT NULL")
-    finally:
-        if not conn_ext and conn and not conn.is_closed(): await conn.close()
-
-async def add_username_column(conn_ext: Optional[asyncpg.Connection] = None):
-    conn = conn_ext if conn_ext else await get_connection()
-    try:
-        await _add_column_if_not_exists(conn, "user_oneui", "username", "TEXT")
-    finally:
-        if not conn_ext and conn and not conn.is_closed(): await conn.close()
-
-async def add_full_name_column(conn_ext: Optional[asyncpg.Connection] = None):
-    conn = conn_ext if conn_ext else await get_connection()
-    try:
-        await _add_column_if_not_exists(conn, "user_oneui", "full_name", "TEXT")
-    finally:
-        if not conn_ext and conn and not conn.is_closed(): await conn.close()
-
-async def add_chat_title_column(conn_ext: Optional[asyncpg.Connection] = None):
-    conn = conn_ext if conn_ext else await get_connection()
-    try:
-        await _add_column_if_not_exists(conn, "user_oneui", "chat_title", "TEXT")
-    finally:
-        if not conn_ext and conn and not conn.is_closed(): await conn.close()
-
-async def add_version_column(conn_ext: Optional[asyncpg.Connection] = None):
-    conn = conn_ext if conn_ext else await get_connection()
-    try:
-        await _add_column_if_not_exists(conn, "user_oneui", "version", "NUMERIC(10, 1) DEFAULT 0.0")
-    finally:
-        if not conn_ext and conn and not conn.is_closed(): await conn.close()
-
-async def add_last_used_column(conn_ext: Optional[asyncpg.Connection] = None):
-    conn = conn_ext if conn_ext else await get_connection()
-    try:
-        col_info = await conn.fetchrow("SELECT data_type FROM information_schema.columns WHERE table_name='user_oneui' AND column_name='last_used';")
-        if col_info:
-            if col_info['data_type'] == 'timestamp without time zone':
-                await conn.execute("ALTER TABLE user_oneui ALTER COLUMN last_used TYPE TIMESTAMP WITH TIME ZONE USING last_used AT TIME ZONE 'UTC';")
-                logger.info("ИЗМЕНЕНО (в add_last_used_column): 'user_oneui.last_used' конвертирована в TIMESTAMP WITH TIME ZONE.")
-        else: # Если колонки нет, создаем ее с нужным типом
-            await _add_column_if_not_exists(conn, "user_oneui", "last_used", "TIMESTAMP WITH TIME ZONE DEFAULT NULL")
-            logger.info("НОВОЕ/ИЗМЕНЕНО (в add_last_used_column): Добавлена/проверена колонка 'last_used' TIMESTAMP WITH TIME ZONE.")
-    finally:
-        if not conn_ext and conn and not conn.is_closed(): await conn.close()
-
-
 async def get_user_version(user_id: int, chat_id: int) -> float:
     MAX_RETRIES = 2
     last_exception = None
@@ -1107,7 +810,7 @@ async def get_user_robbank_status(user_id: int, chat_id: int, conn_ext: Optional
         if row:
             data = dict(row)
             # Преобразование timestamp в aware datetime
-            for ts_key in ['last_robbank_attempt_utc', 'robbank_oneui_blocked_until_utc', 'current_operation_start_utc']:
+            for ts_key in ['last_robbank_attempt_utc', 'robbank_oneui_blocked_until_utc', 'current_operation_start_utc', 'current_operation_due_utc']:
                 if data.get(ts_key) and isinstance(data[ts_key], datetime):
                     ts_val = data[ts_key]
                     # Если время naive, делаем его aware UTC, иначе приводим к UTC
@@ -1129,6 +832,8 @@ async def update_user_robbank_status(
     current_operation_name: Optional[str] = ..., # Используем ... как маркер "не передано"
     current_operation_start_utc: Optional[datetime] = ...,
     current_operation_base_reward: Optional[int] = ...,
+    current_operation_due_utc: Optional[datetime] = ...,
+    current_operation_thread_id: Optional[int] = ...,
     conn_ext: Optional[asyncpg.Connection] = None
 ):
     conn = conn_ext if conn_ext else await get_connection()
@@ -1141,7 +846,9 @@ async def update_user_robbank_status(
                 'robbank_oneui_blocked_until_utc': None,
                 'current_operation_name': None,
                 'current_operation_start_utc': None,
-                'current_operation_base_reward': None
+                'current_operation_base_reward': None,
+                'current_operation_due_utc': None,
+                'current_operation_thread_id': None
             }
 
         # Определяем значения для SQL-запроса
@@ -1154,28 +861,41 @@ async def update_user_robbank_status(
         val_op_name = current_operation_name if current_operation_name is not ... else current_status.get('current_operation_name')
         val_op_start = current_operation_start_utc if current_operation_start_utc is not ... else current_status.get('current_operation_start_utc')
         val_op_reward = current_operation_base_reward if current_operation_base_reward is not ... else current_status.get('current_operation_base_reward')
+        val_op_due = current_operation_due_utc if current_operation_due_utc is not ... else current_status.get('current_operation_due_utc')
+        val_op_thread = current_operation_thread_id if current_operation_thread_id is not ... else current_status.get('current_operation_thread_id')
+        if val_op_start is None: # Операция очищена - вместе с ней и ее срок
+            val_op_due = None
+            val_op_thread = None
 
         # Преобразуем в aware UTC, если не None
         if val_last_attempt and val_last_attempt.tzinfo is None: val_last_attempt = val_last_attempt.replace(tzinfo=dt_timezone.utc)
         if val_blocked_until and val_blocked_until.tzinfo is None: val_blocked_until = val_blocked_until.replace(tzinfo=dt_timezone.utc)
         if val_op_start and val_op_start.tzinfo is None: val_op_start = val_op_start.replace(tzinfo=dt_timezone.utc)
+        if val_op_due and val_op_due.tzinfo is None: val_op_due = val_op_due.replace(tzinfo=dt_timezone.utc)
 
         await conn.execute(
             """
             INSERT INTO user_robbank_status (
                 user_id, chat_id, last_robbank_attempt_utc, robbank_oneui_blocked_until_utc,
-                current_operation_name, current_operation_start_utc, current_operation_base_reward
-            ) VALUES ($1, $2, $3, $4, $5, $6, $7)
+                current_operation_name, current_operation_start_utc, current_operation_base_reward,
+                current_operation_due_utc, current_operation_thread_id
+            ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
             ON CONFLICT (user_id, chat_id) DO UPDATE SET
                 last_robbank_attempt_utc = EXCLUDED.last_robbank_attempt_utc,
                 robbank_oneui_blocked_until_utc = EXCLUDED.robbank_oneui_blocked_until_utc,
                 current_operation_name = EXCLUDED.current_operation_name,
                 current_operation_start_utc = EXCLUDED.current_operation_start_utc,
-                current_operation_base_reward = EXCLUDED.current_operation_base_reward;
+                current_operation_base_reward = EXCLUDED.current_operation_base_reward,
+                current_operation_due_utc = EXCLUDED.current_operation_due_utc,
+                current_operation_thread_id = EXCLUDED.current_operation_thread_id;
             """,
             user_id, chat_id, val_last_attempt, val_blocked_until,
-            val_op_name, val_op_start, val_op_reward
+            val_op_name, val_op_start, val_op_reward, val_op_due, val_op_thread
         )
+        if val_op_start is not None and val_op_due is not None:
+            deadlines.schedule(deadlines.KIND_ROBBANK, (user_id, chat_id), val_op_due)
+        else:
+            deadlines.cancel(deadlines.KIND_ROBBANK, (user_id, chat_id))
     except Exception as e:
         logger.error(f"DB: Ошибка обновления статуса ограбления для user {user_id}, chat {chat_id}: {e}", exc_info=True)
         # Можно перебросить исключение, если это критично для логики вызывающей функции
@@ -1216,6 +936,8 @@ async def update_user_version(user_id: int, chat_id: int, new_version: float,
     if timestamp_for_last_used_value and timestamp_for_last_used_value.tzinfo is None:
         timestamp_for_last_used_value = timestamp_for_last_used_value.replace(tzinfo=dt_timezone.utc)
 
+    db_username, db_full_name, db_chat_title = _identity_delta("user_oneui", user_id, chat_id, username, full_name, chat_title)
+
     try:
         # Базовые поля для INSERT
         insert_columns_list = [
@@ -1224,7 +946,7 @@ async def update_user_version(user_id: int, chat_id: int, new_version: float,
         ]
         # onecoins по умолчанию 0 для новой записи.
         insert_values_for_query_list = [
-            user_id, chat_id, username, full_name, chat_title,
+            user_id, chat_id, db_username, db_full_name, db_chat_title,
             rounded_version, 0, telegram_chat_link # onecoins = 0 по умолчанию
         ]
 
@@ -1255,14 +977,32 @@ async def update_user_version(user_id: int, chat_id: int, new_version: float,
 
         update_set_clause_str = ", ".join(update_set_parts)
 
+        # Не переписываем строку, если ни одно значение не меняется
+        changed_guard_new = [
+            "COALESCE(EXCLUDED.username, user_oneui.username)",
+            "COALESCE(EXCLUDED.full_name, user_oneui.full_name)",
+            "COALESCE(EXCLUDED.chat_title, user_oneui.chat_title)",
+            "EXCLUDED.version",
+            "COALESCE(EXCLUDED.telegram_chat_link, user_oneui.telegram_chat_link)"
+        ]
+        changed_guard_old = [
+            "user_oneui.username", "user_oneui.full_name", "user_oneui.chat_title",
+            "user_oneui.version", "user_oneui.telegram_chat_link"
+        ]
+        if timestamp_for_last_used_value:
+            changed_guard_new.append("EXCLUDED.last_used")
+            changed_guard_old.append("user_oneui.last_used")
+
         query = f"""
             INSERT INTO user_oneui ({insert_columns_str})
             VALUES ({insert_placeholders_str})
             ON CONFLICT (user_id, chat_id) DO UPDATE SET
-                {update_set_clause_str};
+                {update_set_clause_str}
+            WHERE ({", ".join(changed_guard_new)}) IS DISTINCT FROM ({", ".join(changed_guard_old)});
         """
 
         await conn_to_use.execute(query, *insert_values_for_query_list)
+        _remember_identity(conn_to_use, "user_oneui", user_id, chat_id, username, full_name, chat_title)
 
         # --- Логика записи в историю ---
         # Время для записи в историю:
@@ -1291,6 +1031,96 @@ async def update_user_version(user_id: int, chat_id: int, new_version: float,
         if not conn_ext and conn_to_use and not conn_to_use.is_closed():
             await conn_to_use.close()
             
+def get_oneui_reset_bounds(now_utc: datetime) -> Tuple[datetime, datetime]:
+    """
+    Возвращает (последний фактический сброс, следующий сброс) кулдауна /oneui в UTC.
+    Сброс происходит ежедневно в Config.RESET_HOUR по Config.TIMEZONE.
+    """
+    target_tz = pytz_timezone(Config.TIMEZONE)
+    now_target_tz = now_utc.astimezone(target_tz)
+
+    # Время сброса СЕГОДНЯ по местному времени
+    reset_time_today_local = now_target_tz.replace(hour=Config.RESET_HOUR, minute=0, second=0, microsecond=0)
+
+    # Если текущее время МЕНЬШЕ чем время сброса сегодня, значит последний сброс был ВЧЕРА в это же время
+    if now_target_tz < reset_time_today_local:
+        last_actual_reset_local = reset_time_today_local - timedelta(days=1)
+        next_reset_local = reset_time_today_local
+    else: # Иначе, последний сброс был СЕГОДНЯ
+        last_actual_reset_local = reset_time_today_local
+        next_reset_local = reset_time_today_local + timedelta(days=1)
+
+    return last_actual_reset_local.astimezone(dt_timezone.utc), next_reset_local.astimezone(dt_timezone.utc)
+
+
+_ONEUI_STREAK_GOALS_JSON = json.dumps([
+    {
+        "target_days": goal["target_days"],
+        "version_reward": goal.get("version_reward", 0.0),
+        "onecoin_reward": goal.get("onecoin_reward", 0),
+    }
+    for goal in Config.DAILY_STREAKS_CONFIG
+])
+_ONEUI_STREAK_COMPENSATION_JSON = json.dumps([
+    {
+        "min_streak_days_before_break": tier["min_streak_days_before_break"],
+        "version_bonus": tier["version_bonus"],
+        "onecoin_bonus": tier["onecoin_bonus"],
+    }
+    for tier in Config.PROGRESSIVE_STREAK_BREAK_COMPENSATION
+])
+
+
+async def apply_oneui_roll(
+    user_id: int,
+    chat_id: int,
+    base_change: float,
+    case_bonus_percent: float,
+    now_utc: datetime,
+    streak_date: DDate,
+    username: Optional[str],
+    full_name: Optional[str],
+    chat_title: Optional[str],
+    telegram_chat_link: Optional[str] = None,
+    conn_ext: Optional[asyncpg.Connection] = None
+) -> Dict[str, Any]:
+    """
+    Выполняет /oneui за один запрос (функция oneui_roll, миграция 0003): обновляет стрик,
+    проверяет блокировку ограблением, доп. попытки и кулдаун, применяет защиту, бонус-множитель,
+    бонус чехла и награды за стрик, записывает версию, историю и монеты.
+    status в ответе: 'ok', 'blocked' или 'cooldown'. Исключения пробрасываются.
+    """
+    last_reset_utc, next_reset_utc = get_oneui_reset_bounds(now_utc)
+    conn = conn_ext if conn_ext else await get_connection()
+    try:
+        row = await conn.fetchrow(
+            """
+            SELECT * FROM oneui_roll($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12::jsonb, $13::jsonb, $14, $15)
+            """,
+            user_id, chat_id, username, full_name, chat_title, telegram_chat_link,
+            now_utc, streak_date, last_reset_utc,
+            Decimal(str(base_change)), Decimal(str(case_bonus_percent)),
+            _ONEUI_STREAK_GOALS_JSON, _ONEUI_STREAK_COMPENSATION_JSON,
+            Decimal(str(Config.DEFAULT_STREAK_BREAK_COMPENSATION_VERSION)), Config.DEFAULT_STREAK_BREAK_COMPENSATION_ONECOIN
+        )
+        # oneui_roll сам пишет имена в user_oneui - запомненные значения больше не достоверны
+        _persisted_identity.discard(("user_oneui", user_id, chat_id))
+        result = dict(row)
+        for key in ("comp_version", "goal_version", "bonus_multiplier", "bonus_multiplier_base", "bonus_boost",
+                    "change_after_protection", "effective_change", "case_bonus_value", "final_change",
+                    "old_version", "new_version"):
+            if result.get(key) is not None:
+                result[key] = float(result[key])
+        blocked_until = result.get("blocked_until")
+        if blocked_until is not None and blocked_until.tzinfo is None:
+            result["blocked_until"] = blocked_until.replace(tzinfo=dt_timezone.utc)
+        result["next_reset_utc"] = next_reset_utc
+        return result
+    finally:
+        if not conn_ext and conn and not conn.is_closed():
+            await conn.close()
+
+
 async def check_cooldown(user_id: int, chat_id: int) -> Tuple[bool, Optional[datetime]]:
     conn = await get_connection()
     try:
@@ -1307,30 +1137,13 @@ async def check_cooldown(user_id: int, chat_id: int) -> Tuple[bool, Optional[dat
         # Гарантируем aware datetime
         last_used_utc = last_used_utc_db.astimezone(dt_timezone.utc) if last_used_utc_db.tzinfo else last_used_utc_db.replace(tzinfo=dt_timezone.utc)
 
-        target_tz = pytz_timezone(Config.TIMEZONE)
-        reset_hour_local = Config.RESET_HOUR
-
-        now_utc = datetime.now(dt_timezone.utc)
-        now_target_tz = now_utc.astimezone(target_tz)
-
-        # Время сброса СЕГОДНЯ по местному времени
-        reset_time_today_local = now_target_tz.replace(hour=reset_hour_local, minute=0, second=0, microsecond=0)
-
-        # Определяем, какой был ПОСЛЕДНИЙ ФАКТИЧЕСКИЙ сброс
-        # Если текущее время МЕНЬШЕ чем время сброса сегодня, значит последний сброс был ВЧЕРА в это же время
-        if now_target_tz < reset_time_today_local:
-            last_actual_reset_local = reset_time_today_local - timedelta(days=1)
-        else: # Иначе, последний сброс был СЕГОДНЯ
-            last_actual_reset_local = reset_time_today_local
-
-        last_actual_reset_utc = last_actual_reset_local.astimezone(dt_timezone.utc) # Конвертируем в UTC для сравнения
+        last_actual_reset_utc, next_reset_utc = get_oneui_reset_bounds(datetime.now(dt_timezone.utc))
 
         on_cooldown = last_used_utc > last_actual_reset_utc
 
         if on_cooldown:
             # Если на кулдауне, сообщаем, когда будет СЛЕДУЮЩИЙ сброс
-            next_reset_local = reset_time_today_local if now_target_tz < reset_time_today_local else reset_time_today_local + timedelta(days=1)
-            return True, next_reset_local.astimezone(dt_timezone.utc) # Возвращаем следующий сброс в UTC
+            return True, next_reset_utc
         else:
             return False, None
     except Exception as e:
@@ -1720,12 +1533,9 @@ async def get_family_members(family_id: int, active_only: bool = True) -> List[D
                 fm.user_id,
                 fm.full_name_when_joined,
                 fm.joined_at,
-                (SELECT uo.username
-                 FROM user_oneui uo
-                 WHERE uo.user_id = fm.user_id
-                 ORDER BY uo.last_used DESC NULLS LAST -- Берем самый свежий username
-                 LIMIT 1) as username
+                u.username
             FROM family_members fm
+            LEFT JOIN users u ON u.user_id = fm.user_id
             WHERE fm.family_id = $1
         """
         params: List[Any] = [family_id]
@@ -1750,9 +1560,11 @@ async def get_top_families_by_total_contribution(limit: int = 10) -> List[Dict[s
         query = """
             SELECT
                 f.family_id, f.name, f.leader_id,
-                (SELECT uo.full_name FROM user_oneui uo WHERE uo.user_id = f.leader_id ORDER BY uo.last_used DESC NULLS LAST LIMIT 1) as leader_full_name,
+                u.full_name as leader_full_name,
+                u.username as leader_username,
                 (SELECT COUNT(*) FROM family_members fm_count WHERE fm_count.family_id = f.family_id AND fm_count.is_active = TRUE) as member_count
             FROM families f
+            LEFT JOIN users u ON u.user_id = f.leader_id
             ORDER BY member_count DESC, f.name ASC
             LIMIT $1;
         """
@@ -1772,74 +1584,138 @@ async def get_family_logs(family_id: int, limit: int = 15) -> List[Dict[str, Any
     finally:
         if conn and not conn.is_closed(): await conn.close()
 
-async def get_user_onecoins(user_id: int, chat_id: int, conn_ext: Optional[asyncpg.Connection] = None) -> int:
-    # Используем переданное соединение, если оно есть, иначе получаем новое
-    conn_to_use = conn_ext if conn_ext else await get_connection()
-    conn_was_none = conn_ext is None # Флаг, чтобы знать, нужно ли закрывать соединение в finally
+async def upsert_user_identity(user_id: int, username: Optional[str], full_name: Optional[str],
+                               conn_ext: Optional[asyncpg.Connection] = None) -> None:
+    """
+    Записывает актуальные имя и username пользователя в users.
+    Если значения совпадают с последними записанными в этом процессе - запроса к БД нет.
+    """
+    key = ("users", user_id, 0)
+    identity = (username, full_name, None)
+    if _persisted_identity.get(key) == identity:
+        return
+    conn = conn_ext if conn_ext else await get_connection()
+    try:
+        await conn.execute("""
+            INSERT INTO users (user_id, full_name, username, updated_at)
+            VALUES ($1, $2, $3, $4)
+            ON CONFLICT (user_id) DO UPDATE SET
+                full_name = COALESCE(EXCLUDED.full_name, users.full_name),
+                username = EXCLUDED.username,
+                updated_at = EXCLUDED.updated_at
+            WHERE (COALESCE(EXCLUDED.full_name, users.full_name), EXCLUDED.username)
+                  IS DISTINCT FROM (users.full_name, users.username)
+        """, user_id, full_name, username, datetime.now(dt_timezone.utc))
+        if conn.is_in_transaction():
+            _persisted_identity.discard(key)
+        else:
+            _persisted_identity.put(key, identity)
+    finally:
+        if not conn_ext and conn and not conn.is_closed():
+            await conn.close()
 
+async def get_user_identity(user_id: int, conn_ext: Optional[asyncpg.Connection] = None) -> Optional[Dict[str, Any]]:
+    """Возвращает {'user_id', 'full_name', 'username'} из users или None."""
+    conn = conn_ext if conn_ext else await get_connection()
     try:
-        # Убедимся, что запись пользователя существует.
-        # Если запись не существует, создаем минимальную, чтобы избежать ошибок.
-        # Вставляем только user_id и chat_id при первом создании, остальные поля возьмут DEFAULT.
-        await conn_to_use.execute("""
-            INSERT INTO user_oneui (user_id, chat_id)
-            VALUES ($1, $2)
-            ON CONFLICT (user_id, chat_id) DO NOTHING; -- DO NOTHING, чтобы не сбрасывать существующие данные
-        """, user_id, chat_id)
+        row = await conn.fetchrow("SELECT user_id, full_name, username FROM users WHERE user_id = $1", user_id)
+        return dict(row) if row else None
+    finally:
+        if not conn_ext and conn and not conn.is_closed():
+            await conn.close()
+
+async def get_user_identities(user_ids: List[int], conn_ext: Optional[asyncpg.Connection] = None) -> List[Dict[str, Any]]:
+    """Возвращает [{'user_id', 'full_name', 'username'}] из users для списка пользователей одним запросом."""
+    if not user_ids:
+        return []
+    conn = conn_ext if conn_ext else await get_connection()
+    try:
+        rows = await conn.fetch("SELECT user_id, full_name, username FROM users WHERE user_id = ANY($1::BIGINT[])", list(user_ids))
+        return [dict(row) for row in rows]
+    finally:
+        if not conn_ext and conn and not conn.is_closed():
+            await conn.close()
 
-        # Теперь безопасно получаем баланс
+async def find_user_by_username(username: str, conn_ext: Optional[asyncpg.Connection] = None) -> Optional[Dict[str, Any]]:
+    """Ищет пользователя по username без учета регистра (индекс idx_users_lower_username)."""
+    conn = conn_ext if conn_ext else await get_connection()
+    try:
+        row = await conn.fetchrow(
+            "SELECT user_id, full_name, username FROM users WHERE lower(username) = lower($1) ORDER BY updated_at DESC LIMIT 1",
+            username.lstrip('@')
+        )
+        return dict(row) if row else None
+    finally:
+        if not conn_ext and conn and not conn.is_closed():
+            await conn.close()
+
+async def ensure_user_row(user_id: int, chat_id: int,
+                          username: Optional[str] = None, full_name: Optional[str] = None,
+                          chat_title: Optional[str] = None, conn_ext: Optional[asyncpg.Connection] = None) -> None:
+    """
+    Создает минимальную запись user_oneui, если ее еще нет. Существующие данные не трогает.
+    Вызывается при первом контакте пользователя с чатом (KnownUsersMiddleware),
+    а не при каждом чтении баланса.
+    """
+    conn = conn_ext if conn_ext else await get_connection()
+    try:
+        await conn.execute("""
+            INSERT INTO user_oneui (user_id, chat_id, username, full_name, chat_title)
+            VALUES ($1, $2, $3, $4, $5)
+            ON CONFLICT (user_id, chat_id) DO NOTHING
+        """, user_id, chat_id, username, full_name, chat_title)
+    finally:
+        if not conn_ext and conn and not conn.is_closed():
+            await conn.close()
+
+async def get_user_onecoins(user_id: int, chat_id: int, conn_ext: Optional[asyncpg.Connection] = None) -> int:
+    # Только чтение: для отсутствующей записи возвращаем 0, запись создает ensure_user_row
+    conn_to_use = conn_ext if conn_ext else await get_connection()
+    try:
         balance = await conn_to_use.fetchval(
             "SELECT onecoins FROM user_oneui WHERE user_id = $1 AND chat_id = $2",
             user_id, chat_id
         )
-        return balance if balance is not None else 0 # Возвращаем 0, если onecoins почему-то NULL
+        return balance if balance is not None else 0
     except Exception as e:
         logger.error(f"DB: Error in get_user_onecoins for user {user_id}, chat {chat_id}: {e}", exc_info=True)
         return 0 # При любой ошибке возвращаем 0
     finally:
-        # Закрываем соединение только если оно было создано ВНУТРИ этой функции
-        if conn_was_none and conn_to_use and not conn_to_use.is_closed():
+        if not conn_ext and conn_to_use and not conn_to_use.is_closed():
             await conn_to_use.close()
 
 async def update_user_onecoins(user_id: int, chat_id: int, amount_change: int,
                                username: Optional[str] = None, full_name: Optional[str] = None,
                                chat_title: Optional[str] = None, conn_ext: Optional[asyncpg.Connection] = None) -> int:
+    """
+    Изменяет баланс OneCoin одним запросом: создает запись, если ее нет, иначе прибавляет amount_change
+    и обновляет username/full_name/chat_title (если переданы). Возвращает новый баланс.
+    """
     conn_to_use = conn_ext if conn_ext else await get_connection()
+    db_username, db_full_name, db_chat_title = _identity_delta("user_oneui", user_id, chat_id, username, full_name, chat_title)
     try:
-        # Сначала убедимся, что запись пользователя существует и содержит актуальные username, full_name, chat_title
-        # Этот INSERT ... ON CONFLICT обновит данные пользователя, если они изменились, но не затронет onecoins и version.
-        await conn_to_use.execute("""
+        new_balance = await conn_to_use.fetchval("""
             INSERT INTO user_oneui (user_id, chat_id, username, full_name, chat_title, version, onecoins, last_used)
-            VALUES (
-                $1, $2, $3, $4, $5,
-                COALESCE((SELECT version FROM user_oneui WHERE user_id = $1 AND chat_id = $2 LIMIT 1), 0.0), 
-                COALESCE((SELECT onecoins FROM user_oneui WHERE user_id = $1 AND chat_id = $2 LIMIT 1), 0), 
-                COALESCE((SELECT last_used FROM user_oneui WHERE user_id = $1 AND chat_id = $2 LIMIT 1), $6)
-            )
+            VALUES ($1, $2, $3, $4, $5, 0.0, $6, $7)
             ON CONFLICT (user_id, chat_id) DO UPDATE SET
+                onecoins = user_oneui.onecoins + EXCLUDED.onecoins,
                 username = COALESCE(EXCLUDED.username, user_oneui.username),
                 full_name = COALESCE(EXCLUDED.full_name, user_oneui.full_name),
-                chat_title = COALESCE(EXCLUDED.chat_title, user_oneui.chat_title);
-            """, user_id, chat_id, username, full_name, chat_title, datetime.now(dt_timezone.utc)
+                chat_title = COALESCE(EXCLUDED.chat_title, user_oneui.chat_title)
+            WHERE EXCLUDED.onecoins <> 0
+               OR (COALESCE(EXCLUDED.username, user_oneui.username),
+                   COALESCE(EXCLUDED.full_name, user_oneui.full_name),
+                   COALESCE(EXCLUDED.chat_title, user_oneui.chat_title))
+                  IS DISTINCT FROM (user_oneui.username, user_oneui.full_name, user_oneui.chat_title)
+            RETURNING onecoins
+            """, user_id, chat_id, db_username, db_full_name, db_chat_title, amount_change, datetime.now(dt_timezone.utc)
         )
-
-        # Теперь обновляем баланс OneCoin
-        new_balance_record = await conn_to_use.fetchrow("""
-            UPDATE user_oneui
-            SET onecoins = onecoins + $3
-            WHERE user_id = $1 AND chat_id = $2
-            RETURNING onecoins;
-            """, user_id, chat_id, amount_change
-        )
-
-        if new_balance_record and new_balance_record['onecoins'] is not None:
-            return new_balance_record['onecoins']
-        else: # Редкий случай, если RETURNING не сработал как ожидалось
-            current_balance = await conn_to_use.fetchval(
-                 "SELECT onecoins FROM user_oneui WHERE user_id = $1 AND chat_id = $2", user_id, chat_id
+        _remember_identity(conn_to_use, "user_oneui", user_id, chat_id, username, full_name, chat_title)
+        if new_balance is None: # Строка уже была и не изменилась - RETURNING пуст
+            new_balance = await conn_to_use.fetchval(
+                "SELECT onecoins FROM user_oneui WHERE user_id = $1 AND chat_id = $2", user_id, chat_id
             )
-            logger.warning(f"DB: update_user_onecoins for user {user_id} chat {chat_id} did not return balance from UPDATE. Fallback read: {current_balance}")
-            return current_balance if current_balance is not None else 0
+        return new_balance if new_balance is not None else 0
     except Exception as e:
         logger.error(f"DB: Error updating onecoins for user {user_id} chat {chat_id}: {e}", exc_info=True)
         try: # Попытка прочитать баланс даже после ошибки
@@ -1847,13 +1723,43 @@ async def update_user_onecoins(user_id: int, chat_id: int, amount_change: int,
                 "SELECT onecoins FROM user_oneui WHERE user_id = $1 AND chat_id = $2", user_id, chat_id
             )
             return current_balance_after_fail if current_balance_after_fail is not None else 0
-        except:
+        except Exception:
             logger.error(f"DB: Failed to read onecoins after update error for user {user_id} chat {chat_id}.")
             return 0 # Безопасное значение по умолчанию
     finally:
         if not conn_ext and conn_to_use and not conn_to_use.is_closed():
             await conn_to_use.close()
-            
+
+async def update_users_onecoins_batch(changes: List[Tuple[int, int, int]],
+                                      conn_ext: Optional[asyncpg.Connection] = None) -> Dict[Tuple[int, int], int]:
+    """
+    Пакетное изменение балансов для задач шедулера (награды за соревнования и т.п.).
+    changes - список (user_id, chat_id, amount_change); повторы одной пары суммируются.
+    Один запрос на весь пакет. Возвращает {(user_id, chat_id): новый баланс}.
+    В отличие от update_user_onecoins, ошибки не глушит - вызывающий код решает, откатывать ли транзакцию.
+    """
+    if not changes:
+        return {}
+    user_ids = [c[0] for c in changes]
+    chat_ids = [c[1] for c in changes]
+    deltas = [c[2] for c in changes]
+    conn = conn_ext if conn_ext else await get_connection()
+    try:
+        rows = await conn.fetch("""
+            INSERT INTO user_oneui (user_id, chat_id, version, onecoins)
+            SELECT d.user_id, d.chat_id, 0.0, SUM(d.delta)
+            FROM unnest($1::BIGINT[], $2::BIGINT[], $3::INTEGER[]) AS d(user_id, chat_id, delta)
+            GROUP BY d.user_id, d.chat_id
+            ON CONFLICT (user_id, chat_id) DO UPDATE SET
+                onecoins = user_oneui.onecoins + EXCLUDED.onecoins
+            RETURNING user_id, chat_id, onecoins
+            """, user_ids, chat_ids, deltas
+        )
+        return {(row['user_id'], row['chat_id']): row['onecoins'] for row in rows}
+    finally:
+        if not conn_ext and conn and not conn.is_closed():
+            await conn.close()
+
 async def update_user_total_business_income(user_id: int, amount_change: int, conn_ext: Optional[asyncpg.Connection] = None) -> int:
     """
     Увеличивает общий заработанный доход пользователя с бизнесов.
@@ -2220,18 +2126,77 @@ async def get_competitions_to_finalize() -> List[Dict[str, Any]]:
     finally:
         if conn and not conn.is_closed(): await conn.close()
 
+# --- Кэш system_settings (settings_cache.py): значение ключа - (setting_value_text, setting_value_timestamp) или None ---
+def _setting_row_value(row: Optional[asyncpg.Record]) -> Optional[Tuple[Optional[str], Optional[datetime]]]:
+    if row is None:
+        return None
+    ts_val = row['setting_value_timestamp']
+    if isinstance(ts_val, datetime):
+        ts_val = ts_val.replace(tzinfo=dt_timezone.utc) if ts_val.tzinfo is None else ts_val.astimezone(dt_timezone.utc)
+    return (row['setting_value_text'], ts_val)
+
+async def fetch_setting_row(key: str, conn_ext: Optional[asyncpg.Connection] = None) -> Optional[Tuple[Optional[str], Optional[datetime]]]:
+    """Строка настройки напрямую из БД, мимо кэша. Ошибки пробрасываются."""
+    conn = conn_ext if conn_ext else await get_connection()
+    try:
+        row = await conn.fetchrow(
+            "SELECT setting_value_text, setting_value_timestamp FROM system_settings WHERE setting_key = $1", key
+        )
+        return _setting_row_value(row)
+    finally:
+        if not conn_ext and conn and not conn.is_closed():
+            await conn.close()
+
+async def fetch_all_setting_rows(conn_ext: Optional[asyncpg.Connection] = None) -> List[Tuple[str, Optional[Tuple[Optional[str], Optional[datetime]]]]]:
+    """Все строки system_settings для прогрева кэша. Ошибки пробрасываются."""
+    conn = conn_ext if conn_ext else await get_connection()
+    try:
+        rows = await conn.fetch("SELECT setting_key, setting_value_text, setting_value_timestamp FROM system_settings")
+        return [(row['setting_key'], _setting_row_value(row)) for row in rows]
+    finally:
+        if not conn_ext and conn and not conn.is_closed():
+            await conn.close()
+
+async def _connect_settings_listener() -> asyncpg.Connection:
+    # Отдельное соединение вне пула: LISTEN держит его все время работы бота
+    return await asyncpg.connect(DATABASE_URL, statement_cache_size=0)
+
+# Загрузчики передаются через lambda: к моменту вызова fetch_* уже обернуты db_metrics
+settings_cache_instance = settings_cache.SettingsCache(
+    _connect_settings_listener,
+    load_all=lambda: fetch_all_setting_rows(),
+    load_one=lambda key: fetch_setting_row(key),
+)
+
+async def _get_setting_row(key: str, conn_ext: Optional[asyncpg.Connection] = None) -> Optional[Tuple[Optional[str], Optional[datetime]]]:
+    cached = settings_cache_instance.get(key)
+    if cached is not settings_cache.NOT_CACHED:
+        return cached
+    token = settings_cache_instance.token(key)
+    conn = conn_ext if conn_ext else await get_connection()
+    try:
+        value = await fetch_setting_row(key, conn_ext=conn)
+        # Внутри транзакции можно прочитать собственную незафиксированную запись - такое не кэшируем
+        if not conn.is_in_transaction():
+            settings_cache_instance.put(key, value, token)
+        return value
+    finally:
+        if not conn_ext and conn and not conn.is_closed():
+            await conn.close()
+
+async def _notify_setting_changed(conn: asyncpg.Connection, key: str) -> None:
+    # Уведомление уйдет при фиксации транзакции conn; свой кэш сбрасываем сразу
+    await conn.execute("SELECT pg_notify($1, $2)", settings_cache.SETTINGS_CHANNEL, key)
+    settings_cache_instance.invalidate(key)
+
 async def get_setting_timestamp(key: str, conn_ext: Optional[asyncpg.Connection] = None) -> Optional[datetime]:
-    conn_to_use = conn_ext if conn_ext else await get_connection()
+    """Время из system_settings (setting_value_timestamp). Читается из кэша настроек, в БД - только при промахе."""
     try:
-        ts_val = await conn_to_use.fetchval("SELECT setting_value_timestamp FROM system_settings WHERE setting_key = $1", key)
-        if ts_val and isinstance(ts_val, datetime):
-            return ts_val.replace(tzinfo=dt_timezone.utc) if ts_val.tzinfo is None else ts_val.astimezone(dt_timezone.utc)
-        return None
+        row = await _get_setting_row(key, conn_ext=conn_ext)
+        return row[1] if row else None
     except Exception as e:
         logger.error(f"DB: Ошибка получения настройки времени '{key}': {e}", exc_info=True)
         return None
-    finally:
-        if not conn_ext and conn_to_use and not conn_to_use.is_closed(): await conn_to_use.close()
 
 async def set_setting_timestamp(key: str, value: datetime, conn_ext: Optional[asyncpg.Connection] = None):
     conn_to_use = conn_ext if conn_ext else await get_connection()
@@ -2242,11 +2207,72 @@ async def set_setting_timestamp(key: str, value: datetime, conn_ext: Optional[as
             "ON CONFLICT (setting_key) DO UPDATE SET setting_value_timestamp = EXCLUDED.setting_value_timestamp",
             key, value_utc
         )
+        await _notify_setting_changed(conn_to_use, key)
     except Exception as e:
         logger.error(f"DB: Ошибка установки настройки времени '{key}': {e}", exc_info=True)
     finally:
         if not conn_ext and conn_to_use and not conn_to_use.is_closed(): await conn_to_use.close()
 
+# --- Аренда (lease) в system_settings: setting_value_text - владелец, setting_value_timestamp - до какого момента ---
+async def try_acquire_lease(key: str, holder_id: str, lease_seconds: float, conn_ext: Optional[asyncpg.Connection] = None) -> bool:
+    """
+    Захватывает или продлевает аренду key для holder_id на lease_seconds. True - аренда у holder_id.
+    Чужая аренда перехватывается только после истечения. Время берется с сервера БД, поэтому
+    расхождение часов между процессами не влияет. Ошибки пробрасываются: вызывающий сам решает,
+    считать ли аренду потерянной.
+    """
+    conn_to_use = conn_ext if conn_ext else await get_connection()
+    try:
+        owner = await conn_to_use.fetchval(
+            """
+            INSERT INTO system_settings (setting_key, setting_value_text, setting_value_timestamp)
+            VALUES ($1, $2, NOW() + make_interval(secs => $3))
+            ON CONFLICT (setting_key) DO UPDATE
+            SET setting_value_text = EXCLUDED.setting_value_text,
+                setting_value_timestamp = EXCLUDED.setting_value_timestamp
+            WHERE system_settings.setting_value_text = EXCLUDED.setting_value_text
+               OR system_settings.setting_value_timestamp IS NULL
+               OR system_settings.setting_value_timestamp < NOW()
+            RETURNING setting_value_text
+            """,
+            key, holder_id, float(lease_seconds)
+        )
+        return owner == holder_id
+    finally:
+        if not conn_ext and conn_to_use and not conn_to_use.is_closed(): await conn_to_use.close()
+
+async def release_lease(key: str, holder_id: str, conn_ext: Optional[asyncpg.Connection] = None) -> bool:
+    """Досрочно освобождает аренду key, если она принадлежит holder_id. True - аренда была снята."""
+    conn_to_use = conn_ext if conn_ext else await get_connection()
+    try:
+        result = await conn_to_use.execute(
+            "UPDATE system_settings SET setting_value_timestamp = NULL "
+            "WHERE setting_key = $1 AND setting_value_text = $2",
+            key, holder_id
+        )
+        return result == "UPDATE 1"
+    except Exception as e:
+        logger.error(f"DB: Ошибка освобождения аренды '{key}' для {holder_id}: {e}", exc_info=True)
+        return False
+    finally:
+        if not conn_ext and conn_to_use and not conn_to_use.is_closed(): await conn_to_use.close()
+
+async def get_lease_holder(key: str, conn_ext: Optional[asyncpg.Connection] = None) -> Optional[Dict[str, Any]]:
+    """Текущий владелец аренды key: {'holder_id', 'expires_at'} или None, если аренды нет или она истекла."""
+    conn_to_use = conn_ext if conn_ext else await get_connection()
+    try:
+        row = await conn_to_use.fetchrow(
+            "SELECT setting_value_text AS holder_id, setting_value_timestamp AS expires_at FROM system_settings "
+            "WHERE setting_key = $1 AND setting_value_timestamp >= NOW()",
+            key
+        )
+        return dict(row) if row else None
+    except Exception as e:
+        logger.error(f"DB: Ошибка получения владельца аренды '{key}': {e}", exc_info=True)
+        return None
+    finally:
+        if not conn_ext and conn_to_use and not conn_to_use.is_closed(): await conn_to_use.close()
+
 async def get_user_bonus_multiplier_status(user_id: int, chat_id: int, conn_ext: Optional[asyncpg.Connection] = None) -> Optional[Dict[str, Any]]:
     conn_to_use = conn_ext if conn_ext else await get_connection()
     try:
@@ -2324,7 +2350,12 @@ async def update_user_daily_streak(
                 last_streak_timestamp_utc = EXCLUDED.last_streak_timestamp_utc,
                 username_at_last_check = EXCLUDED.username_at_last_check,
                 full_name_at_last_check = EXCLUDED.full_name_at_last_check,
-                chat_title_at_last_check = EXCLUDED.chat_title_at_last_check;
+                chat_title_at_last_check = EXCLUDED.chat_title_at_last_check
+            WHERE (EXCLUDED.current_streak, EXCLUDED.last_streak_check_date, EXCLUDED.last_streak_timestamp_utc,
+                   EXCLUDED.username_at_last_check, EXCLUDED.full_name_at_last_check, EXCLUDED.chat_title_at_last_check)
+                  IS DISTINCT FROM
+                  (user_daily_streaks.current_streak, user_daily_streaks.last_streak_check_date, user_daily_streaks.last_streak_timestamp_utc,
+                   user_daily_streaks.username_at_last_check, user_daily_streaks.full_name_at_last_check, user_daily_streaks.chat_title_at_last_check);
             """,
             user_id, chat_id, streak, check_date, timestamp_utc, username, full_name, chat_title
         )
@@ -2430,12 +2461,11 @@ async def update_roulette_status(user_id: int, chat_id: int, fields_to_update: D
 async def get_setting_float(key: str, default_value: Optional[float] = None, conn_ext: Optional[asyncpg.Connection] = None) -> Optional[float]:
     """
     Получает числовое значение (float) из system_settings (хранимое в setting_value_text).
+    Читается из кэша настроек, в БД - только при промахе.
     """
-    conn_to_use = conn_ext if conn_ext else await get_connection()
     try:
-        value_str = await conn_to_use.fetchval(
-            "SELECT setting_value_text FROM system_settings WHERE setting_key = $1", key
-        )
+        row = await _get_setting_row(key, conn_ext=conn_ext)
+        value_str = row[0] if row else None
         if value_str is not None:
             try:
                 return float(value_str)
@@ -2447,9 +2477,6 @@ async def get_setting_float(key: str, default_value: Optional[float] = None, con
     except Exception as e:
         logger.error(f"DB: Ошибка при получении числовой настройки '{key}': {e}", exc_info=True)
         return default_value # Возвращаем default_value и при других ошибках БД
-    finally:
-        if not conn_ext and conn_to_use and not conn_to_use.is_closed():
-            await conn_to_use.close()
 
 async def set_setting_float(key: str, value: float, conn_ext: Optional[asyncpg.Connection] = None):
     """
@@ -2480,6 +2507,7 @@ async def set_setting_float(key: str, value: float, conn_ext: Optional[asyncpg.C
             """,
             key, value_to_save_str
         )
+        await _notify_setting_changed(conn_to_use, key)
         logger.info(f"DB: Установлена/обновлена настройка '{key}' со значением '{value_to_save_str}' (исходное float: {value}).")
     except Exception as e:
         logger.error(f"DB: Ошибка при установке числовой настройки '{key}' со значением {value}: {e}", exc_info=True)
@@ -2568,6 +2596,8 @@ async def add_phone_to_user_inventory(
             last_charged, battery_dead_after, battery_break_after,
             custom_phone_data_json # <--- ПЕРЕДАЕМ СЮДА
         )
+        if phone_inventory_id:
+            deadlines.schedule(deadlines.KIND_BATTERY_BREAK, phone_inventory_id, battery_break_after)
         return phone_inventory_id
     except Exception as e:
         logger.error(f"DB: Ошибка при добавлении телефона в инвентарь для user {user_id}, модель {phone_model_key}: {e}", exc_info=True)
@@ -2927,6 +2957,8 @@ async def update_phone_status_fields(
 
     try:
         result = await conn.execute(query, *values)
+        if result == "UPDATE 1" and isinstance(fields_to_update.get("battery_break_after_utc"), datetime):
+            deadlines.schedule(deadlines.KIND_BATTERY_BREAK, phone_inventory_id, fields_to_update["battery_break_after_utc"])
         return result == "UPDATE 1"
     except Exception as e:
         logger.error(f"DB: Ошибка при обновлении полей телефона ID {phone_inventory_id}: {e}", exc_info=True)
@@ -3159,60 +3191,6 @@ async def get_all_operational_phones(conn_ext: Optional[asyncpg.Connection] = No
         if not conn_ext and conn and not conn.is_closed():
             await conn.close()      
             
-async def get_phones_for_battery_check(conn_ext: Optional[asyncpg.Connection] = None) -> List[Dict[str, Any]]:
-    """
-    Получает все активные, не проданные телефоны, у которых аккумулятор еще не помечен как сломанный
-    из-за истечения battery_break_after_utc (т.е. is_broken = FALSE ИЛИ (is_broken = TRUE, но broken_component_key НЕ батарея)).
-    Также проверяем, что battery_break_after_utc не NULL.
-    """
-    conn = conn_ext if conn_ext else await get_connection()
-    try:
-        # Нам нужны телефоны, которые:
-        # 1. Не проданы (is_sold = FALSE)
-        # 2. Либо вообще не сломаны (is_broken = FALSE)
-        # 3. Либо сломаны, но сломанный компонент НЕ является батареей (чтобы не проверять батарею, которая уже помечена как сломанная по другой причине)
-        # 4. И у которых есть дата окончательной поломки батареи (battery_break_after_utc IS NOT NULL)
-        
-        # Получаем все ключи компонентов, которые являются батареями
-        battery_component_keys = [
-            key for key, data in PHONE_COMPONENTS.items() 
-            if data.get("component_type") == "battery"
-        ]
-
-        # Если список ключей батарей пуст, это ошибка конфигурации, но запрос все равно выполним без этого условия
-        if not battery_component_keys:
-            logger.warning("DB (get_phones_for_battery_check): Список ключей батарей (PHONE_COMPONENTS с type='battery') пуст. Проверка на тип сломанного компонента будет неполной.")
-            condition_broken_not_battery = "is_broken = FALSE" # Если нет ключей батарей, считаем только несломанные
-        else:
-            # Формируем строку для условия IN ($1, $2, ...)
-            placeholders = ", ".join([f"${i+1}" for i in range(len(battery_component_keys))])
-            condition_broken_not_battery = f"(is_broken = FALSE OR (is_broken = TRUE AND broken_component_key NOT IN ({placeholders})))"
-            params_for_query = battery_component_keys
-        
-        query_string = f"""
-            SELECT * FROM user_phones
-            WHERE is_sold = FALSE
-            AND {condition_broken_not_battery}
-            AND battery_break_after_utc IS NOT NULL 
-            ORDER BY user_id, battery_break_after_utc ASC
-        """
-
-        rows = await conn.fetch(query_string, *params_for_query if battery_component_keys else [])
-        
-        result_phones = []
-        for row_dict in (dict(r) for r in rows):
-            for key, value in row_dict.items():
-                if isinstance(value, datetime) and value.tzinfo is None:
-                    row_dict[key] = value.replace(tzinfo=dt_timezone.utc)
-            result_phones.append(row_dict)
-        return result_phones
-    except Exception as e:
-        logger.error(f"DB: Ошибка при получении телефонов для проверки батареи: {e}", exc_info=True)
-        return []
-    finally:
-        if not conn_ext and conn and not conn.is_closed():
-            await conn.close()   
-            
 async def add_user_business(
     user_id: int,
     chat_id: int,
@@ -3545,26 +3523,38 @@ async def create_or_update_user_bank(
     conn_to_use = conn_ext if conn_ext else await get_connection()
     try:
         now_utc = datetime.now(dt_timezone.utc)
-        
-        # Если пытаемся обновить уровень, и он не None
-        level_update_sql = ""
-        if new_bank_level is not None:
-            level_update_sql = f", bank_level = GREATEST(user_bank.bank_level, {new_bank_level})" # GREATEST чтобы не понизить уровень случайно
+        db_username, db_full_name, db_chat_title = _identity_delta("user_bank", user_id, chat_id, username, full_name, chat_title)
 
-        # Используем RETURNING *, чтобы получить все данные обновленной/вставленной строки
+        # Используем RETURNING *, чтобы получить все данные обновленной/вставленной строки.
+        # Уровень только растет (GREATEST), last_deposit_utc меняется только при движении денег.
+        # Если ничего не меняется - строку не переписываем и читаем ее отдельно.
         result_row = await conn_to_use.fetchrow(
-            f"""
+            """
             INSERT INTO user_bank (user_id, chat_id, username, full_name, chat_title, current_balance, bank_level, last_deposit_utc)
-            VALUES ($1, $2, $3, $4, $5, $6, COALESCE((SELECT bank_level FROM user_bank WHERE user_id = $1 AND chat_id = $2), 0), $7)
+            VALUES ($1, $2, $3, $4, $5, $6, COALESCE($8, 0), $7)
             ON CONFLICT (user_id, chat_id) DO UPDATE SET
                 current_balance = user_bank.current_balance + $6,
-                last_deposit_utc = EXCLUDED.last_deposit_utc
-                {level_update_sql}
+                last_deposit_utc = CASE WHEN $6 <> 0 THEN EXCLUDED.last_deposit_utc ELSE user_bank.last_deposit_utc END,
+                bank_level = GREATEST(user_bank.bank_level, COALESCE($8, user_bank.bank_level)),
+                username = COALESCE(EXCLUDED.username, user_bank.username),
+                full_name = COALESCE(EXCLUDED.full_name, user_bank.full_name),
+                chat_title = COALESCE(EXCLUDED.chat_title, user_bank.chat_title)
+            WHERE $6 <> 0
+               OR COALESCE($8, user_bank.bank_level) > user_bank.bank_level
+               OR (COALESCE(EXCLUDED.username, user_bank.username),
+                   COALESCE(EXCLUDED.full_name, user_bank.full_name),
+                   COALESCE(EXCLUDED.chat_title, user_bank.chat_title))
+                  IS DISTINCT FROM (user_bank.username, user_bank.full_name, user_bank.chat_title)
             RETURNING *;
             """,
-            user_id, chat_id, username, full_name, chat_title,
-            current_balance_change, now_utc
+            user_id, chat_id, db_username, db_full_name, db_chat_title,
+            current_balance_change, now_utc, new_bank_level
         )
+        _remember_identity(conn_to_use, "user_bank", user_id, chat_id, username, full_name, chat_title)
+        if result_row is None:
+            result_row = await conn_to_use.fetchrow(
+                "SELECT * FROM user_bank WHERE user_id = $1 AND chat_id = $2", user_id, chat_id
+            )
         if result_row:
             data = dict(result_row)
             if data.get('last_deposit_utc') and isinstance(data['last_deposit_utc'], datetime):
@@ -3742,34 +3732,6 @@ async def get_user_achievements(user_id: int, conn_ext: Optional[asyncpg.Connect
             await conn.close()
 
 # --- КОНЕЦ НОВЫХ ФУНКЦИЙ ДЛЯ ДОСТИЖЕНИЙ ---   
-async def create_event_queue_table():
-    """
-    Создает таблицу event_queue, если она не существует.
-    """
-    query = """
-    CREATE TABLE IF NOT EXISTS event_queue (
-        event_id SERIAL PRIMARY KEY,
-        user_id BIGINT NOT NULL,
-        event_type VARCHAR(50) NOT NULL,
-        event_data JSONB,
-        created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-        processed BOOLEAN DEFAULT FALSE,
-        processed_at TIMESTAMP WITH TIME ZONE
-    );
-    """
-    conn = None
-    try:
-        conn = await asyncpg.connect(Config.DATABASE_URL)
-        await conn.execute(query)
-        logger.info("Таблица 'event_queue' проверена/создана успешно.")
-        return True
-    except Exception as e:
-        logger.error(f"Ошибка при создании/проверке таблицы 'event_queue': {e}", exc_info=True)
-        return False
-    finally:
-        if conn:
-            await conn.close()
-
 # Теперь добавьте функции для работы с очередью событий (если вы их ещё не добавили)
 async def add_event_to_queue(user_id: int, event_type: str, event_data: Dict[str, Any], conn_ext: Optional[asyncpg.Connection] = None) -> bool:
     """
@@ -3784,10 +3746,11 @@ async def add_event_to_queue(user_id: int, event_type: str, event_data: Dict[str
         if conn_ext:
             await conn_ext.execute(query, user_id, event_type, json.dumps(event_data))
         else:
-            # Используем пул соединений, если conn_ext не передан
-            async with asyncpg.create_pool(Config.DATABASE_URL) as pool:
-                async with pool.acquire() as conn:
-                    await conn.execute(query, user_id, event_type, json.dumps(event_data))
+            conn = await get_connection()
+            try:
+                await conn.execute(query, user_id, event_type, json.dumps(event_data))
+            finally:
+                if not conn.is_closed(): await conn.close()
         return True
     except Exception as e:
         logger.error(f"Failed to add event to queue for user {user_id}, type {event_type}: {e}", exc_info=True)
@@ -3800,7 +3763,7 @@ async def get_pending_events(limit: int = 100, conn_ext: Optional[asyncpg.Connec
     query = """
         SELECT event_id, user_id, event_type, event_data, created_at, processed
         FROM event_queue
-        WHERE processed = FALSE
+        WHERE status = 'pending'
         ORDER BY created_at ASC
         LIMIT $1;
     """
@@ -3809,9 +3772,11 @@ async def get_pending_events(limit: int = 100, conn_ext: Optional[asyncpg.Connec
         if conn_ext:
             rows = await conn_ext.fetch(query, limit)
         else:
-            async with asyncpg.create_pool(Config.DATABASE_URL) as pool:
-                async with pool.acquire() as conn:
-                    rows = await conn.fetch(query, limit)
+            conn = await get_connection()
+            try:
+                rows = await conn.fetch(query, limit)
+            finally:
+                if not conn.is_closed(): await conn.close()
         for row in rows:
             # asyncpg возвращает Record, преобразуем в dict для удобства
             record_dict = dict(row)
@@ -3833,17 +3798,412 @@ async def mark_event_as_processed(event_id: int, conn_ext: Optional[asyncpg.Conn
     """
     query = """
         UPDATE event_queue
-        SET processed = TRUE, processed_at = NOW()
+        SET processed = TRUE, processed_at = NOW(), status = 'done', locked_until = NULL
         WHERE event_id = $1;
     """
     try:
         if conn_ext:
             status = await conn_ext.execute(query, event_id)
         else:
-            async with asyncpg.create_pool(Config.DATABASE_URL) as pool:
-                async with pool.acquire() as conn:
-                    status = await conn.execute(query, event_id)
+            conn = await get_connection()
+            try:
+                status = await conn.execute(query, event_id)
+            finally:
+                if not conn.is_closed(): await conn.close()
         return status == 'UPDATE 1' # Проверяем, что обновилась одна строка
     except Exception as e:
         logger.error(f"Failed to mark event {event_id} as processed: {e}", exc_info=True)
         return False         
+
+# --- Воркер очереди событий (см. event_queue.py) ---
+EVENT_QUEUE_CHANNEL = "event_queue"
+
+def _event_record_to_dict(row: asyncpg.Record) -> Dict[str, Any]:
+    record_dict = dict(row)
+    if isinstance(record_dict.get('event_data'), str):
+        try:
+            record_dict['event_data'] = json.loads(record_dict['event_data'])
+        except json.JSONDecodeError:
+            logger.warning(f"Failed to decode JSON for event_data in event {record_dict.get('event_id')}")
+            record_dict['event_data'] = {}
+    return record_dict
+
+async def add_events_to_queue(events: List[Tuple[int, str, Dict[str, Any]]],
+                              conn_ext: Optional[asyncpg.Connection] = None) -> int:
+    """
+    Пакетная постановка событий (user_id, event_type, event_data) в очередь одним запросом.
+    Порядок событий одного пользователя сохраняется (event_id растет в порядке списка).
+    Возвращает количество добавленных событий; ошибки пробрасываются.
+    """
+    if not events:
+        return 0
+    conn = conn_ext if conn_ext else await get_connection()
+    try:
+        status = await conn.execute("""
+            INSERT INTO event_queue (user_id, event_type, event_data, created_at)
+            SELECT d.user_id, d.event_type, d.event_data::jsonb, NOW()
+            FROM unnest($1::BIGINT[], $2::TEXT[], $3::TEXT[]) WITH ORDINALITY AS d(user_id, event_type, event_data, ord)
+            ORDER BY d.ord
+        """, [e[0] for e in events], [e[1] for e in events], [json.dumps(e[2]) for e in events])
+        return int(status.split()[-1])
+    finally:
+        if not conn_ext and conn and not conn.is_closed():
+            await conn.close()
+
+async def claim_events(limit: int, lock_seconds: float, conn_ext: Optional[asyncpg.Connection] = None) -> List[Dict[str, Any]]:
+    """
+    Захватывает до limit готовых событий (FOR UPDATE SKIP LOCKED) и переводит их в 'processing'
+    на lock_seconds. Берется только самое раннее незавершенное событие каждого пользователя,
+    поэтому события одного пользователя обрабатываются строго по порядку.
+    Зависшие 'processing' с истекшей арендой захватываются повторно.
+    """
+    conn = conn_ext if conn_ext else await get_connection()
+    try:
+        rows = await conn.fetch("""
+            WITH candidates AS (
+                SELECT e.event_id
+                FROM event_queue e
+                WHERE ((e.status = 'pending' AND e.available_at <= NOW())
+                       OR (e.status = 'processing' AND e.locked_until < NOW()))
+                  AND NOT EXISTS (
+                      SELECT 1 FROM event_queue p
+                      WHERE p.user_id = e.user_id AND p.event_id < e.event_id
+                        AND p.status IN ('pending', 'processing')
+                  )
+                ORDER BY e.event_id
+                LIMIT $1
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE event_queue q
+            SET status = 'processing',
+                attempts = q.attempts + 1,
+                locked_until = NOW() + make_interval(secs => $2)
+            FROM candidates c
+            WHERE q.event_id = c.event_id
+            RETURNING q.event_id, q.user_id, q.event_type, q.event_data, q.created_at, q.attempts
+        """, limit, float(lock_seconds))
+        return sorted((_event_record_to_dict(r) for r in rows), key=lambda r: r['event_id'])
+    finally:
+        if not conn_ext and conn and not conn.is_closed():
+            await conn.close()
+
+async def complete_events(event_ids: List[int], conn_ext: Optional[asyncpg.Connection] = None) -> None:
+    """Помечает захваченные события как обработанные."""
+    if not event_ids:
+        return
+    conn = conn_ext if conn_ext else await get_connection()
+    try:
+        await conn.execute("""
+            UPDATE event_queue
+            SET status = 'done', processed = TRUE, processed_at = NOW(), locked_until = NULL, last_error = NULL
+            WHERE event_id = ANY($1::INTEGER[]) AND status = 'processing'
+        """, event_ids)
+    finally:
+        if not conn_ext and conn and not conn.is_closed():
+            await conn.close()
+
+async def fail_event(event_id: int, error_text: str, retry_in_seconds: Optional[float],
+                     conn_ext: Optional[asyncpg.Connection] = None) -> None:
+    """
+    Возвращает событие в очередь через retry_in_seconds или, если retry_in_seconds is None,
+    переводит его в 'dead' (dead-letter) для ручного разбора.
+    """
+    conn = conn_ext if conn_ext else await get_connection()
+    try:
+        if retry_in_seconds is None:
+            await conn.execute("""
+                UPDATE event_queue SET status = 'dead', locked_until = NULL, last_error = $2
+                WHERE event_id = $1
+            """, event_id, error_text)
+        else:
+            await conn.execute("""
+                UPDATE event_queue
+                SET status = 'pending', locked_until = NULL, last_error = $2,
+                    available_at = NOW() + make_interval(secs => $3)
+                WHERE event_id = $1
+            """, event_id, error_text, float(retry_in_seconds))
+    finally:
+        if not conn_ext and conn and not conn.is_closed():
+            await conn.close()
+
+async def requeue_dead_events(event_type: Optional[str] = None, conn_ext: Optional[asyncpg.Connection] = None) -> int:
+    """Возвращает события из 'dead' в очередь (все или только указанного типа). Возвращает их количество."""
+    conn = conn_ext if conn_ext else await get_connection()
+    try:
+        status = await conn.execute("""
+            UPDATE event_queue
+            SET status = 'pending', attempts = 0, available_at = NOW(), last_error = NULL
+            WHERE status = 'dead' AND ($1::TEXT IS NULL OR event_type = $1)
+        """, event_type)
+        return int(status.split()[-1])
+    finally:
+        if not conn_ext and conn and not conn.is_closed():
+            await conn.close()
+
+
+# --- Хранилище FSM (fsm_storage.py) ---
+async def get_fsm_record(storage_key: str, conn_ext: Optional[asyncpg.Connection] = None) -> Optional[Dict[str, Any]]:
+    """
+    Состояние FSM по ключу: {'state', 'data' (JSON-строка), 'ttl_seconds'} или None, если записи нет или она истекла.
+    ttl_seconds - сколько записи осталось жить по часам сервера БД.
+    """
+    conn = conn_ext if conn_ext else await get_connection()
+    try:
+        row = await conn.fetchrow(
+            "SELECT state, data::text AS data, EXTRACT(EPOCH FROM (expires_at - NOW()))::float8 AS ttl_seconds "
+            "FROM fsm_storage WHERE storage_key = $1 AND expires_at > NOW()",
+            storage_key
+        )
+        return dict(row) if row else None
+    finally:
+        if not conn_ext and conn and not conn.is_closed():
+            await conn.close()
+
+async def save_fsm_records_batch(upserts: List[Tuple[str, Optional[str], str, float]], delete_keys: List[str],
+                                 conn_ext: Optional[asyncpg.Connection] = None) -> None:
+    """
+    Пакетная запись FSM одной транзакцией: upserts - список (storage_key, state, data_json, ttl_seconds),
+    delete_keys - ключи, состояние которых очищено. Ошибки пробрасываются (хранилище повторит запись).
+    """
+    if not upserts and not delete_keys:
+        return
+    conn = conn_ext if conn_ext else await get_connection()
+    try:
+        async with conn.transaction():
+            if upserts:
+                await conn.execute("""
+                    INSERT INTO fsm_storage (storage_key, state, data, expires_at, updated_at)
+                    SELECT u.storage_key, u.state, u.data::jsonb, NOW() + make_interval(secs => u.ttl_seconds), NOW()
+                    FROM unnest($1::TEXT[], $2::TEXT[], $3::TEXT[], $4::FLOAT8[]) AS u(storage_key, state, data, ttl_seconds)
+                    ON CONFLICT (storage_key) DO UPDATE SET
+                        state = EXCLUDED.state,
+                        data = EXCLUDED.data,
+                        expires_at = EXCLUDED.expires_at,
+                        updated_at = EXCLUDED.updated_at
+                    """,
+                    [u[0] for u in upserts], [u[1] for u in upserts], [u[2] for u in upserts], [float(u[3]) for u in upserts]
+                )
+            if delete_keys:
+                await conn.execute("DELETE FROM fsm_storage WHERE storage_key = ANY($1::TEXT[])", delete_keys)
+    finally:
+        if not conn_ext and conn and not conn.is_closed():
+            await conn.close()
+
+async def delete_expired_fsm_states(conn_ext: Optional[asyncpg.Connection] = None) -> int:
+    """Удаляет истекшие состояния FSM. Возвращает количество удаленных строк."""
+    conn = conn_ext if conn_ext else await get_connection()
+    try:
+        result = await conn.execute("DELETE FROM fsm_storage WHERE expires_at <= NOW()")
+        return int(result.split()[-1]) if result and result.startswith("DELETE") else 0
+    except Exception as e:
+        logger.error(f"DB: Ошибка удаления истекших состояний FSM: {e}", exc_info=True)
+        return 0
+    finally:
+        if not conn_ext and conn and not conn.is_closed():
+            await conn.close()
+
+
+# --- Исходящие сообщения (outbox.py) ---
+async def insert_outbox_messages(messages: List[Tuple[int, str, str, int]], lease_seconds: float,
+                                 conn_ext: Optional[asyncpg.Connection] = None) -> List[int]:
+    """
+    Сохраняет сообщения (chat_id, text, options_json, priority) с арендой текущего процесса на lease_seconds.
+    Возвращает id в том же порядке. Ошибки пробрасываются.
+    """
+    if not messages:
+        return []
+    conn = conn_ext if conn_ext else await get_standalone_connection()
+    try:
+        rows = await conn.fetch("""
+            INSERT INTO outbox (chat_id, text, options, priority, locked_until)
+            SELECT m.chat_id, m.text, m.options::jsonb, m.priority, NOW() + make_interval(secs => $5)
+            FROM unnest($1::BIGINT[], $2::TEXT[], $3::TEXT[], $4::SMALLINT[]) WITH ORDINALITY AS m(chat_id, text, options, priority, ord)
+            ORDER BY m.ord
+            RETURNING id
+            """,
+            [m[0] for m in messages], [m[1] for m in messages], [m[2] for m in messages], [m[3] for m in messages],
+            float(lease_seconds)
+        )
+        # id выдаются последовательностью в порядке вставки (ORDER BY m.ord), поэтому сортировка восстанавливает порядок
+        return sorted(row['id'] for row in rows)
+    finally:
+        if not conn_ext and conn and not conn.is_closed():
+            await conn.close()
+
+async def delete_outbox_messages(outbox_ids: List[int], conn_ext: Optional[asyncpg.Connection] = None) -> None:
+    """Удаляет отправленные (или окончательно не отправленные) сообщения."""
+    if not outbox_ids:
+        return
+    conn = conn_ext if conn_ext else await get_standalone_connection()
+    try:
+        await conn.execute("DELETE FROM outbox WHERE id = ANY($1::BIGINT[])", outbox_ids)
+    except Exception as e:
+        logger.error(f"DB: Ошибка удаления {len(outbox_ids)} сообщений из outbox: {e}", exc_info=True)
+    finally:
+        if not conn_ext and conn and not conn.is_closed():
+            await conn.close()
+
+async def record_outbox_failure(outbox_id: int, attempts: int, error: str, conn_ext: Optional[asyncpg.Connection] = None) -> None:
+    conn = conn_ext if conn_ext else await get_standalone_connection()
+    try:
+        await conn.execute("UPDATE outbox SET attempts = $2, last_error = $3 WHERE id = $1", outbox_id, attempts, error[:1000])
+    except Exception as e:
+        logger.error(f"DB: Ошибка записи неудачной отправки outbox {outbox_id}: {e}", exc_info=True)
+    finally:
+        if not conn_ext and conn and not conn.is_closed():
+            await conn.close()
+
+async def claim_orphaned_outbox_messages(limit: int, lease_seconds: float,
+                                         conn_ext: Optional[asyncpg.Connection] = None) -> List[Dict[str, Any]]:
+    """Забирает сообщения без действующей аренды (процесс-владелец упал или освободил их при остановке)."""
+    conn = conn_ext if conn_ext else await get_standalone_connection()
+    try:
+        rows = await conn.fetch("""
+            UPDATE outbox SET locked_until = NOW() + make_interval(secs => $2)
+            WHERE id IN (
+                SELECT id FROM outbox
+                WHERE locked_until IS NULL OR locked_until < NOW()
+                ORDER BY priority, id
+                LIMIT $1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, chat_id, text, options::text AS options, priority, attempts
+            """, limit, float(lease_seconds)
+        )
+        return [dict(row) for row in rows]
+    except Exception as e:
+        logger.error(f"DB: Ошибка захвата сообщений outbox: {e}", exc_info=True)
+        return []
+    finally:
+        if not conn_ext and conn and not conn.is_closed():
+            await conn.close()
+
+async def release_outbox_messages(outbox_ids: List[int], conn_ext: Optional[asyncpg.Connection] = None) -> None:
+    """Снимает аренду, чтобы сообщения сразу забрал другой процесс (при остановке)."""
+    if not outbox_ids:
+        return
+    conn = conn_ext if conn_ext else await get_standalone_connection()
+    try:
+        await conn.execute("UPDATE outbox SET locked_until = NULL WHERE id = ANY($1::BIGINT[])", outbox_ids)
+    except Exception as e:
+        logger.error(f"DB: Ошибка освобождения {len(outbox_ids)} сообщений outbox: {e}", exc_info=True)
+    finally:
+        if not conn_ext and conn and not conn.is_closed():
+            await conn.close()
+
+
+# --- Сводка уведомлений (digest.py) ---
+async def add_digest_items(items: List[Tuple[int, str, str]], conn_ext: Optional[asyncpg.Connection] = None) -> None:
+    """Добавляет уведомления (user_id, category, text) в сводку одним запросом. Ошибки пробрасываются."""
+    if not items:
+        return
+    conn = conn_ext if conn_ext else await get_connection()
+    try:
+        await conn.execute("""
+            INSERT INTO notification_digest (user_id, category, text)
+            SELECT i.user_id, i.category, i.text
+            FROM unnest($1::BIGINT[], $2::TEXT[], $3::TEXT[]) WITH ORDINALITY AS i(user_id, category, text, ord)
+            ORDER BY i.ord
+            """,
+            [i[0] for i in items], [i[1] for i in items], [i[2] for i in items]
+        )
+    finally:
+        if not conn_ext and conn and not conn.is_closed():
+            await conn.close()
+
+async def take_due_digest_items(window_seconds: float, max_users: int,
+                                conn_ext: Optional[asyncpg.Connection] = None) -> List[Dict[str, Any]]:
+    """
+    Забирает (удаляет и возвращает) все уведомления пользователей, у которых самое старое
+    уведомление старше window_seconds. Не больше max_users пользователей за вызов.
+    Результат упорядочен по user_id и времени добавления. Вызывать в транзакции conn_ext вместе
+    с постановкой сообщений в outbox, чтобы при ошибке уведомления не пропали.
+    """
+    conn = conn_ext if conn_ext else await get_connection()
+    try:
+        rows = await conn.fetch("""
+            WITH due_users AS (
+                SELECT user_id FROM notification_digest
+                GROUP BY user_id
+                HAVING MIN(created_at) <= NOW() - make_interval(secs => $1)
+                ORDER BY MIN(created_at)
+                LIMIT $2
+            ), taken AS (
+                DELETE FROM notification_digest d
+                USING due_users u
+                WHERE d.user_id = u.user_id
+                RETURNING d.id, d.user_id, d.category, d.text
+            )
+            SELECT user_id, category, text FROM taken ORDER BY user_id, id
+            """, float(window_seconds), max_users
+        )
+        return [dict(row) for row in rows]
+    finally:
+        if not conn_ext and conn and not conn.is_closed():
+            await conn.close()
+
+
+# --- Сроки для движка deadlines.py: (ключ, срок) со сроком не позже until ---
+async def get_phone_prize_deadlines(until_utc: datetime, conn_ext: Optional[asyncpg.Connection] = None) -> List[Tuple[int, datetime]]:
+    """Ожидающие решения призы: срок - время выигрыша плюс MARKET_PHONE_CONFIRMATION_TIMEOUT_SECONDS."""
+    timeout = timedelta(seconds=Config.MARKET_PHONE_CONFIRMATION_TIMEOUT_SECONDS)
+    conn = conn_ext if conn_ext else await get_connection()
+    try:
+        rows = await conn.fetch(
+            "SELECT user_id, prize_won_at_utc FROM user_pending_phone_prizes WHERE prize_won_at_utc <= $1",
+            until_utc - timeout
+        )
+        return [(row['user_id'], row['prize_won_at_utc'] + timeout) for row in rows]
+    finally:
+        if not conn_ext and conn and not conn.is_closed():
+            await conn.close()
+
+async def get_battery_break_deadlines(until_utc: datetime, conn_ext: Optional[asyncpg.Connection] = None) -> List[Tuple[int, datetime]]:
+    """Не проданные телефоны, у которых аккумулятор сломается до until_utc (и еще не сломан)."""
+    battery_component_keys = list(catalog.BATTERY_COMPONENT_KEYS)
+    conn = conn_ext if conn_ext else await get_connection()
+    try:
+        rows = await conn.fetch(
+            """
+            SELECT phone_inventory_id, battery_break_after_utc FROM user_phones
+            WHERE is_sold = FALSE AND battery_break_after_utc IS NOT NULL AND battery_break_after_utc <= $1
+              AND (is_broken = FALSE OR broken_component_key IS NULL OR NOT (broken_component_key = ANY($2::TEXT[])))
+            """,
+            until_utc, battery_component_keys
+        )
+        return [(row['phone_inventory_id'], row['battery_break_after_utc']) for row in rows]
+    finally:
+        if not conn_ext and conn and not conn.is_closed():
+            await conn.close()
+
+async def get_robbank_operation_deadlines(until_utc: datetime, legacy_delay_seconds: int,
+                                          conn_ext: Optional[asyncpg.Connection] = None) -> List[Tuple[Tuple[int, int], datetime]]:
+    """
+    Незавершенные операции /robbank. У операций, начатых до появления current_operation_due_utc,
+    срок - начало плюс legacy_delay_seconds.
+    """
+    conn = conn_ext if conn_ext else await get_connection()
+    try:
+        rows = await conn.fetch(
+            """
+            SELECT user_id, chat_id,
+                   COALESCE(current_operation_due_utc, current_operation_start_utc + make_interval(secs => $2)) AS due_utc
+            FROM user_robbank_status
+            WHERE current_operation_start_utc IS NOT NULL
+              AND (current_operation_due_utc <= $1
+                   OR (current_operation_due_utc IS NULL AND current_operation_start_utc <= $1 - make_interval(secs => $2)))
+            """,
+            until_utc, float(legacy_delay_seconds)
+        )
+        return [((row['user_id'], row['chat_id']), row['due_utc']) for row in rows]
+    finally:
+        if not conn_ext and conn and not conn.is_closed():
+            await conn.close()
+
+
+# --- Метрики: оборачиваем все публичные корутины модуля (должно оставаться в самом конце файла) ---
+# get_setting_* обычно отвечают из кэша - в метрики попадают только их обращения к БД (fetch_setting_row).
+# get_connection - ожидание пула, а не запрос: иначе оно попадало бы в лог медленных запросов
+# и дублировало время функций, которые его вызывают
+db_metrics.instrument_module(sys.modules[__name__], exclude=("create_pool", "close_pool", "get_connection", "get_standalone_connection",
+                                                             "get_setting_timestamp", "get_setting_float"))
@@ -0,0 +1,200 @@
+# db_metrics.py
+"""
+Метрики вызовов database.py: количество, ошибки, задержки (p50/p95/p99), строки и вызывающий обработчик.
+
+database.py в самом конце вызывает instrument_module(), который оборачивает все публичные
+корутины модуля. Вызовы дольше Config.DB_SLOW_QUERY_MS пишутся в лог медленных запросов.
+Данные доступны через snapshot() / slow_queries() и админ-команду /dbstats (admin_logic.py).
+"""
+import contextvars
+import functools
+import inspect
+import math
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timezone as dt_timezone
+from types import ModuleType
+from typing import Any, Deque, Dict, Iterable, List, Optional
+
+import asyncpg
+
+from config import Config
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+BACKGROUND_CALLER = "background"
+_OTHER_CALLERS = "other"
+_MAX_CALLERS_PER_OPERATION = 50
+
+# Кто сейчас обращается к БД: имя обработчика апдейта (HandlerNameMiddleware), задачи очереди и т.п.
+current_caller: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("db_metrics_caller", default=None)
+# Выполняется ли уже обернутая функция: вложенные вызовы database.* входят в ее время и отдельно не учитываются
+_inside_operation: contextvars.ContextVar[bool] = contextvars.ContextVar("db_metrics_inside", default=False)
+
+
+class _OperationStats:
+    __slots__ = ("count", "errors", "total_seconds", "max_seconds", "rows", "samples", "callers")
+
+    def __init__(self, sample_size: int):
+        self.count = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.rows = 0
+        self.samples: Deque[float] = deque(maxlen=sample_size)
+        self.callers: Dict[str, int] = {}
+
+    def add(self, seconds: float, rows: Optional[int], failed: bool, caller: str) -> None:
+        self.count += 1
+        if failed:
+            self.errors += 1
+        self.total_seconds += seconds
+        if seconds > self.max_seconds:
+            self.max_seconds = seconds
+        if rows:
+            self.rows += rows
+        self.samples.append(seconds)
+        if caller not in self.callers and len(self.callers) >= _MAX_CALLERS_PER_OPERATION:
+            caller = _OTHER_CALLERS
+        self.callers[caller] = self.callers.get(caller, 0) + 1
+
+
+_stats: Dict[str, _OperationStats] = {}
+_slow_log: Deque[Dict[str, Any]] = deque(maxlen=Config.DB_SLOW_QUERY_LOG_SIZE)
+
+
+def _percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def _count_rows(result: Any) -> Optional[int]:
+    if result is None:
+        return 0
+    if isinstance(result, (list, tuple)):
+        return len(result)
+    if isinstance(result, (dict, asyncpg.Record)):
+        return 1
+    return None
+
+
+def record(operation: str, seconds: float, result: Any = None, failed: bool = False) -> None:
+    """Учитывает один вызов operation длительностью seconds."""
+    caller = current_caller.get() or BACKGROUND_CALLER
+    rows = None if failed else _count_rows(result)
+    stats = _stats.get(operation)
+    if stats is None:
+        stats = _stats[operation] = _OperationStats(Config.DB_METRICS_SAMPLE_SIZE)
+    stats.add(seconds, rows, failed, caller)
+
+    elapsed_ms = seconds * 1000.0
+    if elapsed_ms >= Config.DB_SLOW_QUERY_MS:
+        entry = {
+            "operation": operation,
+            "ms": round(elapsed_ms, 1),
+            "caller": caller,
+            "rows": rows,
+            "failed": failed,
+            "at": datetime.now(dt_timezone.utc),
+        }
+        _slow_log.append(entry)
+        logger.warning(f"Медленный запрос: {operation} {elapsed_ms:.1f} мс (caller={caller}, rows={rows}, failed={failed})")
+
+
+def instrument(operation: str, func: Any) -> Any:
+    """
+    Оборачивает корутину func так, чтобы каждый ее вызов попадал в метрики под именем operation.
+    Вызовы изнутри другой обернутой функции не учитываются - их время уже входит во внешний вызов.
+    """
+    if getattr(func, "__db_metrics_instrumented__", False):
+        return func
+
+    @functools.wraps(func)
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:
+        if _inside_operation.get():
+            return await func(*args, **kwargs)
+        token = _inside_operation.set(True)
+        started = time.perf_counter()
+        result = None
+        failed = False
+        try:
+            result = await func(*args, **kwargs)
+            return result
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            _inside_operation.reset(token)
+            record(operation, time.perf_counter() - started, result, failed)
+
+    wrapper.__db_metrics_instrumented__ = True  # type: ignore[attr-defined]
+    return wrapper
+
+
+def instrument_module(module: ModuleType, exclude: Iterable[str] = ()) -> int:
+    """
+    Оборачивает все публичные корутины, определенные в module (не импортированные в него).
+    Возвращает количество обернутых функций. Ничего не делает, если Config.DB_METRICS_ENABLED выключен.
+    """
+    if not Config.DB_METRICS_ENABLED:
+        return 0
+    excluded = set(exclude)
+    wrapped = 0
+    for name, value in list(vars(module).items()):
+        if name.startswith("_") or name in excluded:
+            continue
+        if not inspect.iscoroutinefunction(value) or getattr(value, "__module__", None) != module.__name__:
+            continue
+        setattr(module, name, instrument(name, value))
+        wrapped += 1
+    return wrapped
+
+
+@contextmanager
+def caller_scope(caller: str):
+    """Помечает все обращения к БД внутри блока как сделанные из caller."""
+    token = current_caller.set(caller)
+    try:
+        yield
+    finally:
+        current_caller.reset(token)
+
+
+def snapshot() -> Dict[str, Dict[str, Any]]:
+    """
+    Текущие метрики по операциям:
+    {операция: {count, errors, total_ms, avg_ms, p50_ms, p95_ms, p99_ms, max_ms, rows, callers}}.
+    Перцентили считаются по последним Config.DB_METRICS_SAMPLE_SIZE вызовам.
+    """
+    result: Dict[str, Dict[str, Any]] = {}
+    for operation, stats in _stats.items():
+        samples = sorted(stats.samples)
+        result[operation] = {
+            "count": stats.count,
+            "errors": stats.errors,
+            "total_ms": stats.total_seconds * 1000.0,
+            "avg_ms": (stats.total_seconds / stats.count * 1000.0) if stats.count else 0.0,
+            "p50_ms": _percentile(samples, 0.50) * 1000.0,
+            "p95_ms": _percentile(samples, 0.95) * 1000.0,
+            "p99_ms": _percentile(samples, 0.99) * 1000.0,
+            "max_ms": stats.max_seconds * 1000.0,
+            "rows": stats.rows,
+            "callers": dict(stats.callers),
+        }
+    return result
+
+
+def slow_queries(limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Последние медленные вызовы, от новых к старым."""
+    entries = list(reversed(_slow_log))
+    return entries[:limit] if limit is not None else entries
+
+
+def reset() -> None:
+    _stats.clear()
+    _slow_log.clear()
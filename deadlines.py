@@ -0,0 +1,233 @@
+# deadlines.py
+"""
+Выполнение действий в момент наступления срока (истечение приза, поломка аккумулятора,
+завершение ограбления банка) вместо периодического обхода таблиц.
+
+DeadlineEngine держит min-кучу (срок, вид, ключ) и спит до ближайшего срока. Сроки попадают в кучу
+двумя путями:
+- schedule(kind, key, due_at) из кода, который записывает соответствующее время в БД
+  (database.add_pending_phone_prize, update_phone_status_fields и т.д.);
+- reconcile: раз в reconcile_interval секунд для каждого вида вызывается loader(until) - индексированный
+  запрос сроков, наступающих до now + horizon. Так подхватываются сроки, записанные до запуска
+  процесса или другими процессами, и те, что были дальше горизонта.
+
+Сроки дальше горизонта в кучу не кладутся, поэтому ее размер ограничен. Один и тот же срок может
+прийти и из schedule, и из reconcile, а в БД он может успеть измениться - обработчик вида обязан
+перепроверить состояние в БД и ничего не делать, если срок еще не наступил или объект уже обработан.
+Если обработчик завершился без ошибки, а loader снова возвращает тот же срок (обработчик не смог
+ничего сделать с записью, например модель телефона неизвестна), срок повторно не выполняется,
+пока он не изменится в БД. Упавший обработчик, наоборот, повторяется при следующей сверке.
+
+Движок запускается там же, где выполняются задачи планировщика (при выборе лидера - только у лидера).
+В остальных процессах schedule ничего не делает: их сроки подхватит reconcile лидера.
+"""
+import asyncio
+import heapq
+import itertools
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Виды сроков
+KIND_PHONE_PRIZE = "phone_prize" # Ключ - user_id: выигранный телефон продается, если владелец не решил до срока
+KIND_BATTERY_BREAK = "battery_break" # Ключ - phone_inventory_id: незаряженный аккумулятор окончательно ломается
+KIND_ROBBANK = "robbank" # Ключ - (user_id, chat_id): завершение операции /robbank
+
+Loader = Callable[[datetime], Awaitable[List[Tuple[Hashable, datetime]]]]
+Handler = Callable[[Hashable], Awaitable[Any]]
+
+
+def _to_timestamp(due_at: datetime) -> float:
+    if due_at.tzinfo is None:
+        due_at = due_at.replace(tzinfo=dt_timezone.utc)
+    return due_at.timestamp()
+
+
+class DeadlineEngine:
+    def __init__(self, horizon_seconds: float = 3600.0, reconcile_interval: float = 60.0, max_concurrency: int = 10):
+        self.reconcile_interval = reconcile_interval
+        self.horizon_seconds = max(horizon_seconds, reconcile_interval * 2) # Иначе сроки между сверками не попадут в кучу
+        self._loaders: Dict[str, Loader] = {}
+        self._handlers: Dict[str, Handler] = {}
+        self._heap: List[Tuple[float, int, str, Hashable]] = []
+        self._due: Dict[Tuple[str, Hashable], float] = {} # Актуальный срок каждого объекта; остальные записи кучи устарели
+        self._running_keys: Set[Tuple[str, Hashable]] = set()
+        self._handled: Dict[Tuple[str, Hashable], float] = {} # Срок, который обработчик уже выполнил без ошибки
+        self._handler_tasks: Set[asyncio.Task] = set()
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._reconcile_task: Optional[asyncio.Task] = None
+        self.fired = 0
+        self.failed = 0
+
+    def register(self, kind: str, loader: Loader, handler: Handler) -> None:
+        """loader(until) возвращает [(ключ, срок)] со сроком до until; handler(ключ) выполняет действие."""
+        self._loaders[kind] = loader
+        self._handlers[kind] = handler
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @property
+    def pending(self) -> int:
+        return len(self._due)
+
+    def stats(self) -> Dict[str, Any]:
+        by_kind: Dict[str, int] = {}
+        for kind, _ in self._due:
+            by_kind[kind] = by_kind.get(kind, 0) + 1
+        next_due = self._heap[0][0] - time.time() if self._heap else None
+        return {
+            "pending": self.pending,
+            "pending_by_kind": by_kind,
+            "in_progress": len(self._running_keys),
+            "handled_unchanged": len(self._handled),
+            "fired": self.fired,
+            "failed": self.failed,
+            "next_due_in_seconds": next_due,
+        }
+
+    # --- Сроки ---
+    def schedule(self, kind: str, key: Hashable, due_at: datetime) -> None:
+        """Назначает (или переносит) срок объекта. Срок дальше горизонта подхватит reconcile."""
+        if kind not in self._handlers:
+            logger.warning(f"Deadlines: Неизвестный вид срока '{kind}'.")
+            return
+        due_ts = _to_timestamp(due_at)
+        if due_ts > time.time() + self.horizon_seconds:
+            self._due.pop((kind, key), None)
+            return
+        if self._due.get((kind, key)) == due_ts:
+            return
+        self._due[(kind, key)] = due_ts
+        heapq.heappush(self._heap, (due_ts, next(self._seq), kind, key))
+        if self._heap[0][0] == due_ts:
+            self._wakeup.set() # Новый срок раньше того, до которого спит цикл
+
+    def cancel(self, kind: str, key: Hashable) -> None:
+        # Запись в куче остается и будет пропущена при извлечении
+        self._due.pop((kind, key), None)
+
+    async def reconcile(self) -> int:
+        """Загружает из БД сроки в пределах горизонта. Возвращает число загруженных сроков."""
+        until = datetime.now(dt_timezone.utc) + timedelta(seconds=self.horizon_seconds)
+        loaded = 0
+        for kind, loader in self._loaders.items():
+            try:
+                items = await loader(until)
+            except Exception as e:
+                logger.error(f"Deadlines: Ошибка загрузки сроков '{kind}': {e}", exc_info=True)
+                continue
+            still_due: Set[Hashable] = set()
+            for key, due_at in items:
+                if self._handled.get((kind, key)) == _to_timestamp(due_at):
+                    still_due.add(key) # Уже выполнен, но запись не изменилась - не повторяем
+                    continue
+                if (kind, key) not in self._running_keys:
+                    self.schedule(kind, key, due_at)
+                    loaded += 1
+            for handled_key in [k for k in self._handled if k[0] == kind and k[1] not in still_due]:
+                del self._handled[handled_key] # Срок изменен или объект обработан
+        return loaded
+
+    # --- Цикл ---
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                due_ts, _, kind, key = heapq.heappop(self._heap)
+                if self._due.get((kind, key)) != due_ts:
+                    continue # Срок перенесен или отменен
+                del self._due[(kind, key)]
+                self._fire(kind, key, due_ts)
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _fire(self, kind: str, key: Hashable, due_ts: float) -> None:
+        self._running_keys.add((kind, key))
+        task = asyncio.create_task(self._call_handler(kind, key, due_ts))
+        self._handler_tasks.add(task)
+        task.add_done_callback(self._handler_tasks.discard)
+
+    async def _call_handler(self, kind: str, key: Hashable, due_ts: float) -> None:
+        try:
+            async with self._semaphore:
+                await self._handlers[kind](key)
+            self.fired += 1
+            self._handled[(kind, key)] = due_ts
+        except Exception as e:
+            # Объект остался в БД со сроком в прошлом - следующая сверка попробует снова
+            self.failed += 1
+            logger.error(f"Deadlines: Ошибка обработки срока '{kind}' для {key}: {e}", exc_info=True)
+        finally:
+            self._running_keys.discard((kind, key))
+
+    async def _reconcile_loop(self) -> None:
+        while True:
+            loaded = await self.reconcile()
+            if loaded:
+                logger.debug(f"Deadlines: Сверка загрузила {loaded} сроков, в очереди {self.pending}.")
+            await asyncio.sleep(self.reconcile_interval)
+
+    def start(self) -> None:
+        if not self.running:
+            self._task = asyncio.create_task(self._run())
+            self._reconcile_task = asyncio.create_task(self._reconcile_loop())
+            logger.info(f"Deadlines: Движок сроков запущен (сверка каждые {self.reconcile_interval:.0f} сек).")
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Останавливает цикл и дожидается выполняющихся обработчиков (не дольше timeout)."""
+        if self._task is None:
+            return
+        for task in (self._task, self._reconcile_task):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except (asyncio.CancelledError, Exception):
+                    pass
+        self._task = None
+        self._reconcile_task = None
+        if self._handler_tasks:
+            await asyncio.wait(list(self._handler_tasks), timeout=timeout)
+        # Сроки не сохраняются: при следующем запуске их загрузит reconcile
+        self._heap.clear()
+        self._due.clear()
+        self._handled.clear()
+        logger.info("Deadlines: Движок сроков остановлен.")
+
+
+_engine: Optional[DeadlineEngine] = None
+
+
+def set_deadline_engine(engine: Optional[DeadlineEngine]) -> None:
+    global _engine
+    _engine = engine
+
+
+def get_deadline_engine() -> Optional[DeadlineEngine]:
+    return _engine
+
+
+def schedule(kind: str, key: Hashable, due_at: Optional[datetime]) -> None:
+    """Сообщает движку новый срок объекта; без запущенного движка ничего не делает."""
+    engine = _engine
+    if engine is not None and engine.running and due_at is not None:
+        engine.schedule(kind, key, due_at)
+
+
+def cancel(kind: str, key: Hashable) -> None:
+    engine = _engine
+    if engine is not None and engine.running:
+        engine.cancel(kind, key)
@@ -0,0 +1,136 @@
+# digest.py
+"""
+Сводка уведомлений задач планировщика.
+
+Раньше каждая задача (поломки, аккумуляторы, страховки, события бизнесов) слала пользователю
+отдельное сообщение, и в часы запуска задач один игрок получал их пачкой. Теперь задачи вызывают
+digest.notify / digest.notify_many: уведомление сохраняется в таблицу notification_digest, а задача
+flush_due_digests раз в Config.DIGEST_FLUSH_INTERVAL_SECONDS собирает уведомления пользователей,
+самое старое из которых ждет дольше Config.DIGEST_WINDOW_MINUTES, в одно сообщение на пользователя
+(если текст длиннее лимита Telegram - в несколько) и ставит их в очередь outbox. Удаление уведомлений
+и запись в outbox идут в одной транзакции: если outbox не принял сообщения, уведомления остаются до следующего запуска.
+Отправка сообщений начинается только после COMMIT.
+
+Срочные уведомления (urgent=True), а также все уведомления при Config.DIGEST_ENABLED = False,
+отправляются сразу, как раньше. Если записать уведомление в БД не удалось, оно тоже отправляется сразу.
+"""
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
+
+from aiogram import Bot
+
+from config import Config
+import database
+import outbox
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_LIMIT = 4096 # Лимит длины сообщения Telegram
+DIGEST_HEADER = "📬 <b>Сводка уведомлений</b>"
+SEND_OPTIONS: Dict[str, Any] = {"parse_mode": "HTML", "disable_web_page_preview": True}
+
+# Заголовки разделов сводки; разделы выводятся в этом порядке, неизвестные категории - в конце
+CATEGORY_TITLES = {
+    "phone": "📱 Телефоны",
+    "insurance": "📄 Страховки",
+    "business": "🏢 Бизнесы",
+}
+
+
+async def notify(bot: Bot, user_id: int, text: str, category: str, urgent: bool = False) -> None:
+    """Добавляет уведомление в сводку пользователя (или отправляет сразу, если urgent)."""
+    await notify_many(bot, [(user_id, text)], category, urgent=urgent)
+
+
+async def notify_many(bot: Bot, items: List[Tuple[int, str]], category: str, urgent: bool = False) -> None:
+    """То же для пачки (user_id, text) одной категории - одной записью в БД."""
+    if not items:
+        return
+    if not urgent and Config.DIGEST_ENABLED:
+        try:
+            await database.add_digest_items([(user_id, category, text) for user_id, text in items])
+            return
+        except Exception as e:
+            logger.error(f"Digest: Не удалось сохранить {len(items)} уведомлений ({category}), отправляем сразу: {e}", exc_info=True)
+    await outbox.send_messages(bot, [(user_id, text, dict(SEND_OPTIONS)) for user_id, text in items],
+                               priority=outbox.PRIORITY_NOTIFICATION)
+
+
+def render_digest(items: List[Dict[str, Any]]) -> List[str]:
+    """
+    Собирает уведомления одного пользователя (category, text) в текст сводки.
+    Одно уведомление отправляется как есть. Если сводка не помещается в одно сообщение,
+    она делится по границам уведомлений.
+    """
+    if len(items) == 1:
+        return [items[0]["text"]]
+
+    by_category: "OrderedDict[str, List[str]]" = OrderedDict()
+    for category in CATEGORY_TITLES:
+        by_category[category] = []
+    for item in items:
+        by_category.setdefault(item["category"], []).append(item["text"])
+
+    blocks: List[str] = [DIGEST_HEADER]
+    for category, texts in by_category.items():
+        if not texts:
+            continue
+        # Заголовок раздела склеен с первым уведомлением, чтобы не остаться в конце сообщения отдельно
+        blocks.append(f"<b>{CATEGORY_TITLES.get(category, category)}</b>\n{texts[0]}")
+        blocks.extend(texts[1:])
+
+    messages: List[str] = []
+    current = ""
+    for block in blocks:
+        if len(block) > MESSAGE_LIMIT:
+            block = block[:MESSAGE_LIMIT] # Отдельное уведомление не может быть длиннее лимита, но на всякий случай
+        candidate = f"{current}\n\n{block}" if current else block
+        if len(candidate) > MESSAGE_LIMIT:
+            messages.append(current)
+            current = block
+        else:
+            current = candidate
+    if current:
+        messages.append(current)
+    return messages
+
+
+async def flush_due_digests(bot: Bot) -> None:
+    """Задача планировщика: отправляет сводки, окно которых истекло."""
+    window_seconds = Config.DIGEST_WINDOW_MINUTES * 60
+    total_users = 0
+    while True:
+        by_user: "OrderedDict[int, List[Dict[str, Any]]]" = OrderedDict()
+        stored: List[outbox.OutboundMessage] = []
+        conn = None
+        try:
+            conn = await database.get_connection()
+            async with conn.transaction():
+                rows = await database.take_due_digest_items(window_seconds, Config.DIGEST_FLUSH_BATCH_USERS, conn_ext=conn)
+                for row in rows:
+                    by_user.setdefault(row["user_id"], []).append(row)
+                messages_to_send = [
+                    (user_id, text, dict(SEND_OPTIONS))
+                    for user_id, user_items in by_user.items()
+                    for text in render_digest(user_items)
+                ]
+                if messages_to_send:
+                    stored = await outbox.store_messages(messages_to_send, conn, priority=outbox.PRIORITY_NOTIFICATION)
+        except Exception as e:
+            # Транзакция откатилась: уведомления остались в notification_digest и уйдут при следующем запуске
+            logger.error(f"Digest: Не удалось отправить сводки, повтор при следующем запуске: {e}", exc_info=True)
+            return
+        finally:
+            if conn and not conn.is_closed():
+                await conn.close()
+        outbox.push_committed(stored)
+        if not by_user:
+            break
+        total_users += len(by_user)
+        if len(by_user) < Config.DIGEST_FLUSH_BATCH_USERS:
+            break
+
+    if total_users:
+        logger.info(f"Digest: Отправлены сводки {total_users} пользователям.")
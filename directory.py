@@ -0,0 +1,88 @@
+# directory.py
+"""
+Справочник отображаемых имен пользователей и чатов в памяти процесса.
+
+utils.fetch_user_display_data раньше на каждый вызов ходил в users, а при отсутствии имени -
+в bot.get_chat. Задача бизнесов вызывает ее для каждого владельца, статистика и топы - для каждой строки.
+Теперь (full_name, username) берутся из LRU-кэша с TTL:
+- кэш наполняется из входящих апдейтов (KnownUsersMiddleware) - в каждом сообщении уже есть from_user;
+- промахи читаются из users (utils.prefetch_user_display_data - одним запросом на пачку) и только затем из get_chat;
+- неудачный get_chat кэшируется как отрицательный ответ на negative_ttl, чтобы не повторять запрос
+  для удаленных аккаунтов и заблокировавших бота пользователей.
+TTL ограничивает устаревание имени, сменившегося в другом процессе.
+
+Так же устроен справочник чатов chats ((title, username, type) по chat_id) для /reminders в личке:
+он наполняется из апдейтов, затем из user_oneui.chat_title и только затем из get_chat.
+"""
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+from config import Config
+
+MISSING = object() # Ключа нет в кэше (None - закэшированный отрицательный ответ)
+
+
+class LruTtlCache:
+    def __init__(self, max_size: int, ttl: float, negative_ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict() # ключ -> (истекает, значение)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Any:
+        """Значение, None для отрицательного ответа или MISSING."""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return MISSING
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def put_negative(self, key: Hashable) -> None:
+        self.put(key, None, ttl=self.negative_ttl)
+
+    def discard(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+# user_id -> (full_name, username)
+users = LruTtlCache(
+    max_size=Config.USER_DIRECTORY_MAX_SIZE,
+    ttl=Config.USER_DIRECTORY_TTL_SECONDS,
+    negative_ttl=Config.USER_DIRECTORY_NEGATIVE_TTL_SECONDS,
+)
+
+
+def remember_user(user_id: int, full_name: Optional[str], username: Optional[str]) -> None:
+    if full_name:
+        users.put(user_id, (full_name, username))
+
+
+# chat_id -> (title, username, type); type None, если известно только название из user_oneui
+chats = LruTtlCache(
+    max_size=Config.CHAT_DIRECTORY_MAX_SIZE,
+    ttl=Config.CHAT_DIRECTORY_TTL_SECONDS,
+    negative_ttl=Config.USER_DIRECTORY_NEGATIVE_TTL_SECONDS,
+)
+
+
+def remember_chat(chat_id: int, title: Optional[str], username: Optional[str], chat_type: Optional[str]) -> None:
+    chats.put(chat_id, (title, username, chat_type))
@@ -0,0 +1,157 @@
+# event_queue.py
+"""
+Фоновый обработчик таблицы event_queue.
+
+События ставятся в очередь через database.add_event_to_queue / database.add_events_to_queue
+и обрабатываются вне интерактивного пути: воркер пачками захватывает их через
+FOR UPDATE SKIP LOCKED, просыпается по LISTEN/NOTIFY (а не постоянным опросом),
+сохраняет порядок событий одного пользователя, повторяет упавшие с экспоненциальной
+задержкой и после EVENT_QUEUE_MAX_ATTEMPTS попыток переводит событие в 'dead'.
+
+Обработчики регистрируются декоратором @register_event_handler("тип_события")
+и получают (bot, event), где event - dict с event_id, user_id, event_type, event_data, attempts.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from aiogram import Bot
+
+from config import Config
+import database
+import db_metrics
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+EventHandler = Callable[[Bot, Dict[str, Any]], Awaitable[None]]
+
+_event_handlers: Dict[str, EventHandler] = {}
+
+
+def register_event_handler(event_type: str) -> Callable[[EventHandler], EventHandler]:
+    """Регистрирует обработчик для событий типа event_type."""
+    def decorator(func: EventHandler) -> EventHandler:
+        if event_type in _event_handlers and _event_handlers[event_type] is not func:
+            logger.warning(f"EventQueue: Обработчик для '{event_type}' переопределен ({func.__name__}).")
+        _event_handlers[event_type] = func
+        return func
+    return decorator
+
+
+def retry_delay_seconds(attempts: int) -> float:
+    """Задержка перед следующей попыткой: base * 2^(attempts-1), но не больше EVENT_QUEUE_RETRY_MAX_SECONDS."""
+    delay = Config.EVENT_QUEUE_RETRY_BASE_SECONDS * (2 ** max(attempts - 1, 0))
+    return min(delay, Config.EVENT_QUEUE_RETRY_MAX_SECONDS)
+
+
+class EventQueueWorker:
+    def __init__(self, bot: Bot):
+        self.bot = bot
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task: Optional[asyncio.Task] = None
+        self._listen_conn: Optional[Any] = None
+
+    # --- LISTEN/NOTIFY ---
+    def _on_notify(self, *args: Any) -> None:
+        self._wakeup.set()
+
+    async def _ensure_listener(self) -> None:
+        if self._listen_conn is not None and not self._listen_conn.is_closed():
+            return
+        try:
+            # Отдельное соединение из пула на все время работы воркера
+            self._listen_conn = await database.get_standalone_connection()
+            await self._listen_conn.add_listener(database.EVENT_QUEUE_CHANNEL, self._on_notify)
+        except Exception as e:
+            self._listen_conn = None
+            logger.warning(f"EventQueue: Не удалось подписаться на NOTIFY, работаем опросом: {e}")
+
+    async def _close_listener(self) -> None:
+        conn, self._listen_conn = self._listen_conn, None
+        if conn is None or conn.is_closed():
+            return
+        try:
+            await conn.remove_listener(database.EVENT_QUEUE_CHANNEL, self._on_notify)
+        except Exception as e:
+            logger.debug(f"EventQueue: Ошибка при отписке от NOTIFY: {e}")
+        await conn.close()
+
+    # --- Обработка ---
+    async def _handle_event(self, event: Dict[str, Any], semaphore: asyncio.Semaphore) -> bool:
+        handler = _event_handlers.get(event['event_type'])
+        if handler is None:
+            logger.error(f"EventQueue: Нет обработчика для события {event['event_id']} типа '{event['event_type']}', событие отправлено в dead.")
+            await database.fail_event(event['event_id'], "Нет обработчика для типа события", None)
+            return False
+        async with semaphore:
+            try:
+                with db_metrics.caller_scope(f"event_queue:{event['event_type']}"):
+                    await handler(self.bot, event)
+                return True
+            except Exception as e:
+                attempts = event.get('attempts', 1)
+                if attempts >= Config.EVENT_QUEUE_MAX_ATTEMPTS:
+                    logger.error(f"EventQueue: Событие {event['event_id']} ('{event['event_type']}') не обработано за {attempts} попыток, отправлено в dead: {e}", exc_info=True)
+                    await database.fail_event(event['event_id'], repr(e), None)
+                else:
+                    delay = retry_delay_seconds(attempts)
+                    logger.warning(f"EventQueue: Ошибка обработки события {event['event_id']} ('{event['event_type']}'), попытка {attempts}, повтор через {delay:.0f} сек: {e}")
+                    await database.fail_event(event['event_id'], repr(e), delay)
+                return False
+
+    async def process_batch(self) -> int:
+        """Захватывает и обрабатывает одну пачку событий. Возвращает размер пачки."""
+        events = await database.claim_events(Config.EVENT_QUEUE_BATCH_SIZE, Config.EVENT_QUEUE_LOCK_TIMEOUT_SECONDS)
+        if not events:
+            return 0
+        # В пачке не больше одного события на пользователя, поэтому их можно обрабатывать параллельно
+        semaphore = asyncio.Semaphore(Config.EVENT_QUEUE_CONCURRENCY)
+        results = await asyncio.gather(*(self._handle_event(e, semaphore) for e in events), return_exceptions=True)
+        done_ids: List[int] = []
+        for event, result in zip(events, results):
+            if result is True:
+                done_ids.append(event['event_id'])
+            elif isinstance(result, Exception):
+                logger.error(f"EventQueue: Сбой при фиксации результата события {event['event_id']}: {result}")
+        await database.complete_events(done_ids)
+        return len(events)
+
+    async def _run(self) -> None:
+        logger.info("EventQueue: Воркер запущен.")
+        while not self._stopping:
+            await self._ensure_listener()
+            self._wakeup.clear()
+            try:
+                claimed = await self.process_batch()
+            except Exception as e:
+                logger.error(f"EventQueue: Ошибка цикла воркера: {e}", exc_info=True)
+                claimed = 0
+            if self._stopping:
+                break
+            if claimed >= Config.EVENT_QUEUE_BATCH_SIZE:
+                continue # Очередь не пуста - сразу берем следующую пачку
+            # Ждем NOTIFY; таймаут подбирает отложенные повторы и зависшие события
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=Config.EVENT_QUEUE_POLL_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+        logger.info("EventQueue: Воркер остановлен.")
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Останавливает воркер, дождавшись текущей пачки."""
+        self._stopping = True
+        self._wakeup.set()
+        if self._task is not None:
+            try:
+                await self._task
+            except Exception as e:
+                logger.error(f"EventQueue: Воркер завершился с ошибкой: {e}", exc_info=True)
+            self._task = None
+        await self._close_listener()
@@ -410,16 +410,12 @@ async def family_stats_command(message: Message, command: CommandObject, bot: Bo
 
         leader_full_name_from_db: Optional[str] = None
         leader_username_from_db: Optional[str] = None
-        conn = None
         try:
-            conn = await database.get_connection()
-            leader_info_row = await conn.fetchrow("SELECT full_name, username FROM user_oneui WHERE user_id = $1 ORDER BY last_used DESC NULLS LAST LIMIT 1", leader_id)
+            leader_info_row = await database.get_user_identity(leader_id)
             if leader_info_row:
                 leader_full_name_from_db = leader_info_row['full_name']
                 leader_username_from_db = leader_info_row['username']
         except Exception as e_db: print(f"DB error fetching leader info for {leader_id}: {e_db}") # Оставим print для отладки БД
-        finally:
-            if conn and not conn.is_closed(): await conn.close()
 
         if not leader_full_name_from_db:
             try:
@@ -472,38 +468,27 @@ async def top_families_command(message: Message, bot: Bot):
             return await message.reply("Пока нет семей для отображения в топе.")
 
         response_lines = ["<b>🏆 Топ Семей (сортировка по участникам):</b>"]
-        conn_local = None # Используем локальное имя, чтобы не пересекаться с conn в других местах
-        try:
-            conn_local = await database.get_connection()
-            for i, fam_data in enumerate(top_fams):
-                leader_id = fam_data['leader_id']
-                leader_full_name = fam_data.get('leader_full_name') # Это имя из user_oneui или при создании
-                leader_username: Optional[str] = None
-
-                # Дополнительный запрос для самого свежего username, если leader_full_name уже есть
-                # leader_full_name из get_top_families_by_total_contribution уже должен быть актуальным из user_oneui
-                if conn_local:
-                    leader_info_row = await conn_local.fetchrow("SELECT username FROM user_oneui WHERE user_id = $1 ORDER BY last_used DESC NULLS LAST LIMIT 1", leader_id)
-                    if leader_info_row:
-                        leader_username = leader_info_row['username']
-                
-                # Если имя все еще не определено (маловероятно, если лидер есть в user_oneui)
-                if not leader_full_name:
-                    try:
-                        leader_chat_info = await bot.get_chat(leader_id) # type: ignore
-                        leader_full_name = getattr(leader_chat_info, 'full_name', None) or getattr(leader_chat_info, 'first_name', None)
-                        if not leader_username: # Если username не был найден из БД
-                           leader_username = getattr(leader_chat_info, 'username', None)
-                    except Exception as e_gc: print(f"API error fetching leader info {leader_id} for topfamilies: {e_gc}")
-
-
-                leader_link = get_user_mention_html(leader_id, leader_full_name, leader_username)
-                response_lines.append(
-                    f"{i + 1}. <b>{html.escape(fam_data['name'])}</b> - "
-                    f"Участников: {fam_data['member_count']}/{Config.FAMILY_MAX_MEMBERS}, Лидер: {leader_link}"
-                )
-        finally:
-            if conn_local and not conn_local.is_closed(): await conn_local.close()
+        for i, fam_data in enumerate(top_fams):
+            leader_id = fam_data['leader_id']
+            # Имя и username лидера уже подтянуты из users в get_top_families_by_total_contribution
+            leader_full_name = fam_data.get('leader_full_name')
+            leader_username: Optional[str] = fam_data.get('leader_username')
+
+            # Если имя все еще не определено (лидера нет в users)
+            if not leader_full_name:
+                try:
+                    leader_chat_info = await bot.get_chat(leader_id) # type: ignore
+                    leader_full_name = getattr(leader_chat_info, 'full_name', None) or getattr(leader_chat_info, 'first_name', None)
+                    if not leader_username: # Если username не был найден из БД
+                       leader_username = getattr(leader_chat_info, 'username', None)
+                except Exception as e_gc: print(f"API error fetching leader info {leader_id} for topfamilies: {e_gc}")
+
+
+            leader_link = get_user_mention_html(leader_id, leader_full_name, leader_username)
+            response_lines.append(
+                f"{i + 1}. <b>{html.escape(fam_data['name'])}</b> - "
+                f"Участников: {fam_data['member_count']}/{Config.FAMILY_MAX_MEMBERS}, Лидер: {leader_link}"
+            )
         await message.reply("\n".join(response_lines), parse_mode="HTML", disable_web_page_preview=True)
     except Exception as e:
         await message.reply("Произошла ошибка при отображении топа семей.")
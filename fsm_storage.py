@@ -0,0 +1,250 @@
+# fsm_storage.py
+"""
+Хранилище FSM aiogram в PostgreSQL (таблица fsm_storage) вместо MemoryStorage.
+
+- TTL: у каждой записи есть срок жизни. Он зависит от группы состояний (таймаут подтверждения плюс запас)
+  и продлевается при каждой записи. Истекшая запись читается как пустая, а из таблицы ее удаляет
+  задача планировщика (database.delete_expired_fsm_states).
+- Пакетная запись: set_state / set_data меняют кэш сразу, а в БД изменения уходят пачкой раз в
+  flush_interval (или сразу, если накопилось flush_batch_size ключей). Несколько записей одного ключа
+  (set_state + update_data в одном обработчике) схлопываются в одну.
+- Кэш: чтения обслуживаются из памяти процесса, в БД идет только промах. Отсутствие состояния тоже
+  кэшируется: aiogram читает состояние на каждый апдейт, а у большинства пользователей его нет.
+  Записи кэша живут cache_ttl секунд. Кэш рассчитан на то, что апдейты одного пользователя попадают
+  в один процесс; при нескольких процессах без такого разбиения cache_ttl стоит уменьшить.
+
+Данные сериализуются в JSON; datetime/date сохраняются с пометкой типа и восстанавливаются при чтении.
+"""
+import asyncio
+import copy
+import json
+import time
+from collections import OrderedDict
+from datetime import date, datetime
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+import database
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+_DATETIME_TAG = "__datetime__"
+_DATE_TAG = "__date__"
+
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return {_DATETIME_TAG: value.isoformat()}
+    if isinstance(value, date):
+        return {_DATE_TAG: value.isoformat()}
+    raise TypeError(f"Значение типа {type(value).__name__} нельзя сохранить в состоянии FSM")
+
+
+def _json_object_hook(obj: Dict[str, Any]) -> Any:
+    if len(obj) == 1:
+        if _DATETIME_TAG in obj:
+            return datetime.fromisoformat(obj[_DATETIME_TAG])
+        if _DATE_TAG in obj:
+            return date.fromisoformat(obj[_DATE_TAG])
+    return obj
+
+
+def dump_data(data: Dict[str, Any]) -> str:
+    return json.dumps(data, default=_json_default, ensure_ascii=False)
+
+
+def load_data(raw: Optional[str]) -> Dict[str, Any]:
+    return json.loads(raw, object_hook=_json_object_hook) if raw else {}
+
+
+class _Record:
+    __slots__ = ("state", "data", "expires_at", "cached_at")
+
+    def __init__(self, state: Optional[str], data: Dict[str, Any], expires_at: float):
+        self.state = state
+        self.data = data
+        self.expires_at = expires_at # time.monotonic(), после которого запись считается пустой
+        self.cached_at = time.monotonic()
+
+    def is_empty(self) -> bool:
+        return self.state is None and not self.data
+
+
+class PostgresStorage(BaseStorage):
+    def __init__(self, state_ttls: Optional[Mapping[str, float]] = None, default_ttl: float = 3600.0,
+                 flush_interval: float = 0.2, flush_batch_size: int = 200,
+                 cache_ttl: float = 300.0, cache_max_size: int = 10000):
+        """
+        state_ttls - срок жизни записи по имени состояния ("Группа:состояние") или группы ("Группа"),
+        default_ttl - для остальных состояний.
+        """
+        self.state_ttls = dict(state_ttls or {})
+        self.default_ttl = default_ttl
+        self.flush_interval = flush_interval
+        self.flush_batch_size = flush_batch_size
+        self.cache_ttl = cache_ttl
+        self.cache_max_size = cache_max_size
+        self._cache: "OrderedDict[str, _Record]" = OrderedDict()
+        self._dirty: Dict[str, _Record] = {} # Изменения, еще не записанные в БД
+        self._inflight: Dict[str, _Record] = {} # Изменения, которые записываются прямо сейчас
+        self._flush_wakeup = asyncio.Event()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._closing = False
+
+    @staticmethod
+    def make_key(key: StorageKey) -> str:
+        return ":".join(str(part) for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id or "",
+            getattr(key, "business_connection_id", None) or "", key.destiny,
+        ))
+
+    def ttl_for_state(self, state: Optional[str]) -> float:
+        if state is None:
+            return self.default_ttl
+        if state in self.state_ttls:
+            return self.state_ttls[state]
+        return self.state_ttls.get(state.split(":", 1)[0], self.default_ttl)
+
+    # --- Кэш ---
+    def _cache_put(self, storage_key: str, record: _Record) -> None:
+        self._cache[storage_key] = record
+        self._cache.move_to_end(storage_key)
+        while len(self._cache) > self.cache_max_size:
+            evicted_key, _ = self._cache.popitem(last=False)
+            pending = self._pending(evicted_key)
+            if pending is not None:
+                # Не записанное в БД не вытесняем, иначе следующее чтение вернет старое значение
+                self._cache[evicted_key] = pending
+                break
+
+    def _pending(self, storage_key: str) -> Optional[_Record]:
+        return self._dirty.get(storage_key) or self._inflight.get(storage_key)
+
+    async def _load(self, storage_key: str) -> _Record:
+        now = time.monotonic()
+        pending = self._pending(storage_key)
+        record = pending or self._cache.get(storage_key)
+        if record is not None and (pending is not None or now - record.cached_at < self.cache_ttl):
+            if now >= record.expires_at:
+                record = _Record(None, {}, float("inf"))
+                self._cache_put(storage_key, record)
+                if pending is not None:
+                    self._dirty[storage_key] = record
+            return record
+        row = await database.get_fsm_record(storage_key)
+        if row is None:
+            record = _Record(None, {}, float("inf"))
+        else:
+            record = _Record(row['state'], load_data(row['data']), now + max(row['ttl_seconds'] or 0.0, 0.0))
+        self._cache_put(storage_key, record)
+        return record
+
+    def _store(self, storage_key: str, state: Optional[str], data: Dict[str, Any]) -> None:
+        record = _Record(state, data, time.monotonic() + self.ttl_for_state(state))
+        self._cache_put(storage_key, record)
+        self._dirty[storage_key] = record
+        self._ensure_flusher()
+        if len(self._dirty) >= self.flush_batch_size:
+            self._flush_wakeup.set()
+
+    # --- Интерфейс BaseStorage ---
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = self.make_key(key)
+        record = await self._load(storage_key)
+        new_state = state.state if isinstance(state, State) else state
+        self._store(storage_key, new_state, record.data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._load(self.make_key(key))).state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise TypeError(f"Данные FSM должны быть dict, получено {type(data).__name__}")
+        storage_key = self.make_key(key)
+        record = await self._load(storage_key)
+        dump_data(data) # Несериализуемые данные должны падать в обработчике, а не при фоновой записи
+        self._store(storage_key, record.state, copy.deepcopy(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return copy.deepcopy((await self._load(self.make_key(key))).data)
+
+    async def close(self) -> None:
+        """Останавливает фоновую запись и сбрасывает в БД все накопленные изменения."""
+        self._closing = True
+        self._flush_wakeup.set()
+        task, self._flush_task = self._flush_task, None
+        if task is not None:
+            try:
+                await task
+            except Exception as e:
+                logger.error(f"FSMStorage: Фоновая запись завершилась с ошибкой: {e}", exc_info=True)
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"FSMStorage: При остановке не удалось записать {len(self._dirty)} состояний FSM: {e}", exc_info=True)
+        self._closing = False
+
+    # --- Пакетная запись ---
+    def _ensure_flusher(self) -> None:
+        if self._closing:
+            return
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def flush(self) -> int:
+        """Записывает накопленные изменения одной транзакцией. Возвращает количество ключей."""
+        if not self._dirty:
+            return 0
+        batch, self._dirty = self._dirty, {}
+        self._inflight = batch
+        upserts = []
+        delete_keys = []
+        for storage_key, record in batch.items():
+            if record.is_empty():
+                delete_keys.append(storage_key)
+            else:
+                ttl = max(record.expires_at - time.monotonic(), 1.0)
+                upserts.append((storage_key, record.state, dump_data(record.data), ttl))
+        try:
+            await database.save_fsm_records_batch(upserts, delete_keys)
+        except Exception:
+            # Возвращаем в очередь то, что не успели перезаписать новыми изменениями
+            for storage_key, record in batch.items():
+                self._dirty.setdefault(storage_key, record)
+            raise
+        finally:
+            self._inflight = {}
+        return len(batch)
+
+    async def _flush_loop(self) -> None:
+        retry_delay = self.flush_interval
+        while True:
+            if not self._dirty:
+                if self._closing:
+                    return
+                self._flush_wakeup.clear()
+                await self._flush_wakeup.wait()
+                continue
+            if len(self._dirty) < self.flush_batch_size and not self._closing:
+                # Даем накопиться пачке
+                self._flush_wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._flush_wakeup.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            try:
+                await self.flush()
+                retry_delay = self.flush_interval
+            except Exception as e:
+                logger.error(f"FSMStorage: Не удалось записать {len(self._dirty)} состояний FSM, повтор через {retry_delay:.1f} сек: {e}")
+                if self._closing:
+                    return
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, 30.0)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"cached": len(self._cache), "pending_writes": len(self._dirty)}
@@ -0,0 +1,127 @@
+# leader_election.py
+"""
+Выбор лидера среди нескольких запущенных процессов бота.
+
+Лидерство - это аренда (lease) в system_settings: строка с ключом, владельцем и временем истечения
+(database.try_acquire_lease). Каждый процесс раз в heartbeat_seconds пытается взять или продлить
+аренду. Лидер продлевает ее, остальные получают отказ, пока аренда не истечет; если лидер упал,
+аренду через lease_seconds забирает следующий процесс. При нормальной остановке лидер освобождает
+аренду сразу (release_lease), и другой процесс становится лидером на ближайшем heartbeat.
+
+Используется для планировщика задач (main.py): задачи регистрируются во всех процессах,
+но планировщик запущен на паузе и возобновляется только у лидера.
+"""
+import asyncio
+import inspect
+import os
+import socket
+import time
+import uuid
+from typing import Any, Callable, Optional
+
+import database
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_LEASE_KEY = "scheduler_leader_lease"
+
+
+def make_holder_id() -> str:
+    """Уникальный идентификатор процесса: хост, pid и случайный суффикс (pid может повториться после рестарта)."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class LeaderElector:
+    def __init__(self, lease_key: str, lease_seconds: float, heartbeat_seconds: float,
+                 on_elected: Optional[Callable[[], Any]] = None,
+                 on_demoted: Optional[Callable[[], Any]] = None,
+                 holder_id: Optional[str] = None):
+        if heartbeat_seconds >= lease_seconds:
+            raise ValueError("heartbeat_seconds должен быть меньше lease_seconds, иначе аренда истечет между продлениями.")
+        self.lease_key = lease_key
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.holder_id = holder_id or make_holder_id()
+        self._on_elected = on_elected
+        self._on_demoted = on_demoted
+        self._is_leader = False
+        self._lease_valid_until = 0.0 # time.monotonic(), до которого наша аренда точно действует
+        self._stop_event = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self._is_leader
+
+    async def _call(self, callback: Optional[Callable[[], Any]], what: str) -> None:
+        if callback is None:
+            return
+        try:
+            result = callback()
+            if inspect.isawaitable(result):
+                await result
+        except Exception as e:
+            logger.error(f"LeaderElection: Ошибка в обработчике '{what}' для '{self.lease_key}': {e}", exc_info=True)
+
+    async def _set_leader(self, is_leader: bool) -> None:
+        if is_leader == self._is_leader:
+            return
+        self._is_leader = is_leader
+        if is_leader:
+            logger.info(f"LeaderElection: {self.holder_id} стал лидером '{self.lease_key}'.")
+            await self._call(self._on_elected, "on_elected")
+        else:
+            logger.warning(f"LeaderElection: {self.holder_id} больше не лидер '{self.lease_key}'.")
+            await self._call(self._on_demoted, "on_demoted")
+
+    async def heartbeat(self) -> bool:
+        """Одна попытка взять/продлить аренду. Возвращает, является ли процесс лидером после нее."""
+        started = time.monotonic()
+        try:
+            acquired = await database.try_acquire_lease(self.lease_key, self.holder_id, self.lease_seconds)
+        except Exception as e:
+            logger.warning(f"LeaderElection: Не удалось продлить аренду '{self.lease_key}': {e}")
+            # Связи с БД нет: лидер остается лидером, пока аренда не может истечь, затем уступает,
+            # чтобы задачи не выполнялись одновременно с новым лидером
+            if self._is_leader and time.monotonic() >= self._lease_valid_until:
+                await self._set_leader(False)
+            return self._is_leader
+        if acquired:
+            # Сервер отсчитывает аренду от начала запроса, поэтому и здесь считаем от started, с запасом в один heartbeat
+            self._lease_valid_until = started + self.lease_seconds - self.heartbeat_seconds
+        await self._set_leader(acquired)
+        return self._is_leader
+
+    async def _run(self) -> None:
+        logger.info(f"LeaderElection: {self.holder_id} участвует в выборе лидера '{self.lease_key}' "
+                    f"(аренда {self.lease_seconds:.0f} сек, продление каждые {self.heartbeat_seconds:.0f} сек).")
+        while not self._stop_event.is_set():
+            try:
+                await self.heartbeat()
+            except Exception as e:
+                logger.error(f"LeaderElection: Ошибка цикла выбора лидера: {e}", exc_info=True)
+            try:
+                await asyncio.wait_for(self._stop_event.wait(), timeout=self.heartbeat_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._stop_event.clear()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Прекращает участие в выборах; если процесс был лидером - освобождает аренду для остальных."""
+        self._stop_event.set()
+        if self._task is not None:
+            try:
+                await self._task
+            except Exception as e:
+                logger.error(f"LeaderElection: Цикл выбора лидера завершился с ошибкой: {e}", exc_info=True)
+            self._task = None
+        if self._is_leader:
+            await self._set_leader(False)
+            if await database.release_lease(self.lease_key, self.holder_id):
+                logger.info(f"LeaderElection: {self.holder_id} освободил аренду '{self.lease_key}'.")
@@ -0,0 +1,269 @@
+# locks.py
+"""
+Блокировки команд по ключу (например, (user_id, chat_id)).
+
+Раньше это были словари asyncio.Lock, которые никогда не уменьшались, а каждое получение
+лока шло через один глобальный asyncio.Lock. Здесь запись для ключа создается при входе
+в `async with` и удаляется, как только ее никто не держит и не ждет, поэтому словарь
+содержит только активные ключи. Все операции со словарем синхронные (между проверкой и
+изменением нет await), так что отдельный мьютекс на создание не нужен.
+
+Использование не изменилось:
+    lock = await database.get_user_chat_lock(user_id, chat_id)
+    async with lock:
+        ...
+
+Для запуска нескольких процессов бота поверх локального лока можно включить межпроцессный
+бэкенд (set_lock_backend, Config.LOCK_BACKEND = "postgres"): PostgresAdvisoryLockBackend
+дополнительно берет pg_try_advisory_lock по хэшу (набор, ключ). По умолчанию бэкенда нет -
+хватает локальных локов одного процесса.
+"""
+import asyncio
+import hashlib
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class _LockEntry:
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0 # Держат лок или ждут его
+
+
+class LockTimeoutError(Exception):
+    pass
+
+
+class LockBackend(ABC):
+    """Межпроцессная блокировка, которая берется поверх локальной. acquire возвращает токен для release."""
+    name = "base"
+
+    @abstractmethod
+    async def acquire(self, scope: str, key: Hashable) -> Any:
+        ...
+
+    @abstractmethod
+    async def release(self, token: Any) -> None:
+        ...
+
+
+class PostgresAdvisoryLockBackend(LockBackend):
+    """
+    Advisory-блокировка PostgreSQL на уровне сессии (pg_try_advisory_lock с повтором и backoff).
+    connection_factory - обычно database.get_connection: внутри апдейта это соединение апдейта,
+    поэтому отдельное соединение из пула не занимается. Если разблокировка не удалась, блокировку
+    снимет сброс соединения при возврате в пул (asyncpg делает pg_advisory_unlock_all()).
+    """
+    name = "postgres"
+
+    def __init__(self, connection_factory: Callable[[], Awaitable[Any]],
+                 timeout: Optional[float] = 30.0, poll_initial: float = 0.05, poll_max: float = 0.5):
+        self._connection_factory = connection_factory
+        self.timeout = timeout
+        self.poll_initial = poll_initial
+        self.poll_max = poll_max
+
+    @staticmethod
+    def advisory_key(scope: str, key: Hashable) -> int:
+        """Стабильный между процессами 64-битный ключ для (набор, ключ)."""
+        digest = hashlib.blake2b(f"{scope}:{key!r}".encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "big", signed=True)
+
+    async def acquire(self, scope: str, key: Hashable) -> Any:
+        lock_id = self.advisory_key(scope, key)
+        conn = await self._connection_factory()
+        try:
+            delay = self.poll_initial
+            deadline = time.monotonic() + self.timeout if self.timeout else None
+            while not await conn.fetchval("SELECT pg_try_advisory_lock($1)", lock_id):
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise LockTimeoutError(f"Не удалось получить advisory-блокировку {scope}:{key!r} за {self.timeout} сек.")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.poll_max)
+            return conn, lock_id
+        except BaseException:
+            await conn.close()
+            raise
+
+    async def release(self, token: Any) -> None:
+        conn, lock_id = token
+        try:
+            await conn.execute("SELECT pg_advisory_unlock($1)", lock_id)
+        except Exception as e:
+            logger.warning(f"Locks: Не удалось снять advisory-блокировку {lock_id}, она будет снята при возврате соединения: {e}")
+        finally:
+            await conn.close()
+
+
+_backend: Optional[LockBackend] = None
+
+
+def set_lock_backend(backend: Optional[LockBackend]) -> None:
+    """Включает межпроцессный бэкенд для всех наборов локов (None - только локальные локи)."""
+    global _backend
+    _backend = backend
+    logger.info(f"Locks: Бэкенд блокировок: {backend.name if backend else 'memory'}.")
+
+
+def get_lock_backend() -> Optional[LockBackend]:
+    return _backend
+
+
+class KeyedLock:
+    """Лок для одного ключа. Поддерживает `async with` и повторное использование."""
+    __slots__ = ("_manager", "_key", "_entry", "_backend", "_backend_token")
+
+    def __init__(self, manager: "KeyedLockManager", key: Hashable):
+        self._manager = manager
+        self._key = key
+        self._entry: Optional[_LockEntry] = None
+        self._backend: Optional[LockBackend] = None
+        self._backend_token: Any = None
+
+    @property
+    def key(self) -> Hashable:
+        return self._key
+
+    def locked(self) -> bool:
+        entry = self._manager._entries.get(self._key)
+        return bool(entry and entry.lock.locked())
+
+    async def acquire(self) -> bool:
+        if self._entry is not None:
+            raise RuntimeError(f"Лок {self._key!r} уже захвачен через этот объект.")
+        entry = await self._manager._acquire(self._key)
+        backend = _backend
+        if backend is not None:
+            started = time.perf_counter()
+            try:
+                self._backend_token = await backend.acquire(self._manager.name, self._key)
+            except BaseException:
+                self._manager._release(self._key, entry)
+                raise
+            self._manager._record_backend_wait(time.perf_counter() - started)
+            self._backend = backend
+        self._entry = entry
+        return True
+
+    async def release(self) -> None:
+        entry, self._entry = self._entry, None
+        if entry is None:
+            raise RuntimeError(f"Лок {self._key!r} не был захвачен.")
+        backend, token = self._backend, self._backend_token
+        self._backend, self._backend_token = None, None
+        try:
+            if backend is not None:
+                await backend.release(token)
+        finally:
+            self._manager._release(self._key, entry)
+
+    async def __aenter__(self) -> "KeyedLock":
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type: Any, exc: Any, tb: Any) -> None:
+        await self.release()
+
+
+class KeyedLockManager:
+    """Набор локов по ключу с удалением неиспользуемых записей и метриками ожидания."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._entries: Dict[Hashable, _LockEntry] = {}
+        self._reset_metrics()
+
+    def _reset_metrics(self) -> None:
+        self.acquisitions = 0
+        self.contended = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.peak_size = len(self._entries)
+        self.backend_acquisitions = 0
+        self.backend_total_wait_seconds = 0.0
+        self.backend_max_wait_seconds = 0.0
+
+    def _record_backend_wait(self, seconds: float) -> None:
+        self.backend_acquisitions += 1
+        self.backend_total_wait_seconds += seconds
+        if seconds > self.backend_max_wait_seconds:
+            self.backend_max_wait_seconds = seconds
+
+    def get(self, *key_parts: Hashable) -> KeyedLock:
+        key = key_parts[0] if len(key_parts) == 1 else tuple(key_parts)
+        return KeyedLock(self, key)
+
+    async def _acquire(self, key: Hashable) -> _LockEntry:
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = _LockEntry()
+            if len(self._entries) > self.peak_size:
+                self.peak_size = len(self._entries)
+        entry.users += 1
+        self.acquisitions += 1
+        # users считает и держащих лок, и ожидающих его: если мы не одни, захват может ждать,
+        # даже когда лок уже отпущен, но еще не передан разбуженному ожидающему
+        contended = entry.users > 1
+        if contended:
+            self.contended += 1
+        started = time.perf_counter()
+        try:
+            await entry.lock.acquire()
+        except BaseException:
+            self._forget(key, entry) # Иначе при отмене во время ожидания запись не удалится
+            raise
+        if contended:
+            waited = time.perf_counter() - started
+            self.total_wait_seconds += waited
+            if waited > self.max_wait_seconds:
+                self.max_wait_seconds = waited
+        return entry
+
+    def _release(self, key: Hashable, entry: _LockEntry) -> None:
+        entry.lock.release()
+        self._forget(key, entry)
+
+    def _forget(self, key: Hashable, entry: _LockEntry) -> None:
+        entry.users -= 1
+        if entry.users <= 0 and self._entries.get(key) is entry:
+            del self._entries[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active_keys": len(self._entries),
+            "peak_keys": self.peak_size,
+            "acquisitions": self.acquisitions,
+            "contended": self.contended,
+            "total_wait_ms": self.total_wait_seconds * 1000.0,
+            "avg_wait_ms": (self.total_wait_seconds / self.contended * 1000.0) if self.contended else 0.0,
+            "max_wait_ms": self.max_wait_seconds * 1000.0,
+            "backend_acquisitions": self.backend_acquisitions,
+            "backend_avg_wait_ms": (self.backend_total_wait_seconds / self.backend_acquisitions * 1000.0) if self.backend_acquisitions else 0.0,
+            "backend_max_wait_ms": self.backend_max_wait_seconds * 1000.0,
+        }
+
+    def reset_stats(self) -> None:
+        self._reset_metrics()
+
+
+_managers: Dict[str, KeyedLockManager] = {}
+
+
+def get_lock_manager(name: str) -> KeyedLockManager:
+    """Возвращает (создавая при необходимости) набор локов с именем name."""
+    manager = _managers.get(name)
+    if manager is None:
+        manager = _managers[name] = KeyedLockManager(name)
+    return manager
+
+
+def lock_stats() -> Dict[str, Dict[str, Any]]:
+    """Метрики всех наборов локов: {имя: stats()}."""
+    return {name: manager.stats() for name, manager in _managers.items()}
@@ -10,15 +10,14 @@ from aiogram import Bot, Dispatcher, Router, F
 from aiogram.filters import Command, CommandObject
 from aiogram.types import Message, Chat, User as AiogramUser # AiogramUser может быть нужен для resolve_target_user
 from aiogram.client.default import DefaultBotProperties
-from aiogram.fsm.storage.memory import MemoryStorage # Если используется FSM
-from phone_data import PHONE_MODELS as PHONE_MODELS_STANDARD_LIST_FOR_MAIN
-from exclusive_phone_data import EXCLUSIVE_PHONE_MODELS as EXCLUSIVE_PHONE_MODELS_LIST_FOR_MAIN
+from fsm_storage import PostgresStorage
+import catalog
 from business_data import BUSINESS_DATA # Добавлено
 from business_logic import setup_business_handlers, process_daily_business_income_and_events # Добавлено
 from stats_logic import setup_stats_handlers
-from achievements_logic import check_and_grant_achievements, setup_achievements_handlers
+from achievements_logic import check_and_grant_achievements, enqueue_achievements_check, setup_achievements_handlers
 from commands_data import COMMAND_CATEGORIES
-from robbank_logic import setup_robbank_handlers
+from robbank_logic import setup_robbank_handlers, process_due_robbank_operation
 from dotenv import load_dotenv
 from pytz import timezone as pytz_timezone # Убедитесь, что pytz установлен: pip install pytz
 import logging
@@ -29,9 +28,20 @@ from reminders_logic import setup_reminders_handlers
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 from apscheduler.triggers.date import DateTrigger
-from black_market_logic import setup_black_market_handlers, refresh_black_market_offers
+from black_market_logic import setup_black_market_handlers, refresh_black_market_offers, BlackMarketPurchaseStates
 
 from config import Config
+from middlewares import DbConnectionMiddleware, KnownUsersMiddleware, KnownUserRowsMiddleware, HandlerNameMiddleware, FloodControlMiddleware
+from admin_logic import setup_admin_handlers
+import locks
+from event_queue import EventQueueWorker
+from leader_election import LeaderElector, SCHEDULER_LEASE_KEY
+import sharding
+import webhook
+import outbox
+import digest
+import deadlines
+import shop_pages
 import database # Импортируем модуль database целиком
 # Можно также импортировать конкретные функции, если их много и это улучшает читаемость
 from database import (
@@ -46,16 +56,15 @@ from database import (
     get_user_bonus_multiplier_status, update_user_bonus_multiplier_status,
     get_user_daily_streak, update_user_daily_streak,
     # НОВЫЕ ИМПОРТЫ ДЛЯ ШЕДУЛЕРА ТЕЛЕФОНОВ
-    get_all_operational_phones, get_phones_for_battery_check, update_phone_status_fields,
+    get_all_operational_phones, update_phone_status_fields,
     get_phones_with_expiring_insurance,
     get_user_chat_lock
 )
 
 # Импортируем обработчики из других модулей
 try:
-    from utils import get_user_mention_html, send_telegram_log
+    from utils import get_user_mention_html, send_telegram_log, fetch_user_display_data
     from item_data import PHONE_CASES, CORE_PHONE_COMPONENT_TYPES, PHONE_COMPONENTS
-    from phone_data import PHONE_MODELS as PHONE_MODELS_LIST_MAIN
 
 
 except ImportError:
@@ -67,19 +76,19 @@ except ImportError:
         return f'<a href="tg://user?id={user_id}">{display_name}</a>'
     async def send_telegram_log(bot_instance: Bot, message_text: str, include_timestamp: bool = True): # type: ignore
         logging.error(f"Функция send_telegram_log не доступна (заглушка). Сообщение: {message_text}")
+    async def fetch_user_display_data(bot_instance: Bot, user_id_to_fetch: int) -> Tuple[str, Optional[str]]: # type: ignore
+        return f"User ID {user_id_to_fetch}", None
 
 from item_data import PHONE_CASES, CORE_PHONE_COMPONENT_TYPES
-from families_logic import setup_families_handlers
+from families_logic import setup_families_handlers, FamilyLeaveStates, CONFIRMATION_TIMEOUT_SECONDS as FAMILY_LEAVE_CONFIRMATION_TIMEOUT_SECONDS
 from onecoin_logic import setup_onecoin_handlers
 from competition_logic import setup_competition_handlers
 from bonus_logic import setup_bonus_handlers
 from roulette_logic import setup_roulette_handlers
-from market_logic import setup_market_handlers # <<< ИМПОРТ ДЛЯ РЫНКА
-from phone_logic import setup_phone_handlers, get_active_user_phone_bonuses 
+from market_logic import setup_market_handlers, MarketPurchaseStates # <<< ИМПОРТ ДЛЯ РЫНКА
+from phone_logic import setup_phone_handlers, get_active_user_phone_bonuses, PurchaseStates, CONFIRMATION_TIMEOUT_SECONDS_ITEM, CONFIRMATION_TIMEOUT_SECONDS_PHONE, _auto_sell_expired_prize
 
-PHONE_MODELS_MAIN = {phone_info["key"]: phone_info for phone_info in PHONE_MODELS_LIST_MAIN}
 load_dotenv()
-EXCLUSIVE_PHONE_MODELS_DICT = {p["key"]: p for p in EXCLUSIVE_PHONE_MODELS_LIST_FOR_MAIN}
 
 logging.basicConfig(
     level=logging.INFO, # Общий уровень INFO
@@ -93,13 +102,102 @@ if not Config.BOT_TOKEN:
     raise ValueError("BOT_TOKEN environment variable not set.")
 
 bot = Bot(token=Config.BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
-storage = MemoryStorage() # Для FSM
+# FSM в PostgreSQL: запись живет таймаут подтверждения плюс запас, чтобы обработчик успел ответить "время вышло"
+storage = PostgresStorage(
+    state_ttls={
+        PurchaseStates.__full_group_name__: max(CONFIRMATION_TIMEOUT_SECONDS_PHONE, CONFIRMATION_TIMEOUT_SECONDS_ITEM) + Config.FSM_TTL_GRACE_SECONDS,
+        BlackMarketPurchaseStates.__full_group_name__: Config.MARKET_PHONE_CONFIRMATION_TIMEOUT_SECONDS + Config.FSM_TTL_GRACE_SECONDS,
+        MarketPurchaseStates.__full_group_name__: Config.MARKET_PURCHASE_CONFIRMATION_TIMEOUT_SECONDS + Config.FSM_TTL_GRACE_SECONDS,
+        FamilyLeaveStates.__full_group_name__: FAMILY_LEAVE_CONFIRMATION_TIMEOUT_SECONDS + Config.FSM_TTL_GRACE_SECONDS,
+    },
+    default_ttl=Config.FSM_DEFAULT_TTL_SECONDS,
+    flush_interval=Config.FSM_FLUSH_INTERVAL_SECONDS,
+    flush_batch_size=Config.FSM_FLUSH_BATCH_SIZE,
+    cache_ttl=Config.FSM_CACHE_TTL_SECONDS,
+    cache_max_size=Config.FSM_CACHE_MAX_SIZE,
+)
 dp = Dispatcher(storage=storage)
+dp.update.outer_middleware(DbConnectionMiddleware(use_transaction=Config.DB_REQUEST_TRANSACTION))
+dp.update.outer_middleware(KnownUsersMiddleware())
+# Внутренние middleware наследуются вложенными роутерами: ограничение частоты команд и имя обработчика для метрик БД
+if Config.FLOOD_CONTROL_ENABLED:
+    # Одна middleware на сообщения и callback'и, чтобы у них были общие ведра токенов
+    flood_control = FloodControlMiddleware(
+        user_capacity=Config.FLOOD_USER_BURST, user_rate=Config.FLOOD_USER_RATE_PER_SECOND,
+        chat_capacity=Config.FLOOD_CHAT_BURST, chat_rate=Config.FLOOD_CHAT_RATE_PER_SECOND,
+        costs=Config.FLOOD_COMMAND_COSTS, warning_window=Config.FLOOD_WARNING_WINDOW_SECONDS,
+        warning_text=Config.FLOOD_WARNING_TEXT, exempt_user_ids=(Config.ADMIN_ID,),
+    )
+    dp.message.middleware(flood_control)
+    dp.callback_query.middleware(flood_control)
+dp.message.middleware(HandlerNameMiddleware())
+dp.callback_query.middleware(HandlerNameMiddleware())
+# Записи user_oneui создаются только для апдейтов, дошедших до обработчика
+known_user_rows = KnownUserRowsMiddleware(max_size=Config.KNOWN_USERS_CACHE_MAX_SIZE)
+dp.message.middleware(known_user_rows)
+dp.callback_query.middleware(known_user_rows)
 scheduler = AsyncIOScheduler(timezone=Config.TIMEZONE if Config.TIMEZONE else "UTC")
 
-# --- Словари для блокировок команд ---
-user_command_locks: Dict[Tuple[int, int], asyncio.Lock] = {}
-locks_dict_creation_lock = asyncio.Lock()
+# Общий бюджет отправки: рассылки идут через очередь outbox, ответы на команды - через middleware сессии
+# с более высоким приоритетом. При нескольких процессах-обработчиках (ShardedPolling) бюджет делится между ними;
+# в режиме webhook BOT_WORKERS не используется, и процесс получает весь бюджет.
+outbound_budget_shares = Config.BOT_WORKERS if Config.BOT_MODE != "webhook" and Config.BOT_WORKERS > 1 else 1
+outbound_limiter = outbox.PriorityRateLimiter(Config.OUTBOX_GLOBAL_RATE_PER_SECOND / outbound_budget_shares)
+bot.session.middleware(outbox.OutboundRateMiddleware(outbound_limiter))
+outbound_dispatcher = outbox.OutboundDispatcher(
+    bot.send_message, outbound_limiter,
+    private_interval=Config.OUTBOX_PRIVATE_CHAT_INTERVAL_SECONDS, group_interval=Config.OUTBOX_GROUP_CHAT_INTERVAL_SECONDS,
+    max_attempts=Config.OUTBOX_MAX_ATTEMPTS, retry_base_seconds=Config.OUTBOX_RETRY_BASE_SECONDS,
+    lease_seconds=Config.OUTBOX_LEASE_SECONDS,
+)
+outbox.set_outbound_dispatcher(outbound_dispatcher)
+event_queue_worker = EventQueueWorker(bot)
+
+
+# Сроки (истечение призов, поломка аккумуляторов, итог /robbank) выполняются в момент наступления, см. deadlines.py
+deadline_engine = deadlines.DeadlineEngine(
+    horizon_seconds=Config.DEADLINE_HORIZON_SECONDS,
+    reconcile_interval=Config.DEADLINE_RECONCILE_INTERVAL_SECONDS,
+    max_concurrency=Config.DEADLINE_MAX_CONCURRENCY,
+)
+deadline_engine.register(
+    deadlines.KIND_PHONE_PRIZE, database.get_phone_prize_deadlines,
+    lambda user_id: handle_phone_prize_deadline(bot, user_id),
+)
+deadline_engine.register(
+    deadlines.KIND_BATTERY_BREAK, database.get_battery_break_deadlines,
+    lambda phone_id: handle_battery_break_deadline(bot, phone_id),
+)
+deadline_engine.register(
+    deadlines.KIND_ROBBANK,
+    lambda until_utc: database.get_robbank_operation_deadlines(until_utc, Config.ROBBANK_RESULT_DELAY_MAX_SECONDS),
+    lambda key: process_due_robbank_operation(bot, *key),
+)
+deadlines.set_deadline_engine(deadline_engine)
+
+
+def _resume_scheduler_jobs():
+    if scheduler.running:
+        scheduler.resume()
+        logger.info("Планировщик: этот процесс - лидер, задачи возобновлены.")
+    deadline_engine.start()
+
+
+async def _pause_scheduler_jobs():
+    if scheduler.running:
+        scheduler.pause()
+        logger.info("Планировщик: этот процесс больше не лидер, задачи приостановлены.")
+    await deadline_engine.stop()
+
+
+# Несколько процессов бота: задачи планировщика выполняет только лидер (см. leader_election.py)
+scheduler_leader = LeaderElector(
+    SCHEDULER_LEASE_KEY,
+    lease_seconds=Config.SCHEDULER_LEASE_SECONDS,
+    heartbeat_seconds=Config.SCHEDULER_HEARTBEAT_SECONDS,
+    on_elected=_resume_scheduler_jobs,
+    on_demoted=_pause_scheduler_jobs,
+)
 
 
 # --- Конец блокировок ---
@@ -219,6 +317,7 @@ async def check_and_finalize_competitions():
                     conn_reward = await database.get_connection()
                     try:
                         async with conn_reward.transaction():
+                            onecoin_rewards: List[Tuple[int, int, int]] = []
                             for member in winner_members_data:
                                 user_id_member = member['user_id']
                                 current_user_data = await database.get_user_data_for_update(user_id_member, Config.ADMIN_ID, conn_ext=conn_reward) # Chat_id заглушка
@@ -239,12 +338,10 @@ async def check_and_finalize_competitions():
                                     username=final_username_for_reward, full_name=final_full_name_for_reward,
                                     chat_title=f"Награда за соревнование {competition_id}", conn_ext=conn_reward
                                 )
-                                await database.update_user_onecoins(
-                                    user_id_member, reward_chat_id_to_use, Config.COMPETITION_WINNER_ONECOIN_BONUS,
-                                    username=final_username_for_reward, full_name=final_full_name_for_reward,
-                                    chat_title=f"Награда за соревнование {competition_id}", conn_ext=conn_reward
-                                )
+                                onecoin_rewards.append((user_id_member, reward_chat_id_to_use, Config.COMPETITION_WINNER_ONECOIN_BONUS))
                                 logger.info(f"Rewarded user {user_id_member} (Family '{winner_family_name}') with {Config.COMPETITION_WINNER_VERSION_BONUS:.1f}V and {Config.COMPETITION_WINNER_ONECOIN_BONUS}C in chat {reward_chat_id_to_use}.")
+                            # Монеты всем победителям - одним запросом
+                            await database.update_users_onecoins_batch(onecoin_rewards, conn_ext=conn_reward)
                     except Exception as e_reward:
                         logger.error(f"Error during reward transaction for comp {competition_id}, family {winner_family_id}: {e_reward}", exc_info=True)
                     finally:
@@ -273,46 +370,31 @@ async def check_and_finalize_competitions():
         logger.error(f"Critical error in check_and_finalize_competitions: {e_main_check}", exc_info=True)
         await send_telegram_log(bot, f"🔴 Ошибка при завершении соревнований:\n<pre>{html.escape(str(e_main_check))}</pre>")
         
-async def scheduled_check_expired_phone_prizes(bot_instance: Bot):
+async def handle_phone_prize_deadline(bot_instance: Bot, user_id: int):
     """
-    Периодическая задача для проверки просроченных выигранных телефонов, ожидающих решения.
-    Автоматически продает их боту.
+    Срок deadlines.KIND_PHONE_PRIZE: пользователь не решил судьбу выигранного телефона -
+    телефон автоматически продается боту.
     """
-    logger.info("SCHEDULER: Запуск проверки просроченных выигранных телефонов...")
-    expiry_time_td = timedelta(seconds=getattr(Config, "MARKET_PHONE_CONFIRMATION_TIMEOUT_SECONDS", 60)) # Тот же таймаут
+    expiry_time_td = timedelta(seconds=Config.MARKET_PHONE_CONFIRMATION_TIMEOUT_SECONDS)
 
     conn = None
     try:
         conn = await database.get_connection() # Получаем соединение для транзакции
-        expired_prizes = await database.get_expired_pending_phone_prizes(expiry_time_td, conn_ext=conn)
-
-        if not expired_prizes:
-            logger.info("SCHEDULER (Expired Prizes): Нет просроченных призов для обработки.")
-            return
-
-        logger.info(f"SCHEDULER (Expired Prizes): Найдено {len(expired_prizes)} просроченных призов.")
-
-        async with conn.transaction(): # Оборачиваем обработку всех просроченных призов в одну транзакцию
-            for prize_data in expired_prizes:
-                user_id = prize_data['user_id']
-                logger.info(f"SCHEDULER (Expired Prizes): Обработка просроченного приза для user {user_id}.")
-                # Вызываем функцию автоматической продажи внутри транзакции
-                try:
-                    await _auto_sell_expired_prize(user_id, bot_instance, conn_ext=conn)
-                except Exception as e_auto_sell:
-                    logger.error(f"SCHEDULER (Expired Prizes): Ошибка при автопродаже приза для user {user_id}: {e_auto_sell}", exc_info=True)
-                    # Логируем ошибку, но продолжаем обработку других призов в рамках той же транзакции
-
-
-        logger.info(f"SCHEDULER (Expired Prizes): Завершено обработка просроченных призов.")
-
-    except Exception as e_main_scheduler:
-        logger.error(f"SCHEDULER (Expired Prizes): Критическая ошибка в задаче проверки просроченных призов: {e_main_scheduler}", exc_info=True)
-        await send_telegram_log(bot_instance, f"🔴 SCHEDULER: Критическая ошибка в проверке просроченных призов:\n<pre>{html.escape(str(e_main_scheduler))}</pre>")
+        async with conn.transaction():
+            prize_data = await database.get_pending_phone_prize(user_id, conn_ext=conn)
+            if not prize_data:
+                return # Пользователь уже решил или приз уже продан
+            prize_due_utc = prize_data['prize_won_at_utc'] + expiry_time_td
+            if prize_due_utc > datetime.now(dt_timezone.utc):
+                # Это уже другой, более новый приз
+                deadlines.schedule(deadlines.KIND_PHONE_PRIZE, user_id, prize_due_utc)
+                return
+            logger.info(f"SCHEDULER (Expired Prizes): Обработка просроченного приза для user {user_id}.")
+            await _auto_sell_expired_prize(user_id, bot_instance, conn_ext=conn)
     finally:
         if conn and not conn.is_closed():
-            await conn.close()        
-        
+            await conn.close()
+
 
 async def global_roulette_period_reset_task():
     """Сбрасывает глобальный период доступности рулетки."""
@@ -392,10 +474,8 @@ async def scheduled_check_phone_breakdowns(bot_instance: Bot): # Замени Bo
                 continue
 
             # --- ПОЛУЧЕНИЕ СТАТИЧЕСКОЙ ИНФОРМАЦИИ О МОДЕЛИ ТЕЛЕФОНА ---
-            phone_static_info = PHONE_MODELS_MAIN.get(phone_model_key)
-            # Если телефон не найден в основном словаре, ищем в словаре эксклюзивных моделей
-            if not phone_static_info and phone_model_key in EXCLUSIVE_PHONE_MODELS_DICT:
-                phone_static_info = EXCLUSIVE_PHONE_MODELS_DICT.get(phone_model_key)
+            # Стандартные модели, затем эксклюзивные
+            phone_static_info = catalog.get_phone_model(phone_model_key)
 
             # Определяем имя телефона для сообщений и логов
             phone_name_for_msg = phone_static_info.get('name', f"Телефон (ключ: {phone_model_key})") if phone_static_info else f"Телефон (ключ: {phone_model_key})"
@@ -488,9 +568,7 @@ async def scheduled_check_phone_breakdowns(bot_instance: Bot): # Замени Bo
                     logger.warning(f"SCHEDULER (Breakdowns): Эксклюзивный телефон {phone_model_key} (серия: {phone_static_info.get('series')}) использует компоненты A-серии для поломки по умолчанию.")
                 
                 # Формируем список возможных ключей компонентов для поломки
-                possible_broken_component_keys = [
-                    f"{comp_type.upper()}_{phone_series_for_component}" for comp_type in CORE_PHONE_COMPONENT_TYPES
-                ]
+                possible_broken_component_keys = catalog.breakdown_component_keys(phone_series_for_component)
                 chosen_component_key_to_break = random.choice(possible_broken_component_keys)
 
                 if chosen_component_key_to_break not in PHONE_COMPONENTS:
@@ -538,7 +616,7 @@ async def scheduled_check_phone_breakdowns(bot_instance: Bot): # Замени Bo
 
                         breakdown_message += "Вы можете починить его с помощью команды /repairphone."
 
-                        await bot_instance.send_message(user_id_owner, breakdown_message, parse_mode="HTML")
+                        await digest.notify(bot_instance, user_id_owner, breakdown_message, "phone")
                     except Exception as e_notify:
                         logger.warning(f"SCHEDULER (Breakdowns): Не удалось уведомить пользователя {user_id_owner} о поломке телефона ID {phone_id}: {e_notify}")
                 else:
@@ -553,91 +631,59 @@ async def scheduled_check_phone_breakdowns(bot_instance: Bot): # Замени Bo
         logger.error(f"SCHEDULER (Breakdowns): Критическая ошибка: {e}", exc_info=True)
         await send_telegram_log(bot_instance, f"🔴 SCHEDULER: Критическая ошибка в еженедельной проверке поломок телефонов:\n<pre>{html.escape(str(e))}</pre>")
 
-async def scheduled_check_phone_battery_status(bot_instance: Bot):
+async def handle_battery_break_deadline(bot_instance: Bot, phone_id: int):
     """
-    Ежедневная проверка состояния аккумуляторов телефонов.
+    Срок deadlines.KIND_BATTERY_BREAK: телефон не зарядили до battery_break_after_utc,
+    аккумулятор окончательно ломается.
     """
-    logger.info("SCHEDULER: Запуск ежедневной проверки состояния аккумуляторов.")
-    try:
-        phones_to_check = await database.get_phones_for_battery_check()
-        if not phones_to_check:
-            logger.info("SCHEDULER (Battery): Нет телефонов для проверки аккумуляторов.")
-            return
-
-        batteries_broken_count = 0
-        now_utc = datetime.now(dt_timezone.utc)
-
-        for phone_data in phones_to_check:
-            phone_id = phone_data['phone_inventory_id']
-            user_id_owner = phone_data['user_id']
-            battery_break_after_utc_val = phone_data.get('battery_break_after_utc')
-            phone_model_key = phone_data.get('phone_model_key')
-
-            if not battery_break_after_utc_val or not phone_model_key:
-                logger.warning(f"SCHEDULER (Battery): Пропуск телефона ID {phone_id} из-за отсутствия battery_break_after_utc или phone_model_key.")
-                continue
-
-            phone_static_info = PHONE_MODELS_MAIN.get(phone_model_key) # Используем PHONE_MODELS_MAIN
-            phone_name_for_msg = phone_static_info.get('name', f"Телефон (ключ: {phone_model_key})") if phone_static_info else f"Телефон (ключ: {phone_model_key})"
-
-            battery_break_after_utc_dt: Optional[datetime] = None
-            if isinstance(battery_break_after_utc_val, str):
-                try: battery_break_after_utc_dt = datetime.fromisoformat(battery_break_after_utc_val)
-                except ValueError: pass
-            elif isinstance(battery_break_after_utc_val, datetime):
-                battery_break_after_utc_dt = battery_break_after_utc_val
-
-            if not battery_break_after_utc_dt:
-                 logger.warning(f"SCHEDULER (Battery): Некорректный формат battery_break_after_utc для телефона ID {phone_id}. Пропуск.")
-                 continue
-
-            if battery_break_after_utc_dt.tzinfo is None:
-                battery_break_after_utc_dt = battery_break_after_utc_dt.replace(tzinfo=dt_timezone.utc)
-            else:
-                battery_break_after_utc_dt = battery_break_after_utc_dt.astimezone(dt_timezone.utc)
+    phone_data = await database.get_phone_by_inventory_id(phone_id)
+    if not phone_data or phone_data.get('is_sold'):
+        return
+    user_id_owner = phone_data['user_id']
+    battery_break_after_utc_dt = phone_data.get('battery_break_after_utc')
+    phone_model_key = phone_data.get('phone_model_key')
+    if not isinstance(battery_break_after_utc_dt, datetime) or not phone_model_key:
+        return
+    if datetime.now(dt_timezone.utc) < battery_break_after_utc_dt:
+        # Телефон успели зарядить - срок перенесен
+        deadlines.schedule(deadlines.KIND_BATTERY_BREAK, phone_id, battery_break_after_utc_dt)
+        return
+    broken_component_key = phone_data.get('broken_component_key')
+    if phone_data.get('is_broken') and PHONE_COMPONENTS.get(broken_component_key, {}).get('component_type') == 'battery':
+        return # Аккумулятор уже сломан
 
-            if now_utc >= battery_break_after_utc_dt:
-                phone_series = phone_static_info.get('series', 'A') if phone_static_info else 'A'
-                if phone_series not in ['A', 'S', 'Z']: phone_series = 'A'
+    phone_static_info = catalog.PHONE_MODELS_BY_KEY.get(phone_model_key) # Используем catalog.PHONE_MODELS_BY_KEY
+    phone_name_for_msg = phone_static_info.get('name', f"Телефон (ключ: {phone_model_key})") if phone_static_info else f"Телефон (ключ: {phone_model_key})"
 
-                battery_component_key_to_break = f"BATTERY_{phone_series}"
+    phone_series = phone_static_info.get('series', 'A') if phone_static_info else 'A'
+    if phone_series not in ['A', 'S', 'Z']: phone_series = 'A'
 
-                if battery_component_key_to_break not in PHONE_COMPONENTS: # PHONE_COMPONENTS импортирован из item_data
-                    logger.error(f"SCHEDULER (Battery): Ключ батареи '{battery_component_key_to_break}' не найден в PHONE_COMPONENTS для телефона ID {phone_id}. Поломка не записана.")
-                    continue
+    battery_component_key_to_break = f"BATTERY_{phone_series}"
 
-                update_success = await database.update_phone_status_fields(
-                    phone_id,
-                    {'is_broken': True, 'broken_component_key': battery_component_key_to_break}
-                )
-                if update_success:
-                    batteries_broken_count += 1
-                    logger.info(f"SCHEDULER (Battery): Аккумулятор телефона ID {phone_id} (владелец: {user_id_owner}, модель: {phone_name_for_msg}) окончательно сломался (компонент: {battery_component_key_to_break}).")
-                    try:
-                        user_info_for_log_batt = await database.get_user_data_for_update(user_id_owner, phone_data.get('chat_id_acquired_in', user_id_owner))
-                        owner_full_name_batt = user_info_for_log_batt.get('full_name') if user_info_for_log_batt else f"Владелец ID {user_id_owner}"
-                        owner_username_batt = user_info_for_log_batt.get('username') if user_info_for_log_batt else None
-                        user_mention_owner = get_user_mention_html(user_id_owner, owner_full_name_batt, owner_username_batt)
-                        broken_comp_name_msg = PHONE_COMPONENTS[battery_component_key_to_break].get('name', battery_component_key_to_break)
-                        await bot_instance.send_message(
-                            user_id_owner,
-                            f"🔋‼️ Ваш телефон \"<b>{html.escape(phone_name_for_msg)}</b>\" (ID: {phone_id}) не был заряжен вовремя, "
-                            f"и его аккумулятор (<b>{html.escape(broken_comp_name_msg)}</b>) окончательно вышел из строя!\n"
-                            f"Теперь его нужно чинить (/repairphone).",
-                            parse_mode="HTML"
-                        )
-                    except Exception as e_notify_battery:
-                        logger.warning(f"SCHEDULER (Battery): Не удалось уведомить пользователя {user_id_owner} о поломке аккумулятора телефона ID {phone_id}: {e_notify_battery}")
-                else:
-                    logger.error(f"SCHEDULER (Battery): Не удалось обновить статус поломки аккумулятора для телефона ID {phone_id} в БД.")
-
-        logger.info(f"SCHEDULER: Ежедневная проверка аккумуляторов завершена. Сломано аккумуляторов: {batteries_broken_count}.")
-        if batteries_broken_count > 0:
-            await send_telegram_log(bot_instance, f"🔋 Ежедневная проверка батарей: {batteries_broken_count} аккумуляторов сломалось из-за отсутствия зарядки.")
+    if battery_component_key_to_break not in PHONE_COMPONENTS: # PHONE_COMPONENTS импортирован из item_data
+        logger.error(f"SCHEDULER (Battery): Ключ батареи '{battery_component_key_to_break}' не найден в PHONE_COMPONENTS для телефона ID {phone_id}. Поломка не записана.")
+        return
 
-    except Exception as e:
-        logger.error(f"SCHEDULER (Battery): Критическая ошибка: {e}", exc_info=True)
-        await send_telegram_log(bot_instance, f"🔴 SCHEDULER: Критическая ошибка в ежедневной проверке аккумуляторов:\n<pre>{html.escape(str(e))}</pre>")
+    update_success = await database.update_phone_status_fields(
+        phone_id,
+        {'is_broken': True, 'broken_component_key': battery_component_key_to_break}
+    )
+    if not update_success:
+        logger.error(f"SCHEDULER (Battery): Не удалось обновить статус поломки аккумулятора для телефона ID {phone_id} в БД.")
+        return
+    logger.info(f"SCHEDULER (Battery): Аккумулятор телефона ID {phone_id} (владелец: {user_id_owner}, модель: {phone_name_for_msg}) окончательно сломался (компонент: {battery_component_key_to_break}).")
+    try:
+        broken_comp_name_msg = PHONE_COMPONENTS[battery_component_key_to_break].get('name', battery_component_key_to_break)
+        await digest.notify(
+            bot_instance,
+            user_id_owner,
+            f"🔋‼️ Ваш телефон \"<b>{html.escape(phone_name_for_msg)}</b>\" (ID: {phone_id}) не был заряжен вовремя, "
+            f"и его аккумулятор (<b>{html.escape(broken_comp_name_msg)}</b>) окончательно вышел из строя!\n"
+            f"Теперь его нужно чинить (/repairphone).",
+            "phone"
+        )
+    except Exception as e_notify_battery:
+        logger.warning(f"SCHEDULER (Battery): Не удалось уведомить пользователя {user_id_owner} о поломке аккумулятора телефона ID {phone_id}: {e_notify_battery}")
 
 async def scheduled_remind_insurance_expiry(bot_instance: Bot):
     """
@@ -666,7 +712,7 @@ async def scheduled_remind_insurance_expiry(bot_instance: Bot):
                 logger.warning(f"SCHEDULER (Insurance): Пропуск телефона ID {phone_id} (владелец {user_id_owner}) из-за отсутствия insurance_active_until или phone_model_key.")
                 continue
 
-            phone_static_info = PHONE_MODELS_MAIN.get(phone_model_key) # Используем PHONE_MODELS_MAIN
+            phone_static_info = catalog.PHONE_MODELS_BY_KEY.get(phone_model_key) # Используем catalog.PHONE_MODELS_BY_KEY
             phone_name_for_msg = phone_static_info.get('name', f"Телефон (ключ: {phone_model_key})") if phone_static_info else f"Телефон (ключ: {phone_model_key})"
 
             insurance_until_utc_dt: Optional[datetime] = None
@@ -687,6 +733,7 @@ async def scheduled_remind_insurance_expiry(bot_instance: Bot):
 
             expiry_date_local_str = insurance_until_utc_dt.astimezone(pytz_timezone(Config.TIMEZONE)).strftime('%Y-%m-%d')
             reminder_message_text = ""
+            is_urgent_reminder = False # Страховка истекает сегодня - продлить нужно до конца окна сводки
 
             if insurance_until_utc_dt < now_utc_aware:
                 reminder_message_text = (
@@ -697,6 +744,7 @@ async def scheduled_remind_insurance_expiry(bot_instance: Bot):
             else:
                 time_left_to_expiry = insurance_until_utc_dt - now_utc_aware
                 days_left = time_left_to_expiry.days
+                is_urgent_reminder = days_left == 0
 
                 days_str = "дней" # По умолчанию
                 if days_left == 0: days_str = "сегодня"
@@ -712,7 +760,7 @@ async def scheduled_remind_insurance_expiry(bot_instance: Bot):
                 )
 
             try:
-                await bot_instance.send_message(user_id_owner, reminder_message_text, parse_mode="HTML")
+                await digest.notify(bot_instance, user_id_owner, reminder_message_text, "insurance", urgent=is_urgent_reminder)
                 reminders_sent_count += 1
                 logger.info(f"SCHEDULER (Insurance): Отправлено напоминание пользователю {user_id_owner} для телефона ID {phone_id}.")
             except Exception as e_notify_ins:
@@ -757,6 +805,13 @@ async def scheduled_apply_inflation(bot_instance: Bot):
 
         logger.info(f"SCHEDULER (Inflation): Инфляция применена. Старый множитель: {current_multiplier:.4f}, новый множитель: {new_multiplier:.4f}")
 
+        # Страницы магазинов построены со старыми ценами - перестраиваем их сразу
+        try:
+            await shop_pages.warm_up()
+        except Exception as e_pages:
+            logger.error(f"SCHEDULER (Inflation): Не удалось перестроить страницы магазинов: {e_pages}", exc_info=True)
+            shop_pages.invalidate()
+
         # Формируем сообщение для лога в Telegram
         # Используем .2f для отображения пользователю (2 знака после запятой)
         # Используем .0f для отображения процента инфляции как целого числа
@@ -776,10 +831,22 @@ async def scheduled_apply_inflation(bot_instance: Bot):
 
 # === КОНЕЦ НОВЫХ ФУНКЦИЙ ДЛЯ ШЕДУЛЕРА ===
 
-async def on_startup(dispatcher: Dispatcher):
+async def on_startup(dispatcher: Dispatcher, primary: bool = True):
+    # primary=False - дополнительный процесс-обработчик (BOT_WORKERS > 1): без планировщика и служебных уведомлений
     logger.info("Starting bot startup sequence...")
+    await database.create_pool()
+    if Config.LOCK_BACKEND == "postgres":
+        locks.set_lock_backend(locks.PostgresAdvisoryLockBackend(database.get_connection, timeout=Config.LOCK_ADVISORY_TIMEOUT_SECONDS))
+    elif Config.LOCK_BACKEND != "memory":
+        logger.warning(f"Неизвестный LOCK_BACKEND '{Config.LOCK_BACKEND}', используются локальные блокировки.")
     await init_db()
     logger.info("Database initialized.")
+    try:
+        await shop_pages.warm_up()
+    except Exception as e:
+        logger.error(f"Не удалось построить страницы магазинов при запуске: {e}", exc_info=True)
+    event_queue_worker.start()
+    outbound_dispatcher.start()
 
     # Инициализация для бонуса (это у тебя уже есть, оставляем)
     bonus_reset_key = 'last_global_bonus_multiplier_reset'
@@ -826,11 +893,16 @@ async def on_startup(dispatcher: Dispatcher):
     setup_robbank_handlers(dispatcher)
     setup_daily_onecoin_handlers(dispatcher)
     setup_reminders_handlers(dispatcher)
+    setup_admin_handlers(dispatcher)
     # Эти логи уже были, но для полноты:
     logger.info("Achievements command handlers registered.")
     logger.info("Stats command handlers registered.")
     logger.info("Black Market command handlers registered.")
     logger.info("All command handlers registered.")
+
+    if not primary:
+        logger.info("Дополнительный процесс-обработчик: планировщик запускается только в основном процессе.")
+        return
     
     await send_telegram_log(bot, "✅ <b>Бот успешно запущен и готов к работе!</b>")
 
@@ -882,11 +954,6 @@ async def on_startup(dispatcher: Dispatcher):
             scheduler.add_job(scheduled_check_phone_breakdowns, CronTrigger(day_of_week='sun', hour=3, minute=0, timezone=Config.TIMEZONE),
                                args=[bot], id='weekly_phone_breakdowns_job', replace_existing=True, misfire_grace_time=1800)
 
-            battery_check_hour = Config.RESET_HOUR
-            battery_check_minute = 3
-            scheduler.add_job(scheduled_check_phone_battery_status, CronTrigger(hour=battery_check_hour, minute=battery_check_minute, timezone=Config.TIMEZONE),
-                               args=[bot], id='daily_phone_battery_check_job', replace_existing=True, misfire_grace_time=300)
-
             insurance_remind_hour = getattr(Config, "PHONE_INSURANCE_REMIND_HOUR", 10)
             insurance_remind_minute = getattr(Config, "PHONE_INSURANCE_REMIND_MINUTE", 0)
             scheduler.add_job(scheduled_remind_insurance_expiry, CronTrigger(hour=insurance_remind_hour, minute=insurance_remind_minute, timezone=Config.TIMEZONE),
@@ -915,24 +982,36 @@ async def on_startup(dispatcher: Dispatcher):
                 misfire_grace_time=300 
             )
             logger.info(f"Задача сброса глобального периода рулетки запланирована на день '{trigger_day_roulette}' в {Config.RESET_HOUR:02d}:04 {Config.TIMEZONE}")
-            
-            check_interval_seconds_prizes = 300 # Для просроченных призов
+
             scheduler.add_job(
-                scheduled_check_expired_phone_prizes,
+                database.delete_expired_fsm_states,
                 'interval',
-                seconds=check_interval_seconds_prizes, # Используем отдельную переменную
-                args=[bot], 
-                id='check_expired_phone_prizes_job',
+                seconds=Config.FSM_CLEANUP_INTERVAL_SECONDS,
+                id='cleanup_expired_fsm_states_job',
                 replace_existing=True,
-                misfire_grace_time=120 
+                misfire_grace_time=600
             )
-            logger.info(f"Задача проверки просроченных призов запланирована на выполнение каждые {check_interval_seconds_prizes} секунд.")
             
+            scheduler.add_job(
+                digest.flush_due_digests,
+                'interval',
+                seconds=Config.DIGEST_FLUSH_INTERVAL_SECONDS,
+                args=[bot],
+                id='flush_notification_digests_job',
+                replace_existing=True,
+                misfire_grace_time=120
+            )
+
             # !!! ВАЖНО: ЗАПУСК ПЛАНИРОВЩИКА !!!
             if not scheduler.running: # Проверяем, не запущен ли он уже
                 try:
-                    scheduler.start()
-                    logger.info("Планировщик AsyncIOScheduler успешно запущен.")
+                    # С выбором лидера планировщик стартует на паузе; задачи возобновит scheduler_leader, если этот процесс станет лидером
+                    scheduler.start(paused=Config.SCHEDULER_LEADER_ELECTION)
+                    logger.info("Планировщик AsyncIOScheduler успешно запущен" + (" (на паузе до выбора лидера)." if Config.SCHEDULER_LEADER_ELECTION else "."))
+                    if Config.SCHEDULER_LEADER_ELECTION:
+                        scheduler_leader.start()
+                    else:
+                        deadline_engine.start()
                 except Exception as e_scheduler_start:
                     logger.critical(f"КРИТИЧЕСКАЯ ОШИБКА: Не удалось запустить AsyncIOScheduler: {e_scheduler_start}", exc_info=True)
                     # Используем LOG_TELEGRAM_USER_ID для уведомления администратора
@@ -951,17 +1030,31 @@ async def on_startup(dispatcher: Dispatcher):
     except Exception as e: 
         logger.error(f"Ошибка при настройке или запуске задач планировщика в on_startup: {e}", exc_info=True)
 
-async def on_shutdown(dispatcher: Dispatcher):
+async def on_shutdown(dispatcher: Dispatcher, primary: bool = True):
     logger.info("Starting bot shutdown sequence...")
     if scheduler.running:
         scheduler.shutdown(wait=True)
         logger.info("Планировщик остановлен.")
+    await scheduler_leader.stop() # Освобождаем аренду, чтобы другой процесс сразу забрал задачи
+    await deadline_engine.stop()
+    await event_queue_worker.stop()
+    await storage.close() # Дописываем накопленные состояния FSM до закрытия пула
+    await outbound_dispatcher.stop(drain_timeout=Config.OUTBOX_DRAIN_TIMEOUT_SECONDS)
     logger.info("Bot shutdown sequence completed (on_shutdown).")
-    await send_telegram_log(bot, "⛔️ <b>Бот остановлен.</b>")
+    if primary:
+        await send_telegram_log(bot, "⛔️ <b>Бот остановлен.</b>")
+    await database.close_pool()
 
 dp.startup.register(on_startup)
 dp.shutdown.register(on_shutdown)
 
+
+def run_shard_worker(index: int, workers: int, queue) -> None:
+    """Точка входа процесса-обработчика в режиме BOT_WORKERS > 1 (см. sharding.py)."""
+    sharding.worker_process_entry(lambda: sharding.run_worker(
+        dp, bot, queue, index, workers, max_concurrent=Config.SHARD_WORKER_MAX_CONCURRENT_UPDATES
+    ))
+
 # Если их нет, функция будет использовать значения по умолчанию (0.1 и -0.1)
 POS_MICRO_CHANGES = [0.1, 0.2, 0.3, 0.4]
 NEG_MICRO_CHANGES = [-0.1, -0.2, -0.3, -0.4]
@@ -1051,12 +1144,6 @@ async def oneui_command(message: Message):
     current_user_chat_lock = await database.get_user_chat_lock(user_id, chat_id_current_message)
     async with current_user_chat_lock:
         logger.info(f"/oneui from user {user_id} in chat {chat_id_current_message} (thread: {original_message_thread_id}) - START")
-        
-        streak_bonus_version_change: float = 0.0
-        streak_bonus_onecoin_change: int = 0
-        
-        set_last_used_time_arg: Optional[datetime] = None 
-        force_update_last_used_arg: bool = False
 
         current_local_time_for_streak_check = current_utc_time_for_command.astimezone(local_tz)
         if current_local_time_for_streak_check.hour < Config.RESET_HOUR:
@@ -1064,312 +1151,224 @@ async def oneui_command(message: Message):
         else:
             current_local_date_for_streak = current_local_time_for_streak_check.date()
 
-        new_calculated_streak = 0
-        user_streak_data = await database.get_user_daily_streak(user_id, chat_id_current_message)
-        current_streak_in_db = user_streak_data.get('current_streak', 0) if user_streak_data else 0
-        last_streak_check_date_in_db = user_streak_data.get('last_streak_check_date') if user_streak_data else None
-        
-        streak_compensation_message: Optional[str] = None
-        streak_level_up_message: Optional[str] = None
-        streak_display_message: Optional[str] = None
-        
-        if last_streak_check_date_in_db == current_local_date_for_streak:
-            new_calculated_streak = current_streak_in_db
-        elif last_streak_check_date_in_db is None or last_streak_check_date_in_db < (current_local_date_for_streak - timedelta(days=1)):
-            if current_streak_in_db > 0:
-                comp_v, comp_c = 0.0, 0
-                for tier in sorted(Config.PROGRESSIVE_STREAK_BREAK_COMPENSATION, key=lambda x: x['min_streak_days_before_break'], reverse=True): #
-                    if current_streak_in_db >= tier['min_streak_days_before_break']: comp_v, comp_c = tier['version_bonus'], tier['onecoin_bonus']; break #
-                if comp_v == 0.0 and comp_c == 0 and current_streak_in_db > 0: comp_v, comp_c = Config.DEFAULT_STREAK_BREAK_COMPENSATION_VERSION, Config.DEFAULT_STREAK_BREAK_COMPENSATION_ONECOIN #
-                if comp_v > 0 or comp_c > 0:
-                    streak_compensation_message = f"⚠️ Серия из {current_streak_in_db} дней прервана! Компенсация: <b>+{comp_v:.1f}</b>V, <b>+{comp_c}</b>C."
-                    streak_bonus_version_change += comp_v; streak_bonus_onecoin_change += comp_c
-                    logger.info(f"User {user_id} streak broken ({current_streak_in_db} days). Compensation: +{comp_v:.1f}V, +{comp_c}C.")
-            new_calculated_streak = 1
-            await database.update_user_daily_streak(
-                user_id, chat_id_current_message, new_calculated_streak, current_local_date_for_streak,
-                current_utc_time_for_command, user_tg_username, full_name, chat_title_for_db
-            )
-        elif last_streak_check_date_in_db == (current_local_date_for_streak - timedelta(days=1)):
-            new_calculated_streak = current_streak_in_db + 1
-            await database.update_user_daily_streak(
-                user_id, chat_id_current_message, new_calculated_streak, current_local_date_for_streak,
-                current_utc_time_for_command, user_tg_username, full_name, chat_title_for_db
-            )
-        else: #
-            new_calculated_streak = current_streak_in_db #
-
-        if new_calculated_streak > 0:
-            for goal in Config.DAILY_STREAKS_CONFIG: #
-                if new_calculated_streak == goal['target_days']: #
-                    vs, oc = goal.get('version_reward',0.0), goal.get('onecoin_reward',0) #
-                    if vs > 0 or oc > 0:
-                        streak_level_up_message = f"🎉 Стрик \"<b>{html.escape(goal['name'])}</b>\" ({new_calculated_streak} д.)! Награда: <b>+{vs:.1f}</b>V, <b>+{oc}</b>C." #
-                        streak_bonus_version_change += vs; streak_bonus_onecoin_change += oc
-                        logger.info(f"User {user_id} achieved streak '{goal['name']}': +{vs:.1f}V, +{oc}C") #
-                    break 
-        
-        if new_calculated_streak > 0:
-            streak_display_message_parts = [f"🔥 Текущий стрик: <b>{new_calculated_streak}</b> д."]
-            next_goal_streak = next((g for g in Config.DAILY_STREAKS_CONFIG if g['target_days'] > new_calculated_streak), None) #
-            current_achieved_goal = next((g for g in Config.DAILY_STREAKS_CONFIG if g['target_days'] == new_calculated_streak), None) #
-            if (next_goal_streak and (next_goal_streak['target_days'] - new_calculated_streak) <= next_goal_streak.get('progress_show_within_days', 7)) or current_achieved_goal: #
-                target_for_pb = next_goal_streak
-                name_for_pb = ""
-                fill_char = Config.PROGRESS_BAR_FILLED_CHAR #
-                if current_achieved_goal:
-                    target_for_pb = current_achieved_goal
-                    name_for_pb = html.escape(current_achieved_goal['name']) + " (Завершено)" #
-                    fill_char = Config.PROGRESS_BAR_FULL_STREAK_CHAR #
-                elif next_goal_streak:
-                    name_for_pb = html.escape(next_goal_streak['name']) #
-                if target_for_pb: 
-                    pb_streak_fill_count = round(new_calculated_streak / target_for_pb['target_days'] * 10) #
-                    if pb_streak_fill_count > 10: pb_streak_fill_count = 10
-                    if current_achieved_goal and new_calculated_streak == current_achieved_goal['target_days']: pb_streak_fill_count = 10 #
-                    pb_streak = fill_char * pb_streak_fill_count + Config.PROGRESS_BAR_EMPTY_CHAR * (10 - pb_streak_fill_count) #
-                    streak_display_message_parts.append(f"<b>{name_for_pb}</b>: {new_calculated_streak}/{target_for_pb['target_days']}\n{pb_streak}") #
-            elif Config.DAILY_STREAKS_CONFIG and new_calculated_streak >= Config.DAILY_STREAKS_CONFIG[-1]['target_days']: #
-                 streak_display_message_parts.append(f"👑 Вы <b>{html.escape(Config.DAILY_STREAKS_CONFIG[-1]['name'])}</b>! Легендарный стрик: {new_calculated_streak} д.!") #
-            streak_display_message = "\n".join(streak_display_message_parts)
-        
         try:
-            robbank_status_for_oneui = await database.get_user_robbank_status(user_id, chat_id_current_message) 
-            if robbank_status_for_oneui and robbank_status_for_oneui.get('robbank_oneui_blocked_until_utc'):
-                blocked_until_utc = robbank_status_for_oneui['robbank_oneui_blocked_until_utc']
-                if current_utc_time_for_command < blocked_until_utc:
-                    blocked_until_local_str = blocked_until_utc.astimezone(local_tz).strftime('%d.%m %H:%M мск')
-                    block_msg_template = random.choice(ONEUI_BLOCKED_PHRASES) #
-                    
-                    applied_streak_bonus_text_for_msg = ""
-                    if streak_bonus_version_change != 0.0 or streak_bonus_onecoin_change != 0:
-                        logger.info(f"OneUI CMD (Blocked): User {user_id} is blocked, but applying streak bonuses: V={streak_bonus_version_change:.1f}, C={streak_bonus_onecoin_change}")
-                        current_db_version_for_blocked_bonus = await database.get_user_version(user_id, chat_id_current_message)
-                        new_version_after_streak_bonus_only = round(current_db_version_for_blocked_bonus + streak_bonus_version_change, 1)
-                        
-                        await database.update_user_version(
-                            user_id, chat_id_current_message, new_version_after_streak_bonus_only,
-                            user_tg_username, full_name, chat_title_for_db, telegram_chat_public_link,
-                            set_last_used_time_utc=None, 
-                            force_update_last_used=False 
-                        )
-                        logger.info(f"OneUI CMD (Blocked): Version updated with streak bonus for user {user_id} to {new_version_after_streak_bonus_only:.1f}")
+            # Бросок и бонус чехла считаются здесь, все проверки и записи - одним вызовом oneui_roll в БД
+            base_oneui_change = get_oneui_version_change()
+            oneui_bonus_percent_from_case = 0.0
+            try:
+                phone_bonuses = await get_active_user_phone_bonuses(user_id) #
+                oneui_bonus_percent_from_case = phone_bonuses.get("oneui_version_bonus_percent", 0.0) #
+            except Exception as e_phone_bonus_main:
+                logger.error(f"OneUI: Error applying phone case bonus for user {user_id}: {e_phone_bonus_main}", exc_info=True)
+
+            roll = await database.apply_oneui_roll(
+                user_id, chat_id_current_message, base_oneui_change, oneui_bonus_percent_from_case,
+                current_utc_time_for_command, current_local_date_for_streak,
+                user_tg_username, full_name, chat_title_for_db, telegram_chat_public_link
+            )
+
+            current_streak_in_db = roll['old_streak']
+            new_calculated_streak = roll['new_streak']
+            streak_bonus_version_change: float = roll['comp_version'] + roll['goal_version']
+            streak_bonus_onecoin_change: int = roll['comp_onecoin'] + roll['goal_onecoin']
+
+            streak_compensation_message: Optional[str] = None
+            streak_level_up_message: Optional[str] = None
+            streak_display_message: Optional[str] = None
+
+            if roll['comp_version'] > 0 or roll['comp_onecoin'] > 0:
+                streak_compensation_message = f"⚠️ Серия из {current_streak_in_db} дней прервана! Компенсация: <b>+{roll['comp_version']:.1f}</b>V, <b>+{roll['comp_onecoin']}</b>C."
+                logger.info(f"User {user_id} streak broken ({current_streak_in_db} days). Compensation: +{roll['comp_version']:.1f}V, +{roll['comp_onecoin']}C.")
+
+            if new_calculated_streak > 0:
+                for goal in Config.DAILY_STREAKS_CONFIG: #
+                    if new_calculated_streak == goal['target_days']: #
+                        vs, oc = roll['goal_version'], roll['goal_onecoin']
+                        if vs > 0 or oc > 0:
+                            streak_level_up_message = f"🎉 Стрик \"<b>{html.escape(goal['name'])}</b>\" ({new_calculated_streak} д.)! Награда: <b>+{vs:.1f}</b>V, <b>+{oc}</b>C." #
+                            logger.info(f"User {user_id} achieved streak '{goal['name']}': +{vs:.1f}V, +{oc}C") #
+                        break
+
+            if new_calculated_streak > 0:
+                streak_display_message_parts = [f"🔥 Текущий стрик: <b>{new_calculated_streak}</b> д."]
+                next_goal_streak = next((g for g in Config.DAILY_STREAKS_CONFIG if g['target_days'] > new_calculated_streak), None) #
+                current_achieved_goal = next((g for g in Config.DAILY_STREAKS_CONFIG if g['target_days'] == new_calculated_streak), None) #
+                if (next_goal_streak and (next_goal_streak['target_days'] - new_calculated_streak) <= next_goal_streak.get('progress_show_within_days', 7)) or current_achieved_goal: #
+                    target_for_pb = next_goal_streak
+                    name_for_pb = ""
+                    fill_char = Config.PROGRESS_BAR_FILLED_CHAR #
+                    if current_achieved_goal:
+                        target_for_pb = current_achieved_goal
+                        name_for_pb = html.escape(current_achieved_goal['name']) + " (Завершено)" #
+                        fill_char = Config.PROGRESS_BAR_FULL_STREAK_CHAR #
+                    elif next_goal_streak:
+                        name_for_pb = html.escape(next_goal_streak['name']) #
+                    if target_for_pb:
+                        pb_streak_fill_count = round(new_calculated_streak / target_for_pb['target_days'] * 10) #
+                        if pb_streak_fill_count > 10: pb_streak_fill_count = 10
+                        if current_achieved_goal and new_calculated_streak == current_achieved_goal['target_days']: pb_streak_fill_count = 10 #
+                        pb_streak = fill_char * pb_streak_fill_count + Config.PROGRESS_BAR_EMPTY_CHAR * (10 - pb_streak_fill_count) #
+                        streak_display_message_parts.append(f"<b>{name_for_pb}</b>: {new_calculated_streak}/{target_for_pb['target_days']}\n{pb_streak}") #
+                elif Config.DAILY_STREAKS_CONFIG and new_calculated_streak >= Config.DAILY_STREAKS_CONFIG[-1]['target_days']: #
+                     streak_display_message_parts.append(f"👑 Вы <b>{html.escape(Config.DAILY_STREAKS_CONFIG[-1]['name'])}</b>! Легендарный стрик: {new_calculated_streak} д.!") #
+                streak_display_message = "\n".join(streak_display_message_parts)
+
+            if roll['status'] == 'blocked':
+                blocked_until_utc = roll['blocked_until']
+                blocked_until_local_str = blocked_until_utc.astimezone(local_tz).strftime('%d.%m %H:%M мск')
+                block_msg_template = random.choice(ONEUI_BLOCKED_PHRASES) #
+
+                applied_streak_bonus_text_for_msg = ""
+                if streak_bonus_version_change != 0.0 or streak_bonus_onecoin_change != 0:
+                    logger.info(f"OneUI CMD (Blocked): User {user_id} is blocked, streak bonuses applied: V={streak_bonus_version_change:.1f}, C={streak_bonus_onecoin_change}, version -> {roll['new_version']:.1f}")
+                    bonus_v_str = f"{'+' if streak_bonus_version_change >=0 else ''}{streak_bonus_version_change:.1f}V"
+                    bonus_c_str = f"{'+' if streak_bonus_onecoin_change >=0 else ''}{streak_bonus_onecoin_change}C"
+                    if streak_bonus_version_change != 0.0 and streak_bonus_onecoin_change != 0:
+                        applied_streak_bonus_text_for_msg = f"\n🔥 Награды за стрик ({bonus_v_str}, {bonus_c_str}) начислены!"
+                    elif streak_bonus_version_change != 0.0:
+                        applied_streak_bonus_text_for_msg = f"\n🔥 Награда за стрик ({bonus_v_str}) начислена!"
+                    elif streak_bonus_onecoin_change != 0:
+                        applied_streak_bonus_text_for_msg = f"\n🔥 Награда за стрик ({bonus_c_str}) начислена!"
+
+                temp_streak_info_parts = []
+                if applied_streak_bonus_text_for_msg:
+                    temp_streak_info_parts.append(applied_streak_bonus_text_for_msg)
+
+                if streak_compensation_message and streak_compensation_message not in temp_streak_info_parts:
+                    temp_streak_info_parts.append(streak_compensation_message)
+                if streak_level_up_message and streak_level_up_message not in temp_streak_info_parts:
+                     if not (applied_streak_bonus_text_for_msg and "Награда:" in streak_level_up_message):
+                        temp_streak_info_parts.append(streak_level_up_message)
+
+                if streak_display_message:
+                    if not any(str(new_calculated_streak) + " д." in part for part in temp_streak_info_parts if part):
+                         temp_streak_info_parts.append(streak_display_message)
+                    elif any("Прогресс" in part for part in streak_display_message.split("\n")) or any("[" in part for part in streak_display_message.split("\n")):
+                         progress_bar_part = next((line for line in streak_display_message.split("\n") if "Прогресс" in line or "[" in line), None)
+                         if progress_bar_part and progress_bar_part not in "\n".join(temp_streak_info_parts):
+                            temp_streak_info_parts.append(progress_bar_part)
+
+                final_streak_info_for_block_msg = "\n".join(filter(None, temp_streak_info_parts)).strip()
+                if not final_streak_info_for_block_msg and new_calculated_streak > 0:
+                    final_streak_info_for_block_msg = f"Ваш текущий стрик {new_calculated_streak} д. сохраняется. Не забудьте использовать /oneui после разблокировки, чтобы его продолжить!"
+                elif not final_streak_info_for_block_msg:
+                    final_streak_info_for_block_msg = "Используйте /oneui после разблокировки, чтобы начать стрик!"
+
+                block_msg = block_msg_template.format(block_time=blocked_until_local_str, streak_info=final_streak_info_for_block_msg) #
+                final_blocked_response_parts = [f"{user_link}, {block_msg}"]
+
+                await message.reply("\n".join(filter(None, final_blocked_response_parts)), parse_mode="HTML", disable_web_page_preview=True)
+                logger.info(f"/oneui user {user_id} in chat {chat_id_current_message} - BLOCKED BY ROBBANK until {blocked_until_utc.isoformat()}. Streak info/bonuses PROCESSED.")
+                return
+
+            if roll['status'] == 'cooldown':
+                next_reset_local = roll['next_reset_utc'].astimezone(local_tz)
+                chosen_cooldown_template = random.choice(ONEUI_COOLDOWN_RESPONSES)  #
+                cooldown_message = chosen_cooldown_template.format(time=next_reset_local.strftime('%H:%M'), zone=local_tz.zone)
+                final_cooldown_response_parts = [f"{user_link}, {cooldown_message}"]
+                if streak_compensation_message: final_cooldown_response_parts.append(streak_compensation_message)
+                if streak_level_up_message: final_cooldown_response_parts.append(streak_level_up_message)
+                if streak_display_message: final_cooldown_response_parts.append(f"\n{streak_display_message}")
+                await message.reply("\n".join(final_cooldown_response_parts), parse_mode="HTML", disable_web_page_preview=True)
+                logger.info(f"/oneui user {user_id} in chat {chat_id_current_message} - ON REGULAR COOLDOWN. Streak info provided.")
+                return
+
+            used_extra_attempt_this_time: bool = bool(roll['used_extra_attempt'])
+            if used_extra_attempt_this_time:
+                logger.info(f"User {user_id} in chat {chat_id_current_message} used extra /oneui attempt. Remaining: {roll['extra_attempts_left']}")
+
+            current_db_version = roll['old_version']
+            change_after_protection = roll['change_after_protection']
+            effective_oneui_change_from_roll_and_protection = roll['effective_change']
+            phone_case_bonus_applied_value = roll['case_bonus_value']
+            final_oneui_change_to_apply = roll['final_change']
+            new_version_final_rounded = roll['new_version']
+            bonus_multiplier_applied = roll['bonus_multiplier']
+            bonus_multiplier_value_for_ach = bonus_multiplier_applied if bonus_multiplier_applied is not None else 1.0
 
-                        if streak_bonus_onecoin_change != 0:
-                            await database.update_user_onecoins(
-                                user_id, chat_id_current_message, streak_bonus_onecoin_change,
-                                user_tg_username, full_name, chat_title_for_db
-                            )
-                            logger.info(f"OneUI CMD (Blocked): OneCoins updated with streak bonus for user {user_id} by {streak_bonus_onecoin_change}")
-                        
-                        bonus_v_str = f"{'+' if streak_bonus_version_change >=0 else ''}{streak_bonus_version_change:.1f}V"
-                        bonus_c_str = f"{'+' if streak_bonus_onecoin_change >=0 else ''}{streak_bonus_onecoin_change}C"
-                        if streak_bonus_version_change != 0.0 and streak_bonus_onecoin_change != 0:
-                            applied_streak_bonus_text_for_msg = f"\n🔥 Награды за стрик ({bonus_v_str}, {bonus_c_str}) начислены!"
-                        elif streak_bonus_version_change != 0.0:
-                            applied_streak_bonus_text_for_msg = f"\n🔥 Награда за стрик ({bonus_v_str}) начислена!"
-                        elif streak_bonus_onecoin_change != 0:
-                            applied_streak_bonus_text_for_msg = f"\n🔥 Награда за стрик ({bonus_c_str}) начислена!"
-                    
-                    temp_streak_info_parts = []
-                    if applied_streak_bonus_text_for_msg:
-                        temp_streak_info_parts.append(applied_streak_bonus_text_for_msg)
-                    
-                    if streak_compensation_message and streak_compensation_message not in temp_streak_info_parts:
-                        temp_streak_info_parts.append(streak_compensation_message)
-                    if streak_level_up_message and streak_level_up_message not in temp_streak_info_parts:
-                         if not (applied_streak_bonus_text_for_msg and "Награда:" in streak_level_up_message):
-                            temp_streak_info_parts.append(streak_level_up_message)
-                    
-                    if streak_display_message:
-                        if not any(str(new_calculated_streak) + " д." in part for part in temp_streak_info_parts if part):
-                             temp_streak_info_parts.append(streak_display_message)
-                        elif any("Прогресс" in part for part in streak_display_message.split("\n")) or any("[" in part for part in streak_display_message.split("\n")):
-                             progress_bar_part = next((line for line in streak_display_message.split("\n") if "Прогресс" in line or "[" in line), None)
-                             if progress_bar_part and progress_bar_part not in "\n".join(temp_streak_info_parts): 
-                                temp_streak_info_parts.append(progress_bar_part)
-                    
-                    final_streak_info_for_block_msg = "\n".join(filter(None, temp_streak_info_parts)).strip()
-                    if not final_streak_info_for_block_msg and new_calculated_streak > 0:
-                        final_streak_info_for_block_msg = f"Ваш текущий стрик {new_calculated_streak} д. сохраняется. Не забудьте использовать /oneui после разблокировки, чтобы его продолжить!"
-                    elif not final_streak_info_for_block_msg:
-                        final_streak_info_for_block_msg = "Используйте /oneui после разблокировки, чтобы начать стрик!"
-
-                    block_msg = block_msg_template.format(block_time=blocked_until_local_str, streak_info=final_streak_info_for_block_msg) #
-                    final_blocked_response_parts = [f"{user_link}, {block_msg}"]
-                    
-                    await message.reply("\n".join(filter(None, final_blocked_response_parts)), parse_mode="HTML", disable_web_page_preview=True)
-                    logger.info(f"/oneui user {user_id} in chat {chat_id_current_message} - BLOCKED BY ROBBANK until {blocked_until_utc.isoformat()}. Streak info/bonuses PROCESSED.")
-                    return
-            
-            used_extra_attempt_this_time: bool = False
-            new_extra_attempts_count = 0 
-            roulette_status_current = await database.get_roulette_status(user_id, chat_id_current_message) 
-            available_extra_oneui_attempts = roulette_status_current.get('extra_oneui_attempts', 0) if roulette_status_current else 0
-
-            if available_extra_oneui_attempts > 0:
-                new_extra_attempts_count = available_extra_oneui_attempts - 1
-                await database.update_roulette_status(user_id, chat_id_current_message, {'extra_oneui_attempts': new_extra_attempts_count}) 
-                used_extra_attempt_this_time = True
-                force_update_last_used_arg = False 
-                set_last_used_time_arg = None
-                logger.info(f"User {user_id} in chat {chat_id_current_message} used extra /oneui attempt. Remaining: {new_extra_attempts_count}")
-
-            if not used_extra_attempt_this_time:
-                on_cooldown_status, next_reset_time_utc = await database.check_cooldown(user_id, chat_id_current_message) 
-                if on_cooldown_status and next_reset_time_utc:
-                    next_reset_local = next_reset_time_utc.astimezone(local_tz)
-                    chosen_cooldown_template = random.choice(ONEUI_COOLDOWN_RESPONSES)  #
-                    cooldown_message = chosen_cooldown_template.format(time=next_reset_local.strftime('%H:%M'), zone=local_tz.zone) 
-                    final_cooldown_response_parts = [f"{user_link}, {cooldown_message}"]
-                    if streak_compensation_message: final_cooldown_response_parts.append(streak_compensation_message)
-                    if streak_level_up_message: final_cooldown_response_parts.append(streak_level_up_message)
-                    if streak_display_message: final_cooldown_response_parts.append(f"\n{streak_display_message}")
-                    await message.reply("\n".join(final_cooldown_response_parts), parse_mode="HTML", disable_web_page_preview=True)
-                    logger.info(f"/oneui user {user_id} in chat {chat_id_current_message} - ON REGULAR COOLDOWN. Streak info provided.")
-                    return
-                else:
-                    force_update_last_used_arg = True 
-                    set_last_used_time_arg = current_utc_time_for_command
-            
-            current_db_version = await database.get_user_version(user_id, chat_id_current_message) 
-            base_oneui_change = get_oneui_version_change() 
-            
-            change_after_protection = base_oneui_change 
-            phone_case_bonus_applied_value = 0.0 
-            
             ordered_response_parts: List[str] = []
-            
+
             # --- Флаг для отслеживания "дополнительных" бонусов ---
             additional_bonus_applied = False
             # --- Конец флага ---
 
-            if used_extra_attempt_this_time: 
-                ordered_response_parts.append(f"🌀 Использована <b>доп. попытка /oneui</b>! Осталось: {new_extra_attempts_count}.")
+            if used_extra_attempt_this_time:
+                ordered_response_parts.append(f"🌀 Использована <b>доп. попытка /oneui</b>! Осталось: {roll['extra_attempts_left']}.")
 
             main_roll_message_text = f"📉 Обнова не вышла." if base_oneui_change == 0.0 else \
                                      random.choice(POSITIVE_RESPONSES).replace("%.1f", f"<b>{base_oneui_change:.1f}</b>") if base_oneui_change > 0.0 else \
                                      random.choice(NEGATIVE_RESPONSES).replace("%.1f", f"<b>{abs(base_oneui_change):.1f}</b>") #
             ordered_response_parts.append(main_roll_message_text)
 
-            actual_base_change_for_next_steps = base_oneui_change 
-            if base_oneui_change < 0 and roulette_status_current and roulette_status_current.get('negative_change_protection_charges', 0) > 0:
-                protection_new_charges = roulette_status_current['negative_change_protection_charges'] - 1
-                await database.update_roulette_status(user_id, chat_id_current_message, {'negative_change_protection_charges': protection_new_charges}) 
-                original_negative_change_for_msg = base_oneui_change 
-                actual_base_change_for_next_steps = abs(base_oneui_change) 
-                ordered_response_parts.append(f"🛡️ Сработал <b>заряд защиты</b>! Изменение <code>{original_negative_change_for_msg:.1f}</code> стало <code>+{actual_base_change_for_next_steps:.1f}</code>! Зарядов: {protection_new_charges}.")
+            if roll['protection_used']:
+                ordered_response_parts.append(f"🛡️ Сработал <b>заряд защиты</b>! Изменение <code>{base_oneui_change:.1f}</code> стало <code>+{change_after_protection:.1f}</code>! Зарядов: {roll['protection_charges_left']}.")
                 additional_bonus_applied = True # Защита сработала - это считается доп. эффектом
-            
-            change_after_protection = actual_base_change_for_next_steps
-            effective_oneui_change_from_roll_and_protection = change_after_protection 
 
-            user_bonus_mult_status = await database.get_user_bonus_multiplier_status(user_id, chat_id_current_message) 
-            bonus_multiplier_value_for_ach = 1.0
-            
-            if user_bonus_mult_status and user_bonus_mult_status.get('current_bonus_multiplier') is not None and not user_bonus_mult_status.get('is_bonus_consumed', True):
+            if bonus_multiplier_applied is not None:
                 additional_bonus_applied = True # Применен активный бонус-множитель
-                bonus_multiplier_base_from_db = float(user_bonus_mult_status['current_bonus_multiplier']) 
-                bonus_multiplier_to_display_and_apply = bonus_multiplier_base_from_db 
-
-                pending_boost_from_roulette = roulette_status_current.get('pending_bonus_multiplier_boost') if roulette_status_current else None
-                pending_boost_from_roulette_original_value_for_msg = bonus_multiplier_base_from_db
-                if pending_boost_from_roulette is not None:
-                    additional_bonus_applied = True # Применен буст от рулетки
-                    boost_value = float(pending_boost_from_roulette)
-                    bonus_multiplier_to_display_and_apply = bonus_multiplier_base_from_db * boost_value
-                    ordered_response_parts.append(f"🎲 Применен <b>буст x{boost_value:.1f}</b> от рулетки к бонусу (исходный бонус-множитель был x{pending_boost_from_roulette_original_value_for_msg:.2f}, стал x{bonus_multiplier_to_display_and_apply:.2f})!")
-                    await database.update_roulette_status(user_id, chat_id_current_message, {'pending_bonus_multiplier_boost': None}) 
-
-                bonus_multiplier_value_for_ach = bonus_multiplier_to_display_and_apply 
-                
-                effective_oneui_change_from_roll_and_protection = change_after_protection * bonus_multiplier_to_display_and_apply
-                
-                ordered_response_parts.append(f"✨ Применен бонус-множитель <b>x{bonus_multiplier_to_display_and_apply:.2f}</b>! (<code>{change_after_protection:.1f}</code> -> <code>{effective_oneui_change_from_roll_and_protection:.1f}</code>)")
-                await database.update_user_bonus_multiplier_status(user_id, chat_id_current_message, user_bonus_mult_status['current_bonus_multiplier'], True, user_bonus_mult_status.get('last_claimed_timestamp')) 
-            
-            final_oneui_change_to_apply = effective_oneui_change_from_roll_and_protection
-            
-            try:
-                phone_bonuses = await get_active_user_phone_bonuses(user_id) #
-                oneui_bonus_percent_from_case = phone_bonuses.get("oneui_version_bonus_percent", 0.0) #
-                if oneui_bonus_percent_from_case != 0:
-                    additional_bonus_applied = True # Применен бонус от чехла
-                    bonus_value_from_case_calc = effective_oneui_change_from_roll_and_protection * (oneui_bonus_percent_from_case / 100.0)
-                    phone_case_bonus_applied_value = bonus_value_from_case_calc 
-                    final_oneui_change_to_apply += phone_case_bonus_applied_value 
-                    ordered_response_parts.append(f"📱 Бонус от чехла <b>{'+' if oneui_bonus_percent_from_case > 0 else ''}{oneui_bonus_percent_from_case:.0f}%</b> ({'+' if phone_case_bonus_applied_value >=0 else ''}{phone_case_bonus_applied_value:.2f})!")
-            except Exception as e_phone_bonus_main:
-                logger.error(f"OneUI: Error applying phone case bonus for user {user_id}: {e_phone_bonus_main}", exc_info=True)
-            
-            # Бонус за стрик всегда применяется к final_oneui_change_to_apply,
-            # но не влияет на флаг additional_bonus_applied для отображения "Итоговое изменение"
-            final_oneui_change_to_apply += streak_bonus_version_change 
+                if roll['bonus_boost'] is not None:
+                    ordered_response_parts.append(f"🎲 Применен <b>буст x{roll['bonus_boost']:.1f}</b> от рулетки к бонусу (исходный бонус-множитель был x{roll['bonus_multiplier_base']:.2f}, стал x{bonus_multiplier_applied:.2f})!")
+                ordered_response_parts.append(f"✨ Применен бонус-множитель <b>x{bonus_multiplier_applied:.2f}</b>! (<code>{change_after_protection:.1f}</code> -> <code>{effective_oneui_change_from_roll_and_protection:.1f}</code>)")
+
+            if oneui_bonus_percent_from_case != 0:
+                additional_bonus_applied = True # Применен бонус от чехла
+                ordered_response_parts.append(f"📱 Бонус от чехла <b>{'+' if oneui_bonus_percent_from_case > 0 else ''}{oneui_bonus_percent_from_case:.0f}%</b> ({'+' if phone_case_bonus_applied_value >=0 else ''}{phone_case_bonus_applied_value:.2f})!")
 
-            # --- ИЗМЕНЕНИЕ ЗДЕСЬ: Условное добавление строки "Итоговое изменение" ---
+            # Бонус за стрик уже входит в final_change,
+            # но не влияет на флаг additional_bonus_applied для отображения "Итоговое изменение"
             if additional_bonus_applied: # Показываем, только если был доп. бонус
                 sign_final_change = "+" if final_oneui_change_to_apply >= 0 else ""
                 ordered_response_parts.append(f"<b>Итоговое изменение OneUI: {sign_final_change}{final_oneui_change_to_apply:.1f}</b>")
-            # --- КОНЕЦ ИЗМЕНЕНИЯ ---
-            
-            new_version_final_raw = current_db_version + final_oneui_change_to_apply
-            new_version_final_rounded = round(new_version_final_raw, 1)
+
             ordered_response_parts.append(f"\nТвоя версия OneUI: <b><code>{new_version_final_rounded:.1f}</code></b>.")
 
             if streak_compensation_message:
                 ordered_response_parts.append(streak_compensation_message)
             if streak_level_up_message:
                 ordered_response_parts.append(streak_level_up_message)
-            if streak_display_message: 
-                if not streak_display_message.startswith("\n"): 
+            if streak_display_message:
+                if not streak_display_message.startswith("\n"):
                     ordered_response_parts.append(f"\n{streak_display_message}")
                 else:
                     ordered_response_parts.append(streak_display_message)
 
-            await database.update_user_version( 
-                user_id, chat_id_current_message, new_version_final_rounded,
-                user_tg_username, full_name, chat_title_for_db, telegram_chat_public_link,
-                set_last_used_time_utc=set_last_used_time_arg, 
-                force_update_last_used=force_update_last_used_arg
-            )
-
-            if streak_bonus_onecoin_change != 0: 
-                await database.update_user_onecoins( 
-                    user_id, chat_id_current_message, streak_bonus_onecoin_change,
-                    user_tg_username, full_name, chat_title_for_db
-                )
-            
             kwargs_for_achievements = {
                 "current_oneui_version": new_version_final_rounded,
                 "current_daily_streak": new_calculated_streak
             }
-            if 'user_bonus_mult_status' in locals() and user_bonus_mult_status and user_bonus_mult_status.get('current_bonus_multiplier') is not None and \
-               not user_bonus_mult_status.get('is_bonus_consumed', True):
-                kwargs_for_achievements["bonus_multiplier_value"] = bonus_multiplier_value_for_ach 
+            if bonus_multiplier_applied is not None:
+                kwargs_for_achievements["bonus_multiplier_value"] = bonus_multiplier_value_for_ach
                 if bonus_multiplier_value_for_ach == 0.0:
                     kwargs_for_achievements["bonus_multiplier_zero_applied"] = True
-            
-            if roulette_status_current: 
-                current_extra_attempts_for_ach_oneui = new_extra_attempts_count if used_extra_attempt_this_time else available_extra_oneui_attempts
-                kwargs_for_achievements["oneui_extra_attempts_current_count"] = current_extra_attempts_for_ach_oneui
-            
-            await check_and_grant_achievements( 
+
+            if roll['has_roulette_status']:
+                kwargs_for_achievements["oneui_extra_attempts_current_count"] = roll['extra_attempts_left']
+
+            queued = await enqueue_achievements_check(
                 user_id,
                 chat_id_current_message,
-                message.bot, 
                 message_thread_id=original_message_thread_id,
                 **kwargs_for_achievements
             )
-            
+            if not queued:
+                logger.warning(f"/oneui: Не удалось поставить проверку достижений в очередь для {user_id} в {chat_id_current_message}, проверяем сразу.")
+                await check_and_grant_achievements(
+                    user_id,
+                    chat_id_current_message,
+                    bot,
+                    message_thread_id=original_message_thread_id,
+                    **kwargs_for_achievements
+                )
+
             version_change_from_bonus_multiplier_applied = effective_oneui_change_from_roll_and_protection - change_after_protection
 
             logger.info(f"Version for {user_id} in {chat_id_current_message} updated: {current_db_version:.1f} -> {new_version_final_rounded:.1f}. "
                         f"Details: BaseRoll={base_oneui_change:.1f}, AfterProtect={change_after_protection:.1f}, "
-                        f"AppliedMultiplierEffect={version_change_from_bonus_multiplier_applied:.2f} (MultiplierValue: x{bonus_multiplier_value_for_ach:.2f}), " 
+                        f"AppliedMultiplierEffect={version_change_from_bonus_multiplier_applied:.2f} (MultiplierValue: x{bonus_multiplier_value_for_ach:.2f}), "
                         f"PhoneCaseBonusVal={phone_case_bonus_applied_value:.2f}, "
                         f"StreakVersionBonus={streak_bonus_version_change:.1f}, StreakCoinBonus={streak_bonus_onecoin_change}, "
                         f"TotalAppliedChange={final_oneui_change_to_apply:.2f}")
-            
+
             await message.reply("\n".join(ordered_response_parts), parse_mode="HTML", disable_web_page_preview=True)
             logger.info(f"/oneui user {user_id} in chat {chat_id_current_message} (thread: {original_message_thread_id}) - SUCCESS (Conditional Total Change Display)")
 
@@ -1381,25 +1380,7 @@ async def oneui_command(message: Message):
             logger.info(f"/oneui user {user_id} in chat {chat_id_current_message} (thread: {original_message_thread_id}) - END")
 
 # === Вспомогательные функции для команд (из вашего файла) ===
-# fetch_user_display_data и resolve_target_user
-async def fetch_user_display_data(bot_instance: Bot, user_id_to_fetch: int) -> Tuple[str, Optional[str]]:
-    full_name, username = None, None; conn = None
-    try:
-        conn = await database.get_connection()
-        udb = await conn.fetchrow("SELECT full_name, username FROM user_oneui WHERE user_id = $1 ORDER BY last_used DESC NULLS LAST LIMIT 1", user_id_to_fetch)
-        if udb: full_name, username = udb.get('full_name'), udb.get('username')
-    except Exception as e: logger.warning(f"DB fetch error for user {user_id_to_fetch}: {e}")
-    finally:
-        if conn and not conn.is_closed(): await conn.close()
-    if not full_name:
-        try:
-            ci = await bot_instance.get_chat(user_id_to_fetch)
-            fn_api = getattr(ci, 'full_name', None) or getattr(ci, 'first_name', None)
-            if fn_api: full_name = fn_api
-            if not username: username = getattr(ci, 'username', None)
-        except Exception as e: logger.warning(f"API get_chat error for user {user_id_to_fetch}: {e}")
-    return full_name or f"User ID {user_id_to_fetch}", username
-
+# resolve_target_user (fetch_user_display_data - в utils.py)
 async def resolve_target_user(msg: Message, cmd: CommandObject, bot_inst: Bot) -> Optional[Tuple[int, str, Optional[str]]]:
     uid, fn, un = None, None, None
     if msg.reply_to_message and msg.reply_to_message.from_user and not msg.reply_to_message.from_user.is_bot:
@@ -1408,15 +1389,12 @@ async def resolve_target_user(msg: Message, cmd: CommandObject, bot_inst: Bot) -
     elif cmd.args:
         arg = cmd.args.strip()
         if arg.startswith('@'):
-            uname_find = arg[1:].lower(); conn = None
+            uname_find = arg[1:].lower()
             try:
-                conn = await database.get_connection()
-                urow = await conn.fetchrow("SELECT user_id, full_name, username FROM user_oneui WHERE lower(username) = $1 ORDER BY last_used DESC NULLS LAST LIMIT 1", uname_find)
+                urow = await database.find_user_by_username(uname_find)
                 if urow: uid, fn, un = urow['user_id'], urow.get('full_name'), urow.get('username')
                 else: await msg.reply(f"Не найден юзер @{html.escape(arg[1:])}. Попробуйте ID/ответ."); return None
             except Exception as e: logger.error(f"DB error searching @{html.escape(arg[1:])}: {e}", exc_info=True); await msg.reply(f"Ошибка поиска @{html.escape(arg[1:])}."); return None
-            finally:
-                if conn and not conn.is_closed(): await conn.close()
         else:
             try: uid = int(arg)
             except ValueError: await msg.reply("Неверный формат. ID, @username или ответ."); return None
@@ -1760,8 +1738,22 @@ async def user_top_versions_command(message: Message, command: CommandObject, bo
 if __name__ == '__main__':
     async def main_runner():
         try:
-            logger.info("Запуск бота...")
-            await dp.start_polling(bot)
+            if Config.BOT_MODE == "webhook":
+                if Config.BOT_WORKERS > 1:
+                    logger.warning("BOT_WORKERS игнорируется в режиме webhook: для масштабирования запускайте несколько экземпляров за балансировщиком.")
+                await webhook.WebhookServer(
+                    dp, bot, Config.WEBHOOK_PATH, secret_token=Config.WEBHOOK_SECRET_TOKEN, base_url=Config.WEBHOOK_BASE_URL,
+                    max_in_flight=Config.WEBHOOK_MAX_IN_FLIGHT, drain_timeout=Config.WEBHOOK_DRAIN_TIMEOUT_SECONDS,
+                ).run(Config.WEBHOOK_HOST, Config.WEBHOOK_PORT)
+            elif Config.BOT_WORKERS > 1:
+                logger.info(f"Запуск бота: приемник апдейтов и {Config.BOT_WORKERS} процессов-обработчиков...")
+                await sharding.ShardedPolling(
+                    bot, run_shard_worker, Config.BOT_WORKERS,
+                    queue_size=Config.SHARD_QUEUE_SIZE, polling_timeout=Config.SHARD_POLLING_TIMEOUT_SECONDS,
+                ).run()
+            else:
+                logger.info("Запуск бота...")
+                await dp.start_polling(bot)
         except (KeyboardInterrupt, SystemExit):
             logger.info("Бот остановлен вручную (KeyboardInterrupt/SystemExit).")
         except Exception as e_run:
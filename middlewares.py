@@ -0,0 +1,224 @@
+# middlewares.py
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Set, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, Chat, Message, TelegramObject, User
+
+import database
+import db_metrics
+import directory
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class DbConnectionMiddleware(BaseMiddleware):
+    """
+    Привязывает одно соединение с БД к обработке апдейта (database.request_connection_scope).
+    Вложенные вызовы database.* без conn_ext переиспользуют его вместо того,
+    чтобы каждый раз брать новое соединение из пула.
+
+    Внимание: get_connection() внутри апдейта возвращает это же соединение. Функция, которая
+    раньше коммитила на своем соединении, теперь входит в открытую транзакцию обработчика
+    и откатывается вместе с ней. Соединение держится весь апдейт, в том числе во время
+    запросов к Telegram и ожидания блокировок. То, что должно закоммититься независимо
+    (outbox, журналы), использует database.get_standalone_connection().
+    """
+
+    def __init__(self, use_transaction: bool = False):
+        self.use_transaction = use_transaction
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        async with database.request_connection_scope(use_transaction=self.use_transaction):
+            return await handler(event, data)
+
+
+class KnownUsersMiddleware(BaseMiddleware):
+    """
+    Внешняя middleware (dp.update): поддерживает актуальные имя и username в таблице users
+    (database.upsert_user_identity сама пропускает запись, если они не изменились)
+    и в справочниках directory.users и directory.chats - для любого апдейта.
+    Записи user_oneui здесь не создаются, см. KnownUserRowsMiddleware.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user: Optional[User] = data.get("event_from_user")
+        chat: Optional[Chat] = data.get("event_chat")
+        if user and not user.is_bot:
+            directory.remember_user(user.id, user.full_name, user.username)
+            try:
+                await database.upsert_user_identity(user.id, user.username, user.full_name)
+            except Exception as e:
+                logger.error(f"KnownUsers: Не удалось обновить users для user {user.id}: {e}", exc_info=True)
+        if chat:
+            directory.remember_chat(chat.id, chat.title, chat.username, chat.type)
+        return await handler(event, data)
+
+
+class KnownUserRowsMiddleware(BaseMiddleware):
+    """
+    Внутренняя middleware (dp.message, dp.callback_query): при первой команде пользователя в чате
+    создает его запись в user_oneui (database.ensure_user_row). Внутренние middleware вызываются только
+    для апдейтов, нашедших обработчик, поэтому обычные сообщения в группе записей не создают
+    и не попадают в топы и /reminders.
+    Уже встреченные пары (user_id, chat_id) хранятся в памяти, поэтому повторные команды
+    не пишут в БД. При переполнении множество сбрасывается - ensure_user_row идемпотентна.
+    """
+
+    def __init__(self, max_size: int = 100000):
+        self.max_size = max_size
+        self._known: Set[Tuple[int, int]] = set()
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user: Optional[User] = data.get("event_from_user")
+        chat: Optional[Chat] = data.get("event_chat")
+        if user and chat and not user.is_bot:
+            key = (user.id, chat.id)
+            if key not in self._known:
+                try:
+                    await database.ensure_user_row(user.id, chat.id, user.username, user.full_name, chat.title)
+                    if len(self._known) >= self.max_size:
+                        self._known.clear()
+                    self._known.add(key)
+                except Exception as e:
+                    logger.error(f"KnownUsers: Не удалось создать запись для user {user.id} в чате {chat.id}: {e}", exc_info=True)
+        return await handler(event, data)
+
+
+class HandlerNameMiddleware(BaseMiddleware):
+    """
+    Внутренняя middleware: запоминает имя выбранного обработчика в db_metrics.current_caller,
+    чтобы метрики БД показывали, какой обработчик сделал запрос.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        callback = getattr(handler_object, "callback", None)
+        if callback is None:
+            return await handler(event, data)
+        caller = f"{getattr(callback, '__module__', '?')}.{getattr(callback, '__qualname__', repr(callback))}"
+        with db_metrics.caller_scope(caller):
+            return await handler(event, data)
+
+
+class _TokenBucket:
+    __slots__ = ("tokens", "updated_at")
+
+    def __init__(self, capacity: float, now: float):
+        self.tokens = capacity
+        self.updated_at = now
+
+    def refill(self, capacity: float, rate: float, now: float) -> float:
+        self.tokens = min(capacity, self.tokens + (now - self.updated_at) * rate)
+        self.updated_at = now
+        return self.tokens
+
+
+class FloodControlMiddleware(BaseMiddleware):
+    """
+    Внутренняя middleware: ограничивает частоту команд ведрами токенов на пользователя и на чат.
+    Стоимость команды берется из costs по имени функции-обработчика (алиасы команды
+    ведут к одному обработчику), остальные стоят default_cost. Команда выполняется, только если
+    в обоих ведрах хватает токенов. Иначе она отбрасывается до обработчика (и до обращений к БД),
+    а пользователь получает заранее заданный ответ "не так быстро" - не чаще раза в warning_window
+    секунд на пару (пользователь, чат). Администратор (Config.ADMIN_ID) не ограничивается.
+    """
+
+    def __init__(self, user_capacity: float, user_rate: float, chat_capacity: float, chat_rate: float,
+                 costs: Optional[Dict[str, float]] = None, default_cost: float = 1.0,
+                 warning_window: float = 30.0, warning_text: str = "", max_buckets: int = 100000,
+                 exempt_user_ids: Tuple[int, ...] = ()):
+        self.user_capacity = user_capacity
+        self.user_rate = user_rate
+        self.chat_capacity = chat_capacity
+        self.chat_rate = chat_rate
+        self.costs = dict(costs or {})
+        self.default_cost = default_cost
+        self.warning_window = warning_window
+        self.warning_text = warning_text
+        self.max_buckets = max_buckets
+        self.exempt_user_ids = set(exempt_user_ids)
+        self._user_buckets: Dict[int, _TokenBucket] = {}
+        self._chat_buckets: Dict[int, _TokenBucket] = {}
+        self._warned_at: Dict[Tuple[int, int], float] = {}
+        self.rejected = 0
+
+    def _bucket(self, buckets: Dict[int, _TokenBucket], key: int, capacity: float, rate: float, now: float) -> _TokenBucket:
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= self.max_buckets:
+                self._evict_idle(buckets, capacity, rate, now)
+            bucket = buckets[key] = _TokenBucket(capacity, now)
+        else:
+            bucket.refill(capacity, rate, now)
+        return bucket
+
+    @staticmethod
+    def _evict_idle(buckets: Dict[int, _TokenBucket], capacity: float, rate: float, now: float) -> None:
+        # Полное (восстановившееся) ведро ничем не отличается от нового - его можно забыть
+        idle_after = capacity / rate if rate > 0 else float("inf")
+        for key in [k for k, b in buckets.items() if now - b.updated_at >= idle_after]:
+            del buckets[key]
+
+    def command_cost(self, data: Dict[str, Any]) -> float:
+        callback = getattr(data.get("handler"), "callback", None)
+        return self.costs.get(getattr(callback, "__name__", ""), self.default_cost)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user: Optional[User] = data.get("event_from_user")
+        chat: Optional[Chat] = data.get("event_chat")
+        if user is None or user.id in self.exempt_user_ids:
+            return await handler(event, data)
+        cost = self.command_cost(data)
+        now = time.monotonic()
+        user_bucket = self._bucket(self._user_buckets, user.id, self.user_capacity, self.user_rate, now)
+        chat_bucket = self._bucket(self._chat_buckets, chat.id, self.chat_capacity, self.chat_rate, now) if chat else None
+        if user_bucket.tokens >= cost and (chat_bucket is None or chat_bucket.tokens >= cost):
+            user_bucket.tokens -= cost
+            if chat_bucket is not None:
+                chat_bucket.tokens -= cost
+            return await handler(event, data)
+
+        self.rejected += 1
+        warn_key = (user.id, chat.id if chat else 0)
+        should_warn = now - self._warned_at.get(warn_key, float("-inf")) >= self.warning_window
+        if should_warn:
+            if len(self._warned_at) >= self.max_buckets:
+                self._warned_at = {k: t for k, t in self._warned_at.items() if now - t < self.warning_window}
+            self._warned_at[warn_key] = now
+        try:
+            if isinstance(event, CallbackQuery):
+                # На callback отвечаем всегда, иначе у пользователя висят "часики"; текст - только раз в окно
+                await event.answer(self.warning_text if should_warn and self.warning_text else None)
+            elif should_warn and self.warning_text and isinstance(event, Message):
+                await event.reply(self.warning_text, disable_web_page_preview=True)
+        except Exception as e:
+            logger.debug(f"FloodControl: Не удалось ответить user {user.id} на отклоненный апдейт: {e}")
+        return None
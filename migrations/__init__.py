@@ -0,0 +1,121 @@
+# migrations/__init__.py
+"""
+Версионные миграции схемы БД.
+
+Каждая миграция - модуль mNNNN_<название>.py в этом пакете с константой SQL.
+Примененные миграции записываются в schema_migrations вместе с контрольной суммой SQL,
+поэтому на старте достаточно одного SELECT, если новых миграций нет.
+Уже примененные миграции менять нельзя - для изменений схемы добавляйте новый модуль.
+"""
+import hashlib
+import importlib
+import pkgutil
+import re
+from typing import Dict, List, NamedTuple
+
+import asyncpg
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_TABLE = "schema_migrations"
+# Ключ advisory-блокировки, чтобы две копии бота не применяли миграции одновременно
+MIGRATIONS_ADVISORY_LOCK_KEY = 727_001
+
+_MODULE_NAME_RE = re.compile(r"^m(\d{4})_(\w+)$")
+
+_BOOTSTRAP_SQL = f"""
+CREATE TABLE IF NOT EXISTS {MIGRATIONS_TABLE} (
+    version INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    checksum TEXT NOT NULL,
+    applied_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP NOT NULL
+);
+SELECT pg_advisory_xact_lock({MIGRATIONS_ADVISORY_LOCK_KEY});
+"""
+
+
+class MigrationError(Exception):
+    pass
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    sql: str
+    checksum: str
+
+
+def load_migrations() -> List[Migration]:
+    """Находит все модули миграций пакета и возвращает их по возрастанию версии."""
+    found: Dict[int, Migration] = {}
+    for module_info in pkgutil.iter_modules(__path__):
+        match = _MODULE_NAME_RE.match(module_info.name)
+        if not match:
+            continue
+        module = importlib.import_module(f"{__name__}.{module_info.name}")
+        sql = getattr(module, "SQL", None)
+        if not isinstance(sql, str) or not sql.strip():
+            raise MigrationError(f"Миграция '{module_info.name}' не содержит SQL.")
+        version = int(match.group(1))
+        if version in found:
+            raise MigrationError(f"Дублирующийся номер миграции {version}: '{found[version].name}' и '{match.group(2)}'.")
+        checksum = hashlib.sha256(sql.strip().encode("utf-8")).hexdigest()
+        found[version] = Migration(version, match.group(2), sql, checksum)
+    return [found[v] for v in sorted(found)]
+
+
+def _pending(migrations: List[Migration], applied: Dict[int, str]) -> List[Migration]:
+    for migration in migrations:
+        applied_checksum = applied.get(migration.version)
+        if applied_checksum is not None and applied_checksum != migration.checksum:
+            raise MigrationError(
+                f"Контрольная сумма миграции {migration.version:04d}_{migration.name} не совпадает с примененной. "
+                f"Примененные миграции нельзя изменять - создайте новую."
+            )
+    unknown = sorted(set(applied) - {m.version for m in migrations})
+    if unknown:
+        logger.warning(f"Migrations: В БД есть миграции, неизвестные этой версии кода: {unknown}.")
+    return [m for m in migrations if m.version not in applied]
+
+
+async def _fetch_applied(conn: asyncpg.Connection) -> Dict[int, str]:
+    rows = await conn.fetch(f"SELECT version, checksum FROM {MIGRATIONS_TABLE}")
+    return {row["version"]: row["checksum"] for row in rows}
+
+
+def _build_script(pending: List[Migration]) -> str:
+    parts = []
+    for migration in pending:
+        parts.append(migration.sql)
+        parts.append(
+            f"INSERT INTO {MIGRATIONS_TABLE} (version, name, checksum) "
+            f"VALUES ({migration.version}, '{migration.name}', '{migration.checksum}');"
+        )
+    return "\n".join(parts)
+
+
+async def apply_migrations(conn: asyncpg.Connection) -> List[Migration]:
+    """
+    Применяет недостающие миграции и возвращает список примененных.
+    Если все миграции уже есть в schema_migrations - это один запрос к БД.
+    Иначе все ожидающие миграции выполняются одним скриптом в одной транзакции.
+    """
+    migrations = load_migrations()
+    try:
+        applied = await _fetch_applied(conn)
+    except asyncpg.UndefinedTableError:
+        applied = {}
+    if not _pending(migrations, applied):
+        return []
+
+    async with conn.transaction():
+        await conn.execute(_BOOTSTRAP_SQL)
+        # Перечитываем под блокировкой: другая копия бота могла успеть применить миграции
+        pending = _pending(migrations, await _fetch_applied(conn))
+        if pending:
+            await conn.execute(_build_script(pending))
+    for migration in pending:
+        logger.info(f"Migrations: Применена миграция {migration.version:04d}_{migration.name}.")
+    return pending
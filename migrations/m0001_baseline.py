@@ -0,0 +1,349 @@
+# migrations/m0001_baseline.py
+# Базовая схема - бывший init_db(). Идемпотентна: безопасно применяется к уже существующей БД,
+# в том числе к старым версиям схемы (добавляет недостающие колонки, конвертирует типы).
+
+SQL = """
+-- --- user_oneui (основная таблица для версий и монет) ---
+CREATE TABLE IF NOT EXISTS user_oneui (
+    user_id BIGINT NOT NULL,
+    chat_id BIGINT NOT NULL,
+    PRIMARY KEY (user_id, chat_id)
+);
+ALTER TABLE user_oneui ADD COLUMN IF NOT EXISTS username TEXT;
+ALTER TABLE user_oneui ADD COLUMN IF NOT EXISTS full_name TEXT;
+ALTER TABLE user_oneui ADD COLUMN IF NOT EXISTS chat_title TEXT;
+ALTER TABLE user_oneui ADD COLUMN IF NOT EXISTS version NUMERIC(10, 1) DEFAULT 0.0;
+ALTER TABLE user_oneui ADD COLUMN IF NOT EXISTS last_used TIMESTAMP WITH TIME ZONE DEFAULT NULL;
+ALTER TABLE user_oneui ADD COLUMN IF NOT EXISTS onecoins INTEGER DEFAULT 0 NOT NULL;
+ALTER TABLE user_oneui ADD COLUMN IF NOT EXISTS telegram_chat_link TEXT DEFAULT NULL;
+ALTER TABLE user_oneui ADD COLUMN IF NOT EXISTS total_income_earned_from_businesses BIGINT DEFAULT 0 NOT NULL;
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM information_schema.columns
+               WHERE table_name = 'user_oneui' AND column_name = 'last_used'
+                 AND data_type = 'timestamp without time zone') THEN
+        ALTER TABLE user_oneui ALTER COLUMN last_used TYPE TIMESTAMP WITH TIME ZONE USING last_used AT TIME ZONE 'UTC';
+    END IF;
+END $$;
+
+-- --- Ограбления ---
+CREATE TABLE IF NOT EXISTS user_robbank_status (
+    user_id BIGINT NOT NULL,
+    chat_id BIGINT NOT NULL,
+    last_robbank_attempt_utc TIMESTAMP WITH TIME ZONE,
+    robbank_oneui_blocked_until_utc TIMESTAMP WITH TIME ZONE,
+    current_operation_name TEXT,
+    current_operation_start_utc TIMESTAMP WITH TIME ZONE,
+    current_operation_base_reward INTEGER,
+    PRIMARY KEY (user_id, chat_id),
+    FOREIGN KEY (user_id, chat_id) REFERENCES user_oneui (user_id, chat_id) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS idx_user_robbank_status_blocked ON user_robbank_status (robbank_oneui_blocked_until_utc);
+CREATE INDEX IF NOT EXISTS idx_user_robbank_status_pending_op ON user_robbank_status (current_operation_start_utc);
+
+-- --- Бонусы и достижения ---
+CREATE TABLE IF NOT EXISTS user_bonus_multipliers (
+    user_id BIGINT NOT NULL,
+    chat_id BIGINT NOT NULL,
+    current_bonus_multiplier NUMERIC(3, 2),
+    is_bonus_consumed BOOLEAN DEFAULT TRUE NOT NULL,
+    last_claimed_timestamp TIMESTAMP WITH TIME ZONE,
+    PRIMARY KEY (user_id, chat_id)
+);
+
+CREATE TABLE IF NOT EXISTS user_display_achievement (
+    user_id BIGINT PRIMARY KEY,
+    selected_achievement_key TEXT DEFAULT NULL,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_user_display_achievement_user_id ON user_display_achievement (user_id);
+
+CREATE TABLE IF NOT EXISTS user_achievements (
+    user_id BIGINT NOT NULL,
+    achievement_key TEXT NOT NULL,
+    achieved_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    progress_data JSONB DEFAULT NULL,
+    PRIMARY KEY (user_id, achievement_key)
+);
+CREATE INDEX IF NOT EXISTS idx_user_achievements_user_id ON user_achievements (user_id);
+
+-- --- Телефоны ---
+CREATE TABLE IF NOT EXISTS user_phones (
+    phone_inventory_id SERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    chat_id_acquired_in BIGINT NOT NULL,
+    phone_model_key TEXT NOT NULL,
+    color TEXT NOT NULL,
+    purchase_price_onecoins INTEGER NOT NULL,
+    purchase_date_utc TIMESTAMP WITH TIME ZONE NOT NULL,
+    is_sold BOOLEAN DEFAULT FALSE NOT NULL,
+    sold_date_utc TIMESTAMP WITH TIME ZONE,
+    sold_price_onecoins INTEGER
+);
+ALTER TABLE user_phones ADD COLUMN IF NOT EXISTS current_memory_gb INTEGER DEFAULT NULL;
+ALTER TABLE user_phones ADD COLUMN IF NOT EXISTS is_broken BOOLEAN DEFAULT FALSE NOT NULL;
+ALTER TABLE user_phones ADD COLUMN IF NOT EXISTS broken_component_key TEXT DEFAULT NULL;
+ALTER TABLE user_phones ADD COLUMN IF NOT EXISTS insurance_active_until TIMESTAMP WITH TIME ZONE DEFAULT NULL;
+ALTER TABLE user_phones ADD COLUMN IF NOT EXISTS equipped_case_key TEXT DEFAULT NULL;
+ALTER TABLE user_phones ADD COLUMN IF NOT EXISTS is_contraband BOOLEAN DEFAULT FALSE NOT NULL;
+ALTER TABLE user_phones ADD COLUMN IF NOT EXISTS last_charged_utc TIMESTAMP WITH TIME ZONE DEFAULT NULL;
+ALTER TABLE user_phones ADD COLUMN IF NOT EXISTS battery_dead_after_utc TIMESTAMP WITH TIME ZONE DEFAULT NULL;
+ALTER TABLE user_phones ADD COLUMN IF NOT EXISTS battery_break_after_utc TIMESTAMP WITH TIME ZONE DEFAULT NULL;
+ALTER TABLE user_phones ADD COLUMN IF NOT EXISTS data JSONB DEFAULT NULL;
+CREATE INDEX IF NOT EXISTS idx_user_phones_user_id ON user_phones (user_id);
+CREATE INDEX IF NOT EXISTS idx_user_phones_user_active ON user_phones (user_id, is_sold);
+
+CREATE TABLE IF NOT EXISTS user_items (
+    user_item_id SERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    item_key TEXT NOT NULL,
+    item_type TEXT NOT NULL,
+    quantity INTEGER DEFAULT 1 NOT NULL,
+    data JSONB DEFAULT NULL,
+    equipped_phone_id INTEGER DEFAULT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_user_items_user_id ON user_items (user_id);
+CREATE INDEX IF NOT EXISTS idx_user_items_user_item_type ON user_items (user_id, item_key, item_type);
+
+CREATE TABLE IF NOT EXISTS user_pending_phone_prizes (
+    prize_id SERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    phone_model_key TEXT NOT NULL,
+    color TEXT NOT NULL,
+    initial_memory_gb INTEGER NOT NULL,
+    prize_won_at_utc TIMESTAMP WITH TIME ZONE NOT NULL,
+    original_roulette_chat_id BIGINT NOT NULL,
+    UNIQUE (user_id)
+);
+CREATE INDEX IF NOT EXISTS idx_user_pending_phone_prizes_user_id ON user_pending_phone_prizes (user_id);
+CREATE INDEX IF NOT EXISTS idx_user_pending_phone_prizes_won_at_utc ON user_pending_phone_prizes (prize_won_at_utc);
+
+-- --- История версий ---
+CREATE TABLE IF NOT EXISTS user_version_history (
+    id SERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    chat_id BIGINT NOT NULL,
+    version NUMERIC(10, 1),
+    full_name_at_change TEXT,
+    changed_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (user_id, chat_id, changed_at)
+);
+ALTER TABLE user_version_history ADD COLUMN IF NOT EXISTS full_name_at_change TEXT;
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint
+                   WHERE conrelid = 'user_version_history'::regclass AND contype = 'f') THEN
+        BEGIN
+            ALTER TABLE user_version_history ADD CONSTRAINT user_version_history_user_chat_fkey
+                FOREIGN KEY (user_id, chat_id) REFERENCES user_oneui (user_id, chat_id) ON DELETE CASCADE;
+        EXCEPTION WHEN others THEN
+            RAISE WARNING 'Не удалось добавить FOREIGN KEY для user_version_history: %', SQLERRM;
+        END;
+    END IF;
+    IF EXISTS (SELECT 1 FROM information_schema.columns
+               WHERE table_name = 'user_version_history' AND column_name = 'changed_at'
+                 AND data_type = 'timestamp without time zone') THEN
+        ALTER TABLE user_version_history ALTER COLUMN changed_at TYPE TIMESTAMP WITH TIME ZONE USING changed_at AT TIME ZONE 'UTC';
+    END IF;
+END $$;
+
+-- --- Бизнесы и банк ---
+CREATE TABLE IF NOT EXISTS user_businesses (
+    business_id SERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    chat_id BIGINT NOT NULL,
+    username TEXT DEFAULT NULL,
+    full_name TEXT DEFAULT NULL,
+    chat_title TEXT DEFAULT NULL,
+    business_key TEXT NOT NULL,
+    current_level INTEGER DEFAULT 0 NOT NULL,
+    staff_hired_slots INTEGER DEFAULT 0 NOT NULL,
+    last_income_calculation_utc TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    time_purchased_utc TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    is_active BOOLEAN DEFAULT TRUE NOT NULL,
+    name_override TEXT DEFAULT NULL,
+    UNIQUE (user_id, chat_id, business_key)
+);
+CREATE INDEX IF NOT EXISTS idx_user_businesses_user_chat ON user_businesses (user_id, chat_id);
+CREATE INDEX IF NOT EXISTS idx_user_businesses_active ON user_businesses (is_active);
+
+CREATE TABLE IF NOT EXISTS user_business_upgrades (
+    upgrade_id SERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    business_internal_id INTEGER NOT NULL REFERENCES user_businesses(business_id) ON DELETE CASCADE,
+    upgrade_key TEXT NOT NULL,
+    time_installed_utc TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    UNIQUE (business_internal_id, upgrade_key)
+);
+CREATE INDEX IF NOT EXISTS idx_user_business_upgrades_business_id ON user_business_upgrades (business_internal_id);
+
+CREATE TABLE IF NOT EXISTS user_bank (
+    user_id BIGINT NOT NULL,
+    chat_id BIGINT NOT NULL,
+    username TEXT DEFAULT NULL,
+    full_name TEXT DEFAULT NULL,
+    chat_title TEXT DEFAULT NULL,
+    current_balance BIGINT DEFAULT 0 NOT NULL,
+    bank_level INTEGER DEFAULT 0 NOT NULL,
+    last_deposit_utc TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    PRIMARY KEY (user_id, chat_id)
+);
+CREATE INDEX IF NOT EXISTS idx_user_bank_user_id ON user_bank (user_id);
+
+-- --- Семьи ---
+CREATE TABLE IF NOT EXISTS families (
+    family_id SERIAL PRIMARY KEY, name TEXT UNIQUE NOT NULL, leader_id BIGINT NOT NULL,
+    chat_id_created_in BIGINT NOT NULL, chat_title_created_in TEXT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS family_members (
+    member_entry_id SERIAL PRIMARY KEY, family_id INTEGER NOT NULL REFERENCES families(family_id) ON DELETE CASCADE,
+    user_id BIGINT NOT NULL, full_name_when_joined TEXT, chat_id_joined_from BIGINT NOT NULL,
+    joined_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP, is_active BOOLEAN DEFAULT TRUE,
+    UNIQUE (family_id, user_id)
+);
+CREATE INDEX IF NOT EXISTS idx_family_members_active ON family_members (family_id, user_id, is_active);
+CREATE INDEX IF NOT EXISTS idx_family_members_user_active ON family_members (user_id, is_active);
+
+CREATE TABLE IF NOT EXISTS family_logs (
+    log_id SERIAL PRIMARY KEY, family_id INTEGER NOT NULL REFERENCES families(family_id) ON DELETE CASCADE,
+    timestamp TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP, action_type TEXT NOT NULL,
+    actor_user_id BIGINT, actor_full_name TEXT, target_user_id BIGINT NULL, target_full_name TEXT NULL,
+    chat_id_context BIGINT, chat_title_context TEXT, description TEXT NOT NULL
+);
+
+-- --- Соревнования семей ---
+CREATE TABLE IF NOT EXISTS family_competitions (
+    competition_id SERIAL PRIMARY KEY,
+    start_ts TIMESTAMP WITH TIME ZONE,
+    end_ts TIMESTAMP WITH TIME ZONE,
+    is_active BOOLEAN DEFAULT FALSE,
+    winner_family_id INTEGER NULL REFERENCES families(family_id) ON DELETE SET NULL,
+    started_by_admin_id BIGINT,
+    rewards_distributed BOOLEAN DEFAULT FALSE
+);
+DO $$
+DECLARE
+    col TEXT;
+BEGIN
+    -- Старые БД: start_time/end_time -> start_ts/end_ts
+    IF NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name = 'family_competitions' AND column_name = 'start_ts')
+       AND EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name = 'family_competitions' AND column_name = 'start_time') THEN
+        ALTER TABLE family_competitions RENAME COLUMN start_time TO start_ts;
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name = 'family_competitions' AND column_name = 'end_ts')
+       AND EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name = 'family_competitions' AND column_name = 'end_time') THEN
+        ALTER TABLE family_competitions RENAME COLUMN end_time TO end_ts;
+    END IF;
+    FOREACH col IN ARRAY ARRAY['start_ts', 'end_ts'] LOOP
+        IF EXISTS (SELECT 1 FROM information_schema.columns
+                   WHERE table_name = 'family_competitions' AND column_name = col
+                     AND data_type = 'timestamp without time zone') THEN
+            EXECUTE format('ALTER TABLE family_competitions ALTER COLUMN %I TYPE TIMESTAMP WITH TIME ZONE USING %I AT TIME ZONE ''UTC''', col, col);
+        END IF;
+    END LOOP;
+END $$;
+ALTER TABLE family_competitions ADD COLUMN IF NOT EXISTS start_ts TIMESTAMP WITH TIME ZONE;
+ALTER TABLE family_competitions ADD COLUMN IF NOT EXISTS end_ts TIMESTAMP WITH TIME ZONE;
+ALTER TABLE family_competitions ADD COLUMN IF NOT EXISTS is_active BOOLEAN DEFAULT FALSE;
+ALTER TABLE family_competitions ADD COLUMN IF NOT EXISTS winner_family_id INTEGER NULL REFERENCES families(family_id) ON DELETE SET NULL;
+ALTER TABLE family_competitions ADD COLUMN IF NOT EXISTS started_by_admin_id BIGINT;
+ALTER TABLE family_competitions ADD COLUMN IF NOT EXISTS rewards_distributed BOOLEAN DEFAULT FALSE;
+
+CREATE TABLE IF NOT EXISTS family_competition_scores (
+    score_entry_id SERIAL PRIMARY KEY,
+    competition_id INTEGER NOT NULL REFERENCES family_competitions(competition_id) ON DELETE CASCADE,
+    family_id INTEGER NOT NULL REFERENCES families(family_id) ON DELETE CASCADE,
+    total_score NUMERIC(10, 1) DEFAULT 0.0,
+    UNIQUE (competition_id, family_id)
+);
+ALTER TABLE family_competition_scores ADD COLUMN IF NOT EXISTS total_score NUMERIC(10,1) DEFAULT 0.0;
+
+CREATE TABLE IF NOT EXISTS family_competition_daily_contributions (
+    contribution_id SERIAL PRIMARY KEY,
+    competition_id INTEGER NOT NULL REFERENCES family_competitions(competition_id) ON DELETE CASCADE,
+    family_id INTEGER NOT NULL REFERENCES families(family_id) ON DELETE CASCADE,
+    user_id BIGINT NOT NULL,
+    contribution_date DATE NOT NULL,
+    max_oneui_version_today NUMERIC(10, 1) NOT NULL,
+    UNIQUE (competition_id, family_id, user_id, contribution_date)
+);
+
+-- --- Системные настройки, стрики, рулетка ---
+CREATE TABLE IF NOT EXISTS system_settings (
+    setting_key TEXT PRIMARY KEY,
+    setting_value_text TEXT,
+    setting_value_timestamp TIMESTAMP WITH TIME ZONE,
+    setting_value_int INTEGER,
+    setting_value_bool BOOLEAN
+);
+-- Начальный множитель инфляции задает database.init_db из Config (SQL миграции не зависит от настроек)
+
+CREATE TABLE IF NOT EXISTS user_daily_streaks (
+    user_id BIGINT NOT NULL,
+    chat_id BIGINT NOT NULL,
+    current_streak INTEGER DEFAULT 0 NOT NULL,
+    last_streak_check_date DATE,
+    last_streak_timestamp_utc TIMESTAMP WITH TIME ZONE,
+    username_at_last_check TEXT,
+    full_name_at_last_check TEXT,
+    chat_title_at_last_check TEXT,
+    PRIMARY KEY (user_id, chat_id)
+);
+CREATE INDEX IF NOT EXISTS idx_user_daily_streaks_last_date ON user_daily_streaks (last_streak_check_date);
+
+CREATE TABLE IF NOT EXISTS roulette_status (
+    user_id BIGINT NOT NULL,
+    chat_id BIGINT NOT NULL,
+    last_roulette_spin_timestamp TIMESTAMP WITH TIME ZONE,
+    extra_bonus_attempts INTEGER DEFAULT 0 NOT NULL,
+    extra_oneui_attempts INTEGER DEFAULT 0 NOT NULL,
+    pending_bonus_multiplier_boost NUMERIC(3,1),
+    negative_change_protection_charges INTEGER DEFAULT 0 NOT NULL,
+    extra_roulette_spins INTEGER DEFAULT 0 NOT NULL,
+    PRIMARY KEY (user_id, chat_id),
+    FOREIGN KEY (user_id, chat_id) REFERENCES user_oneui (user_id, chat_id) ON DELETE CASCADE
+);
+ALTER TABLE roulette_status ADD COLUMN IF NOT EXISTS extra_roulette_spins INTEGER DEFAULT 0 NOT NULL;
+
+-- --- Черный рынок и ежедневные монеты ---
+CREATE TABLE IF NOT EXISTS user_black_market_monthly_stats (
+    user_id BIGINT NOT NULL,
+    year_month TEXT NOT NULL,
+    phones_purchased_count INTEGER DEFAULT 0 NOT NULL,
+    PRIMARY KEY (user_id, year_month)
+);
+
+CREATE TABLE IF NOT EXISTS user_daily_onecoin_claims (
+    user_id BIGINT NOT NULL,
+    chat_id BIGINT NOT NULL,
+    last_claim_utc TIMESTAMP WITH TIME ZONE DEFAULT NULL,
+    PRIMARY KEY (user_id, chat_id),
+    CONSTRAINT fk_user_oneui_onecoin_claim
+    FOREIGN KEY (user_id, chat_id)
+    REFERENCES user_oneui (user_id, chat_id)
+    ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS idx_user_daily_onecoin_claims_user_chat ON user_daily_onecoin_claims (user_id, chat_id);
+
+CREATE TABLE IF NOT EXISTS user_black_market_slots (
+    user_id BIGINT NOT NULL,
+    slot_number INTEGER NOT NULL,
+    item_key TEXT NOT NULL,
+    item_type TEXT NOT NULL,
+    display_name_override TEXT,
+    current_price INTEGER NOT NULL,
+    original_price_before_bm INTEGER NOT NULL,
+    is_stolen BOOLEAN DEFAULT FALSE NOT NULL,
+    is_exclusive BOOLEAN DEFAULT FALSE NOT NULL,
+    quantity_available INTEGER DEFAULT 1 NOT NULL,
+    wear_data JSONB,
+    custom_data JSONB,
+    generated_at_utc TIMESTAMP WITH TIME ZONE NOT NULL,
+    is_purchased BOOLEAN DEFAULT FALSE NOT NULL,
+    PRIMARY KEY (user_id, slot_number)
+);
+CREATE INDEX IF NOT EXISTS idx_user_bm_slots_user_generated_at ON user_black_market_slots (user_id, generated_at_utc);
+CREATE INDEX IF NOT EXISTS idx_user_bm_slots_user_purchased ON user_black_market_slots (user_id, slot_number, is_purchased);
+"""
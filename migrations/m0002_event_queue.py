@@ -0,0 +1,14 @@
+# migrations/m0002_event_queue.py
+# Очередь событий (раньше создавалась отдельно через create_event_queue_table()).
+
+SQL = """
+CREATE TABLE IF NOT EXISTS event_queue (
+    event_id SERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    event_type VARCHAR(50) NOT NULL,
+    event_data JSONB,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    processed BOOLEAN DEFAULT FALSE,
+    processed_at TIMESTAMP WITH TIME ZONE
+);
+"""
@@ -0,0 +1,212 @@
+# migrations/m0003_oneui_roll_function.py
+# Серверная функция для /oneui: стрик, блокировка ограблением, доп. попытки, кулдаун,
+# защита от минуса, бонус-множитель, запись версии + истории и монет - за один вызов.
+# Случайный бросок и тексты остаются в main.py (oneui_command).
+
+SQL = """
+CREATE OR REPLACE FUNCTION oneui_roll(
+    p_user_id BIGINT,
+    p_chat_id BIGINT,
+    p_username TEXT,
+    p_full_name TEXT,
+    p_chat_title TEXT,
+    p_chat_link TEXT,
+    p_now TIMESTAMP WITH TIME ZONE,
+    p_streak_date DATE,
+    p_last_reset TIMESTAMP WITH TIME ZONE,
+    p_base_change NUMERIC,
+    p_case_bonus_percent NUMERIC,
+    p_streak_goals JSONB,
+    p_streak_compensation JSONB,
+    p_default_comp_version NUMERIC,
+    p_default_comp_onecoin INTEGER,
+    OUT status TEXT,
+    OUT old_streak INTEGER,
+    OUT new_streak INTEGER,
+    OUT comp_version NUMERIC,
+    OUT comp_onecoin INTEGER,
+    OUT goal_version NUMERIC,
+    OUT goal_onecoin INTEGER,
+    OUT blocked_until TIMESTAMP WITH TIME ZONE,
+    OUT has_roulette_status BOOLEAN,
+    OUT used_extra_attempt BOOLEAN,
+    OUT extra_attempts_left INTEGER,
+    OUT protection_used BOOLEAN,
+    OUT protection_charges_left INTEGER,
+    OUT bonus_multiplier NUMERIC,
+    OUT bonus_multiplier_base NUMERIC,
+    OUT bonus_boost NUMERIC,
+    OUT change_after_protection NUMERIC,
+    OUT effective_change NUMERIC,
+    OUT case_bonus_value NUMERIC,
+    OUT final_change NUMERIC,
+    OUT old_version NUMERIC,
+    OUT new_version NUMERIC
+) LANGUAGE plpgsql AS $fn$
+DECLARE
+    v_last_used TIMESTAMP WITH TIME ZONE;
+    v_last_date DATE;
+    v_extra INTEGER;
+    v_protection INTEGER;
+    v_pending_boost NUMERIC;
+    v_mult NUMERIC;
+    v_consumed BOOLEAN;
+    v_streak_v NUMERIC;
+    v_streak_c INTEGER;
+    v_set_last_used BOOLEAN;
+BEGIN
+    -- Блокируем строку пользователя (если она есть): параллельные /oneui одного юзера идут по очереди
+    SELECT u.version, u.last_used INTO old_version, v_last_used
+    FROM user_oneui u WHERE u.user_id = p_user_id AND u.chat_id = p_chat_id
+    FOR UPDATE;
+    old_version := COALESCE(old_version, 0);
+    new_version := old_version;
+
+    -- --- Стрик ---
+    SELECT s.current_streak, s.last_streak_check_date INTO old_streak, v_last_date
+    FROM user_daily_streaks s WHERE s.user_id = p_user_id AND s.chat_id = p_chat_id
+    FOR UPDATE;
+    old_streak := COALESCE(old_streak, 0);
+    comp_version := 0; comp_onecoin := 0; goal_version := 0; goal_onecoin := 0;
+
+    IF v_last_date = p_streak_date THEN
+        new_streak := old_streak;
+    ELSIF v_last_date IS NULL OR v_last_date < p_streak_date - 1 THEN
+        IF old_streak > 0 THEN
+            SELECT (t->>'version_bonus')::NUMERIC, (t->>'onecoin_bonus')::INTEGER INTO comp_version, comp_onecoin
+            FROM jsonb_array_elements(p_streak_compensation) t
+            WHERE old_streak >= (t->>'min_streak_days_before_break')::INTEGER
+            ORDER BY (t->>'min_streak_days_before_break')::INTEGER DESC
+            LIMIT 1;
+            comp_version := COALESCE(comp_version, 0);
+            comp_onecoin := COALESCE(comp_onecoin, 0);
+            IF comp_version = 0 AND comp_onecoin = 0 THEN
+                comp_version := p_default_comp_version;
+                comp_onecoin := p_default_comp_onecoin;
+            END IF;
+        END IF;
+        new_streak := 1;
+    ELSIF v_last_date = p_streak_date - 1 THEN
+        new_streak := old_streak + 1;
+    ELSE
+        new_streak := old_streak;
+    END IF;
+
+    IF v_last_date IS NULL OR v_last_date < p_streak_date THEN
+        INSERT INTO user_daily_streaks (user_id, chat_id, current_streak, last_streak_check_date, last_streak_timestamp_utc,
+                                        username_at_last_check, full_name_at_last_check, chat_title_at_last_check)
+        VALUES (p_user_id, p_chat_id, new_streak, p_streak_date, p_now, p_username, p_full_name, p_chat_title)
+        ON CONFLICT (user_id, chat_id) DO UPDATE SET
+            current_streak = EXCLUDED.current_streak,
+            last_streak_check_date = EXCLUDED.last_streak_check_date,
+            last_streak_timestamp_utc = EXCLUDED.last_streak_timestamp_utc,
+            username_at_last_check = EXCLUDED.username_at_last_check,
+            full_name_at_last_check = EXCLUDED.full_name_at_last_check,
+            chat_title_at_last_check = EXCLUDED.chat_title_at_last_check;
+    END IF;
+
+    IF new_streak > 0 THEN
+        SELECT COALESCE((t->>'version_reward')::NUMERIC, 0), COALESCE((t->>'onecoin_reward')::INTEGER, 0)
+        INTO goal_version, goal_onecoin
+        FROM jsonb_array_elements(p_streak_goals) WITH ORDINALITY AS g(t, ord)
+        WHERE (t->>'target_days')::INTEGER = new_streak
+        ORDER BY ord
+        LIMIT 1;
+        goal_version := COALESCE(goal_version, 0);
+        goal_onecoin := COALESCE(goal_onecoin, 0);
+    END IF;
+    v_streak_v := comp_version + goal_version;
+    v_streak_c := comp_onecoin + goal_onecoin;
+
+    -- --- Блокировка после ограбления: начисляем только награды за стрик ---
+    SELECT r.robbank_oneui_blocked_until_utc INTO blocked_until
+    FROM user_robbank_status r WHERE r.user_id = p_user_id AND r.chat_id = p_chat_id;
+    IF blocked_until IS NOT NULL AND p_now < blocked_until THEN
+        status := 'blocked';
+        IF v_streak_v <> 0 OR v_streak_c <> 0 THEN
+            new_version := round(old_version + v_streak_v, 1);
+            v_set_last_used := FALSE;
+        ELSE
+            RETURN;
+        END IF;
+    ELSE
+        -- --- Доп. попытка от рулетки или обычный кулдаун ---
+        SELECT rs.extra_oneui_attempts, rs.negative_change_protection_charges, rs.pending_bonus_multiplier_boost
+        INTO v_extra, v_protection, v_pending_boost
+        FROM roulette_status rs WHERE rs.user_id = p_user_id AND rs.chat_id = p_chat_id
+        FOR UPDATE;
+        has_roulette_status := FOUND;
+        v_extra := COALESCE(v_extra, 0);
+        v_protection := COALESCE(v_protection, 0);
+        used_extra_attempt := v_extra > 0;
+        extra_attempts_left := v_extra;
+        IF used_extra_attempt THEN
+            extra_attempts_left := v_extra - 1;
+            UPDATE roulette_status SET extra_oneui_attempts = extra_attempts_left
+            WHERE user_id = p_user_id AND chat_id = p_chat_id;
+        ELSIF v_last_used IS NOT NULL AND v_last_used > p_last_reset THEN
+            status := 'cooldown';
+            RETURN;
+        END IF;
+        v_set_last_used := NOT used_extra_attempt;
+
+        -- --- Защита от отрицательного изменения ---
+        change_after_protection := p_base_change;
+        protection_used := FALSE;
+        protection_charges_left := v_protection;
+        IF p_base_change < 0 AND v_protection > 0 THEN
+            protection_charges_left := v_protection - 1;
+            UPDATE roulette_status SET negative_change_protection_charges = protection_charges_left
+            WHERE user_id = p_user_id AND chat_id = p_chat_id;
+            change_after_protection := abs(p_base_change);
+            protection_used := TRUE;
+        END IF;
+
+        -- --- Бонус-множитель (+ буст от рулетки) ---
+        effective_change := change_after_protection;
+        SELECT b.current_bonus_multiplier, b.is_bonus_consumed INTO v_mult, v_consumed
+        FROM user_bonus_multipliers b WHERE b.user_id = p_user_id AND b.chat_id = p_chat_id
+        FOR UPDATE;
+        IF v_mult IS NOT NULL AND NOT COALESCE(v_consumed, TRUE) THEN
+            bonus_multiplier_base := v_mult;
+            bonus_multiplier := v_mult;
+            IF v_pending_boost IS NOT NULL THEN
+                bonus_boost := v_pending_boost;
+                bonus_multiplier := v_mult * v_pending_boost;
+                UPDATE roulette_status SET pending_bonus_multiplier_boost = NULL
+                WHERE user_id = p_user_id AND chat_id = p_chat_id;
+            END IF;
+            effective_change := change_after_protection * bonus_multiplier;
+            UPDATE user_bonus_multipliers SET is_bonus_consumed = TRUE
+            WHERE user_id = p_user_id AND chat_id = p_chat_id;
+        END IF;
+
+        -- --- Бонус чехла и стрик ---
+        case_bonus_value := effective_change * COALESCE(p_case_bonus_percent, 0) / 100.0;
+        final_change := effective_change + case_bonus_value + v_streak_v;
+        new_version := round(old_version + final_change, 1);
+        status := 'ok';
+    END IF;
+
+    -- --- Запись версии, истории и монет ---
+    INSERT INTO user_oneui (user_id, chat_id, username, full_name, chat_title, version, onecoins, telegram_chat_link, last_used)
+    VALUES (p_user_id, p_chat_id, p_username, p_full_name, p_chat_title, new_version, 0, p_chat_link,
+            CASE WHEN v_set_last_used THEN p_now END)
+    ON CONFLICT (user_id, chat_id) DO UPDATE SET
+        username = COALESCE(EXCLUDED.username, user_oneui.username),
+        full_name = COALESCE(EXCLUDED.full_name, user_oneui.full_name),
+        chat_title = COALESCE(EXCLUDED.chat_title, user_oneui.chat_title),
+        version = EXCLUDED.version,
+        telegram_chat_link = COALESCE(EXCLUDED.telegram_chat_link, user_oneui.telegram_chat_link),
+        last_used = CASE WHEN v_set_last_used THEN EXCLUDED.last_used ELSE user_oneui.last_used END;
+
+    INSERT INTO user_version_history (user_id, chat_id, version, changed_at, full_name_at_change)
+    VALUES (p_user_id, p_chat_id, new_version, p_now, p_full_name);
+
+    IF v_streak_c <> 0 THEN
+        UPDATE user_oneui SET onecoins = onecoins + v_streak_c
+        WHERE user_id = p_user_id AND chat_id = p_chat_id;
+    END IF;
+END;
+$fn$;
+"""
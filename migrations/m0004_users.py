@@ -0,0 +1,20 @@
+# migrations/m0004_users.py
+# Одна строка на пользователя: актуальные имя и username (раньше брались из user_oneui
+# через ORDER BY last_used DESC по всем чатам). Заполняется из user_oneui, дальше
+# поддерживается KnownUsersMiddleware (database.upsert_user_identity).
+
+SQL = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id BIGINT PRIMARY KEY,
+    full_name TEXT,
+    username TEXT,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_users_lower_username ON users (lower(username));
+
+INSERT INTO users (user_id, full_name, username)
+SELECT DISTINCT ON (user_id) user_id, full_name, username
+FROM user_oneui
+ORDER BY user_id, last_used DESC NULLS LAST
+ON CONFLICT (user_id) DO NOTHING;
+"""
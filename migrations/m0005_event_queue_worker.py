@@ -0,0 +1,31 @@
+# migrations/m0005_event_queue_worker.py
+# Состояния очереди событий для воркера (event_queue.py): pending -> processing -> done | dead,
+# счетчик попыток, время следующей попытки, аренда захваченного события и последняя ошибка.
+# NOTIFY на вставку будит воркер без постоянного опроса таблицы.
+
+SQL = """
+ALTER TABLE event_queue ADD COLUMN IF NOT EXISTS status TEXT NOT NULL DEFAULT 'pending';
+ALTER TABLE event_queue ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE event_queue ADD COLUMN IF NOT EXISTS available_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP;
+ALTER TABLE event_queue ADD COLUMN IF NOT EXISTS locked_until TIMESTAMP WITH TIME ZONE;
+ALTER TABLE event_queue ADD COLUMN IF NOT EXISTS last_error TEXT;
+
+UPDATE event_queue SET status = 'done' WHERE processed = TRUE AND status <> 'done';
+
+CREATE INDEX IF NOT EXISTS idx_event_queue_active ON event_queue (event_id)
+    WHERE status IN ('pending', 'processing');
+CREATE INDEX IF NOT EXISTS idx_event_queue_user_active ON event_queue (user_id, event_id)
+    WHERE status IN ('pending', 'processing');
+
+CREATE OR REPLACE FUNCTION event_queue_notify() RETURNS trigger LANGUAGE plpgsql AS $fn$
+BEGIN
+    PERFORM pg_notify('event_queue', '');
+    RETURN NULL;
+END;
+$fn$;
+
+DROP TRIGGER IF EXISTS trg_event_queue_notify ON event_queue;
+CREATE TRIGGER trg_event_queue_notify
+    AFTER INSERT ON event_queue
+    FOR EACH STATEMENT EXECUTE FUNCTION event_queue_notify();
+"""
@@ -0,0 +1,15 @@
+# migrations/m0006_fsm_storage.py
+# Хранилище FSM aiogram в PostgreSQL (fsm_storage.py) вместо MemoryStorage: состояния подтверждений
+# переживают перезапуск и доступны всем процессам бота. Строка живет до expires_at,
+# просроченные удаляются задачей планировщика (database.delete_expired_fsm_states).
+
+SQL = """
+CREATE TABLE IF NOT EXISTS fsm_storage (
+    storage_key TEXT PRIMARY KEY,
+    state TEXT,
+    data JSONB NOT NULL DEFAULT '{}'::jsonb,
+    expires_at TIMESTAMP WITH TIME ZONE NOT NULL,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_fsm_storage_expires_at ON fsm_storage (expires_at);
+"""
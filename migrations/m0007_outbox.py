@@ -0,0 +1,19 @@
+# migrations/m0007_outbox.py
+# Исходящие сообщения рассылок (outbox.py), еще не доставленные в Telegram. Строка удаляется после
+# отправки; locked_until - аренда процесса, который держит сообщение в своей очереди. Если процесс
+# упал, после истечения аренды сообщение забирает другой.
+
+SQL = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id BIGSERIAL PRIMARY KEY,
+    chat_id BIGINT NOT NULL,
+    text TEXT NOT NULL,
+    options JSONB NOT NULL DEFAULT '{}'::jsonb,
+    priority SMALLINT NOT NULL DEFAULT 2,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    locked_until TIMESTAMP WITH TIME ZONE,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_locked_until ON outbox (locked_until NULLS FIRST, id);
+"""
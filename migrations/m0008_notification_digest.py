@@ -0,0 +1,14 @@
+# migrations/m0008_notification_digest.py
+# Уведомления задач планировщика, собираемые в сводку (digest.py): вместо отдельного сообщения
+# от каждой задачи пользователь получает одно сообщение за окно DIGEST_WINDOW_MINUTES.
+
+SQL = """
+CREATE TABLE IF NOT EXISTS notification_digest (
+    id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    category TEXT NOT NULL,
+    text TEXT NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_notification_digest_user ON notification_digest (user_id, id);
+"""
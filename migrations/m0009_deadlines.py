@@ -0,0 +1,12 @@
+# migrations/m0009_deadlines.py
+# Индексы и столбцы для движка сроков (deadlines.py).
+# Операция /robbank теперь хранит срок завершения и тему чата, чтобы результат пережил перезапуск бота.
+
+SQL = """
+ALTER TABLE user_robbank_status ADD COLUMN IF NOT EXISTS current_operation_due_utc TIMESTAMP WITH TIME ZONE;
+ALTER TABLE user_robbank_status ADD COLUMN IF NOT EXISTS current_operation_thread_id BIGINT;
+CREATE INDEX IF NOT EXISTS idx_user_robbank_status_op_due ON user_robbank_status (current_operation_due_utc)
+    WHERE current_operation_start_utc IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_user_phones_battery_break ON user_phones (battery_break_after_utc)
+    WHERE is_sold = FALSE AND battery_break_after_utc IS NOT NULL;
+"""
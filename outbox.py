@@ -0,0 +1,483 @@
+# outbox.py
+"""
+Очередь исходящих сообщений с учетом лимитов Telegram.
+
+Рассылки задач планировщика (поломки, батареи, страховки, события бизнесов) раньше слали
+bot.send_message в цикле, ловили 429 и теряли сообщения. Теперь они ставятся в очередь
+через outbox.send_message / outbox.send_messages, а OutboundDispatcher отправляет их:
+
+- в пределах общего бюджета сообщений в секунду (PriorityRateLimiter). Тот же лимитер стоит
+  в сессии бота (OutboundRateMiddleware), поэтому ответы на команды тратят тот же бюджет,
+  но получают токены раньше рассылок;
+- не чаще одного сообщения в private_interval секунд в личный чат и в group_interval - в группу;
+- по приоритетам: PRIORITY_INTERACTIVE < PRIORITY_NOTIFICATION < PRIORITY_BROADCAST;
+- с учетом RetryAfter: чат ставится на паузу на retry_after, сообщение остается первым в его очереди;
+- с ограниченным числом повторов при прочих ошибках; "бот заблокирован" и "чат не найден" не повторяются;
+- с сохранением в таблицу outbox (persist=True): неотправленное переживает перезапуск, а сообщения
+  упавшего процесса после истечения аренды забирает другой.
+
+Если диспетчер не запущен, send_message отправляет напрямую через bot.send_message (как раньше).
+FakeBotTransport - транспорт для локальных нагрузочных проверок без Telegram.
+"""
+import asyncio
+import contextvars
+import heapq
+import itertools
+import json
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+
+import database
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = 0 # Ответы на команды
+PRIORITY_NOTIFICATION = 1 # Личные уведомления, которых пользователь ждет (результат операции и т.п.)
+PRIORITY_BROADCAST = 2 # Рассылки задач планировщика
+
+Transport = Callable[..., Awaitable[Any]]
+
+# Отправка идет из диспетчера: токен уже взят, OutboundRateMiddleware не должна брать второй
+_sending_from_outbox: contextvars.ContextVar[bool] = contextvars.ContextVar("outbox_sending", default=False)
+_seq = itertools.count()
+
+
+class PriorityRateLimiter:
+    """Ведро токенов на rate в секунду; ожидающие получают токены по приоритету, затем по очереди."""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1.0, rate / 4) # Небольшой запас, чтобы не выйти за лимит в первую секунду
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._pump_task: Optional[asyncio.Task] = None
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    async def acquire(self, priority: int = PRIORITY_BROADCAST) -> None:
+        if not self._waiters:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(_seq), future))
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+        await future
+
+    async def _pump(self) -> None:
+        while self._waiters:
+            if self._waiters[0][2].done(): # Ожидающий отменен
+                heapq.heappop(self._waiters)
+                continue
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                heapq.heappop(self._waiters)[2].set_result(None)
+            else:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+
+class OutboundRateMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: все send*-запросы вне outbox берут токен лимитера с приоритетом ответа на команду."""
+
+    def __init__(self, limiter: PriorityRateLimiter):
+        self.limiter = limiter
+
+    async def __call__(self, make_request, bot, method):
+        if not _sending_from_outbox.get() and getattr(method, "__api_method__", "").startswith("send"):
+            await self.limiter.acquire(PRIORITY_INTERACTIVE)
+        return await make_request(bot, method)
+
+
+class OutboundMessage:
+    __slots__ = ("chat_id", "text", "options", "priority", "seq", "attempts", "outbox_id")
+
+    def __init__(self, chat_id: int, text: str, options: Dict[str, Any], priority: int,
+                 attempts: int = 0, outbox_id: Optional[int] = None):
+        self.chat_id = chat_id
+        self.text = text
+        self.options = options
+        self.priority = priority
+        self.seq = next(_seq)
+        self.attempts = attempts
+        self.outbox_id = outbox_id
+
+
+def _is_permanent_error(error: Exception) -> bool:
+    # Бот заблокирован, чат не найден, некорректный текст - повтор не поможет
+    return isinstance(error, (TelegramForbiddenError, TelegramBadRequest))
+
+
+class OutboundDispatcher:
+    def __init__(self, transport: Transport, limiter: PriorityRateLimiter,
+                 private_interval: float = 1.0, group_interval: float = 3.0,
+                 max_attempts: int = 5, retry_base_seconds: float = 2.0, max_concurrency: int = 20,
+                 lease_seconds: float = 3600.0, recovery_interval: float = 300.0, recovery_batch: int = 500):
+        """transport(chat_id, text, **options) - обычно bot.send_message."""
+        self.transport = transport
+        self.limiter = limiter
+        self.private_interval = private_interval
+        self.group_interval = group_interval
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+        self.lease_seconds = lease_seconds
+        self.recovery_interval = recovery_interval
+        self.recovery_batch = recovery_batch
+        self._concurrency = asyncio.Semaphore(max_concurrency)
+        self._chat_queues: Dict[int, List[Tuple[int, int, OutboundMessage]]] = {}
+        self._ready: List[Tuple[int, int, int]] = [] # (приоритет, seq первого сообщения, chat_id) - чаты, куда можно слать
+        self._sleeping: List[Tuple[float, int]] = [] # (когда можно слать, chat_id)
+        self._scheduled: Set[int] = set() # Чаты в _ready или _sleeping
+        self._in_flight: Set[int] = set() # Чаты, сообщение в которые отправляется прямо сейчас
+        self._chat_next_at: Dict[int, float] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._send_tasks: Set[asyncio.Task] = set()
+        self._stopping = False
+        self._next_recovery_at = 0.0
+        self.sent = 0
+        self.retried = 0
+        self.rate_limited = 0
+        self.dropped = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done() and not self._stopping
+
+    @property
+    def queued(self) -> int:
+        return sum(len(q) for q in self._chat_queues.values())
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": self.queued,
+            "chats": len(self._chat_queues),
+            "in_flight": len(self._send_tasks),
+            "sent": self.sent,
+            "retried": self.retried,
+            "rate_limited": self.rate_limited,
+            "dropped": self.dropped,
+            "limiter_waiting": self.limiter.waiting,
+        }
+
+    # --- Постановка в очередь ---
+    async def enqueue_many(self, items: List[Tuple[int, str, Dict[str, Any]]], priority: int = PRIORITY_BROADCAST,
+                           persist: bool = True) -> None:
+        """items - список (chat_id, text, options). С persist=True сообщения сначала сохраняются в outbox."""
+        self.push_committed(await self.store_many(items, priority=priority, persist=persist))
+
+    async def store_many(self, items: List[Tuple[int, str, Dict[str, Any]]], priority: int = PRIORITY_BROADCAST,
+                         persist: bool = True, conn_ext: Optional[Any] = None) -> List[OutboundMessage]:
+        """
+        Сохраняет сообщения в outbox (через conn_ext - в транзакции вызывающего), но не ставит их в очередь отправки.
+        Очередь получает их только через push_committed после COMMIT: иначе отправленное сообщение удалялось бы
+        из outbox до того, как его строка видна другим соединениям, и через аренду ушло бы второй раз.
+        """
+        messages = [OutboundMessage(chat_id, text, dict(options), priority) for chat_id, text, options in items]
+        if persist and messages:
+            to_store = []
+            for message in messages:
+                try:
+                    to_store.append((message, json.dumps(message.options)))
+                except (TypeError, ValueError):
+                    pass # Клавиатуры и т.п. не сериализуются - такое сообщение живет только в памяти
+            if to_store:
+                ids = await database.insert_outbox_messages(
+                    [(m.chat_id, m.text, options_json, m.priority) for m, options_json in to_store], self.lease_seconds,
+                    conn_ext=conn_ext
+                )
+                for (message, _), outbox_id in zip(to_store, ids):
+                    message.outbox_id = outbox_id
+        return messages
+
+    def push_committed(self, messages: List[OutboundMessage]) -> None:
+        """Ставит в очередь отправки сообщения из store_many."""
+        for message in messages:
+            self._push(message)
+        self._wakeup.set()
+
+    def _push(self, message: OutboundMessage) -> None:
+        queue = self._chat_queues.setdefault(message.chat_id, [])
+        heapq.heappush(queue, (message.priority, message.seq, message))
+        if message.chat_id not in self._scheduled and message.chat_id not in self._in_flight:
+            self._schedule(message.chat_id)
+
+    def _schedule(self, chat_id: int) -> None:
+        queue = self._chat_queues.get(chat_id)
+        if not queue:
+            return
+        ready_at = self._chat_next_at.get(chat_id, 0.0)
+        if ready_at <= time.monotonic():
+            priority, seq, _ = queue[0]
+            heapq.heappush(self._ready, (priority, seq, chat_id))
+        else:
+            heapq.heappush(self._sleeping, (ready_at, chat_id))
+        self._scheduled.add(chat_id)
+
+    def _chat_interval(self, chat_id: int) -> float:
+        return self.private_interval if chat_id > 0 else self.group_interval
+
+    # --- Отправка ---
+    async def _send(self, message: OutboundMessage) -> None:
+        chat_id = message.chat_id
+        retry_in: Optional[float] = None
+        token = _sending_from_outbox.set(True)
+        try:
+            await self.transport(chat_id, message.text, **message.options)
+            self.sent += 1
+            if message.outbox_id is not None:
+                await database.delete_outbox_messages([message.outbox_id])
+        except Exception as e:
+            retry_after = getattr(e, "retry_after", None)
+            if retry_after:
+                self.rate_limited += 1
+                retry_in = float(retry_after)
+                logger.info(f"Outbox: RetryAfter {retry_in:.0f} сек для чата {chat_id}, сообщение остается в очереди.")
+            elif _is_permanent_error(e):
+                self.dropped += 1
+                logger.info(f"Outbox: Сообщение в чат {chat_id} не может быть доставлено, пропускаем: {e}")
+                if message.outbox_id is not None:
+                    await database.delete_outbox_messages([message.outbox_id])
+            else:
+                message.attempts += 1
+                if message.attempts >= self.max_attempts:
+                    self.dropped += 1
+                    logger.warning(f"Outbox: Сообщение в чат {chat_id} не отправлено за {message.attempts} попыток, пропускаем: {e}")
+                    if message.outbox_id is not None:
+                        await database.delete_outbox_messages([message.outbox_id])
+                else:
+                    self.retried += 1
+                    retry_in = self.retry_base_seconds * (2 ** (message.attempts - 1))
+                    logger.warning(f"Outbox: Ошибка отправки в чат {chat_id} (попытка {message.attempts}), повтор через {retry_in:.0f} сек: {e}")
+                    if message.outbox_id is not None:
+                        await database.record_outbox_failure(message.outbox_id, message.attempts, repr(e))
+        finally:
+            _sending_from_outbox.reset(token)
+            now = time.monotonic()
+            next_at = now + max(retry_in or 0.0, self._chat_interval(chat_id))
+            self._chat_next_at[chat_id] = max(self._chat_next_at.get(chat_id, 0.0), next_at)
+            if retry_in is not None:
+                heapq.heappush(self._chat_queues.setdefault(chat_id, []), (message.priority, message.seq, message))
+            self._in_flight.discard(chat_id)
+            if chat_id not in self._scheduled:
+                self._schedule(chat_id)
+            self._concurrency.release()
+            self._wakeup.set()
+
+    async def _recover(self) -> None:
+        rows = await database.claim_orphaned_outbox_messages(self.recovery_batch, self.lease_seconds)
+        for row in rows:
+            try:
+                options = json.loads(row['options']) if row['options'] else {}
+            except ValueError:
+                options = {}
+            self._push(OutboundMessage(row['chat_id'], row['text'], options, row['priority'], row['attempts'], row['id']))
+        if rows:
+            logger.info(f"Outbox: Подобрано {len(rows)} неотправленных сообщений из outbox.")
+        # Интервалы чатов, в которые давно не писали, больше не нужны
+        now = time.monotonic()
+        for chat_id in [c for c, t in self._chat_next_at.items() if t < now and c not in self._chat_queues and c not in self._in_flight]:
+            del self._chat_next_at[chat_id]
+
+    async def _run(self) -> None:
+        logger.info("Outbox: Диспетчер исходящих сообщений запущен.")
+        while not self._stopping or self._ready or self._sleeping:
+            now = time.monotonic()
+            if not self._stopping and now >= self._next_recovery_at:
+                self._next_recovery_at = now + self.recovery_interval
+                try:
+                    await self._recover()
+                except Exception as e:
+                    logger.error(f"Outbox: Ошибка восстановления сообщений: {e}", exc_info=True)
+            while self._sleeping and self._sleeping[0][0] <= now:
+                _, chat_id = heapq.heappop(self._sleeping)
+                self._scheduled.discard(chat_id)
+                self._schedule(chat_id)
+            if not self._ready:
+                timeout = self._sleeping[0][0] - now if self._sleeping else max(self._next_recovery_at - now, 0.1)
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=max(timeout, 0.01))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, _, chat_id = heapq.heappop(self._ready)
+            self._scheduled.discard(chat_id)
+            queue = self._chat_queues.get(chat_id)
+            if not queue:
+                self._chat_queues.pop(chat_id, None)
+                continue
+            _, _, message = heapq.heappop(queue)
+            if not queue:
+                del self._chat_queues[chat_id]
+            self._in_flight.add(chat_id)
+            try:
+                await self._concurrency.acquire()
+                try:
+                    await self.limiter.acquire(message.priority)
+                except BaseException:
+                    self._concurrency.release()
+                    raise
+            except BaseException:
+                # Остановка во время ожидания токена - сообщение возвращается в очередь, чтобы stop() его учел
+                heapq.heappush(self._chat_queues.setdefault(chat_id, []), (message.priority, message.seq, message))
+                self._in_flight.discard(chat_id)
+                raise
+            task = asyncio.create_task(self._send(message))
+            self._send_tasks.add(task)
+            task.add_done_callback(self._send_tasks.discard)
+        logger.info("Outbox: Диспетчер исходящих сообщений остановлен.")
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, drain_timeout: float = 10.0) -> None:
+        """Дает до drain_timeout секунд на отправку очереди; остаток из outbox освобождается для других процессов."""
+        self._stopping = True
+        self._wakeup.set()
+        if self._task is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(self._task), timeout=drain_timeout)
+            except asyncio.TimeoutError:
+                self._task.cancel()
+                try:
+                    await self._task
+                except (asyncio.CancelledError, Exception):
+                    pass
+            self._task = None
+        if self._send_tasks:
+            await asyncio.gather(*self._send_tasks, return_exceptions=True)
+        leftover = [m for q in self._chat_queues.values() for _, _, m in q]
+        persisted_ids = [m.outbox_id for m in leftover if m.outbox_id is not None]
+        await database.release_outbox_messages(persisted_ids)
+        if leftover:
+            logger.warning(f"Outbox: При остановке не отправлено {len(leftover)} сообщений "
+                           f"({len(persisted_ids)} сохранены в outbox, остальные потеряны).")
+        self._chat_queues.clear()
+        self._ready.clear()
+        self._sleeping.clear()
+        self._scheduled.clear()
+
+
+_dispatcher: Optional[OutboundDispatcher] = None
+
+
+def set_outbound_dispatcher(dispatcher: Optional[OutboundDispatcher]) -> None:
+    global _dispatcher
+    _dispatcher = dispatcher
+
+
+def get_outbound_dispatcher() -> Optional[OutboundDispatcher]:
+    return _dispatcher
+
+
+async def send_messages(bot: Bot, items: List[Tuple[int, str, Dict[str, Any]]],
+                        priority: int = PRIORITY_BROADCAST, persist: bool = True) -> None:
+    """Ставит пачку (chat_id, text, options) в очередь одной записью в БД; без диспетчера отправляет напрямую."""
+    dispatcher = _dispatcher
+    if dispatcher is not None and dispatcher.running:
+        await dispatcher.enqueue_many(items, priority=priority, persist=persist)
+        return
+    for chat_id, text, options in items:
+        try:
+            await bot.send_message(chat_id, text, **options)
+        except Exception as e:
+            logger.warning(f"Outbox: Не удалось отправить сообщение в чат {chat_id}: {e}")
+
+
+async def store_messages(items: List[Tuple[int, str, Dict[str, Any]]], conn_ext: Any,
+                         priority: int = PRIORITY_BROADCAST) -> List[OutboundMessage]:
+    """
+    Сохраняет пачку в outbox в транзакции conn_ext. После COMMIT результат передается в push_committed.
+    Без запущенного диспетчера бросает RuntimeError: прямая отправка не откатилась бы вместе с транзакцией.
+    """
+    dispatcher = _dispatcher
+    if dispatcher is None or not dispatcher.running:
+        raise RuntimeError("Outbox: Диспетчер не запущен, сообщения в транзакции не сохраняются.")
+    return await dispatcher.store_many(items, priority=priority, conn_ext=conn_ext)
+
+
+def push_committed(messages: List[OutboundMessage]) -> None:
+    """Запускает отправку сообщений из store_messages после COMMIT. Если диспетчер уже остановлен,
+    строки outbox после истечения аренды заберет следующий запуск."""
+    dispatcher = _dispatcher
+    if messages and dispatcher is not None and dispatcher.running:
+        dispatcher.push_committed(messages)
+
+
+async def send_message(bot: Bot, chat_id: int, text: str, priority: int = PRIORITY_BROADCAST,
+                       persist: bool = True, **options: Any) -> None:
+    """Замена bot.send_message для рассылок: ставит сообщение в очередь диспетчера, если он запущен."""
+    dispatcher = _dispatcher
+    if dispatcher is not None and dispatcher.running:
+        await dispatcher.enqueue_many([(chat_id, text, options)], priority=priority, persist=persist)
+        return
+    await bot.send_message(chat_id, text, **options)
+
+
+# --- Локальные нагрузочные проверки ---
+class FakeRetryAfter(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f"Flood control exceeded. Retry in {retry_after} seconds")
+        self.retry_after = retry_after
+
+
+class FakeBotTransport:
+    """
+    Подставляется вместо bot.send_message: имитирует задержку ответа и лимиты Telegram
+    (RetryAfter при превышении global_limit сообщений в секунду или частоты в один чат).
+    """
+
+    def __init__(self, latency: float = 0.05, global_limit: int = 30, per_chat_interval: float = 1.0):
+        self.latency = latency
+        self.global_limit = global_limit
+        self.per_chat_interval = per_chat_interval
+        self.sent: List[Tuple[float, int, str]] = []
+        self.retry_after_errors = 0
+        self._recent: Deque[float] = deque()
+        self._last_by_chat: Dict[int, float] = {}
+        self._started_at = time.monotonic()
+
+    async def __call__(self, chat_id: int, text: str, **options: Any) -> None:
+        await asyncio.sleep(self.latency)
+        now = time.monotonic()
+        while self._recent and now - self._recent[0] >= 1.0:
+            self._recent.popleft()
+        if len(self._recent) >= self.global_limit:
+            self.retry_after_errors += 1
+            raise FakeRetryAfter(1)
+        last = self._last_by_chat.get(chat_id)
+        if last is not None and now - last < self.per_chat_interval:
+            self.retry_after_errors += 1
+            raise FakeRetryAfter(self.per_chat_interval)
+        self._recent.append(now)
+        self._last_by_chat[chat_id] = now
+        self.sent.append((now, chat_id, text))
+
+    def stats(self) -> Dict[str, Any]:
+        elapsed = (self.sent[-1][0] - self._started_at) if self.sent else 0.0
+        return {
+            "sent": len(self.sent),
+            "retry_after_errors": self.retry_after_errors,
+            "elapsed_seconds": elapsed,
+            "messages_per_second": len(self.sent) / elapsed if elapsed > 0 else 0.0,
+        }
@@ -11,7 +11,7 @@ from aiogram.filters import Command, CommandObject
 from aiogram.types import Message
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from utils import get_current_price
+from utils import get_current_price, calculate_inflated_price
 import asyncpg
 from achievements_logic import check_and_grant_achievements 
 
@@ -20,8 +20,10 @@ from config import Config
 import database
 from utils import get_user_mention_html, send_telegram_log
 # !!! ИМПОРТИРУЕМ КАК СПИСОК С ДРУГИМ ИМЕНЕМ !!!
-from phone_data import PHONE_MODELS as PHONE_MODELS_LIST, PHONE_COLORS
+from phone_data import PHONE_COLORS
 from item_data import PHONE_COMPONENTS, PHONE_CASES, CORE_PHONE_COMPONENT_TYPES, MAX_PHONE_MEMORY_GB
+import catalog
+import shop_pages
 
 import logging
 
@@ -34,9 +36,6 @@ phone_router = Router()
 CONFIRMATION_TIMEOUT_SECONDS_ITEM = getattr(Config, "MARKET_PURCHASE_CONFIRMATION_TIMEOUT_SECONDS", 60) # Таймаут для предметов
 CONFIRMATION_TIMEOUT_SECONDS_PHONE = getattr(Config, "MARKET_PHONE_CONFIRMATION_TIMEOUT_SECONDS", 60) # Таймаут для подтверждения покупки/продажи телефона (и ремонта)
 
-# !!! ПРЕОБРАЗУЕМ СПИСОК ТЕЛЕФОНОВ В СЛОВАРЬ ДЛЯ БЫСТРОГО ПОИСКА ПО КЛЮЧУ !!!
-# Теперь PHONE_MODELS будет словарем: {"ключ_модели": {информация о модели}, ...}
-PHONE_MODELS = {phone_info["key"]: phone_info for phone_info in PHONE_MODELS_LIST}
 
 # =============================================================================
 REPAIRPHONE_COMMAND_ALIASES = ["repairphone", "починитьтелефон", "ремонттелефона"]
@@ -149,61 +148,32 @@ def calculate_phone_sell_price(
 # Команды для магазина
 # =============================================================================
 
-@phone_router.message(Command("phoneshop", "телефонмагазин", "купитьтелефон", ignore_case=True))
-async def cmd_phoneshop(message: Message, command: CommandObject, bot: Bot):
-    if not message.from_user:
-        return await message.reply("Не удалось определить пользователя.")
-
-    user_link = get_user_mention_html(message.from_user.id, message.from_user.full_name, message.from_user.username)
-
-    # Здесь мы все еще хотим работать с телефонами, сгруппированными по сериям,
-    # поэтому лучше использовать оригинальный список или итерироваться по значениям словаря
-    # Сгруппируем телефоны из словаря по сериям:
-    phones_by_series: Dict[str, List[Dict[str, Any]]] = {"S": [], "A": [], "Z": [], "NOTE": [], "OTHER": []}
-    # !!! ИТЕРИРУЕМ ПО ЗНАЧЕНИЯМ СЛОВАРЯ !!!
-    for phone_info in PHONE_MODELS.values():
-        series = phone_info.get("series", "Other").upper()
-        if series in phones_by_series:
-            phones_by_series[series].append(phone_info)
-        else:
-            phones_by_series["OTHER"].append(phone_info)
-
-    # Используем order, определенный выше
-    phones_by_series_global_order = ["S", "A", "Z", "NOTE", "OTHER"]
-
-    args = command.args
-    requested_series_key: Optional[str] = None
-
-    if args:
-        requested_series_key = args.strip().upper()
-        # Проверяем наличие серии в наших сгруппированных данных
-        if requested_series_key not in phones_by_series_global_order or requested_series_key not in phones_by_series:
-             await message.reply(
-                 f"{user_link}, такой серии телефонов нет или в ней пока нет товаров. Используйте S, A, Z, Note.\n"
-                 f"Пример: /phoneshop S\n"
-                 f"Или просто /phoneshop, чтобы увидеть доступные серии."
-             )
-             return
-        if not phones_by_series.get(requested_series_key): # Дополнительная проверка на пустую серию
-             await message.reply(f"{user_link}, в серии '{requested_series_key}' пока нет телефонов.")
-             return
-
-
+# Телефоны, сгруппированные по сериям магазина (группировка выполнена один раз при импорте)
+PHONESHOP_SERIES_ORDER = ["S", "A", "Z", "NOTE", "OTHER"]
+PHONESHOP_SERIES_DISPLAY_NAMES = {
+    "S": "💎 Флагманы Galaxy S", "A": "📱 Доступные Galaxy A",
+    "Z": "🧬 Гибкие Galaxy Z", "NOTE": "🖋 Производительные Galaxy Note",
+    "OTHER": "⚙️ Другие модели"
+}
+PHONESHOP_PHONES_BY_SERIES: Dict[str, List[Dict[str, Any]]] = {series: [] for series in PHONESHOP_SERIES_ORDER}
+for _series_key_catalog, _series_phones in catalog.PHONE_MODELS_BY_SERIES.items():
+    _series = (_series_key_catalog or "Other").upper()
+    PHONESHOP_PHONES_BY_SERIES[_series if _series in PHONESHOP_PHONES_BY_SERIES else "OTHER"].extend(_series_phones)
+for _series_phones in PHONESHOP_PHONES_BY_SERIES.values():
+    _series_phones.sort(key=lambda x: (x.get("release_year", 0), x.get("price", 0)))
+
+
+def _render_phoneshop_page(requested_series_key: Optional[str], inflation_multiplier: float) -> str:
+    """Страница /phoneshop (список серий или модели серии) для shop_pages."""
+    user_link = shop_pages.USER_LINK_PLACEHOLDER
     response_parts = []
 
-    series_display_name_map = {
-        "S": "💎 Флагманы Galaxy S", "A": "📱 Доступные Galaxy A",
-        "Z": "🧬 Гибкие Galaxy Z", "NOTE": "🖋 Производительные Galaxy Note",
-        "OTHER": "⚙️ Другие модели"
-    }
-
     if not requested_series_key:
         response_parts.append(f"📱 <b>Магазин Телефонов</b>\n{user_link}, выберите серию для просмотра:\n")
         available_series_display = []
-        # !!! ИТЕРИРУЕМ ПО ЗАРАНЕЕ ОПРЕДЕЛЕННОМУ ПОРЯДКУ И ПРОВЕРЯЕМ НАЛИЧИЕ В phones_by_series !!!
-        for series_key_iter in phones_by_series_global_order:
-            if phones_by_series.get(series_key_iter): # Проверяем, есть ли в этой серии телефоны
-                display_name = series_display_name_map.get(series_key_iter, f"Линейка {series_key_iter}")
+        for series_key_iter in PHONESHOP_SERIES_ORDER:
+            if PHONESHOP_PHONES_BY_SERIES.get(series_key_iter): # Проверяем, есть ли в этой серии телефоны
+                display_name = PHONESHOP_SERIES_DISPLAY_NAMES.get(series_key_iter, f"Линейка {series_key_iter}")
                 available_series_display.append(f"  {display_name}: /phoneshop {series_key_iter}")
 
         if not available_series_display:
@@ -215,77 +185,68 @@ async def cmd_phoneshop(message: Message, command: CommandObject, bot: Bot):
         response_parts.append("Пример: /buyphone galaxy_s24_128gb Черный")
 
     else:
-        series_phones_to_show = phones_by_series.get(requested_series_key, []) # Берем из сгруппированного списка
-        series_title = series_display_name_map.get(requested_series_key, f"Линейка {requested_series_key}")
+        series_phones_to_show = PHONESHOP_PHONES_BY_SERIES.get(requested_series_key, [])
+        series_title = PHONESHOP_SERIES_DISPLAY_NAMES.get(requested_series_key, f"Линейка {requested_series_key}")
         response_parts.append(f"📱 <b>{series_title}</b>\n{user_link}, вот доступные модели:\n")
 
-        if not series_phones_to_show:
-            response_parts.append(f"Телефонов серии '{requested_series_key}' пока нет в продаже (внутренняя ошибка группировки).") # Этого не должно быть после проверки выше
-        else:
-            series_phones_to_show.sort(key=lambda x: (x.get("release_year", 0), x.get("price", 0)))
-            phone_lines_for_series = []
-            for phone_info in series_phones_to_show:
-                base_price = phone_info['price']
-                    # Получаем актуальную цену с учетом инфляции
-                    # Предполагается, что get_current_price сама управляет соединением с БД,
-                    # либо вы открываете соединение в начале cmd_phoneshop и передаете conn_ext.
-                    # Для простоты, пусть get_current_price сама управляет.
-                display_price = await get_current_price(base_price)
-                    # TODO: Учесть здесь активные скидки при расчете display_price
-
-                    # Компактный вывод в одну строку: Имя (Память, Год) - Цена OC (Ключ: КЛЮЧ_ТЕЛЕФОНА)
-                phone_line = (
-                    f"• <b>{html.escape(phone_info['name'])}</b> "
-                    f"({phone_info['memory']}, {phone_info.get('release_year', 'N/A')}) "
-                    f"- {display_price} OC (<code>{phone_info['key']}</code>)"
-                )
-                phone_lines_for_series.append(phone_line)
+        phone_lines_for_series = []
+        for phone_info in series_phones_to_show:
+            display_price = calculate_inflated_price(phone_info['price'], inflation_multiplier)
+            # TODO: Учесть здесь активные скидки при расчете display_price
 
-            response_parts.append("\n".join(phone_lines_for_series)) # Объединяем строки телефонов
-            response_parts.append(f"\nДоступные цвета: {', '.join(PHONE_COLORS)}.")
-            response_parts.append("Для покупки используйте: /buyphone КЛЮЧ_ТЕЛЕФОНА Цвет")
-            response_parts.append("Пример: /buyphone galaxy_s23_ultra_256gb Белый")
+            # Компактный вывод в одну строку: Имя (Память, Год) - Цена OC (Ключ: КЛЮЧ_ТЕЛЕФОНА)
+            phone_line = (
+                f"• <b>{html.escape(phone_info['name'])}</b> "
+                f"({phone_info['memory']}, {phone_info.get('release_year', 'N/A')}) "
+                f"- {display_price} OC (<code>{phone_info['key']}</code>)"
+            )
+            phone_lines_for_series.append(phone_line)
 
+        response_parts.append("\n".join(phone_lines_for_series)) # Объединяем строки телефонов
+        response_parts.append(f"\nДоступные цвета: {', '.join(PHONE_COLORS)}.")
+        response_parts.append("Для покупки используйте: /buyphone КЛЮЧ_ТЕЛЕФОНА Цвет")
+        response_parts.append("Пример: /buyphone galaxy_s23_ultra_256gb Белый")
 
-    full_response = "\n".join(response_parts)
+    return "\n".join(response_parts)
 
-    MAX_MESSAGE_LENGTH = 4096
-    if len(full_response) > MAX_MESSAGE_LENGTH:
-        temp_parts = []
-        current_part = ""
-        for line in full_response.split('\n'):
-            if len(current_part) + len(line) + 1 > MAX_MESSAGE_LENGTH:
-                temp_parts.append(current_part)
-                current_part = line
-            else:
-                if current_part:
-                    current_part += "\n" + line
-                else:
-                    current_part = line
-        if current_part:
-            temp_parts.append(current_part)
 
-        for part_msg in temp_parts:
-            await message.answer(part_msg, parse_mode="HTML", disable_web_page_preview=True)
-            await asyncio.sleep(0.2)
-    else:
-        await message.answer(full_response, parse_mode="HTML", disable_web_page_preview=True)
+shop_pages.register(
+    "phoneshop", _render_phoneshop_page,
+    [None] + [series for series in PHONESHOP_SERIES_ORDER if PHONESHOP_PHONES_BY_SERIES[series]],
+)
 
-@phone_router.message(Command("itemshop", "магазинпредметов", "предметы", "детали", "чехлы", ignore_case=True))
-async def cmd_itemshop(message: Message, command: CommandObject, bot: Bot):
+
+@phone_router.message(Command("phoneshop", "телефонмагазин", "купитьтелефон", ignore_case=True))
+async def cmd_phoneshop(message: Message, command: CommandObject, bot: Bot):
     if not message.from_user:
         return await message.reply("Не удалось определить пользователя.")
 
     user_link = get_user_mention_html(message.from_user.id, message.from_user.full_name, message.from_user.username)
 
-    args = command.args.split() if command.args else []
-    category: Optional[str] = None
-    sub_category: Optional[str] = None
+    args = command.args
+    requested_series_key: Optional[str] = None
 
-    if len(args) > 0:
-        category = args[0].lower()
-    if len(args) > 1:
-        sub_category = args[1].upper()
+    if args:
+        requested_series_key = args.strip().upper()
+        if requested_series_key not in PHONESHOP_SERIES_ORDER:
+             await message.reply(
+                 f"{user_link}, такой серии телефонов нет или в ней пока нет товаров. Используйте S, A, Z, Note.\n"
+                 f"Пример: /phoneshop S\n"
+                 f"Или просто /phoneshop, чтобы увидеть доступные серии."
+             )
+             return
+        if not PHONESHOP_PHONES_BY_SERIES.get(requested_series_key): # Дополнительная проверка на пустую серию
+             await message.reply(f"{user_link}, в серии '{requested_series_key}' пока нет телефонов.")
+             return
+
+    # Готовая страница из кэша (пересобирается только при изменении множителя инфляции)
+    await shop_pages.answer_page(message, "phoneshop", requested_series_key, user_link)
+
+
+def _render_itemshop_page(variant: Tuple[Optional[str], Optional[str]], inflation_multiplier: float) -> str:
+    """Страница /itemshop для варианта (категория, серия) для shop_pages."""
+    user_link = shop_pages.USER_LINK_PLACEHOLDER
+    category, sub_category = variant
 
     response_parts = [f"🛠️ <b>Магазин Предметов и Аксессуаров</b>\n{user_link}\n"]
 
@@ -309,7 +270,7 @@ async def cmd_itemshop(message: Message, command: CommandObject, bot: Bot):
             component_lines = []
             # Итерируем по компонентам и фильтруем по серии
             sorted_components = sorted(
-                [(key, info) for key, info in PHONE_COMPONENTS.items() if info.get("series") == sub_category and info.get("component_type") != "memory_module"], # Исключаем модули памяти
+                [(key, PHONE_COMPONENTS[key]) for key in catalog.COMPONENT_KEYS_BY_SERIES.get(sub_category, ())], # Модули памяти в каталоге не относятся к сериям
                 key=lambda x: x[1]["name"]
             )
             if not sorted_components:
@@ -319,7 +280,7 @@ async def cmd_itemshop(message: Message, command: CommandObject, bot: Bot):
                     name = html.escape(comp_info.get("name", key))
                     #price = comp_info.get("price", "N/A")
                     base_price = comp_info.get("price", 0) # Получаем базовую цену как число
-                    actual_price = await get_current_price(base_price) # Вызываем нашу новую функцию
+                    actual_price = calculate_inflated_price(base_price, inflation_multiplier) # Вызываем нашу новую функцию
                     component_lines.append(f"  • {name} - {actual_price} OC (Ключ: <code>{key}</code>)")
                 response_parts.extend(component_lines)
             response_parts.append("\n  Для покупки: /buyitem КЛЮЧ_КОМПОНЕНТА [количество]")
@@ -332,7 +293,7 @@ async def cmd_itemshop(message: Message, command: CommandObject, bot: Bot):
         memory_lines = []
         # Итерируем по компонентам и ищем модули памяти
         sorted_memory_modules = sorted(
-             [(key, info) for key, info in PHONE_COMPONENTS.items() if info.get("component_type") == "memory_module"],
+             [(key, PHONE_COMPONENTS[key]) for key in catalog.MEMORY_MODULE_KEYS],
              key=lambda x: x[1].get("capacity_gb", 0) # Сортируем по объему памяти
         )
 
@@ -342,7 +303,7 @@ async def cmd_itemshop(message: Message, command: CommandObject, bot: Bot):
             for key, comp_info in sorted_memory_modules:
                 name = html.escape(comp_info.get("name", key))
                 base_price = comp_info.get("price", 0) # Базовая цена
-                actual_price = await get_current_price(base_price) # <--- ИЗМЕН
+                actual_price = calculate_inflated_price(base_price, inflation_multiplier) # <--- ИЗМЕН
                 capacity_gb = comp_info.get("memory_gb") # Исправлено: memory_gb
                 capacity_display = f" ({capacity_gb}GB)" if capacity_gb else ""
                 memory_lines.append(f"  • {name}{capacity_display} - {actual_price} OC (Ключ: <code>{key}</code>)") # <--- ИЗМЕНЕНИ
@@ -363,9 +324,8 @@ async def cmd_itemshop(message: Message, command: CommandObject, bot: Bot):
             # Собираем и сортируем чехлы для текущей серии по цене
             temp_case_list_for_sorting = []
             # Итерируем по чехлам и фильтруем по серии
-            for key, case_info in PHONE_CASES.items():
-                if case_info.get("series") == sub_category:
-                    temp_case_list_for_sorting.append((key, case_info))
+            for key in catalog.CASE_KEYS_BY_SERIES.get(sub_category, ()):
+                temp_case_list_for_sorting.append((key, PHONE_CASES[key]))
 
             temp_case_list_for_sorting.sort(key=lambda x: x[1].get("price", 0))
 
@@ -375,7 +335,7 @@ async def cmd_itemshop(message: Message, command: CommandObject, bot: Bot):
                 for key, case_info in temp_case_list_for_sorting:
                     name = html.escape(case_info.get("name", key))
                     base_price = case_info.get("price", 0)
-                    actual_price = await get_current_price(base_price) # Рассчитываем актуальную цену с учетом инфляции
+                    actual_price = calculate_inflated_price(base_price, inflation_multiplier) # Рассчитываем актуальную цену с учетом инфляции
                     protection = case_info.get("break_chance_reduction_percent", 0)
 
                     # Начинаем формировать строки для текущего чехла
@@ -420,28 +380,39 @@ async def cmd_itemshop(message: Message, command: CommandObject, bot: Bot):
         response_parts.append("  💾 Модули памяти: /itemshop memory")
         response_parts.append("  🛡️ Чехлы: /itemshop cases")
 
-    # Отправка сообщения (с разбивкой, если длинное)
-    full_response = "\n".join(response_parts)
+    return "\n".join(response_parts)
 
-    MAX_MESSAGE_LENGTH = 4096
-    if len(full_response) > MAX_MESSAGE_LENGTH:
-        # ... (логика разбивки сообщения, как в cmd_phoneshop) ...
-        temp_parts = []
-        current_part = ""
-        for line in full_response.split('\n'):
-            if len(current_part) + len(line) + 1 > MAX_MESSAGE_LENGTH:
-                temp_parts.append(current_part)
-                current_part = line
-            else:
-                if current_part: current_part += "\n" + line
-                else: current_part = line
-        if current_part: temp_parts.append(current_part)
 
-        for part_msg in temp_parts:
-            await message.answer(part_msg, parse_mode="HTML", disable_web_page_preview=True)
-            await asyncio.sleep(0.2)
-    else:
-        await message.answer(full_response, parse_mode="HTML", disable_web_page_preview=True)
+# Варианты страниц /itemshop, которые строятся заранее; остальные аргументы отрисовываются на каждый вызов
+ITEMSHOP_PAGE_VARIANTS: List[Tuple[Optional[str], Optional[str]]] = (
+    [(None, None), ("components", None), ("memory", None), ("cases", None)]
+    + [("components", series) for series in ("A", "S", "Z")]
+    + [("cases", series) for series in ("A", "S", "Z")]
+)
+shop_pages.register("itemshop", _render_itemshop_page, ITEMSHOP_PAGE_VARIANTS)
+
+
+@phone_router.message(Command("itemshop", "магазинпредметов", "предметы", "детали", "чехлы", ignore_case=True))
+async def cmd_itemshop(message: Message, command: CommandObject, bot: Bot):
+    if not message.from_user:
+        return await message.reply("Не удалось определить пользователя.")
+
+    user_link = get_user_mention_html(message.from_user.id, message.from_user.full_name, message.from_user.username)
+
+    args = command.args.split() if command.args else []
+    category: Optional[str] = None
+    sub_category: Optional[str] = None
+
+    if len(args) > 0:
+        category = args[0].lower()
+    if len(args) > 1:
+        sub_category = args[1].upper()
+
+    if category in (None, "memory"):
+        sub_category = None # Для главного меню и модулей памяти серия не используется
+
+    # Готовая страница из кэша (пересобирается только при изменении множителя инфляции)
+    await shop_pages.answer_page(message, "itemshop", (category, sub_category), user_link)
 
 
         
@@ -487,7 +458,7 @@ async def cmd_buyphone_start(message: Message, command: CommandObject, state: FS
     chosen_color_canonical = PHONE_COLORS[valid_colors_lower.index(chosen_color_arg.lower())]
 
     # !!! ИСПОЛЬЗУЕМ СЛОВАРЬ ДЛЯ ПОИСКА !!!
-    phone_to_buy_info: Optional[Dict[str, Any]] = PHONE_MODELS.get(phone_model_key_arg)
+    phone_to_buy_info: Optional[Dict[str, Any]] = catalog.PHONE_MODELS_BY_KEY.get(phone_model_key_arg)
 
     if not phone_to_buy_info:
         await message.reply(f"{user_link}, телефон с ключом '<code>{html.escape(phone_model_key_arg)}</code>' не найден в магазине.")
@@ -522,15 +493,7 @@ async def cmd_buyphone_start(message: Message, command: CommandObject, state: FS
             if conn_buy_phone and not conn_buy_phone.is_closed(): await conn_buy_phone.close()
             return
 
-        memory_str = phone_to_buy_info.get('memory', '0').upper()
-        initial_memory_val = 0
-        if 'TB' in memory_str:
-            try: initial_memory_val = int(float(memory_str.replace('TB', '').strip()) * 1024)
-            except ValueError: initial_memory_val = 1024
-        elif 'GB' in memory_str:
-            try: initial_memory_val = int(float(memory_str.replace('GB', '').strip()))
-            except ValueError: initial_memory_val = 0
-        else: initial_memory_val = 0
+        initial_memory_val = catalog.get_phone_memory_gb(phone_to_buy_info.get('key'))
 
         await state.set_state(PurchaseStates.awaiting_confirmation)
         await state.update_data(
@@ -598,7 +561,7 @@ async def cmd_sellphone_start(message: Message, command: CommandObject, state: F
         return
 
     phone_model_key = phone_db_data['phone_model_key']
-    phone_static_data = PHONE_MODELS.get(phone_model_key) # Используем словарь
+    phone_static_data = catalog.PHONE_MODELS_BY_KEY.get(phone_model_key) # Используем словарь
     if not phone_static_data:
         await message.reply(f"Ошибка: не найдены данные для модели телефона ID <code>{phone_inventory_id_arg}</code>.")
         return
@@ -1402,11 +1365,8 @@ async def cmd_purchase_confirm_yes(message: Message, state: FSMContext, bot: Bot
                     return
 
                 # Логика выбора модели телефона для крафта
-                # Фильтруем PHONE_MODELS (словарь) по серии
-                craftable_phones_in_series = [
-                    model_info for model_key, model_info in PHONE_MODELS.items()
-                    if model_info.get("series") == phone_series_to_craft
-                ]
+                # Модели серии из catalog.PHONE_MODELS_BY_SERIES
+                craftable_phones_in_series = list(catalog.PHONE_MODELS_BY_SERIES.get(phone_series_to_craft, ()))
 
                 if not craftable_phones_in_series:
                     await message.reply(f"К сожалению, в данный момент нет доступных для сборки моделей {phone_series_to_craft}-серии (внутренняя ошибка). Попробуйте позже.")
@@ -1440,14 +1400,7 @@ async def cmd_purchase_confirm_yes(message: Message, state: FSMContext, bot: Bot
                 # Выбор цвета и определение начальной памяти
                 crafted_phone_color = random.choice(PHONE_COLORS)
                 
-                memory_str_crafted = crafted_phone_model_static.get('memory', '0').upper()
-                initial_memory_crafted_gb = 0
-                if 'TB' in memory_str_crafted:
-                    try: initial_memory_crafted_gb = int(float(memory_str_crafted.replace('TB', '').strip()) * 1024)
-                    except ValueError: initial_memory_crafted_gb = 1024 # Default for TB if parse fails
-                elif 'GB' in memory_str_crafted:
-                    try: initial_memory_crafted_gb = int(float(memory_str_crafted.replace('GB', '').strip()))
-                    except ValueError: initial_memory_crafted_gb = 0 # Default for GB if parse fails
+                initial_memory_crafted_gb = catalog.get_phone_memory_gb(crafted_phone_model_static.get('key'))
                 
                 # Добавляем новый телефон в инвентарь
                 purchase_time_craft = datetime.now(dt_timezone.utc)
@@ -1584,7 +1537,7 @@ async def cmd_insurephone_start(message: Message, command: CommandObject, state:
 
 
         phone_model_key = phone_db_data['phone_model_key']
-        phone_static_data = PHONE_MODELS.get(phone_model_key)
+        phone_static_data = catalog.PHONE_MODELS_BY_KEY.get(phone_model_key)
         if not phone_static_data:
             await message.reply(f"Ошибка: не найдены данные для модели телефона ID <code>{phone_inventory_id_arg}</code>.", parse_mode="HTML")
             if conn and not conn.is_closed(): await conn.close()
@@ -1934,21 +1887,9 @@ async def cmd_myphones(message: Message, bot: Bot): # bot остается, ес
             phone_model_key = phone_db_info.get('phone_model_key')
             
             # --- Получаем статические данные (учитывая стандартные и эксклюзивные) ---
-            phone_info_static = PHONE_MODELS.get(phone_model_key) # PHONE_MODELS это PHONE_MODELS_STD_DICT из phone_logic
-            # Нужно импортировать EXCLUSIVE_PHONE_MODELS_DICT из black_market_logic или определить его здесь
-            # Предположим, что EXCLUSIVE_PHONE_MODELS_DICT доступен (например, импортирован в начале phone_logic.py)
-            # from black_market_logic import EXCLUSIVE_PHONE_MODELS_DICT # <--- Потенциальный импорт, если он нужен здесь
-            # Или лучше передавать его, или реимпортировать из exclusive_phone_data.py
-            # Для простоты, предположим, что если не нашли в PHONE_MODELS, то это может быть эксклюзив,
-            # и его имя будет просто phone_model_key если EXCLUSIVE_PHONE_MODELS_DICT недоступен здесь напрямую.
-            # Но лучше иметь доступ к EXCLUSIVE_PHONE_MODELS_DICT для отображения display_name.
-            # Допустим, он импортирован как в black_market_logic.py:
-            # from exclusive_phone_data import EXCLUSIVE_PHONE_MODELS
-            # EXCLUSIVE_PHONE_MODELS_DICT_MYPHONES = {ex_phone["key"]: ex_phone for ex_phone in EXCLUSIVE_PHONE_MODELS}
-            # phone_info_exclusive = EXCLUSIVE_PHONE_MODELS_DICT_MYPHONES.get(phone_model_key)
-            # phone_info_to_use = phone_info_exclusive or phone_info_static
+            phone_info_static = catalog.PHONE_MODELS_BY_KEY.get(phone_model_key) # Стандартные модели; эксклюзивы - в catalog.EXCLUSIVE_PHONE_MODELS_BY_KEY
             
-            # Упрощенный вариант: если это эксклюзив, его имя может быть в phone_db_info['data']
+            # Если это эксклюзив, его имя может быть в phone_db_info['data']
             phone_custom_data_for_name = phone_db_info.get('data', {}) or {}
             
             if phone_info_static: # Обычный телефон Samsung
@@ -1957,16 +1898,9 @@ async def cmd_myphones(message: Message, bot: Bot): # bot остается, ес
                  phone_name_display = html.escape(phone_custom_data_for_name.get('display_name_override'))
             elif phone_custom_data_for_name.get('name'): # Если вдруг в data есть 'name' от эксклюзива
                  phone_name_display = html.escape(phone_custom_data_for_name.get('name'))
-            else: # Если это эксклюзив без display_name_override в data, ищем в EXCLUSIVE_PHONE_MODELS_DICT
-                 # Предполагаем, что EXCLUSIVE_PHONE_MODELS_DICT импортирован в phone_logic.py
-                 # from exclusive_phone_data import EXCLUSIVE_PHONE_MODELS
-                 # TEMP_EXCLUSIVE_DICT = {p["key"]: p for p in EXCLUSIVE_PHONE_MODELS} # Определить в начале файла
-                 # phone_info_excl_temp = TEMP_EXCLUSIVE_DICT.get(phone_model_key)
-                 # if phone_info_excl_temp:
-                 #     phone_name_display = html.escape(phone_info_excl_temp.get('name', phone_model_key))
-                 # else:
-                 #     phone_name_display = f"Особый телефон (<code>{html.escape(str(phone_model_key))}</code>)"
-                 # Пока упростим:
+            elif phone_model_key in catalog.EXCLUSIVE_PHONE_MODELS_BY_KEY: # Эксклюзив без display_name_override в data
+                 phone_name_display = html.escape(catalog.EXCLUSIVE_PHONE_MODELS_BY_KEY[phone_model_key].get('name', phone_model_key))
+            else:
                  phone_name_display = f"Особый телефон (<code>{html.escape(str(phone_model_key))}</code>)"
 
 
@@ -1983,14 +1917,8 @@ async def cmd_myphones(message: Message, bot: Bot): # bot остается, ес
             current_memory_gb = phone_db_info.get('current_memory_gb')
             # ... (твоя логика определения current_memory_gb и current_memory_display - ОСТАВЛЯЕМ ЕЕ) ...
             if current_memory_gb is None:
-                memory_str_static = (phone_info_static or {}).get('memory', '0').upper()
-                if 'TB' in memory_str_static:
-                    try: current_memory_gb = int(float(memory_str_static.replace('TB', '').strip()) * 1024)
-                    except ValueError: current_memory_gb = 1024
-                elif 'GB' in memory_str_static:
-                    try: current_memory_gb = int(float(memory_str_static.replace('GB', '').strip()))
-                    except ValueError: current_memory_gb = 0
-                else: current_memory_gb = 0 # Если формат памяти неизвестен
+                # Память из каталога есть и у эксклюзивов (раньше они показывались как 0GB); 0, если модель неизвестна
+                current_memory_gb = catalog.get_phone_memory_gb(phone_model_key)
             
             current_memory_display = f"{current_memory_gb}GB" if isinstance(current_memory_gb, int) else html.escape(str(current_memory_gb))
             if isinstance(current_memory_gb, int) and current_memory_gb >= 1024 and current_memory_gb % 1024 == 0:
@@ -2037,7 +1965,7 @@ async def cmd_myphones(message: Message, bot: Bot): # bot остается, ес
             # battery_break_after_utc нам здесь не так важен для отображения заряда, но нужен для is_broken
             is_broken_db = phone_db_info.get('is_broken', False)
             broken_component_key_db = phone_db_info.get('broken_component_key')
-            broken_battery_component_keys = [k for k, v in PHONE_COMPONENTS.items() if v.get("component_type") == "battery"]
+            broken_battery_component_keys = catalog.BATTERY_COMPONENT_KEYS
 
             if is_broken_db and broken_component_key_db in broken_battery_component_keys:
                 broken_comp_name = PHONE_COMPONENTS.get(broken_component_key_db, {}).get('name', 'Аккумулятор')
@@ -2308,7 +2236,7 @@ async def cmd_equip_case(message: Message, command: CommandObject, bot: Bot):
 
             phone_model_key = phone_db_data['phone_model_key']
             # !!! ИСПОЛЬЗУЕМ СЛОВАРЬ ДЛЯ ПОИСКА !!!
-            phone_static_info = PHONE_MODELS.get(phone_model_key)
+            phone_static_info = catalog.PHONE_MODELS_BY_KEY.get(phone_model_key)
             if not phone_static_info:
                 await message.reply(f"Ошибка: не найдены данные для модели телефона ID <code>{phone_inventory_id_arg}</code>.", parse_mode="HTML")
                 return
@@ -2551,7 +2479,7 @@ async def cmd_remove_case(message: Message, command: CommandObject, bot: Bot):
 
             # !!! ИСПОЛЬЗУЕМ СЛОВАРЬ PHONE_MODELS ДЛЯ ПОИСКА ИМЕНИ ТЕЛЕФОНА !!!
             phone_model_key_on_phone = phone_db_data['phone_model_key']
-            phone_static_info_model = PHONE_MODELS.get(phone_model_key_on_phone)
+            phone_static_info_model = catalog.PHONE_MODELS_BY_KEY.get(phone_model_key_on_phone)
             phone_name_static = phone_static_info_model.get('name', phone_model_key_on_phone) if phone_static_info_model else phone_model_key_on_phone
 
 
@@ -2672,21 +2600,12 @@ async def cmd_charge_phone(message: Message, command: CommandObject, bot: Bot):
                 if not is_explicitly_broken_battery: # Только если он еще не помечен как "батарея сломана"
                     determined_battery_key_to_set = None
                     phone_model_key = phone_db_data.get('phone_model_key')
-                    phone_static_data = PHONE_MODELS.get(phone_model_key)
+                    phone_static_data = catalog.PHONE_MODELS_BY_KEY.get(phone_model_key)
 
                     if phone_static_data:
                         phone_series = phone_static_data.get('series')
                         if phone_series:
-                            potential_battery_key = f"BATTERY_{phone_series.upper()}"
-                            if potential_battery_key in PHONE_COMPONENTS and \
-                               PHONE_COMPONENTS[potential_battery_key].get('component_type') == 'battery':
-                                determined_battery_key_to_set = potential_battery_key
-                            else:
-                                for comp_key_iter, comp_info_iter in PHONE_COMPONENTS.items():
-                                    if comp_info_iter.get("component_type") == "battery" and \
-                                       comp_info_iter.get("series") == phone_series:
-                                        determined_battery_key_to_set = comp_key_iter
-                                        break
+                            determined_battery_key_to_set = catalog.BATTERY_KEY_BY_SERIES.get(phone_series.upper())
                             
                             if determined_battery_key_to_set:
                                 try:
@@ -2804,7 +2723,7 @@ async def cmd_charge_phone(message: Message, command: CommandObject, bot: Bot):
                 raise Exception(f"Не удалось обновить статус зарядки для телефона ID {phone_inventory_id_arg} (update_phone_status_fields вернул False/None).")
 
 
-            phone_name_static = PHONE_MODELS.get(phone_db_data.get('phone_model_key'), {}).get('name', phone_db_data.get('phone_model_key', 'N/A'))
+            phone_name_static = catalog.PHONE_MODELS_BY_KEY.get(phone_db_data.get('phone_model_key'), {}).get('name', phone_db_data.get('phone_model_key', 'N/A'))
             new_balance = current_balance - charge_cost
 
             time_left_dead = fields_to_update['battery_dead_after_utc'] - now_utc
@@ -2901,16 +2820,9 @@ async def cmd_upgrade_memory(message: Message, command: CommandObject, bot: Bot)
             if current_memory is None:
                 phone_model_key_local = phone_db_data.get('phone_model_key') # Используем локальную переменную и .get
                 if phone_model_key_local:
-                    phone_static_data = PHONE_MODELS.get(phone_model_key_local) # Используем словарь
+                    phone_static_data = catalog.PHONE_MODELS_BY_KEY.get(phone_model_key_local) # Используем словарь
                     if phone_static_data:
-                        memory_str = phone_static_data.get('memory', '0').upper() # Используем .get
-                        if 'TB' in memory_str:
-                           try: current_memory = int(float(memory_str.replace('TB','').strip())*1024)
-                           except ValueError: current_memory = 1024
-                        elif 'GB' in memory_str:
-                           try: current_memory = int(float(memory_str.replace('GB','').strip()))
-                           except ValueError: current_memory = 0
-                        else: current_memory = 0
+                        current_memory = catalog.get_phone_memory_gb(phone_model_key_local)
                         # Сохраняем начальную память в БД, если она была None
                         await database.update_phone_status_fields(phone_inventory_id_arg, {'current_memory_gb': current_memory}, conn_ext=conn)
                         phone_db_data['current_memory_gb'] = current_memory # Обновляем данные в словаре, чтобы использовать их ниже
@@ -2965,7 +2877,7 @@ async def cmd_upgrade_memory(message: Message, command: CommandObject, bot: Bot)
             if not update_phone_success:
                 raise Exception(f"Не удалось обновить память телефона ID {phone_inventory_id_arg}")
 
-            phone_name_static = PHONE_MODELS.get(phone_db_data.get('phone_model_key'), {}).get('name', phone_db_data.get('phone_model_key', 'N/A')) # Используем .get
+            phone_name_static = catalog.PHONE_MODELS_BY_KEY.get(phone_db_data.get('phone_model_key'), {}).get('name', phone_db_data.get('phone_model_key', 'N/A')) # Используем .get
             new_balance = current_balance - upgrade_work_cost
 
             new_memory_display = f"{new_memory_total}GB"
@@ -3226,7 +3138,7 @@ async def cmd_repairphone_start(message: Message, command: CommandObject, state:
         return
 
     # !!! ИСПОЛЬЗУЕМ СЛОВАРЬ ДЛЯ ПОИСКА !!!
-    phone_static_data = PHONE_MODELS.get(phone_db_data.get('phone_model_key')) # Использование словаря, .get
+    phone_static_data = catalog.PHONE_MODELS_BY_KEY.get(phone_db_data.get('phone_model_key')) # Использование словаря, .get
     if not phone_static_data:
         await message.reply("Ошибка данных модели телефона. Обратитесь к администратору.")
         return
@@ -3441,7 +3353,7 @@ async def cmd_keep_won_phone(message: Message, command: CommandObject, bot: Bot)
 
 
             old_phone_model_key = old_phone_db_data['phone_model_key']
-            old_phone_static_data = PHONE_MODELS.get(old_phone_model_key)
+            old_phone_static_data = catalog.PHONE_MODELS_BY_KEY.get(old_phone_model_key)
             if not old_phone_static_data:
                  await message.reply(f"Ошибка: не найдены данные для модели старого телефона ID <code>{old_phone_inventory_id_to_sell}</code>.", parse_mode="HTML")
                  return
@@ -3512,7 +3424,7 @@ async def cmd_keep_won_phone(message: Message, command: CommandObject, bot: Bot)
                  # Не прерываем транзакцию, это не критично, но нужно залогировать.
 
             # 6. Уведомление пользователя и лог
-            won_phone_static_data = PHONE_MODELS.get(won_phone_model_key)
+            won_phone_static_data = catalog.PHONE_MODELS_BY_KEY.get(won_phone_model_key)
             won_phone_name_display = html.escape(won_phone_static_data.get('name', won_phone_model_key)) if won_phone_static_data else won_phone_model_key
 
             old_phone_name_display = html.escape(old_phone_static_data.get('name', old_phone_model_key))
@@ -3582,7 +3494,7 @@ async def cmd_sell_won_phone(message: Message, bot: Bot):
             won_phone_color = pending_prize_data['color'] # Цвет нужен для отображения, но не для цены
             won_phone_initial_memory_gb = pending_prize_data['initial_memory_gb'] # Память тоже для отображения
 
-            won_phone_static_data = PHONE_MODELS.get(won_phone_model_key)
+            won_phone_static_data = catalog.PHONE_MODELS_BY_KEY.get(won_phone_model_key)
             if not won_phone_static_data:
                 # Если статические данные не найдены, рассчитываем компенсацию от какой-то базовой цены или выдаем фикс. сумму
                 logger.error(f"SellWonPhone: Не найдены статические данные для выигранного телефона {won_phone_model_key} user {user_id}. Расчет цены продажи затруднен.")
@@ -3662,7 +3574,7 @@ async def _auto_sell_expired_prize(user_id: int, bot_instance: Bot, conn_ext: Op
     won_phone_initial_memory_gb = pending_prize_data['initial_memory_gb']
     original_roulette_chat_id = pending_prize_data['original_roulette_chat_id']
 
-    won_phone_static_data = PHONE_MODELS.get(won_phone_model_key)
+    won_phone_static_data = catalog.PHONE_MODELS_BY_KEY.get(won_phone_model_key)
     if not won_phone_static_data:
          logger.error(f"_auto_sell_expired_prize: Не найдены стат.данные для телефона {won_phone_model_key} user {user_id}. Выдаем фикс. комп.")
          sell_value = random.randint(50, 150)
@@ -3703,12 +3615,11 @@ async def _auto_sell_expired_prize(user_id: int, bot_instance: Bot, conn_ext: Op
                  # В этом случае начисление может не сработать. Продолжаем, но с пониманием риска.
 
 
-    await database.update_user_onecoins(
+    new_balance = await database.update_user_onecoins(
         user_id, chat_id_to_credit, sell_value,
         username=user_db_data_for_log.get('username'), full_name=user_db_data_for_log.get('full_name'),
         chat_title=user_db_data_for_log.get('chat_title'), conn_ext=conn_to_use
     )
-    new_balance = await database.get_user_onecoins(user_id, chat_id_to_credit, conn_ext=conn_to_use)
 
     # Удаляем запись о pending призе
     remove_pending_success = await database.remove_pending_phone_prize(user_id, conn_ext=conn_to_use)
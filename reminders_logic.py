@@ -13,16 +13,13 @@ from pytz import timezone as pytz_timezone
 
 from config import Config #
 import database
-from utils import get_user_mention_html
+from utils import get_user_mention_html, fetch_chat_display_names
 from business_data import BANK_DATA
 from phrases import ONEUI_BLOCKED_PHRASES #
 
-from phone_data import PHONE_MODELS as PHONE_MODELS_STANDARD_LIST_REM
-from exclusive_phone_data import EXCLUSIVE_PHONE_MODELS as EXCLUSIVE_PHONE_MODELS_LIST_REM
 from item_data import PHONE_COMPONENTS as PHONE_COMPONENTS_REM
+import catalog
 
-PHONE_MODELS_REM = {phone_info["key"]: phone_info for phone_info in PHONE_MODELS_STANDARD_LIST_REM}
-EXCLUSIVE_PHONE_MODELS_DICT_REM = {phone_info["key"]: phone_info for phone_info in EXCLUSIVE_PHONE_MODELS_LIST_REM}
 
 logger = logging.getLogger(__name__)
 reminders_router = Router()
@@ -300,11 +297,11 @@ async def get_global_phone_reminders_for_user(user_id: int, bot: Bot) -> List[st
             phone_model_key_rem = phone.get('phone_model_key')
 
             if phone_model_key_rem:
-                phone_static_info_rem = PHONE_MODELS_REM.get(phone_model_key_rem)
+                phone_static_info_rem = catalog.PHONE_MODELS_BY_KEY.get(phone_model_key_rem)
                 if phone_static_info_rem:
                     phone_name_rem = phone_static_info_rem.get('name', phone_model_key_rem)
                 else:
-                    phone_exclusive_info_rem = EXCLUSIVE_PHONE_MODELS_DICT_REM.get(phone_model_key_rem)
+                    phone_exclusive_info_rem = catalog.EXCLUSIVE_PHONE_MODELS_BY_KEY.get(phone_model_key_rem)
                     if phone_exclusive_info_rem:
                         phone_name_rem = phone_exclusive_info_rem.get('name', phone_model_key_rem)
                     else:
@@ -379,35 +376,35 @@ async def cmd_show_reminders(message: Message, bot: Bot):
 
     try:
         if message.chat.type == "private":
-            active_chat_ids_for_dm = await database.get_all_user_activity_chats(user_id)
+            chat_titles_for_dm = await database.get_user_activity_chat_titles(user_id)
+            active_chat_ids_for_dm = list(chat_titles_for_dm)
 
             if not active_chat_ids_for_dm:
                 all_reminders_text_parts.append(f"📌 {user_link}, у тебя пока нет активностей ни в одном из отслеживаемых чатов.")
             else:
                 all_reminders_text_parts.append(f"📌 {user_link}, вот твои напоминания:")
 
-                chat_infos = {}
-                for chat_id_db_loop in active_chat_ids_for_dm:
-                    try:
-                        chat_obj = await bot.get_chat(chat_id_db_loop)
-                        chat_infos[chat_id_db_loop] = chat_obj
-                    except Exception:
-                        chat_infos[chat_id_db_loop] = None
-
-                for chat_id_from_db in active_chat_ids_for_dm:
-                    chat_display_name = f"Чат ID: {chat_id_from_db}"
-                    chat_info = chat_infos.get(chat_id_from_db)
-
-                    if chat_info:
-                        if chat_info.title:
-                            chat_display_name = html.escape(chat_info.title)
-                        elif chat_info.username:
-                            chat_display_name = f"@{chat_info.username}"
-                        elif chat_info.type == "private" and chat_id_from_db == user_id:
-                             chat_display_name = "Личные сообщения (с этим ботом)"
-
-                    reminders_for_chat = await get_chat_specific_reminders_for_user(user_id, chat_id_from_db, bot)
+                # Названия чатов и напоминания по чатам собираются параллельно (не больше
+                # REMINDERS_CHAT_CONCURRENCY чатов одновременно - каждый берет соединение из пула)
+                chat_semaphore = asyncio.Semaphore(max(1, Config.REMINDERS_CHAT_CONCURRENCY))
+
+                async def _chat_reminders(chat_id_for_task: int) -> List[str]:
+                    async with chat_semaphore:
+                        try:
+                            return await get_chat_specific_reminders_for_user(user_id, chat_id_for_task, bot)
+                        except Exception as e_chat:
+                            logger.error(f"Reminders: Ошибка сбора напоминаний для user {user_id} в чате {chat_id_for_task}: {e_chat}", exc_info=True)
+                            return []
+
+                chat_display_names, reminders_by_chat = await asyncio.gather(
+                    fetch_chat_display_names(bot, chat_titles_for_dm, owner_user_id=user_id,
+                                             concurrency=Config.REMINDERS_CHAT_CONCURRENCY),
+                    asyncio.gather(*(_chat_reminders(chat_id_db_loop) for chat_id_db_loop in active_chat_ids_for_dm)),
+                )
+
+                for chat_id_from_db, reminders_for_chat in zip(active_chat_ids_for_dm, reminders_by_chat):
                     if reminders_for_chat:
+                        chat_display_name = chat_display_names.get(chat_id_from_db, f"Чат ID: {chat_id_from_db}")
                         any_reminders_found_globally_or_in_chat = True
                         all_reminders_text_parts.append(f"\n\n🔔<b>В чате {chat_display_name}:</b>")
                         all_reminders_text_parts.extend([f"  • {reminder}" for reminder in reminders_for_chat])
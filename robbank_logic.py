@@ -1,5 +1,4 @@
 # robbank_logic.py
-import asyncio
 import random
 import html
 from datetime import datetime, timedelta, timezone as dt_timezone
@@ -12,6 +11,7 @@ from pytz import timezone as pytz_timezone
 
 from config import Config
 import database
+import deadlines
 from phrases import (
     ROBBANK_OPERATION_NAMES, ROBBANK_PENDING_PHRASES, ROBBANK_SUCCESS_PHRASES,
     ROBBANK_ARREST_PHRASES, ROBBANK_ALREADY_BLOCKED_PHRASES,
@@ -273,12 +273,15 @@ async def handle_robbank_command(message: Message, bot: Bot): # bot: Bot мож
             operation_name = random.choice(ROBBANK_OPERATION_NAMES)
             operation_delay_seconds = random.randint(Config.ROBBANK_RESULT_DELAY_MIN_SECONDS, Config.ROBBANK_RESULT_DELAY_MAX_SECONDS)
             
+            # Срок завершения сохраняется в БД: результат подведет движок сроков (deadlines.py), даже если бот перезапустится
             await database.update_user_robbank_status(
                 user_id, chat_id,
                 last_robbank_attempt_utc=now_utc,
                 current_operation_name=operation_name,
                 current_operation_start_utc=now_utc,
-                current_operation_base_reward=preparation_cost
+                current_operation_base_reward=preparation_cost,
+                current_operation_due_utc=now_utc + timedelta(seconds=operation_delay_seconds),
+                current_operation_thread_id=original_message_thread_id
             )
 
             time_left_display_minutes = f"{int(operation_delay_seconds / 60) + 1} мин."
@@ -293,19 +296,6 @@ async def handle_robbank_command(message: Message, bot: Bot): # bot: Bot мож
             
             logger.info(f"Robbank: Пользователь {user_id} (чат {chat_id}, тема {original_message_thread_id}) начал операцию '{operation_name}'. Цена: {preparation_cost}, Задержка: {operation_delay_seconds}с.")
 
-            # Передаем original_message_thread_id в отложенную задачу
-            asyncio.create_task(
-                _delayed_robbank_processing_wrapper(
-                    delay_seconds=operation_delay_seconds, 
-                    user_id=user_id, 
-                    chat_id=chat_id, 
-                    operation_name=operation_name, 
-                    base_prep_cost=preparation_cost, 
-                    bot_instance=message.bot, # Используем message.bot
-                    initial_message_thread_id=original_message_thread_id # Передаем ID темы
-                )
-            )
-
         except Exception as e:
             logger.error(f"Ошибка в /robbank для user {user_id} в чате {chat_id} (тема {original_message_thread_id}): {e}", exc_info=True)
             await message.reply("Произошла внутренняя ошибка при попытке ограбления. Попробуйте позже.",
@@ -313,19 +303,21 @@ async def handle_robbank_command(message: Message, bot: Bot): # bot: Bot мож
             await send_telegram_log(message.bot, f"🔴 Ошибка в /robbank для {user_link} (тема {original_message_thread_id}): <pre>{html.escape(str(e))}</pre>")
 
 
-async def _delayed_robbank_processing_wrapper(
-    delay_seconds: int, 
-    user_id: int, 
-    chat_id: int, 
-    operation_name: str, 
-    base_prep_cost: int, 
-    bot_instance: Bot, 
-    initial_message_thread_id: Optional[int] # <-- Принимаем ID темы
-):
-    """Обертка для asyncio.sleep и вызова основной логики с обработкой исключений."""
+async def process_due_robbank_operation(bot_instance: Bot, user_id: int, chat_id: int):
+    """Обработчик срока deadlines.KIND_ROBBANK: подводит итог операции, если ее время вышло."""
+    robbank_status = await database.get_user_robbank_status(user_id, chat_id)
+    if not robbank_status or not robbank_status.get('current_operation_start_utc'):
+        return # Операция уже обработана
+    due_utc = robbank_status.get('current_operation_due_utc') or (
+        robbank_status['current_operation_start_utc'] + timedelta(seconds=Config.ROBBANK_RESULT_DELAY_MAX_SECONDS)
+    )
+    if due_utc > datetime.now(dt_timezone.utc):
+        deadlines.schedule(deadlines.KIND_ROBBANK, (user_id, chat_id), due_utc)
+        return
+    operation_name = robbank_status.get('current_operation_name') or ""
+    base_prep_cost = robbank_status.get('current_operation_base_reward') or 0
+    initial_message_thread_id = robbank_status.get('current_operation_thread_id')
     try:
-        await asyncio.sleep(delay_seconds)
-        # Передаем initial_message_thread_id дальше
         await _process_robbank_result(user_id, chat_id, operation_name, base_prep_cost, bot_instance, initial_message_thread_id)
     except Exception as e:
         logger.error(f"Критическая ошибка в отложенной задаче _process_robbank_result для user {user_id}, chat {chat_id}, op '{operation_name}', тема {initial_message_thread_id}: {e}", exc_info=True)
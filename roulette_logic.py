@@ -10,6 +10,9 @@ from aiogram.filters import Command
 from aiogram.types import Message, Chat # Chat добавлен
 import asyncpg 
 import logging
+import locks
+import catalog
+from catalog import parse_memory_string_to_gb
 
 try:
     from config import Config
@@ -31,73 +34,27 @@ except ImportError:
     async def get_active_user_phone_bonuses(user_id: int) -> dict:
         return {}
 
-# >>>>> ИЗМЕНЕНИЕ: Импорт и создание PHONE_MODELS и PHONE_COLORS <<<<<
+# >>>>> ИЗМЕНЕНИЕ: Импорт PHONE_COLORS (модели телефонов - в catalog.py) <<<<<
 try:
-    from phone_data import PHONE_MODELS as PHONE_MODELS_LIST, PHONE_COLORS
-    PHONE_MODELS: Dict[str, Dict[str, Any]] = {
-        phone_info["key"]: phone_info for phone_info in PHONE_MODELS_LIST
-    }
+    from phone_data import PHONE_COLORS
     if not PHONE_COLORS: # На случай, если PHONE_COLORS пуст
         PHONE_COLORS = ["Черный", "Белый", "Синий", "Красный"] # Минимальный набор по умолчанию
 except ImportError:
-    logging.critical("Не удалось импортировать PHONE_MODELS_LIST или PHONE_COLORS из phone_data.py!")
-    # Создаем заглушки, чтобы бот не упал, но функционал телефонов будет сломан
-    PHONE_MODELS = {}
+    logging.critical("Не удалось импортировать PHONE_COLORS из phone_data.py!")
+    # Создаем заглушку, чтобы бот не упал
     PHONE_COLORS = ["Черный", "Белый", "Синий", "Красный"]
 
 
 roulette_router = Router()
 logger = logging.getLogger(__name__)
 
-# Блокировки команд
-user_roulette_locks: Dict[Tuple[int, int], asyncio.Lock] = {} 
-roulette_locks_lock = asyncio.Lock()
-
-async def get_roulette_lock(user_id: int, chat_id: int) -> asyncio.Lock:
-    key = (user_id, chat_id)
-    async with roulette_locks_lock:
-        if key not in user_roulette_locks:
-            user_roulette_locks[key] = asyncio.Lock()
-        return user_roulette_locks[key]
-
-# >>>>> ИЗМЕНЕНИЕ: Вспомогательная функция parse_memory_string_to_gb <<<<<
-# Эту функцию лучше вынести в utils.py, если она используется где-то еще.
-# Для простоты пока оставляю здесь.
-def parse_memory_string_to_gb(memory_str: str) -> int:
-    if not isinstance(memory_str, str):
-        logger.warning(f"parse_memory_string_to_gb: получена не строка: {memory_str}")
-        return 128 # Дефолтное значение
-
-    memory_str_upper = memory_str.upper().strip()
-    num_val = 0
-    num_part = ""
-    try:
-        for char_mem in memory_str_upper:
-            if char_mem.isdigit() or char_mem == '.':
-                num_part += char_mem
-            else:
-                if num_part: break
-        
-        if not num_part:
-            logger.warning(f"Не удалось извлечь число из строки памяти: '{memory_str}'. Возвращено 128GB.")
-            return 128
-
-        value = float(num_part)
-        if 'TB' in memory_str_upper:
-            num_val = int(value * 1024)
-        elif 'GB' in memory_str_upper:
-            num_val = int(value)
-        else: 
-            num_val = int(value) # Если нет единиц, считаем GB
-            
-    except ValueError:
-        logger.warning(f"ValueError при парсинге памяти '{memory_str}'. Возвращено 128GB.")
-        return 128 
-    except Exception as e:
-        logger.error(f"Общая ошибка при парсинге памяти '{memory_str}': {e}. Возвращено 128GB.")
-        return 128
-    
-    return num_val if num_val > 0 else 128
+# Блокировки команд (см. locks.py)
+user_roulette_locks = locks.get_lock_manager("roulette")
+
+async def get_roulette_lock(user_id: int, chat_id: int) -> locks.KeyedLock:
+    return user_roulette_locks.get(user_id, chat_id)
+
+# parse_memory_string_to_gb перенесена в catalog.py; начальная память моделей уже разобрана в catalog.PHONE_MEMORY_GB
 
 
 async def ensure_user_oneui_record_for_roulette(
@@ -445,13 +402,10 @@ async def _apply_prize_and_get_message(
                 new_balance_fallback = await database.update_user_onecoins(user_id, chat_id, coins_won_fallback, username=user_db_data_for_onecoins_update.get('username', user_tg_username_param), full_name=user_db_data_for_onecoins_update.get('full_name', user_full_name_param), chat_title=user_db_data_for_onecoins_update.get('chat_title', chat_title_for_fallback_logic))
                 message_to_user = f"🎁 Ого! Что-то необычное... Вы выиграли <b>{coins_won_fallback} OneCoin(s)</b> в качестве особого приза! Баланс: {new_balance_fallback} OC."
             else:
-                phones_in_selected_series = [
-                    model_info for model_key, model_info in PHONE_MODELS.items()
-                    if model_info.get("series") == selected_series
-                ]
+                phones_in_selected_series = list(catalog.PHONE_MODELS_BY_SERIES.get(selected_series, ()))
 
                 if not phones_in_selected_series:
-                    logger.warning(f"ROULETTE (Phone Apply): Нет телефонов для серии {selected_series} в PHONE_MODELS. Компенсация.")
+                    logger.warning(f"ROULETTE (Phone Apply): Нет телефонов для серии {selected_series} в catalog.PHONE_MODELS_BY_SERIES. Компенсация.")
                     coins_compensation_no_phones = random.randint(30, 50)
                     new_balance_comp = await database.update_user_onecoins(user_id, chat_id, coins_compensation_no_phones, username=user_db_data_for_onecoins_update.get('username', user_tg_username_param), full_name=user_db_data_for_onecoins_update.get('full_name', user_full_name_param), chat_title=user_db_data_for_onecoins_update.get('chat_title', chat_title_for_fallback_logic))
                     message_to_user = f"🤔 Редкая удача! Вы почти выиграли телефон, но в этой серии сейчас пусто. Держите утешительные <b>{coins_compensation_no_phones} OneCoin(s)</b>. Баланс: {new_balance_comp} OC."
@@ -501,7 +455,7 @@ async def _apply_prize_and_get_message(
                         won_phone_base_price = selected_phone_info['price']
                         chosen_color = random.choice(PHONE_COLORS) if PHONE_COLORS else "Черный"
                         memory_str = selected_phone_info.get("memory", "128GB")
-                        initial_memory_gb = parse_memory_string_to_gb(memory_str)
+                        initial_memory_gb = catalog.PHONE_MEMORY_GB.get(won_phone_key) or parse_memory_string_to_gb(memory_str)
 
                         active_phones_count = await database.count_user_active_phones(user_id)
                         max_phones_allowed = getattr(Config, "MAX_PHONES_PER_USER", 2)
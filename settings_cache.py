@@ -0,0 +1,174 @@
+# settings_cache.py
+"""
+Кэш строк system_settings в памяти процесса.
+
+Настройки (множитель инфляции, время глобального сброса бонуса и рулетки) меняются редко, а читаются
+на каждый товар в магазинах и на каждую команду /bonus и /roulette. database.get_setting_* сначала
+смотрят сюда и идут в БД только при промахе.
+
+Согласованность между процессами: database.set_setting_* после записи выполняют
+NOTIFY system_settings_changed с ключом, а SettingsCache держит отдельное соединение с LISTEN
+и по уведомлению сбрасывает ключ и перечитывает его. NOTIFY доставляется при фиксации транзакции,
+поэтому другие процессы не увидят незафиксированное значение.
+
+Пока LISTEN-соединение не установлено (старт, обрыв связи), кэш выключен и все чтения идут в БД:
+уведомления в это время могли потеряться. После переподключения кэш заполняется заново.
+
+Аренды (leader_election.py) хранятся в той же таблице, но читаются и пишутся мимо кэша.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+SETTINGS_CHANNEL = "system_settings_changed"
+NOT_CACHED = object() # Ключа нет в кэше (в отличие от None - "строки нет в БД")
+
+Token = Tuple[int, int]
+
+
+class SettingsCache:
+    def __init__(self, connect: Callable[[], Awaitable[Any]],
+                 load_all: Callable[[], Awaitable[Iterable[Tuple[str, Any]]]],
+                 load_one: Callable[[str], Awaitable[Any]],
+                 health_check_interval: float = 30.0, reconnect_delay: float = 5.0):
+        """
+        connect() - отдельное (не из пула) соединение для LISTEN;
+        load_all() - все строки [(ключ, значение)]; load_one(ключ) - значение ключа или None.
+        """
+        self._connect = connect
+        self._load_all = load_all
+        self._load_one = load_one
+        self.health_check_interval = health_check_interval
+        self.reconnect_delay = reconnect_delay
+        self._values: Dict[str, Any] = {}
+        # Поколения: значение, прочитанное до сброса ключа (или всего кэша), в кэш не попадает
+        self._epoch = 0
+        self._generations: Dict[str, int] = {}
+        self._listening = False
+        self._task: Optional[asyncio.Task] = None
+        self._refresh_tasks: set = set()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._listening
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "keys": len(self._values),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+        }
+
+    # --- Чтение и запись ---
+    def get(self, key: str) -> Any:
+        """Значение ключа или NOT_CACHED."""
+        if not self._listening:
+            return NOT_CACHED
+        value = self._values.get(key, NOT_CACHED)
+        if value is NOT_CACHED:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def token(self, key: str) -> Token:
+        """Берется до чтения из БД и передается в put."""
+        return (self._epoch, self._generations.get(key, 0))
+
+    def put(self, key: str, value: Any, token: Token) -> None:
+        if self._listening and token == self.token(key):
+            self._values[key] = value
+
+    def invalidate(self, key: str) -> None:
+        self._generations[key] = self._generations.get(key, 0) + 1
+        self._values.pop(key, None)
+        self.invalidations += 1
+
+    def clear(self) -> None:
+        self._epoch += 1
+        self._generations.clear()
+        self._values.clear()
+
+    # --- LISTEN ---
+    def _on_notification(self, connection: Any, pid: int, channel: str, payload: str) -> None:
+        self.invalidate(payload)
+        task = asyncio.create_task(self._refresh(payload))
+        self._refresh_tasks.add(task)
+        task.add_done_callback(self._refresh_tasks.discard)
+
+    async def _refresh(self, key: str) -> None:
+        # Сразу перечитываем измененный ключ, чтобы следующее чтение не шло в БД
+        token = self.token(key)
+        try:
+            value = await self._load_one(key)
+        except Exception as e:
+            logger.warning(f"SettingsCache: Не удалось перечитать настройку '{key}': {e}")
+            return
+        self.put(key, value, token)
+
+    async def _warm_up(self) -> None:
+        token_epoch = self._epoch
+        rows = await self._load_all()
+        if token_epoch != self._epoch:
+            return
+        for key, value in rows:
+            self.put(key, value, (token_epoch, self._generations.get(key, 0)))
+
+    async def _listen_once(self) -> None:
+        conn = await self._connect()
+        closed = asyncio.Event()
+        try:
+            conn.add_termination_listener(lambda _conn: closed.set())
+            await conn.add_listener(SETTINGS_CHANNEL, self._on_notification)
+            # Уведомления, пришедшие до LISTEN, потеряны - начинаем с пустого кэша
+            self.clear()
+            self._listening = True
+            await self._warm_up()
+            logger.info(f"SettingsCache: Подписка на {SETTINGS_CHANNEL} активна, загружено настроек: {len(self._values)}.")
+            while not closed.is_set():
+                try:
+                    await asyncio.wait_for(closed.wait(), timeout=self.health_check_interval)
+                except asyncio.TimeoutError:
+                    await asyncio.wait_for(conn.execute("SELECT 1"), timeout=self.health_check_interval)
+            logger.warning("SettingsCache: LISTEN-соединение закрыто.")
+        finally:
+            self._listening = False
+            self.clear()
+            if not conn.is_closed():
+                try:
+                    await conn.close()
+                except Exception:
+                    conn.terminate()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self._listen_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"SettingsCache: Ошибка LISTEN-соединения, кэш настроек выключен: {e}")
+            await asyncio.sleep(self.reconnect_delay)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+        self._listening = False
+        self.clear()
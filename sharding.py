@@ -0,0 +1,210 @@
+# sharding.py
+"""
+Обработка апдейтов в нескольких процессах (Config.BOT_WORKERS > 1).
+
+Один процесс-приемник получает апдейты через getUpdates и раздает их N процессам-обработчикам
+по from_user.id % N. Все апдейты одного пользователя попадают в один процесс. Там они
+выполняются строго по очереди, а апдейты разных пользователей - параллельно (не больше
+max_concurrent одновременно). Каждый обработчик - полноценный бот: свой event loop, свой пул
+соединений с теми же настройками (DB_POOL_* действуют на каждый процесс), свои локальные блокировки
+и кэш FSM. Локальных блокировок хватает, потому что пользователь не переходит между процессами.
+Планировщик и служебные уведомления запускает только обработчик 0 (primary=True в on_startup).
+
+Очереди между процессами ограничены (queue_size, в main.py - Config.SHARD_QUEUE_SIZE): если обработчик не успевает,
+приемник ждет, а не копит апдейты в памяти. Упавший обработчик перезапускается приемником.
+"""
+import asyncio
+import json
+import multiprocessing
+import signal
+from typing import Any, Callable, Dict, List, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+_SHUTDOWN_SENTINEL = None # Сигнал обработчику: доработать принятое и завершиться
+
+
+def update_routing_key(raw_update: Dict[str, Any]) -> int:
+    """Ключ, по которому апдейты упорядочиваются и распределяются: id пользователя, иначе id чата, иначе update_id."""
+    for field, value in raw_update.items():
+        if field == "update_id" or not isinstance(value, dict):
+            continue
+        user = value.get("from") or value.get("user")
+        if isinstance(user, dict) and "id" in user:
+            return int(user["id"])
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if isinstance(chat, dict) and "id" in chat:
+            return int(chat["id"])
+    return int(raw_update.get("update_id", 0))
+
+
+def shard_for_update(raw_update: Dict[str, Any], workers: int) -> int:
+    return update_routing_key(raw_update) % workers
+
+
+# --- Выполнение апдейтов с сохранением порядка пользователя ---
+class OrderedUpdateRunner:
+    """
+    Передает апдейты в диспетчер параллельно, но апдейты с одним ключом (update_routing_key) -
+    строго по очереди. Одновременно выполняется не больше max_in_flight апдейтов.
+    Используется процессом-обработчиком (run_worker) и webhook-сервером (webhook.py).
+    """
+
+    def __init__(self, dp: Dispatcher, bot: Bot, max_in_flight: int = 100):
+        self.dp = dp
+        self.bot = bot
+        self.max_in_flight = max_in_flight
+        self._in_flight = 0
+        self._slot_freed = asyncio.Event()
+        self._tails: Dict[int, asyncio.Task] = {} # Последний апдейт каждого ключа
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def try_submit(self, raw_update: Dict[str, Any]) -> bool:
+        """Запускает апдейт, если есть свободное место; иначе возвращает False."""
+        if self._in_flight >= self.max_in_flight:
+            return False
+        key = update_routing_key(raw_update)
+        self._in_flight += 1
+        task = asyncio.create_task(self._process(raw_update, self._tails.get(key)))
+        self._tails[key] = task
+        task.add_done_callback(lambda t, k=key: self._on_done(k, t))
+        return True
+
+    async def submit(self, raw_update: Dict[str, Any]) -> None:
+        """Запускает апдейт, при необходимости дожидаясь свободного места."""
+        while not self.try_submit(raw_update):
+            self._slot_freed.clear()
+            await self._slot_freed.wait()
+
+    async def drain(self) -> None:
+        """Дожидается всех принятых апдейтов."""
+        if self._tails:
+            # Каждый апдейт ждет предыдущий своего ключа, поэтому достаточно дождаться последних
+            await asyncio.gather(*self._tails.values(), return_exceptions=True)
+
+    def _on_done(self, key: int, task: asyncio.Task) -> None:
+        self._in_flight -= 1
+        self._slot_freed.set()
+        if self._tails.get(key) is task:
+            del self._tails[key]
+
+    async def _process(self, raw_update: Dict[str, Any], previous: Optional[asyncio.Task]) -> None:
+        try:
+            if previous is not None:
+                await asyncio.wait([previous]) # Ждем предыдущий апдейт этого ключа, его ошибки нас не касаются
+            await self.dp.feed_raw_update(self.bot, raw_update)
+        except Exception as e:
+            logger.error(f"Sharding: Ошибка обработки апдейта {raw_update.get('update_id')}: {e}", exc_info=True)
+
+
+# --- Процесс-обработчик ---
+async def run_worker(dp: Dispatcher, bot: Bot, queue: Any, index: int, workers: int,
+                     max_concurrent: int = 100) -> None:
+    """Цикл процесса-обработчика: читает апдейты из queue, пока не получит сигнал остановки."""
+    loop = asyncio.get_running_loop()
+    primary = index == 0
+    await dp.emit_startup(dispatcher=dp, bot=bot, bots=[bot], primary=primary)
+    logger.info(f"Sharding: Обработчик {index + 1}/{workers} запущен{' (основной)' if primary else ''}.")
+    runner = OrderedUpdateRunner(dp, bot, max_in_flight=max_concurrent)
+    try:
+        while True:
+            raw = await loop.run_in_executor(None, queue.get)
+            if raw is _SHUTDOWN_SENTINEL:
+                break
+            await runner.submit(json.loads(raw)) # Не берем из очереди больше, чем готовы обрабатывать
+    finally:
+        if runner.in_flight:
+            logger.info(f"Sharding: Обработчик {index + 1}: дожидаемся {runner.in_flight} апдейтов перед остановкой.")
+        await runner.drain()
+        await dp.emit_shutdown(dispatcher=dp, bot=bot, bots=[bot], primary=primary)
+        await bot.session.close()
+        logger.info(f"Sharding: Обработчик {index + 1}/{workers} остановлен.")
+
+
+def worker_process_entry(run: Callable[[], Any]) -> None:
+    """Общая часть входа в процесс-обработчик: Ctrl+C обрабатывает приемник, он же останавливает обработчики."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(run())
+
+
+# --- Процесс-приемник ---
+class ShardedPolling:
+    def __init__(self, bot: Bot, worker_target: Callable[..., None], workers: int,
+                 queue_size: int = 1000, polling_timeout: int = 30):
+        """worker_target(index, workers, queue) - функция уровня модуля, запускаемая в процессе-обработчике."""
+        self.bot = bot
+        self.worker_target = worker_target
+        self.workers = workers
+        self.polling_timeout = polling_timeout
+        self._ctx = multiprocessing.get_context("spawn")
+        self._queues = [self._ctx.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._processes: List[Optional[multiprocessing.process.BaseProcess]] = [None] * workers
+
+    def _start_worker(self, index: int) -> None:
+        process = self._ctx.Process(
+            target=self.worker_target, args=(index, self.workers, self._queues[index]),
+            name=f"bot-worker-{index}",
+        )
+        process.start()
+        self._processes[index] = process
+        logger.info(f"Sharding: Запущен обработчик {index + 1}/{self.workers} (pid {process.pid}).")
+
+    def _restart_dead_workers(self) -> None:
+        for index, process in enumerate(self._processes):
+            if process is not None and not process.is_alive():
+                logger.error(f"Sharding: Обработчик {index + 1} завершился с кодом {process.exitcode}, перезапускаем.")
+                self._start_worker(index)
+
+    async def _dispatch(self, update: Update) -> None:
+        raw_update = update.model_dump(mode="json", exclude_unset=True, by_alias=True)
+        shard = shard_for_update(raw_update, self.workers)
+        # put блокируется, если очередь обработчика заполнена - это и есть обратное давление
+        await asyncio.get_running_loop().run_in_executor(None, self._queues[shard].put, json.dumps(raw_update))
+
+    async def run(self) -> None:
+        for index in range(self.workers):
+            self._start_worker(index)
+        offset: Optional[int] = None
+        backoff = 1.0
+        try:
+            while True:
+                self._restart_dead_workers()
+                try:
+                    updates = await self.bot.get_updates(offset=offset, timeout=self.polling_timeout)
+                    backoff = 1.0
+                except Exception as e:
+                    retry_after = getattr(e, "retry_after", None)
+                    delay = float(retry_after) if retry_after else backoff
+                    logger.error(f"Sharding: Ошибка getUpdates, повтор через {delay:.0f} сек: {e}")
+                    await asyncio.sleep(delay)
+                    backoff = min(backoff * 2, 30.0)
+                    continue
+                for update in updates:
+                    await self._dispatch(update)
+                    offset = update.update_id + 1
+        finally:
+            await self.stop()
+
+    async def stop(self, timeout: float = 60.0) -> None:
+        """Просит обработчики доработать принятые апдейты и ждет их завершения."""
+        loop = asyncio.get_running_loop()
+        for index, process in enumerate(self._processes):
+            if process is not None and process.is_alive():
+                await loop.run_in_executor(None, self._queues[index].put, _SHUTDOWN_SENTINEL)
+        for index, process in enumerate(self._processes):
+            if process is None:
+                continue
+            await loop.run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                logger.warning(f"Sharding: Обработчик {index + 1} не остановился за {timeout:.0f} сек, завершаем принудительно.")
+                process.terminate()
+            self._processes[index] = None
+        logger.info("Sharding: Все обработчики остановлены.")
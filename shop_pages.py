@@ -0,0 +1,113 @@
+# shop_pages.py
+"""
+Кэш готовых страниц магазинов (/phoneshop, /itemshop, /businessshop).
+
+Страницы магазинов собираются из статических данных (catalog.py) и множителя инфляции, поэтому между
+применениями инфляции их текст не меняется. Модули магазинов регистрируют здесь функцию отрисовки
+render(variant, multiplier) -> HTML и список вариантов страницы (серии, категории); страницы хранятся
+по ключу (страница, вариант, множитель) уже разбитыми на сообщения.
+
+Упоминание пользователя в страницу не входит: вместо него в тексте стоит USER_LINK_PLACEHOLDER,
+который подставляется при отправке. Варианты вне списка (неверные аргументы команды) отрисовываются
+на каждый вызов и не кэшируются, чтобы произвольный ввод не раздувал кэш.
+
+Все страницы строятся при запуске (warm_up) и заново после scheduled_apply_inflation. В других процессах
+новый множитель приходит через кэш настроек (settings_cache.py) и просто дает промах по новому ключу.
+"""
+import asyncio
+from typing import Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+from aiogram.types import Message
+
+from utils import get_inflation_multiplier
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_LIMIT = 4096 # Лимит длины сообщения Telegram
+USER_LINK_RESERVE = 512 # Запас длины первого сообщения под упоминание пользователя
+USER_LINK_PLACEHOLDER = "\x00user_link\x00"
+
+Renderer = Callable[[Hashable, float], str]
+
+_renderers: Dict[str, Renderer] = {}
+_variants: Dict[str, Tuple[Hashable, ...]] = {}
+_pages: Dict[Tuple[str, Hashable, float], Tuple[str, ...]] = {}
+_multiplier: Optional[float] = None # Множитель, для которого построены страницы в _pages
+
+
+def register(page: str, render: Renderer, variants: Iterable[Hashable]) -> None:
+    """render(variant, multiplier) возвращает HTML страницы с USER_LINK_PLACEHOLDER вместо упоминания."""
+    _renderers[page] = render
+    _variants[page] = tuple(variants)
+
+
+def split_message(text: str, limit: int = MESSAGE_LIMIT - USER_LINK_RESERVE) -> Tuple[str, ...]:
+    """Делит текст на сообщения по границам строк."""
+    if len(text) <= limit:
+        return (text,)
+    parts: List[str] = []
+    current_part = ""
+    for line in text.split('\n'):
+        if current_part and len(current_part) + len(line) + 1 > limit:
+            parts.append(current_part)
+            current_part = line
+        else:
+            current_part = f"{current_part}\n{line}" if current_part else line
+    if current_part:
+        parts.append(current_part)
+    return tuple(parts)
+
+
+def invalidate() -> None:
+    global _multiplier
+    _pages.clear()
+    _multiplier = None
+
+
+def _render(page: str, variant: Hashable, multiplier: float) -> Tuple[str, ...]:
+    return split_message(_renderers[page](variant, multiplier))
+
+
+async def get_page(page: str, variant: Hashable = None) -> Tuple[str, ...]:
+    """Сообщения страницы для текущего множителя инфляции (с USER_LINK_PLACEHOLDER)."""
+    global _multiplier
+    multiplier = await get_inflation_multiplier()
+    if variant not in _variants[page]:
+        return _render(page, variant, multiplier)
+
+    key = (page, variant, multiplier)
+    chunks = _pages.get(key)
+    if chunks is None:
+        if multiplier != _multiplier: # Инфляция применена в другом процессе - старые страницы больше не нужны
+            _pages.clear()
+            _multiplier = multiplier
+        chunks = _render(page, variant, multiplier)
+        _pages[key] = chunks
+    return chunks
+
+
+async def warm_up() -> int:
+    """Строит все зарегистрированные страницы для текущего множителя. Возвращает число страниц."""
+    invalidate()
+    built = 0
+    for page, variants in _variants.items():
+        for variant in variants:
+            try:
+                await get_page(page, variant)
+                built += 1
+            except Exception as e:
+                logger.error(f"ShopPages: Не удалось построить страницу {page} ({variant!r}): {e}", exc_info=True)
+    logger.info(f"ShopPages: Построено страниц магазинов: {built} (множитель x{_multiplier}).")
+    return built
+
+
+async def answer_page(message: Message, page: str, variant: Hashable, user_link: str, reply: bool = False) -> None:
+    """Отправляет страницу, подставив упоминание пользователя."""
+    chunks = await get_page(page, variant)
+    send = message.reply if reply else message.answer
+    for index, chunk in enumerate(chunks):
+        if index:
+            await asyncio.sleep(0.2)
+        await send(chunk.replace(USER_LINK_PLACEHOLDER, user_link), parse_mode="HTML", disable_web_page_preview=True)
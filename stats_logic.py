@@ -13,15 +13,12 @@ import database
 from config import Config
 from utils import get_user_mention_html, send_telegram_log, fetch_user_display_data, resolve_target_user
 from business_data import BANK_DATA, BUSINESS_DATA, BUSINESS_UPGRADES
-from phone_data import PHONE_MODELS as PHONE_MODELS_STANDARD_LIST
-from exclusive_phone_data import EXCLUSIVE_PHONE_MODELS as EXCLUSIVE_PHONE_MODELS_LIST
 from item_data import PHONE_COMPONENTS, PHONE_CASES
+import catalog
 
 logger = logging.getLogger(__name__)
 stats_router = Router()
 
-PHONE_MODELS_STD_DICT_STATS = {p["key"]: p for p in PHONE_MODELS_STANDARD_LIST}
-EXCLUSIVE_PHONE_MODELS_DICT_STATS = {p["key"]: p for p in EXCLUSIVE_PHONE_MODELS_LIST}
 
 def _format_time_delta(seconds: float) -> str:
     days, remainder = divmod(seconds, 86400)
@@ -107,7 +104,7 @@ async def _get_formatted_stats(target_user_id: int, target_chat_id: int, bot_ins
             phone_data_json = phone_db.get('data', {}) or {}
 
             phone_name_display = f"Неизвестный ({html.escape(phone_key)})"
-            phone_static_info_lookup = PHONE_MODELS_STD_DICT_STATS.get(phone_key) or EXCLUSIVE_PHONE_MODELS_DICT_STATS.get(phone_key)
+            phone_static_info_lookup = catalog.PHONE_MODELS_BY_KEY.get(phone_key) or catalog.EXCLUSIVE_PHONE_MODELS_BY_KEY.get(phone_key)
             if phone_static_info_lookup:
                 phone_name_display = html.escape(phone_static_info_lookup.get('display_name', phone_static_info_lookup.get('name', phone_key)))
             elif phone_data_json.get('display_name_override'):
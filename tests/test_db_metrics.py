@@ -0,0 +1,91 @@
+# tests/test_db_metrics.py
+"""db_metrics: обертка instrument() и snapshot()."""
+import asyncio
+
+import pytest
+
+import db_metrics
+
+
+@pytest.fixture(autouse=True)
+def clean_metrics():
+    db_metrics.reset()
+    yield
+    db_metrics.reset()
+
+
+def test_snapshot_counts_calls_rows_and_percentiles(monkeypatch):
+    clock = iter(range(1000))
+    monkeypatch.setattr(db_metrics.time, "perf_counter", lambda: next(clock) / 1000.0) # Каждый вызов длится 1 мс
+
+    async def fetch_rows(n):
+        return [{"id": i} for i in range(n)]
+
+    wrapped = db_metrics.instrument("fetch_rows", fetch_rows)
+
+    async def scenario():
+        with db_metrics.caller_scope("cmd_test"):
+            for n in range(1, 11):
+                await wrapped(n)
+
+    asyncio.run(scenario())
+    stats = db_metrics.snapshot()["fetch_rows"]
+    assert stats["count"] == 10
+    assert stats["errors"] == 0
+    assert stats["rows"] == sum(range(1, 11))
+    assert stats["p50_ms"] == pytest.approx(1.0)
+    assert stats["p99_ms"] == pytest.approx(1.0)
+    assert stats["callers"] == {"cmd_test": 10}
+
+
+def test_percentiles_follow_durations(monkeypatch):
+    durations = iter([float(i) for i in range(1, 101)]) # 1..100 мс
+    now = [0.0]
+
+    async def query():
+        now[0] += next(durations) / 1000.0
+        return None
+
+    monkeypatch.setattr(db_metrics.time, "perf_counter", lambda: now[0])
+    wrapped = db_metrics.instrument("query", query)
+
+    async def scenario():
+        for _ in range(100):
+            await wrapped()
+
+    asyncio.run(scenario())
+    stats = db_metrics.snapshot()["query"]
+    assert stats["p50_ms"] == pytest.approx(50.0)
+    assert stats["p95_ms"] == pytest.approx(95.0)
+    assert stats["p99_ms"] == pytest.approx(99.0)
+    assert stats["max_ms"] == pytest.approx(100.0)
+    assert stats["callers"] == {db_metrics.BACKGROUND_CALLER: 100}
+
+
+def test_errors_are_counted_and_reraised():
+    async def broken():
+        raise RuntimeError("db down")
+
+    wrapped = db_metrics.instrument("broken", broken)
+    with pytest.raises(RuntimeError):
+        asyncio.run(wrapped())
+    stats = db_metrics.snapshot()["broken"]
+    assert stats["count"] == 1
+    assert stats["errors"] == 1
+
+
+def test_nested_calls_are_counted_once():
+    async def inner():
+        return [1]
+
+    wrapped_inner = db_metrics.instrument("inner", inner)
+
+    async def outer():
+        return await wrapped_inner()
+
+    wrapped_outer = db_metrics.instrument("outer", outer)
+    asyncio.run(wrapped_outer())
+    asyncio.run(wrapped_inner())
+    snapshot = db_metrics.snapshot()
+    assert snapshot["outer"]["count"] == 1
+    assert snapshot["inner"]["count"] == 1 # Только прямой вызов
@@ -0,0 +1,64 @@
+# tests/test_deadlines.py
+"""DeadlineEngine: выполнение наступивших сроков и сроки, которые обработчик не смог изменить."""
+import asyncio
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+import deadlines
+
+KIND = "test_kind"
+
+
+def test_unchanged_overdue_row_is_not_fired_again():
+    overdue = datetime.now(dt_timezone.utc) - timedelta(minutes=5)
+    rows = {1: overdue, 2: overdue}
+    calls = []
+
+    async def loader(until):
+        return list(rows.items())
+
+    async def handler(key):
+        calls.append(key)
+        if key == 2:
+            del rows[key] # Обработан: запись больше не просрочена
+
+    async def scenario():
+        engine = deadlines.DeadlineEngine(reconcile_interval=3600.0)
+        engine.register(KIND, loader, handler)
+        engine.start()
+        for _ in range(3): # Несколько сверок подряд
+            await engine.reconcile()
+            await asyncio.sleep(0.05)
+        assert sorted(calls) == [1, 2] # Ключ 1 обработчик не изменил, но он выполнен один раз
+        assert engine.stats()["handled_unchanged"] == 1
+
+        rows[1] = overdue + timedelta(seconds=1) # Срок в БД изменился - выполняется снова
+        await engine.reconcile()
+        await asyncio.sleep(0.05)
+        await engine.stop()
+        assert calls.count(1) == 2
+
+    asyncio.run(scenario())
+
+
+def test_failed_handler_is_retried():
+    overdue = datetime.now(dt_timezone.utc) - timedelta(minutes=5)
+    attempts = []
+
+    async def loader(until):
+        return [(1, overdue)]
+
+    async def handler(key):
+        attempts.append(key)
+        raise RuntimeError("db down")
+
+    async def scenario():
+        engine = deadlines.DeadlineEngine(reconcile_interval=3600.0)
+        engine.register(KIND, loader, handler)
+        engine.start()
+        for _ in range(3):
+            await engine.reconcile()
+            await asyncio.sleep(0.05)
+        await engine.stop()
+        assert engine.failed == len(attempts) >= 2
+
+    asyncio.run(scenario())
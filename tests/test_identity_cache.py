@@ -0,0 +1,48 @@
+# tests/test_identity_cache.py
+"""database: LRU последних записанных имен (_identity_delta / _remember_identity)."""
+import pytest
+
+import database
+import directory
+
+
+class FakeConnection:
+    def __init__(self, in_transaction=False):
+        self.in_transaction = in_transaction
+
+    def is_in_transaction(self):
+        return self.in_transaction
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(directory.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(database, "_persisted_identity", directory.LruTtlCache(max_size=10, ttl=60.0, negative_ttl=0.0))
+    return now
+
+
+def test_known_names_are_sent_as_null(clock):
+    database._remember_identity(FakeConnection(), "user_oneui", 1, 2, "alice", "Alice", "Chat")
+    assert database._identity_delta("user_oneui", 1, 2, "alice", "Alice B", "Chat") == (None, "Alice B", None)
+
+
+def test_entry_expires_so_foreign_rename_is_overwritten(clock):
+    # Этот процесс записал "A"; другой процесс затем переименовал в "B" - здесь об этом не знают
+    database._remember_identity(FakeConnection(), "user_oneui", 1, 2, "a", None, None)
+    clock[0] += 61.0
+    assert database._identity_delta("user_oneui", 1, 2, "a", None, None) == ("a", None, None)
+
+
+def test_unchanged_write_does_not_extend_ttl(clock):
+    database._remember_identity(FakeConnection(), "user_oneui", 1, 2, "a", None, None)
+    clock[0] += 50.0
+    database._remember_identity(FakeConnection(), "user_oneui", 1, 2, None, None, None) # Ушли только NULL
+    clock[0] += 11.0
+    assert database._identity_delta("user_oneui", 1, 2, "a", None, None) == ("a", None, None)
+
+
+def test_write_inside_transaction_forgets_entry(clock):
+    database._remember_identity(FakeConnection(), "user_oneui", 1, 2, "a", None, None)
+    database._remember_identity(FakeConnection(in_transaction=True), "user_oneui", 1, 2, "b", None, None)
+    assert database._identity_delta("user_oneui", 1, 2, "a", None, None) == ("a", None, None)
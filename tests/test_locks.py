@@ -0,0 +1,89 @@
+# tests/test_locks.py
+"""KeyedLockManager: записи ключей удаляются после release и отмены, счетчики ожидания."""
+import asyncio
+
+import pytest
+
+import locks
+
+
+def test_entry_is_removed_after_release():
+    async def scenario():
+        manager = locks.KeyedLockManager("test")
+        async with manager.get(1, 2):
+            assert manager.stats()["active_keys"] == 1
+        assert manager.stats()["active_keys"] == 0
+        stats = manager.stats()
+        assert stats["acquisitions"] == 1
+        assert stats["contended"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_waiter_is_counted_as_contended():
+    async def scenario():
+        manager = locks.KeyedLockManager("test")
+        holder = manager.get("key")
+        await holder.acquire()
+        waiter = asyncio.create_task(manager.get("key").acquire())
+        await asyncio.sleep(0.01)
+        await holder.release()
+        await waiter
+        stats = manager.stats()
+        assert stats["acquisitions"] == 2
+        assert stats["contended"] == 1
+        assert stats["max_wait_ms"] > 0
+        assert stats["active_keys"] == 1 # Лок теперь держит ожидавший
+
+    asyncio.run(scenario())
+
+
+def test_entry_is_removed_after_cancelled_wait():
+    async def scenario():
+        manager = locks.KeyedLockManager("test")
+        holder = manager.get("key")
+        await holder.acquire()
+        waiter = asyncio.create_task(manager.get("key").acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        await holder.release()
+        assert manager.stats()["active_keys"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_entry_is_removed_after_cancel_during_handoff():
+    # Лок уже отпущен, но разбуженный ожидающий его еще не забрал: захват "свободного" лока тоже ждет
+    async def scenario():
+        manager = locks.KeyedLockManager("test")
+        holder = manager.get("key")
+        await holder.acquire()
+        next_owner = manager.get("key")
+        waiter = asyncio.create_task(next_owner.acquire())
+        await asyncio.sleep(0)
+
+        async def release_then_acquire():
+            await holder.release() # Будит waiter, но он выполнится только после нас
+            await manager.get("key").acquire()
+
+        late = asyncio.create_task(release_then_acquire())
+        await asyncio.sleep(0)
+        late.cancel()
+        await asyncio.gather(late, return_exceptions=True)
+        await waiter
+        assert manager.stats()["contended"] == 2
+        await next_owner.release()
+        assert manager.stats()["active_keys"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_incomplete_backend_cannot_be_created():
+    class HalfBackend(locks.LockBackend):
+        async def acquire(self, scope, key):
+            return None
+
+    with pytest.raises(TypeError):
+        HalfBackend()
@@ -0,0 +1,54 @@
+# tests/test_outbox.py
+"""OutboundDispatcher с FakeBotTransport вместо Telegram: порядок в чате, отсутствие RetryAfter, темп отправки."""
+import asyncio
+
+import pytest
+
+pytest.importorskip("aiogram")
+
+import database
+import outbox
+
+
+@pytest.fixture(autouse=True)
+def no_database(monkeypatch):
+    async def claim_orphaned(limit, lease_seconds):
+        return []
+
+    async def release(outbox_ids):
+        return None
+
+    monkeypatch.setattr(database, "claim_orphaned_outbox_messages", claim_orphaned)
+    monkeypatch.setattr(database, "release_outbox_messages", release)
+
+
+def test_dispatcher_respects_rate_and_chat_order():
+    rate = 20.0
+    chats = 10
+    per_chat = 4
+    total = chats * per_chat
+
+    async def scenario():
+        transport = outbox.FakeBotTransport(latency=0.01, global_limit=30, per_chat_interval=0.2)
+        limiter = outbox.PriorityRateLimiter(rate)
+        dispatcher = outbox.OutboundDispatcher(transport, limiter, private_interval=0.25, group_interval=0.25)
+        dispatcher.start()
+        items = [(chat_id, f"{chat_id}:{n}", {}) for n in range(per_chat) for chat_id in range(1, chats + 1)]
+        await dispatcher.enqueue_many(items, persist=False)
+        for _ in range(200):
+            if len(transport.sent) >= total:
+                break
+            await asyncio.sleep(0.05)
+        await dispatcher.stop(drain_timeout=1.0)
+        return transport, limiter
+
+    transport, limiter = asyncio.run(scenario())
+    stats = transport.stats()
+    assert stats["sent"] == total
+    assert stats["retry_after_errors"] == 0
+    for chat_id in range(1, chats + 1):
+        texts = [text for _, sent_chat, text in transport.sent if sent_chat == chat_id]
+        assert texts == [f"{chat_id}:{n}" for n in range(per_chat)]
+    # Сверх начального запаса лимитера сообщения уходят не быстрее rate в секунду
+    assert stats["elapsed_seconds"] >= (total - limiter.capacity) / rate * 0.95
+    assert stats["messages_per_second"] <= transport.global_limit
@@ -0,0 +1,68 @@
+# tests/test_request_connection.py
+"""database: соединение апдейта (request_connection_scope) и get_standalone_connection()."""
+import asyncio
+
+import database
+
+
+class FakeConnection:
+    def __init__(self, name):
+        self.name = name
+        self.closed = False
+
+    def is_closed(self):
+        return self.closed
+
+    async def close(self):
+        self.closed = True
+
+
+def test_standalone_connection_is_not_the_request_connection(monkeypatch):
+    opened = []
+
+    async def open_connection():
+        conn = FakeConnection(f"conn{len(opened)}")
+        opened.append(conn)
+        return conn
+
+    monkeypatch.setattr(database, "_open_connection", open_connection)
+
+    async def scenario():
+        async with database.request_connection_scope():
+            first = await database.get_connection()
+            second = await database.get_connection()
+            standalone = await database.get_standalone_connection()
+            assert first.name == second.name == "conn0"
+            assert standalone is opened[1]
+            await standalone.close()
+            assert not opened[0].closed # Соединение апдейта закрывает только scope
+
+    asyncio.run(scenario())
+    assert [conn.closed for conn in opened] == [True, True]
+    assert len(opened) == 2
+
+
+def test_outbox_insert_uses_separate_connection(monkeypatch):
+    opened = []
+
+    class OutboxConnection(FakeConnection):
+        async def fetch(self, query, *args):
+            return [{"id": 7}]
+
+    async def open_connection():
+        conn = OutboxConnection(f"conn{len(opened)}")
+        opened.append(conn)
+        return conn
+
+    monkeypatch.setattr(database, "_open_connection", open_connection)
+
+    async def scenario():
+        async with database.request_connection_scope(use_transaction=False):
+            await database.get_connection()
+            ids = await database.insert_outbox_messages([(1, "text", "{}", 0)], 60.0)
+            assert ids == [7]
+            assert opened[1].closed # Запись в outbox уже завершена на своем соединении
+            assert not opened[0].closed
+
+    asyncio.run(scenario())
+    assert len(opened) == 2
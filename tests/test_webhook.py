@@ -0,0 +1,135 @@
+# tests/test_webhook.py
+"""
+webhook.WebhookServer поднимается через тестовый клиент aiohttp. Вместо Telegram - FakeBot
+(запоминает setWebhook), вместо обработчиков бота - FakeDispatcher, который держит апдейты,
+пока тест не откроет release.
+"""
+import asyncio
+
+import pytest
+
+pytest.importorskip("aiohttp")
+pytest.importorskip("aiogram")
+
+from aiohttp.test_utils import TestClient, TestServer
+
+import webhook
+
+SECRET = "test-secret"
+HEADERS = {webhook.SECRET_TOKEN_HEADER: SECRET}
+
+
+class FakeSession:
+    def __init__(self):
+        self.closed = False
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeBot:
+    def __init__(self):
+        self.session = FakeSession()
+        self.webhooks = []
+
+    async def set_webhook(self, url, secret_token=None):
+        self.webhooks.append((url, secret_token))
+
+
+class FakeDispatcher:
+    def __init__(self):
+        self.release = asyncio.Event()
+        self.processed = []
+        self.started = False
+        self.stopped = False
+
+    async def emit_startup(self, **kwargs):
+        self.started = True
+
+    async def emit_shutdown(self, **kwargs):
+        self.stopped = True
+
+    async def feed_raw_update(self, bot, raw_update):
+        await self.release.wait()
+        self.processed.append(raw_update["update_id"])
+
+
+def make_update(update_id, user_id=1):
+    return {"update_id": update_id, "message": {"message_id": update_id, "from": {"id": user_id}, "chat": {"id": user_id}}}
+
+
+def run_server_test(test, **server_kwargs):
+    async def runner():
+        dp, bot = FakeDispatcher(), FakeBot()
+        server = webhook.WebhookServer(dp, bot, "/hook", secret_token=SECRET, **server_kwargs)
+        client = TestClient(TestServer(server.build_app()))
+        await client.start_server()
+        try:
+            await test(client, server, dp, bot)
+        finally:
+            dp.release.set()
+            await client.close()
+
+    asyncio.run(runner())
+
+
+def test_secret_token_is_required():
+    with pytest.raises(ValueError):
+        webhook.WebhookServer(FakeDispatcher(), FakeBot(), "/hook", secret_token=None)
+    with pytest.raises(ValueError):
+        webhook.WebhookServer(FakeDispatcher(), FakeBot(), "/hook", secret_token="")
+
+
+def test_update_is_accepted_and_processed():
+    async def test(client, server, dp, bot):
+        assert dp.started
+        assert bot.webhooks == [("https://bot.example/hook", SECRET)]
+        response = await client.post("/hook", json=make_update(1), headers=HEADERS)
+        assert response.status == 200
+        dp.release.set()
+        await server.runner.drain()
+        assert dp.processed == [1]
+
+    run_server_test(test, base_url="https://bot.example/")
+
+
+def test_wrong_or_missing_secret_is_rejected():
+    async def test(client, server, dp, bot):
+        for headers in ({}, {webhook.SECRET_TOKEN_HEADER: "wrong"}, {webhook.SECRET_TOKEN_HEADER: "секрет"}):
+            response = await client.post("/hook", json=make_update(1), headers=headers)
+            assert response.status == 401
+        assert server.runner.in_flight == 0
+
+    run_server_test(test)
+
+
+def test_busy_server_answers_503():
+    async def test(client, server, dp, bot):
+        response = await client.post("/hook", json=make_update(1, user_id=1), headers=HEADERS)
+        assert response.status == 200
+        response = await client.post("/hook", json=make_update(2, user_id=2), headers=HEADERS)
+        assert response.status == 503
+        assert response.headers["Retry-After"] == "1"
+        assert server.rejected_busy == 1
+        dp.release.set()
+        await server.runner.drain()
+        assert dp.processed == [1]
+
+    run_server_test(test, max_in_flight=1)
+
+
+def test_shutdown_drains_accepted_updates():
+    async def test(client, server, dp, bot):
+        for update_id in (1, 2):
+            response = await client.post("/hook", json=make_update(update_id), headers=HEADERS)
+            assert response.status == 200
+        close_task = asyncio.create_task(client.close())
+        await asyncio.sleep(0.05)
+        assert not close_task.done() # Остановка ждет принятые апдейты
+        assert dp.processed == [] and not dp.stopped
+        dp.release.set()
+        await close_task
+        assert dp.processed == [1, 2] # Порядок апдейтов одного пользователя сохранен
+        assert dp.stopped and bot.session.closed
+
+    run_server_test(test)
@@ -1,12 +1,14 @@
 # utils.py
+import asyncio
 import logging
 import asyncpg
 import html
 from datetime import datetime
-from typing import Optional, List, Tuple, Any # Убедись, что Tuple есть
+from typing import Optional, List, Tuple, Any, Dict # Убедись, что Tuple есть
 
 # Импорты из твоего проекта
 import database # type: ignore
+import directory
 from config import Config # type: ignore
 
 # Импорты Aiogram
@@ -82,61 +84,55 @@ async def send_telegram_log(bot_instance: Bot, message_text: str, include_timest
         except Exception as e:
             logger_utils.error(f"Не удалось отправить лог-сообщение в Telegram для ID {chat_id_to_send}: {e}")
 
+def calculate_inflated_price(base_price: int, inflation_multiplier: float) -> int:
+    """Цена товара при заданном множителе инфляции (без обращений к БД)."""
+    if inflation_multiplier < 0:
+        logger_utils.warning(f"PriceCalc: Множитель инфляции ({inflation_multiplier}) отрицательный. Используется 0.")
+        inflation_multiplier = 0.0
+    return max(0, int(round(base_price * inflation_multiplier)))
+
+async def get_inflation_multiplier(conn_ext: Optional[asyncpg.Connection] = None) -> float:
+    """Текущий множитель инфляции. Берется из кэша настроек - соединение с БД нужно только при промахе."""
+    inflation_multiplier = await database.get_setting_float(
+        Config.INFLATION_SETTING_KEY,
+        Config.DEFAULT_INFLATION_MULTIPLIER,
+        conn_ext=conn_ext
+    )
+    if inflation_multiplier is None:
+        inflation_multiplier = Config.DEFAULT_INFLATION_MULTIPLIER
+        logger_utils.error(f"PriceCalc: Не удалось получить множитель инфляции, используется дефолтный: {inflation_multiplier}")
+    return inflation_multiplier
+
 async def get_current_price(base_price: int, conn_ext: Optional[asyncpg.Connection] = None) -> int:
     """
     Рассчитывает текущую цену товара с учетом инфляции.
     """
-    conn_was_none = False
-    active_conn = conn_ext
-    if active_conn is None:
-        active_conn = await database.get_connection()
-        conn_was_none = True
-    
     try:
-        inflation_multiplier = await database.get_setting_float(
-            Config.INFLATION_SETTING_KEY, 
-            Config.DEFAULT_INFLATION_MULTIPLIER,
-            conn_ext=active_conn
-        )
-        if inflation_multiplier is None: 
-            inflation_multiplier = Config.DEFAULT_INFLATION_MULTIPLIER 
-            logger_utils.error(f"PriceCalc: Не удалось получить множитель инфляции, используется дефолтный: {inflation_multiplier}")
-        
-        if inflation_multiplier < 0: 
-            logger_utils.warning(f"PriceCalc: Множитель инфляции ({inflation_multiplier}) отрицательный. Используется 0.")
-            inflation_multiplier = 0.0
-
-        current_price_float = base_price * inflation_multiplier
-        current_price_int = int(round(current_price_float))
-        
-        logger_utils.debug(f"PriceCalc: Base: {base_price}, Multiplier: {inflation_multiplier:.4f}, Calculated: {current_price_float:.2f} -> Rounded: {current_price_int}")
-        return max(0, current_price_int)
+        return calculate_inflated_price(base_price, await get_inflation_multiplier(conn_ext=conn_ext))
     except Exception as e:
         logger_utils.error(f"PriceCalc: Ошибка при расчете цены с инфляцией для базовой цены {base_price}: {e}", exc_info=True)
         return base_price 
-    finally:
-        if conn_was_none and active_conn and not active_conn.is_closed():
-            await active_conn.close()
 
 async def fetch_user_display_data(bot_instance: Bot, user_id_to_fetch: int) -> Tuple[str, Optional[str]]:
     """
     Получает отображаемое имя и username пользователя.
-    Сначала пытается извлечь из БД user_oneui, затем через API бота.
+    Сначала из справочника в памяти (directory.users), затем из таблицы users, затем через API бота.
     """
+    cached = directory.users.get(user_id_to_fetch)
+    if cached is not directory.MISSING:
+        if cached is None: # Недавно не удалось узнать имя - не повторяем get_chat
+            return f"User ID {user_id_to_fetch}", None
+        return cached
+
     full_name: Optional[str] = None
     username: Optional[str] = None
-    conn = None
     try:
-        conn = await database.get_connection()
-        udb = await conn.fetchrow("SELECT full_name, username FROM user_oneui WHERE user_id = $1 ORDER BY last_used DESC NULLS LAST LIMIT 1", user_id_to_fetch)
+        udb = await database.get_user_identity(user_id_to_fetch)
         if udb:
             full_name = udb.get('full_name')
             username = udb.get('username')
     except Exception as e:
         logger_utils.warning(f"DB fetch error for user {user_id_to_fetch} in fetch_user_display_data: {e}")
-    finally:
-        if conn and not conn.is_closed():
-            await conn.close()
     
     if not full_name: 
         try:
@@ -149,8 +145,74 @@ async def fetch_user_display_data(bot_instance: Bot, user_id_to_fetch: int) -> T
         except Exception as e:
             logger_utils.warning(f"API get_chat error for user {user_id_to_fetch} in fetch_user_display_data: {e}")
             
+    if full_name:
+        directory.remember_user(user_id_to_fetch, full_name, username)
+    else:
+        directory.users.put_negative(user_id_to_fetch)
     return full_name or f"User ID {user_id_to_fetch}", username
 
+async def prefetch_user_display_data(user_ids: List[int]) -> None:
+    """Загружает в справочник имена пользователей, которых в нем нет, одним запросом к users."""
+    missing_ids = [uid for uid in set(user_ids) if directory.users.get(uid) is directory.MISSING]
+    if not missing_ids:
+        return
+    try:
+        for row in await database.get_user_identities(missing_ids):
+            directory.remember_user(row['user_id'], row.get('full_name'), row.get('username'))
+    except Exception as e:
+        logger_utils.warning(f"DB fetch error in prefetch_user_display_data for {len(missing_ids)} users: {e}")
+
+def _chat_display_name(chat_id: int, chat_info: Optional[Tuple[Optional[str], Optional[str], Optional[str]]]) -> str:
+    if chat_info:
+        title, username, _chat_type = chat_info
+        if title:
+            return html.escape(title)
+        if username:
+            return f"@{username}"
+    return f"Чат ID: {chat_id}"
+
+async def fetch_chat_display_names(bot_instance: Bot, chat_titles: Dict[int, Optional[str]],
+                                   owner_user_id: Optional[int] = None, concurrency: int = 5) -> Dict[int, str]:
+    """
+    Возвращает {chat_id: экранированное название для HTML}.
+    chat_titles - {chat_id: название из user_oneui.chat_title или None}.
+    Порядок: справочник directory.chats, затем название из БД, затем bot.get_chat
+    (не больше concurrency запросов одновременно; неудача кэшируется как отрицательный ответ).
+    """
+    names: Dict[int, str] = {}
+    to_fetch: List[int] = []
+    for chat_id, db_title in chat_titles.items():
+        if owner_user_id is not None and chat_id == owner_user_id:
+            names[chat_id] = "Личные сообщения (с этим ботом)"
+            continue
+        cached = directory.chats.get(chat_id)
+        if cached is directory.MISSING and db_title:
+            cached = (db_title, None, None)
+            directory.remember_chat(chat_id, db_title, None, None)
+        if cached is directory.MISSING:
+            to_fetch.append(chat_id)
+        else:
+            names[chat_id] = _chat_display_name(chat_id, cached)
+
+    if to_fetch:
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+
+        async def _fetch(chat_id: int) -> Tuple[int, Optional[Tuple[Optional[str], Optional[str], Optional[str]]]]:
+            async with semaphore:
+                try:
+                    ci = await bot_instance.get_chat(chat_id)
+                except Exception as e:
+                    logger_utils.warning(f"API get_chat error for chat {chat_id} in fetch_chat_display_names: {e}")
+                    directory.chats.put_negative(chat_id)
+                    return chat_id, None
+            chat_info = (ci.title, ci.username, ci.type)
+            directory.remember_chat(chat_id, *chat_info)
+            return chat_id, chat_info
+
+        for chat_id, chat_info in await asyncio.gather(*(_fetch(chat_id) for chat_id in to_fetch)):
+            names[chat_id] = _chat_display_name(chat_id, chat_info)
+    return names
+
 async def resolve_target_user(msg: Message, cmd: CommandObject, bot_inst: Bot) -> Optional[Tuple[int, str, Optional[str]]]:
     """
     Определяет целевого пользователя из сообщения (ответ, ID, @username).
@@ -167,10 +229,8 @@ async def resolve_target_user(msg: Message, cmd: CommandObject, bot_inst: Bot) -
         arg = cmd.args.strip()
         if arg.startswith('@'):
             uname_find = arg[1:].lower()
-            conn = None
             try:
-                conn = await database.get_connection()
-                urow = await conn.fetchrow("SELECT user_id, full_name, username FROM user_oneui WHERE lower(username) = $1 ORDER BY last_used DESC NULLS LAST LIMIT 1", uname_find)
+                urow = await database.find_user_by_username(uname_find)
                 if urow:
                     uid, fn_from_source, un_from_source = urow['user_id'], urow.get('full_name'), urow.get('username')
                 else:
@@ -180,9 +240,6 @@ async def resolve_target_user(msg: Message, cmd: CommandObject, bot_inst: Bot) -
                 logger_utils.error(f"DB error searching @{html.escape(arg[1:])} in resolve_target_user: {e}", exc_info=True)
                 await msg.reply(f"Произошла ошибка при поиске пользователя @{html.escape(arg[1:])}. Попробуйте позже.", disable_web_page_preview=True)
                 return None
-            finally:
-                if conn and not conn.is_closed():
-                    await conn.close()
         else:
             try:
                 uid = int(arg)
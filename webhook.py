@@ -0,0 +1,117 @@
+# webhook.py
+"""
+Режим webhook (Config.BOT_MODE = "webhook") как альтернатива long polling.
+
+Telegram присылает апдейты POST-запросами на Config.WEBHOOK_PATH; заголовок
+X-Telegram-Bot-Api-Secret-Token сверяется с Config.WEBHOOK_SECRET_TOKEN. Без секрета сервер не запускается:
+иначе любой, кто знает адрес, мог бы прислать апдейт от имени администратора. Апдейт принимается сразу (200),
+а обрабатывается в фоне через sharding.OrderedUpdateRunner - с сохранением порядка апдейтов одного
+пользователя. Если в обработке уже WEBHOOK_MAX_IN_FLIGHT апдейтов, сервер отвечает 503 и Telegram
+повторит доставку позже, так что память не растет при всплеске.
+
+При остановке сервер перестает принимать апдейты, дожидается уже принятых (не дольше
+WEBHOOK_DRAIN_TIMEOUT_SECONDS) и только потом выполняет on_shutdown.
+
+build_app() возвращает обычное aiohttp-приложение - его можно поднять локально и слать
+апдейты POST-запросами (например, из тестового клиента aiohttp), не обращаясь к Telegram.
+"""
+import asyncio
+import hmac
+import signal
+from typing import Optional
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+
+from sharding import OrderedUpdateRunner
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    def __init__(self, dp: Dispatcher, bot: Bot, path: str, secret_token: Optional[str],
+                 base_url: Optional[str] = None, max_in_flight: int = 200, drain_timeout: float = 30.0):
+        """base_url - публичный адрес сервера; если задан, на старте вызывается setWebhook(base_url + path)."""
+        if not secret_token:
+            raise ValueError("Webhook: WEBHOOK_SECRET_TOKEN не задан - без него сервер принимал бы поддельные апдейты.")
+        self.dp = dp
+        self.bot = bot
+        self.path = path if path.startswith("/") else f"/{path}"
+        self.secret_token = secret_token
+        self.base_url = base_url.rstrip("/") if base_url else None
+        self.drain_timeout = drain_timeout
+        self.runner = OrderedUpdateRunner(dp, bot, max_in_flight=max_in_flight)
+        self._accepting = False
+        self.rejected_busy = 0 # Сколько апдейтов отклонено из-за переполнения
+
+    # --- HTTP ---
+    async def handle_update(self, request: web.Request) -> web.Response:
+        received_token = request.headers.get(SECRET_TOKEN_HEADER, "").encode("utf-8", "surrogateescape")
+        if not hmac.compare_digest(received_token, self.secret_token.encode()):
+            logger.warning(f"Webhook: Запрос с неверным секретом от {request.remote}.")
+            return web.Response(status=401)
+        if not self._accepting:
+            return web.Response(status=503, headers={"Retry-After": "5"})
+        try:
+            raw_update = await request.json()
+        except Exception:
+            return web.Response(status=400, text="Invalid JSON")
+        if not isinstance(raw_update, dict) or "update_id" not in raw_update:
+            return web.Response(status=400, text="Not an update")
+        if not self.runner.try_submit(raw_update):
+            self.rejected_busy += 1
+            logger.warning(f"Webhook: В обработке {self.runner.in_flight} апдейтов, апдейт {raw_update['update_id']} отклонен (Telegram повторит).")
+            return web.Response(status=503, headers={"Retry-After": "1"})
+        return web.Response(status=200)
+
+    # --- Жизненный цикл ---
+    async def _on_startup(self, app: web.Application) -> None:
+        await self.dp.emit_startup(dispatcher=self.dp, bot=self.bot, bots=[self.bot])
+        if self.base_url:
+            url = f"{self.base_url}{self.path}"
+            await self.bot.set_webhook(url, secret_token=self.secret_token)
+            logger.info(f"Webhook: Адрес webhook установлен: {url}")
+        self._accepting = True
+
+    async def _on_shutdown(self, app: web.Application) -> None:
+        self._accepting = False
+        if self.runner.in_flight:
+            logger.info(f"Webhook: Дожидаемся {self.runner.in_flight} принятых апдейтов перед остановкой.")
+        try:
+            await asyncio.wait_for(self.runner.drain(), timeout=self.drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Webhook: За {self.drain_timeout:.0f} сек не завершились {self.runner.in_flight} апдейтов, останавливаемся без них.")
+        await self.dp.emit_shutdown(dispatcher=self.dp, bot=self.bot, bots=[self.bot])
+        await self.bot.session.close()
+
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        app.on_startup.append(self._on_startup)
+        app.on_shutdown.append(self._on_shutdown)
+        return app
+
+    async def run(self, host: str, port: int) -> None:
+        """Запускает сервер и работает до SIGINT/SIGTERM (или отмены задачи)."""
+        app_runner = web.AppRunner(self.build_app())
+        await app_runner.setup()
+        site = web.TCPSite(app_runner, host, port)
+        await site.start()
+        logger.info(f"Webhook: Сервер слушает {host}:{port}{self.path}")
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop_event.set)
+            except (NotImplementedError, RuntimeError):
+                pass # Windows: остановка через KeyboardInterrupt
+        try:
+            await stop_event.wait()
+        finally:
+            # Сначала закрывается сокет (новые апдейты не приходят), затем on_shutdown дожидается принятых
+            await app_runner.cleanup()
+            logger.info("Webhook: Сервер остановлен.")